@@ -1,4 +1,3 @@
-import logging
 import tempfile
 from typing import Any, Callable, Dict, List
 import kfp.dsl
@@ -10,17 +9,9 @@ from kfp.v2 import compiler, dsl
 from kfp.v2.dsl import component
 from kubernetes.client.models import V1EnvVar
 
+from src.log import get_logger
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(
-    logging.Formatter(
-        "[%(asctime)s] [%(name)s] [L%(lineno)d] [%(levelname)s][%(funcName)s] %(message)s "
-    )
-)
-logger.addHandler(handler)
-logger.propagate = False
+logger = get_logger(__name__)
 
 
 @component(
@@ -115,6 +106,13 @@ class PipelineRunner(object):
         self.predict_config = config.predict_components
         # prod環境との切り替えなどでyaml_pathを変える
         self.yaml_path = config.yaml_path
+        self.fused_features = config.get("fused_features", False)
+        self.direct_insert = config.get("direct_insert", False)
+        # Trueの場合はdaily pipelineの実験ごとのpredict, insert-predictionをpredict-allの1つにまとめる
+        self.predict_all = config.get("predict_all", False)
+        self.predict_all_config = config.get("predict_all_components")
+        # 空でない場合は各componentのコンテナにSUGI_PROFILEを渡す (src/profiling.py)
+        self.profile = config.get("profile", "")
 
     def _create_component(
         self,
@@ -142,6 +140,7 @@ class PipelineRunner(object):
                 "invoke_command": f"{invoke_command}{suffix}",
                 "image": self.image,
                 "command": command,
+                "profile": self.profile,
             }
         )
         component = load_component_from_text(rendered_text)(**args)
@@ -178,6 +177,44 @@ class PipelineRunner(object):
         )
         return component
 
+    def create_predict_all_component(self, args: Dict[str, Any]):
+        component = self._create_component(
+            "predict.predict-all", args, "predict_all_component"
+        )
+        component.set_cpu_limit(self.predict_all_config.cpu_limit).set_memory_limit(
+            self.predict_all_config.memory_limit
+        )
+        return component
+
+    def create_feature_components(
+        self, default_args: Dict[str, Any]
+    ) -> Dict[str, List[Any]]:
+        """monthly, scaled_monthly, diff_monthlyのtarget, category, holiday特徴量のcomponentを作成する
+
+        fused_featuresがTrueの場合は、全ての特徴量を1つのcomponentで作成する。
+
+        Args:
+            default_args (Dict[str, Any]): componentの引数
+
+        Returns:
+            Dict[str, List[Any]]: prefix("", "scaled-", "diff-")ごとのcomponentのリスト
+        """
+        prefixes = ["", "scaled-", "diff-"]
+        if self.fused_features:
+            fused_feature_task = self.create_bq_component(
+                "preprocess.fused-monthly-feature", args=default_args
+            )
+            return {prefix: [fused_feature_task] for prefix in prefixes}
+        return {
+            prefix: [
+                self.create_bq_component(
+                    f"preprocess.{prefix}monthly-{name}-feature", args=default_args
+                )
+                for name in ["target", "category", "holiday"]
+            ]
+            for prefix in prefixes
+        }
+
     def get_pipeline(self) -> Callable:
         """kfpのパイプラインを作成する
 
@@ -212,19 +249,9 @@ class PipelineRunner(object):
                 "preprocess.monthly-last-prescription-feature",
                 args=default_args,
             )
+            # exp042, exp046, exp047のtarget, category, holiday特徴量
+            feature_tasks = self.create_feature_components(default_args)
             # exp042関連task
-            target_feature_task = self.create_bq_component(
-                "preprocess.monthly-target-feature",
-                args=default_args,
-            )
-            category_feature_task = self.create_bq_component(
-                "preprocess.monthly-category-feature",
-                args=default_args,
-            )
-            holiday_feature_task = self.create_bq_component(
-                "preprocess.monthly-holiday-feature",
-                args=default_args,
-            )
             exp042_create_dataset_task = self.create_bq_component(
                 "train.train-dataset-exp042",
                 args=default_args,
@@ -247,18 +274,6 @@ class PipelineRunner(object):
                 "preprocess.scaled-monthly-prescription",
                 args=default_args,
             )
-            scaled_target_feature_task = self.create_bq_component(
-                "preprocess.scaled-monthly-target-feature",
-                args=default_args,
-            )
-            scaled_category_feature_task = self.create_bq_component(
-                "preprocess.scaled-monthly-category-feature",
-                args=default_args,
-            )
-            scaled_holiday_feature_task = self.create_bq_component(
-                "preprocess.scaled-monthly-holiday-feature",
-                args=default_args,
-            )
             exp046_create_dataset_task = self.create_bq_component(
                 "train.train-dataset-exp046",
                 args=default_args,
@@ -277,18 +292,6 @@ class PipelineRunner(object):
             )
 
             # exp047関連task
-            diff_target_feature_task = self.create_bq_component(
-                "preprocess.diff-monthly-target-feature",
-                args=default_args,
-            )
-            diff_category_feature_task = self.create_bq_component(
-                "preprocess.diff-monthly-category-feature",
-                args=default_args,
-            )
-            diff_holiday_feature_task = self.create_bq_component(
-                "preprocess.diff-monthly-holiday-feature",
-                args=default_args,
-            )
             exp047_create_dataset_task = self.create_bq_component(
                 "train.train-dataset-exp047",
                 args=default_args,
@@ -312,47 +315,51 @@ class PipelineRunner(object):
 
             # exp042
             exp042_feature_tasks = [
-                target_feature_task,
-                category_feature_task,
-                holiday_feature_task,
+                *feature_tasks[""],
                 docter_feature_task,
                 last_prescription_feature_task,
                 min_max_scaler_task,
             ]
             for task in exp042_feature_tasks:
                 task.after(prescription_task)
+            if self.fused_features:
+                # scaled, diffの処方量はmonthly_prescriptionとmin_max_scalerから直接計算する
+                for task in feature_tasks[""]:
+                    task.after(min_max_scaler_task)
             exp042_create_dataset_task.after(*exp042_feature_tasks)
             exp042_train_task.after(exp042_create_dataset_task)
             exp042_evaluation_task.after(exp042_train_task)
 
             # exp046
             exp046_feature_tasks = [
-                scaled_target_feature_task,
-                scaled_category_feature_task,
-                scaled_holiday_feature_task,
+                *feature_tasks["scaled-"],
                 docter_feature_task,
                 last_prescription_feature_task,
             ]
             scaled_prescription_task.after(prescription_task)
-            for task in exp046_feature_tasks:
-                task.after(scaled_prescription_task)
-            exp046_create_dataset_task.after(*exp046_feature_tasks)
+            if not self.fused_features:
+                for task in exp046_feature_tasks:
+                    task.after(scaled_prescription_task)
+            exp046_create_dataset_task.after(
+                scaled_prescription_task, *exp046_feature_tasks
+            )
             exp046_train_task.after(exp046_create_dataset_task)
             exp046_evaluation_task.after(exp046_train_task)
 
             # exp047
             exp047_feature_tasks = [
-                diff_target_feature_task,
-                diff_category_feature_task,
-                diff_holiday_feature_task,
+                *feature_tasks["diff-"],
                 docter_feature_task,
                 last_prescription_feature_task,
             ]
             diff_prescription_task.after(prescription_task)
-            for task in exp047_feature_tasks:
-                task.after(diff_prescription_task)
+            if not self.fused_features:
+                for task in exp047_feature_tasks:
+                    task.after(diff_prescription_task)
 
-            exp047_create_dataset_task.after(*exp047_feature_tasks)
+            exp047_create_dataset_task.after(
+                diff_prescription_task, *exp047_feature_tasks
+            )
             exp047_train_task.after(exp047_create_dataset_task)
             exp047_evaluation_task.after(exp047_train_task)
 
@@ -370,76 +377,60 @@ class PipelineRunner(object):
             last_prescription_feature_task = self.create_bq_component(
                 "preprocess.monthly-last-prescription-feature", default_args
             )
+            # exp042, exp046, exp047のtarget, category, holiday特徴量
+            feature_tasks = self.create_feature_components(default_args)
+            # predict-allの場合は全実験の予測と挿入を1つのcomponentで行う
+            predict_all_task = (
+                self.create_predict_all_component({"execution_date": execution_date})
+                if self.predict_all
+                else None
+            )
+            # predict内で予測結果をBQにロードする場合はinsert-predictionのcomponentを作成しない
+            separate_insert = not (self.direct_insert or self.predict_all)
+
+            def create_predict_components(exp_name: str):
+                if predict_all_task is not None:
+                    return predict_all_task, predict_all_task
+                predict_task = self.create_predict_component(
+                    "predict.predict",
+                    {"exp_name": exp_name, "execution_date": execution_date},
+                )
+                if not separate_insert:
+                    return predict_task, predict_task
+                insert_task = self.create_predict_component(
+                    "predict.insert-prediction",
+                    {"exp_name": exp_name, "execution_date": execution_date},
+                )
+                return predict_task, insert_task
+
             # exp042関連task
-            target_feature_task = self.create_bq_component(
-                "preprocess.monthly-target-feature", default_args
-            )
-            category_feature_task = self.create_bq_component(
-                "preprocess.monthly-category-feature", default_args
-            )
-            holiday_feature_task = self.create_bq_component(
-                "preprocess.monthly-holiday-feature", default_args
-            )
             exp042_create_dataset_task = self.create_bq_component(
                 "predict.predict-dataset-exp042", default_args
             )
-            exp042_predict_task = self.create_predict_component(
-                "predict.predict",
-                {"exp_name": "exp042", "execution_date": execution_date},
-            )
-            exp042_insert_task = self.create_predict_component(
-                "predict.insert-prediction",
-                {"exp_name": "exp042", "execution_date": execution_date},
+            exp042_predict_task, exp042_insert_task = create_predict_components(
+                "exp042"
             )
 
             # exp046関連task
             scaled_prescription_task = self.create_bq_component(
                 "preprocess.scaled-monthly-prescription", default_args
             )
-            scaled_target_feature_task = self.create_bq_component(
-                "preprocess.scaled-monthly-target-feature", default_args
-            )
-            scaled_category_feature_task = self.create_bq_component(
-                "preprocess.scaled-monthly-category-feature", default_args
-            )
-            scaled_holiday_feature_task = self.create_bq_component(
-                "preprocess.scaled-monthly-holiday-feature", default_args
-            )
             exp046_create_dataset_task = self.create_bq_component(
                 "predict.predict-dataset-exp046", default_args
             )
-            exp046_predict_task = self.create_predict_component(
-                "predict.predict",
-                {"exp_name": "exp046", "execution_date": execution_date},
-            )
-            exp046_insert_task = self.create_predict_component(
-                "predict.insert-prediction",
-                {"exp_name": "exp046", "execution_date": execution_date},
+            exp046_predict_task, exp046_insert_task = create_predict_components(
+                "exp046"
             )
 
             # exp047関連task
             diff_prescription_task = self.create_bq_component(
                 "preprocess.diff-monthly-prescription", default_args
             )
-            diff_target_feature_task = self.create_bq_component(
-                "preprocess.diff-monthly-target-feature", default_args
-            )
-            diff_category_feature_task = self.create_bq_component(
-                "preprocess.diff-monthly-category-feature", default_args
-            )
-            diff_holiday_feature_task = self.create_bq_component(
-                "preprocess.diff-monthly-holiday-feature", default_args
-            )
             exp047_create_dataset_task = self.create_bq_component(
                 "predict.predict-dataset-exp047", default_args
             )
-            exp047_predict_task = self.create_predict_component(
-                "predict.predict",
-                {"exp_name": "exp047", "execution_date": execution_date},
-            )
-            exp047_insert_task = self.create_predict_component(
-                "predict.insert-prediction",
-                {"exp_name": "exp047", "execution_date": execution_date},
+            exp047_predict_task, exp047_insert_task = create_predict_components(
+                "exp047"
             )
 
             # その他タスク
@@ -455,58 +446,70 @@ class PipelineRunner(object):
             # =============
 
             exp042_feature_tasks = [
-                target_feature_task,
-                category_feature_task,
-                holiday_feature_task,
+                *feature_tasks[""],
                 last_prescription_feature_task,
             ]
             for task in exp042_feature_tasks:
                 task.after(prescription_task)
             exp042_create_dataset_task.after(*exp042_feature_tasks)
             exp042_predict_task.after(exp042_create_dataset_task)
-            exp042_insert_task.after(exp042_predict_task)
+            if separate_insert:
+                exp042_insert_task.after(exp042_predict_task)
 
             # exp046
             exp046_feature_tasks = [
-                scaled_target_feature_task,
-                scaled_category_feature_task,
-                scaled_holiday_feature_task,
+                *feature_tasks["scaled-"],
                 last_prescription_feature_task,
             ]
             scaled_prescription_task.after(prescription_task)
-            for task in exp046_feature_tasks:
-                task.after(scaled_prescription_task)
+            if not self.fused_features:
+                for task in exp046_feature_tasks:
+                    task.after(scaled_prescription_task)
 
-            exp046_create_dataset_task.after(*exp046_feature_tasks)
+            exp046_create_dataset_task.after(
+                scaled_prescription_task, *exp046_feature_tasks
+            )
             exp046_predict_task.after(exp046_create_dataset_task)
-            exp046_insert_task.after(exp046_predict_task)
+            if separate_insert:
+                exp046_insert_task.after(exp046_predict_task)
 
             # exp047
             exp047_feature_tasks = [
-                diff_target_feature_task,
-                diff_category_feature_task,
-                diff_holiday_feature_task,
+                *feature_tasks["diff-"],
                 last_prescription_feature_task,
             ]
             diff_prescription_task.after(prescription_task)
-            for task in exp047_feature_tasks:
-                task.after(diff_prescription_task)
+            if not self.fused_features:
+                for task in exp047_feature_tasks:
+                    task.after(diff_prescription_task)
 
-            exp047_create_dataset_task.after(*exp047_feature_tasks)
+            exp047_create_dataset_task.after(
+                diff_prescription_task, *exp047_feature_tasks
+            )
             exp047_predict_task.after(exp047_create_dataset_task)
-            exp047_insert_task.after(exp047_predict_task)
+            if separate_insert:
+                exp047_insert_task.after(exp047_predict_task)
 
             # 結合処理
             abc_task.after(prescription_task)
+            # predict-allの場合は3つとも同じcomponentなので重複を除く
             integrate_task.after(
-                exp042_insert_task,
-                exp046_insert_task,
-                exp047_insert_task,
+                *dict.fromkeys(
+                    [exp042_insert_task, exp046_insert_task, exp047_insert_task]
+                )
             )
 
         return locals()[self.pipeline_name]
 
-    def run(self, start_ts: str, end_ts: str, execution_date: str):
+    def run(self, start_ts: str, end_ts: str, execution_date: str, wait: bool = False):
+        """pipelineをコンパイルして実行する
+
+        Args:
+            start_ts (str): クエリに渡すパラメータ
+            end_ts (str): クエリに渡すパラメータ
+            execution_date (str): 予測実行日
+            wait (bool, optional): pipelineの完了まで待つか (失敗した場合は例外になる). Defaults to False.
+        """
         with tempfile.TemporaryDirectory() as td:
             package_path = f"{td}/pipeline.json"
             compiler.Compiler().compile(
@@ -527,6 +530,8 @@ class PipelineRunner(object):
                 enable_caching=True,
             )
             job.submit()
+            if wait:
+                job.wait()
 
     def build(self):
         """
@@ -0,0 +1,167 @@
+import os
+import pickle
+import tempfile
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import get_context
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import matplotlib.pyplot as plt
+import pandas as pd
+
+from src.gcs import GCSClient
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+
+def render_barh(values: pd.Series, title: str, local_path: str) -> str:
+    """特徴量重要度などの横棒グラフ (上から値の大きい順) をPNGに描画する (描画用のプロセスで実行される)
+
+    Args:
+        values (pd.Series): 降順に並んだ値 (indexがラベル)
+        title (str): グラフのタイトル
+        local_path (str): 書き出すPNGのパス
+
+    Returns:
+        str: local_path
+    """
+    fig, ax = plt.subplots(figsize=(10, 20))
+    values[::-1].plot.barh(ax=ax)
+    ax.set_title(title)
+    fig.tight_layout()
+    fig.savefig(local_path)
+    plt.close(fig)
+    return local_path
+
+
+class ArtifactUploader(object):
+    """学習後の成果物 (モデル, 特徴量重要度, 評価結果, 予測値) のシリアライズとGCSへのアップロードをbackgroundで行う
+
+    upload_*は書き出す内容を受け取ってすぐに返り、シリアライズとアップロードはスレッドプールで行う。
+    グラフの描画 (matplotlib) はGILを持ったままなので別プロセスで行い、描画したPNGをスレッドプールからアップロードする。
+    withを抜ける時に全ての書き込みを待ち、失敗したものがあればRuntimeErrorにする
+    (with内で例外が起きた場合は、書き込みを待ってからその例外をそのまま投げる)。
+    渡したDataFrameなどは書き込みが終わるまで変更しないこと。
+
+    Args:
+        gcs (GCSClient): アップロードに使うclient (スレッド間で共有する)
+        bucket (str): アップロード先のbucket
+        n_workers (int): 同時にシリアライズ, アップロードする数
+    """
+
+    def __init__(self, gcs: GCSClient, bucket: str, n_workers: int):
+        self.gcs = gcs
+        self.bucket = bucket
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, n_workers))
+        self._renderer: Optional[ProcessPoolExecutor] = None
+        self._jobs: List[Tuple[str, Future]] = []
+        self.report: Optional[pd.DataFrame] = None
+
+    def __enter__(self) -> "ArtifactUploader":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.join(raise_on_error=exc_type is None)
+
+    def _local_path(self, destination: str) -> str:
+        return os.path.join(self._tmp_dir.name, destination.replace("/", "__"))
+
+    def _upload(self, destination: str, write: Callable[[str], Any]) -> Dict[str, Any]:
+        """writeでローカルに書き出してからアップロードし、それぞれの時間を返す"""
+        local_path = self._local_path(destination)
+        start = time.perf_counter()
+        write(local_path)
+        serialize_sec = time.perf_counter() - start
+        size_mb = os.path.getsize(local_path) / 1024 / 1024
+        start = time.perf_counter()
+        self.gcs.upload_blob(self.bucket, local_path, destination)
+        upload_sec = time.perf_counter() - start
+        os.remove(local_path)
+        return {
+            "serialize_sec": serialize_sec,
+            "upload_sec": upload_sec,
+            "size_mb": size_mb,
+        }
+
+    def submit(self, destination: str, write: Callable[[str], Any]) -> None:
+        """ローカルのパスに書き出す関数writeを渡して、destinationへのアップロードを予約する"""
+        self._jobs.append(
+            (destination, self._executor.submit(self._upload, destination, write))
+        )
+
+    def upload_pickle(self, obj: Any, destination: str) -> None:
+        def write(local_path: str) -> None:
+            with open(local_path, "wb") as fout:
+                pickle.dump(obj, fout)
+
+        self.submit(destination, write)
+
+    def upload_dataframe(self, df: pd.DataFrame, destination: str) -> None:
+        """destinationの拡張子 (.csv, .parquet) の形式でDataFrameをアップロードする"""
+        if destination.endswith(".parquet"):
+            self.submit(destination, lambda path: df.to_parquet(path, index=False))
+        else:
+            self.submit(destination, lambda path: df.to_csv(path, index=False))
+
+    def upload_plot(
+        self, render: Callable[..., str], args: Tuple[Any, ...], destination: str
+    ) -> None:
+        """render(*args, local_path)を描画用のプロセスで実行し、書き出したPNGをアップロードする
+
+        renderはpickleできるmoduleの関数にすること。
+        """
+        if self._renderer is None:
+            # LightGBM (OpenMP) を使った後のforkは子プロセスが止まることがあるのでspawnにする
+            self._renderer = ProcessPoolExecutor(
+                max_workers=1, mp_context=get_context("spawn")
+            )
+        rendered = self._renderer.submit(render, *args, self._local_path(destination))
+        # 描画の完了を待つ時間はserialize_secになる
+        self.submit(destination, lambda path: rendered.result())
+
+    def join(self, raise_on_error: bool = True) -> pd.DataFrame:
+        """全ての書き込みを待ち、成果物ごとの時間をまとめた表を返す
+
+        Args:
+            raise_on_error (bool, optional): 失敗した書き込みがあった場合にRuntimeErrorにするか. Defaults to True.
+
+        Returns:
+            pd.DataFrame: destination, status, serialize_sec, upload_sec, size_mb, error
+        """
+        wait([future for _, future in self._jobs])
+        rows = []
+        for destination, future in self._jobs:
+            error = future.exception()
+            if error is None:
+                rows.append(
+                    {"destination": destination, "status": "ok", **future.result()}
+                )
+            else:
+                logger.error(f"[failed] upload of {destination}: {error!r}")
+                rows.append(
+                    {
+                        "destination": destination,
+                        "status": "failed",
+                        "error": repr(error),
+                    }
+                )
+        self._executor.shutdown()
+        if self._renderer is not None:
+            self._renderer.shutdown()
+        self._tmp_dir.cleanup()
+        self._jobs = []
+        columns = [
+            "destination",
+            "status",
+            "serialize_sec",
+            "upload_sec",
+            "size_mb",
+            "error",
+        ]
+        self.report = pd.DataFrame(rows).reindex(columns=columns)
+        failed = self.report.query("status != 'ok'")["destination"].tolist()
+        if failed and raise_on_error:
+            raise RuntimeError(f"artifact upload failed: {failed}")
+        return self.report
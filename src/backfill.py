@@ -0,0 +1,304 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+from omegaconf import DictConfig
+
+from src.bq import BQClient
+from src.cpu import available_cpus
+from src.gcs import GCSClient
+from src.log import get_logger, log_context
+from src.predict.predictor import LGBMPredictor
+
+logger = get_logger(__name__)
+
+# 日付に依存しないstepのmanifestのkey
+UPSTREAM = "upstream"
+DOWNSTREAM = "downstream"
+
+
+def backfill_dates(start_date: str, end_date: str, step_days: int = 1) -> List[str]:
+    """start_dateからend_dateまで (両端を含む) のstep_days間隔の実行日 (YYYY-MM-DD)"""
+    start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    if end < start:
+        raise ValueError(f"end_date {end_date} is before start_date {start_date}")
+    if step_days < 1:
+        raise ValueError(f"step_days must be positive, got {step_days}")
+    n_dates = (end - start).days // step_days + 1
+    return [f"{start + timedelta(days=i * step_days):%Y-%m-%d}" for i in range(n_dates)]
+
+
+def date_end_ts(date: str, days: int = 0) -> str:
+    """実行日をinvoke.yamlのend_tsと同じ形式 (日本時間の0時) にする"""
+    day = datetime.strptime(date, "%Y-%m-%d").date() + timedelta(days=days)
+    return f"{day:%Y-%m-%d}T00:00:00+09:00"
+
+
+def upstream_key(dates: List[str]) -> str:
+    """共有するstepのmanifestのkey (作成したend_tsと期間が異なる場合は別のstepとして扱う)"""
+    span_days = (
+        datetime.strptime(dates[-1], "%Y-%m-%d")
+        - datetime.strptime(dates[0], "%Y-%m-%d")
+    ).days
+    return f"{UPSTREAM}_{date_end_ts(dates[-1])}_{span_days}d"
+
+
+def modified_tables(
+    bq: BQClient, tables: List[Tuple[str, str]], since: str
+) -> List[str]:
+    """sinceより後に更新された (または存在しない) テーブル
+
+    Args:
+        bq (BQClient): BQのclient
+        tables (List[Tuple[str, str]]): (dataset_id, table_id)のリスト
+        since (str): ISO形式の日時 (タイムゾーンが無い場合はローカル時間)
+
+    Returns:
+        List[str]: dataset_id.table_idのリスト
+    """
+    since_dt = datetime.fromisoformat(since)
+    if since_dt.tzinfo is None:
+        since_dt = since_dt.astimezone()
+    modified = []
+    for dataset_id, table_id in tables:
+        metadata = bq.table_metadata(dataset_id, table_id)
+        if (
+            metadata is None
+            or datetime.fromisoformat(metadata["last_modified"]) > since_dt
+        ):
+            modified.append(f"{dataset_id}.{table_id}")
+    return modified
+
+
+class BackfillManifest(object):
+    """backfillのstep, 日付ごとの結果を追記するJSON Linesのmanifest
+
+    同じkeyは後の行で上書きされるので、statusがokのkeyを完了とみなして再実行時にskipする。
+
+    Args:
+        path (str): manifestのパス
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        """keyごとの最新の記録"""
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, "r") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    records[record["key"]] = record
+        return records
+
+    def completed(self) -> List[str]:
+        return [key for key, record in self.load().items() if record["status"] == "ok"]
+
+    def record(
+        self, key: str, status: str, elapsed_sec: float, error: Optional[str] = None
+    ) -> Dict[str, Any]:
+        record = {
+            "key": key,
+            "status": status,
+            "elapsed_sec": round(elapsed_sec, 1),
+            "error": error,
+            "finished_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        }
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        return record
+
+
+class BackfillRunner(object):
+    """日付ごとの処理を同時にconcurrency日まで実行し、manifestに結果を記録する
+
+    resumeの場合はmanifestで完了している日付とstepをskipする。
+    失敗した日付があっても他の日付は続け、完了した日付ごとに進捗, 処理速度, 残り時間を出力する。
+
+    Args:
+        manifest (BackfillManifest): 結果を記録するmanifest
+        concurrency (int): 同時に処理する日付の数
+        resume (bool, optional): manifestで完了しているものをskipするか. Defaults to True.
+    """
+
+    def __init__(
+        self, manifest: BackfillManifest, concurrency: int, resume: bool = True
+    ):
+        self.manifest = manifest
+        self.concurrency = max(1, concurrency)
+        self.completed = set(manifest.completed()) if resume else set()
+
+    def invalidate(self, key: str) -> None:
+        """完了済みのkeyを未完了に戻す (次のrun_once, run_datesで再実行する)"""
+        self.completed.discard(key)
+
+    def run_once(self, key: str, func: Callable[[], Any]) -> None:
+        """全日付で共有するstepを1回だけ実行する (失敗した場合はそのまま例外を投げる)"""
+        if key in self.completed:
+            logger.info(f"[skip] {key} was already completed.")
+            return
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            self.manifest.record(key, "failed", time.perf_counter() - start, repr(e))
+            raise
+        elapsed = time.perf_counter() - start
+        self.manifest.record(key, "ok", elapsed)
+        self.completed.add(key)
+        logger.info(f"[done] {key} ({elapsed:.1f} sec).")
+
+    def _run_date(self, func: Callable[[str], Any], date: str) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            with log_context(backfill_date=date):
+                func(date)
+        except Exception as e:
+            logger.exception(f"[failed] backfill of {date}.")
+            return self.manifest.record(
+                date, "failed", time.perf_counter() - start, repr(e)
+            )
+        return self.manifest.record(date, "ok", time.perf_counter() - start)
+
+    def run_dates(self, dates: List[str], func: Callable[[str], Any]) -> pd.DataFrame:
+        """未完了の日付ごとにfuncを実行する
+
+        Args:
+            dates (List[str]): 実行日 (YYYY-MM-DD)
+            func (Callable[[str], Any]): 実行日を受け取って1日分を処理する関数
+
+        Returns:
+            pd.DataFrame: 今回処理した日付ごとのkey, status, elapsed_sec, error, finished_at
+        """
+        pending = [date for date in dates if date not in self.completed]
+        n_skipped = len(dates) - len(pending)
+        logger.info(
+            f"backfill {len(pending)} dates with concurrency {self.concurrency} "
+            f"({n_skipped} dates were already completed)."
+        )
+        rows = []
+        n_failed = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            jobs = [executor.submit(self._run_date, func, date) for date in pending]
+            for i, future in enumerate(as_completed(jobs), start=1):
+                record = future.result()
+                rows.append(record)
+                if record["status"] == "ok":
+                    self.completed.add(record["key"])
+                else:
+                    n_failed += 1
+                elapsed = time.perf_counter() - start
+                dates_per_hour = i / elapsed * 3600
+                eta_hours = (len(pending) - i) / dates_per_hour
+                logger.info(
+                    f"[progress] {n_skipped + i}/{len(dates)} dates "
+                    f"({record['key']} {record['status']} in {record['elapsed_sec']:.1f} sec, "
+                    f"{n_failed} failed). {dates_per_hour:.1f} dates/hour, eta {eta_hours:.2f} hours"
+                )
+        return pd.DataFrame(
+            rows, columns=["key", "status", "elapsed_sec", "error", "finished_at"]
+        ).sort_values("key", ignore_index=True)
+
+
+class DatePredictor(object):
+    """共通の特徴量テーブルから、実行日ごとのpredict_datasetの作成と予測, 書き込みを行う
+
+    モデルは実験ごとに1回だけ読み込み、全日付で共有する。
+    predict_dataset_{exp_name}と、prepareで作成する実行日ごとの共有テーブル (doctor_featureなど) のテーブル名は
+    日付によらないので、prepareから全実験のpredict_datasetの読み込みまでは全日付で排他にし、
+    読み込んだ後の予測とGCS, BQへの書き込みは日付ごとに並行に行う。
+    予測結果は{実行日}/resultに保存し、BQのパーティションに直接ロードする。
+
+    Args:
+        config (DictConfig): predict.predictorの設定
+        exp_names (List[str]): 予測する実験名
+        create_dataset (Callable[[str, str], None]): (実験名, end_ts)を受け取ってpredict_datasetを作成する関数
+        concurrency (int): 同時に処理する日付の数 (LightGBMのスレッドを分ける)
+        prepare (Optional[Callable[[str], None]], optional): end_tsを受け取って、predict_datasetの前に実行日ごとに
+            作り直すテーブルを作成する関数. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        config: DictConfig,
+        exp_names: List[str],
+        create_dataset: Callable[[str, str], None],
+        concurrency: int,
+        prepare: Optional[Callable[[str], None]] = None,
+    ):
+        self.config = config
+        self.exp_names = list(exp_names)
+        self.create_dataset = create_dataset
+        self.prepare = prepare
+        self.num_threads = max(1, available_cpus() // max(1, concurrency))
+        self.gcs = GCSClient(config.gcp_project)
+        self.bq = BQClient(config.gcp_project)
+        self._models = {}
+        self._model_lock = threading.Lock()
+        self._dataset_lock = threading.Lock()
+
+    def _predictor(self, exp_name: str, date: str) -> LGBMPredictor:
+        with self._model_lock:
+            if exp_name not in self._models:
+                predictor = LGBMPredictor(
+                    self.config, exp_name=exp_name, gcs=self.gcs, bq=self.bq
+                )
+                self._models[exp_name] = (predictor.le_dict, predictor.bst)
+        predictor = LGBMPredictor(
+            self.config,
+            exp_name=exp_name,
+            model=self._models[exp_name],
+            gcs=self.gcs,
+            bq=self.bq,
+        )
+        predictor.setting = replace(predictor.setting, prediction_path=f"{date}/result")
+        predictor.num_threads = self.num_threads
+        return predictor
+
+    def _load(self, date: str) -> List[Tuple[LGBMPredictor, pd.DataFrame]]:
+        """実行日の共有テーブルと全実験のpredict_datasetを作成して読み込む"""
+        end_ts = date_end_ts(date)
+        loaded = []
+        with self._dataset_lock:
+            if self.prepare is not None:
+                self.prepare(end_ts)
+            for exp_name in self.exp_names:
+                predictor = self._predictor(exp_name, date)
+                self.create_dataset(exp_name, end_ts)
+                loaded.append((predictor, predictor._load_data()))
+        return loaded
+
+    def predict(self, date: str) -> None:
+        """実行日の全実験のpredict_datasetを作成して予測する"""
+        loaded = self._load(date)
+        while loaded:
+            # 予測し終わった実験のデータは順に解放する
+            predictor, df = loaded.pop(0)
+            segments = predictor.segments(df)
+            # encodeしてしまうと, yj_code, store_codeが復元できなくなる場合があるためcopyする
+            feature_df = predictor._preprocess(df.copy())
+            df[predictor.setting.lgbm.pred_col] = predictor.predict_features(
+                feature_df, segments
+            )
+            if predictor.setting.explain.enabled:
+                predictor.upload_contributions(df, feature_df, segments)
+            del feature_df
+            predictor.upload_prediction(df)
+            predictor.insert_prediction(df)
+            logger.info(
+                f"[done] {predictor.exp_name} prediction of {date} ({len(df)} rows)."
+            )
@@ -0,0 +1,98 @@
+import time
+from typing import Any, Callable, Dict
+
+import pandas as pd
+
+from src.config import TrainerSetting
+
+
+def _per_call_ns(func: Callable[[], Any], repeat: int, max_sec: float) -> float:
+    """funcをrepeat回 (max_sec秒を超えた場合はそこまで) 実行した1回あたりの時間(ns)"""
+    func()  # warm up
+    start = time.perf_counter()
+    n_calls = 0
+    while n_calls < repeat:
+        func()
+        n_calls += 1
+        if n_calls % 100 == 0 and time.perf_counter() - start > max_sec:
+            break
+    return (time.perf_counter() - start) / n_calls * 1e9
+
+
+def config_accessors(config: Any) -> Dict[str, Callable[[], Any]]:
+    """LGBMTrainer, LGBMPredictorのループの中で行っていた設定の参照"""
+
+    def cat_cols_loop() -> None:
+        for _ in config.lgbm.cat_cols:
+            pass
+
+    return {
+        "cat_cols_loop": cat_cols_loop,
+        "label_col": lambda: config.lgbm.label_col,
+        "gcp_project": lambda: config.gcp_project,
+        "feature_cols": lambda: config.lgbm.numerical_cols + config.lgbm.cat_cols,
+        "params_dict": lambda: dict(config.lgbm.params),
+    }
+
+
+def setting_accessors(setting: TrainerSetting) -> Dict[str, Callable[[], Any]]:
+    """TrainerSettingを使った同じ参照 (feature_colsは作成時に1回だけ連結する)"""
+
+    def cat_cols_loop() -> None:
+        for _ in setting.lgbm.cat_cols:
+            pass
+
+    return {
+        "cat_cols_loop": cat_cols_loop,
+        "label_col": lambda: setting.lgbm.label_col,
+        "gcp_project": lambda: setting.gcp_project,
+        "feature_cols": lambda: setting.lgbm.feature_cols,
+        "params_dict": lambda: dict(setting.lgbm.params),
+    }
+
+
+def benchmark_config_access(
+    configs: Dict[str, Any], repeat: int, max_sec: float = 1.0
+) -> pd.DataFrame:
+    """設定の参照1回あたりの時間を、設定の種類 (OmegaConf, invoke, TrainerSetting) ごとに比較する
+
+    Args:
+        configs (Dict[str, Any]): 名前とtrainerの設定 (DictConfig, invokeのconfig)
+        repeat (int): 1つの参照の繰り返し回数
+        max_sec (float, optional): 1つの参照の計測時間の上限 (秒). Defaults to 1.0.
+
+    Returns:
+        pd.DataFrame: operation, source, ns_per_call, speedup (TrainerSettingに対する倍率)
+    """
+    rows = []
+    setting = None
+    for name, config in configs.items():
+        start = time.perf_counter()
+        setting = TrainerSetting.from_config(config)
+        rows.append(
+            {
+                "operation": "from_config",
+                "source": name,
+                "ns_per_call": (time.perf_counter() - start) * 1e9,
+            }
+        )
+        for operation, func in config_accessors(config).items():
+            rows.append(
+                {
+                    "operation": operation,
+                    "source": name,
+                    "ns_per_call": _per_call_ns(func, repeat, max_sec),
+                }
+            )
+    for operation, func in setting_accessors(setting).items():
+        rows.append(
+            {
+                "operation": operation,
+                "source": "setting",
+                "ns_per_call": _per_call_ns(func, repeat, max_sec),
+            }
+        )
+    df = pd.DataFrame(rows)
+    baseline = df.query("source == 'setting'").set_index("operation")["ns_per_call"]
+    df["speedup"] = df["ns_per_call"] / df["operation"].map(baseline)
+    return df
@@ -0,0 +1,109 @@
+import time
+from typing import Callable, Dict, List, Mapping
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+
+from src.predict.compiler import CompiledForest
+
+
+def make_synthetic_model(
+    numerical_cols: List[str],
+    cat_cols: List[str],
+    params: Mapping,
+    num_iterations: int,
+    n_rows: int,
+    cardinality: int = 100,
+    seed: int = 0,
+) -> lgb.Booster:
+    """ベンチマーク用に、実験と同じ特徴量の列とパラメータでランダムなデータから学習したモデルを作成する"""
+    rng = np.random.default_rng(seed)
+    df = make_synthetic_features(numerical_cols, cat_cols, n_rows, cardinality, seed)
+    label = df[numerical_cols[: min(5, len(numerical_cols))]].fillna(0).sum(
+        axis=1
+    ) + rng.normal(size=n_rows)
+    for col in cat_cols[:3]:
+        label += np.sin(df[col])
+    return lgb.train(
+        dict(params),
+        lgb.Dataset(df, label, categorical_feature=cat_cols),
+        num_boost_round=num_iterations,
+    )
+
+
+def make_synthetic_features(
+    numerical_cols: List[str],
+    cat_cols: List[str],
+    n_rows: int,
+    cardinality: int = 100,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """LabelEncoder済みの特徴量と同じ形式のランダムなデータを作成する (数値の5%は欠損)"""
+    rng = np.random.default_rng(seed)
+    numerical = rng.normal(size=(n_rows, len(numerical_cols))).astype(np.float32)
+    numerical[rng.random(numerical.shape) < 0.05] = np.nan
+    df = pd.DataFrame(numerical, columns=numerical_cols)
+    for col in cat_cols:
+        df[col] = rng.integers(0, cardinality, n_rows)
+    return df
+
+
+def time_call(func: Callable[[], np.ndarray], repeat: int) -> np.ndarray:
+    """funcをrepeat回実行し、1回ごとの実行時間(秒)を返す"""
+    func()  # warm up
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed.append(time.perf_counter() - start)
+    return np.asarray(elapsed)
+
+
+def benchmark_inference(
+    bst: lgb.Booster,
+    df: pd.DataFrame,
+    batch_sizes: List[int],
+    repeat: int,
+) -> pd.DataFrame:
+    """Booster.predictとCompiledForest.predictのレイテンシとスループットを比較する
+
+    Args:
+        bst (lgb.Booster): 学習済みモデル
+        df (pd.DataFrame): 予測に使う特徴量 (LGBMPredictor._preprocess済みの形式)
+        batch_sizes (List[int]): 1回の予測の行数
+        repeat (int): バッチサイズごとの計測回数
+
+    Returns:
+        pd.DataFrame: engine, batch_size, p50_ms, p99_ms, rows_per_sec, max_abs_diff
+    """
+    compile_start = time.perf_counter()
+    compiled = CompiledForest.from_booster(bst)
+    compile_sec = time.perf_counter() - compile_start
+
+    rows: List[Dict] = []
+    for batch_size in batch_sizes:
+        batch_df = df.iloc[:batch_size]
+        # LGBMPredictorと同じく、どちらもpandasのframeを受け取る
+        engines = {
+            "lightgbm": lambda: bst.predict(batch_df),
+            "compiled": lambda: compiled.predict(batch_df),
+        }
+        max_abs_diff = float(
+            np.abs(engines["lightgbm"]() - engines["compiled"]()).max()
+        )
+        for engine, func in engines.items():
+            elapsed = time_call(func, repeat)
+            rows.append(
+                {
+                    "engine": engine,
+                    "batch_size": len(batch_df),
+                    "p50_ms": np.percentile(elapsed, 50) * 1000,
+                    "p99_ms": np.percentile(elapsed, 99) * 1000,
+                    "rows_per_sec": len(batch_df) / np.median(elapsed),
+                    "max_abs_diff": max_abs_diff,
+                    "num_trees": compiled.num_trees,
+                    "compile_sec": compile_sec,
+                }
+            )
+    return pd.DataFrame(rows)
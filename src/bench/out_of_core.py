@@ -0,0 +1,149 @@
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Dict, List
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.bench.inference import make_synthetic_features
+from src.train.out_of_core import ParquetSequence, read_column
+
+MODES = ["in_memory", "out_of_core"]
+
+
+def write_synthetic_shards(
+    shard_dir: str,
+    numerical_cols: List[str],
+    cat_cols: List[str],
+    label_col: str,
+    n_rows: int,
+    n_shards: int,
+    row_group_size: int,
+    cardinality: int = 100,
+) -> List[str]:
+    """EXPORT DATAの出力と同じく、n_shards個のParquetファイルにランダムな学習データを書き出す"""
+    os.makedirs(shard_dir, exist_ok=True)
+    paths = []
+    rows_per_shard = -(-n_rows // n_shards)
+    for i, start in enumerate(range(0, n_rows, rows_per_shard)):
+        n = min(rows_per_shard, n_rows - start)
+        df = make_synthetic_features(numerical_cols, cat_cols, n, cardinality, seed=i)
+        df[label_col] = (
+            df[numerical_cols[: min(5, len(numerical_cols))]].fillna(0).sum(axis=1)
+        )
+        path = f"{shard_dir}/shard-{i:012d}.parquet"
+        pq.write_table(
+            pa.Table.from_pandas(df, preserve_index=False),
+            path,
+            row_group_size=row_group_size,
+        )
+        paths.append(path)
+    return paths
+
+
+def _peak_rss_mb() -> float:
+    # Linuxのru_maxrssはKB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _construct_dataset(
+    mode: str,
+    paths: List[str],
+    feature_cols: List[str],
+    cat_cols: List[str],
+    label_col: str,
+    batch_size: int,
+) -> Dict[str, float]:
+    """別プロセスでDatasetを作成し、その前後のピークRSSを計測する"""
+    baseline_mb = _peak_rss_mb()
+    start = time.perf_counter()
+    if mode == "in_memory":
+        # LGBMTrainerと同じく、全データをDataFrameに読み込んでからDatasetを作成する
+        df = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+        data = df[feature_cols]
+        label = np.array(df[label_col])
+    else:
+        data = ParquetSequence(paths, feature_cols, batch_size=batch_size)
+        label = read_column(paths, label_col).astype(np.float32)
+    dataset = lgb.Dataset(
+        data,
+        label=label,
+        feature_name=feature_cols,
+        categorical_feature=cat_cols,
+        params={"verbose": -1},
+    ).construct()
+    return {
+        "num_data": dataset.num_data(),
+        "construct_sec": time.perf_counter() - start,
+        "baseline_rss_mb": baseline_mb,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def benchmark_out_of_core(
+    shard_root: str,
+    numerical_cols: List[str],
+    cat_cols: List[str],
+    n_rows_list: List[int],
+    n_shards: int,
+    row_group_size: int,
+    batch_size: int,
+    cardinality: int = 100,
+) -> pd.DataFrame:
+    """データサイズごとに、DataFrame経由とParquetSequence経由のDataset作成のピークRSSを比較する
+
+    計測ごとに新しいプロセスを立ち上げるので、ピークRSSは前の計測の影響を受けない。
+
+    Returns:
+        pd.DataFrame: n_rows, mode, parquet_mb, status, peak_rss_mb, delta_rss_mb, construct_sec
+    """
+    label_col = "label"
+    feature_cols = numerical_cols + cat_cols
+    rows = []
+    for n_rows in n_rows_list:
+        shard_dir = f"{shard_root}/rows_{n_rows}"
+        paths = write_synthetic_shards(
+            shard_dir,
+            numerical_cols,
+            cat_cols,
+            label_col,
+            n_rows,
+            n_shards,
+            row_group_size,
+            cardinality,
+        )
+        parquet_mb = sum(os.path.getsize(path) for path in paths) / 1024 / 1024
+        for mode in MODES:
+            row = {"n_rows": n_rows, "mode": mode, "parquet_mb": parquet_mb}
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=1, mp_context=get_context("spawn")
+                ) as executor:
+                    result = executor.submit(
+                        _construct_dataset,
+                        mode,
+                        paths,
+                        feature_cols,
+                        cat_cols,
+                        label_col,
+                        batch_size,
+                    ).result()
+            except BrokenProcessPool:
+                # メモリ不足でOOM killerに止められた場合
+                row.update(status="killed")
+            else:
+                row.update(
+                    status="ok",
+                    peak_rss_mb=result["peak_rss_mb"],
+                    delta_rss_mb=result["peak_rss_mb"] - result["baseline_rss_mb"],
+                    construct_sec=result["construct_sec"],
+                )
+            rows.append(row)
+    return pd.DataFrame(rows)
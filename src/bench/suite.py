@@ -0,0 +1,296 @@
+import json
+import os
+import platform
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from multiprocessing import get_context
+from typing import Any, Dict, Iterator, List, Mapping, Optional
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+from src.bench.synthetic import make_frame
+from src.predict.predictor import LGBMPredictor
+from src.train.trainer import LGBMTrainer
+
+STAGES = [
+    "generate",
+    "trainer_preprocess",
+    "dataset_construct",
+    "train",
+    "evaluate",
+    "predictor_preprocess",
+    "predict",
+]
+
+_PAGE_MB = os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+# ベンチマークではGCS, BQにアクセスしないので、trainer, predictorの必須の設定はダミーの値にする
+_TRAINER_PATHS = {
+    "gcp_project": "bench",
+    "dataset_id": "bench",
+    "bucket": "bench",
+    "latest_model_path": "bench",
+}
+_PREDICTOR_PATHS = {
+    "gcp_project": "bench",
+    "dataset": "bench",
+    "train_bucket": "bench",
+    "bucket": "bench",
+    "latest_model_path": "bench",
+}
+
+
+def _rss_mb() -> float:
+    """現在のRSS (ru_maxrssはプロセス全体のピークなのでstageごとの計測には使えない)"""
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * _PAGE_MB
+
+
+class StageProfiler(object):
+    """stageごとの経過時間と、stage前後と実行中のピークのRSSを記録する
+
+    実行中のピークはinterval秒ごとにRSSを読むスレッドで計測する。
+
+    Args:
+        interval (float, optional): RSSを読む間隔 (秒). Defaults to 0.05.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.results: Dict[str, Dict[str, float]] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        rss_before = _rss_mb()
+        peak = [rss_before]
+        stop = threading.Event()
+
+        def sample() -> None:
+            while not stop.wait(self.interval):
+                peak[0] = max(peak[0], _rss_mb())
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stop.set()
+            sampler.join()
+            rss_after = _rss_mb()
+            self.results[name] = {
+                "sec": elapsed,
+                "rss_before_mb": rss_before,
+                "peak_rss_mb": max(peak[0], rss_after),
+                "rss_after_mb": rss_after,
+                "delta_peak_mb": max(peak[0], rss_after) - rss_before,
+            }
+
+
+def _run_scale(
+    exp_name: str,
+    n_rows: int,
+    lgbm_config: Dict[str, Any],
+    data_config: Dict[str, Any],
+    num_iterations: int,
+    compiled: bool,
+) -> Dict[str, Any]:
+    """1つのデータサイズで学習から予測までの各stageを計測する (別プロセスで実行される)"""
+    profiler = StageProfiler()
+    trainer_config = OmegaConf.create({**_TRAINER_PATHS, "lgbm": lgbm_config})
+    trainer = LGBMTrainer(trainer_config, exp_name)
+    numerical_cols = list(lgbm_config["numerical_cols"])
+    cat_cols = list(lgbm_config["cat_cols"])
+
+    with profiler.stage("generate"):
+        df = make_frame(
+            numerical_cols,
+            cat_cols,
+            n_rows,
+            label_col=lgbm_config["label_col"],
+            **data_config,
+        )
+    with profiler.stage("trainer_preprocess"):
+        train_df, valid_df, _, test_df, le_dict = trainer._preprocess(df)
+    del df
+    params = {**trainer.params, "num_iterations": num_iterations, "verbose": -1}
+    with profiler.stage("dataset_construct"):
+        train_set = trainer._make_dataset(train_df, params=params).construct()
+        valid_set = trainer._make_dataset(
+            valid_df, reference=train_set, params=params
+        ).construct()
+    with profiler.stage("train"):
+        bst = lgb.train(
+            params,
+            train_set,
+            valid_sets=[valid_set],
+            # construct済みのDatasetなので、作成時と同じ指定にする
+            feature_name=trainer.feature_cols,
+            categorical_feature=cat_cols,
+            callbacks=[lgb.log_evaluation(0)],
+        )
+    del train_set, valid_set, train_df, valid_df
+    with profiler.stage("evaluate"):
+        metrics, _ = trainer.evaluate(le_dict, bst, test_df)
+    n_test = len(test_df)
+    del test_df
+
+    pred_df = make_frame(
+        numerical_cols,
+        cat_cols,
+        n_rows,
+        **{**data_config, "seed": data_config["seed"] + 1},
+    )
+    predictor_config = OmegaConf.create(
+        {**_PREDICTOR_PATHS, "lgbm": lgbm_config, "compiled": compiled}
+    )
+    predictor = LGBMPredictor(predictor_config, exp_name, model=(le_dict, bst))
+    with profiler.stage("predictor_preprocess"):
+        feature_df = predictor._preprocess(pred_df.copy())
+    with profiler.stage("predict"):
+        predictor.predict_features(feature_df)
+    return {
+        "n_test": n_test,
+        "rmse": float(metrics["rmse"]),
+        "stages": profiler.results,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(
+    exp_name: str,
+    scales: List[int],
+    lgbm_config: Mapping[str, Any],
+    data_config: Mapping[str, Any],
+    num_iterations: int,
+    compiled: bool = False,
+) -> Dict[str, Any]:
+    """データサイズごとに学習, 予測の各stageの時間とメモリを計測する
+
+    データサイズごとに新しいプロセスで実行するので、RSSは前の計測の影響を受けない。
+    メモリ不足でプロセスが止められた場合はstatusをkilledにして次のデータサイズに進む。
+
+    Args:
+        exp_name (str): 特徴量の列を使う実験名
+        scales (List[int]): 計測する行数
+        lgbm_config (Mapping[str, Any]): numerical_cols, cat_cols, label_col, pred_col, params
+        data_config (Mapping[str, Any]): make_frameに渡すデータの設定 (end_ts, split_config, n_yjなど)
+        num_iterations (int): trainで学習する木の数
+        compiled (bool, optional): CompiledForestで予測するか. Defaults to False.
+
+    Returns:
+        Dict[str, Any]: 実行環境と設定のmetadataと、データサイズごとの結果
+    """
+    lgbm_config = dict(lgbm_config)
+    data_config = dict(data_config)
+    results = []
+    for n_rows in scales:
+        result: Dict[str, Any] = {"n_rows": n_rows}
+        start = time.perf_counter()
+        try:
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=get_context("spawn")
+            ) as executor:
+                result.update(
+                    executor.submit(
+                        _run_scale,
+                        exp_name,
+                        n_rows,
+                        lgbm_config,
+                        data_config,
+                        num_iterations,
+                        compiled,
+                    ).result()
+                )
+        except BrokenProcessPool:
+            # メモリ不足でOOM killerに止められた場合
+            result["status"] = "killed"
+        else:
+            result["status"] = "ok"
+        result["total_sec"] = time.perf_counter() - start
+        results.append(result)
+    return {
+        "metadata": {
+            "exp_name": exp_name,
+            "created_at": pd.Timestamp.now(tz="Asia/Tokyo").isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "lightgbm": lgb.__version__,
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+            "num_iterations": num_iterations,
+            "compiled": compiled,
+            "data": data_config,
+            "n_features": len(lgbm_config["numerical_cols"])
+            + len(lgbm_config["cat_cols"]),
+        },
+        "results": results,
+    }
+
+
+def to_frame(report: Mapping[str, Any]) -> pd.DataFrame:
+    """suiteの結果をn_rows, stageごとの表にする"""
+    rows = []
+    for result in report["results"]:
+        if result["status"] != "ok":
+            rows.append(
+                {"n_rows": result["n_rows"], "stage": None, "status": result["status"]}
+            )
+            continue
+        for stage in STAGES:
+            rows.append(
+                {
+                    "n_rows": result["n_rows"],
+                    "stage": stage,
+                    "status": "ok",
+                    **result["stages"][stage],
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def save_report(report: Mapping[str, Any], path: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+def load_report(path: str) -> Dict[str, Any]:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def compare_reports(base: Mapping[str, Any], target: Mapping[str, Any]) -> pd.DataFrame:
+    """2つのsuiteの結果をn_rows, stageごとに比較する (ratioが1より小さいとtargetの方が速い, 省メモリ)"""
+    keys = ["n_rows", "stage"]
+    base_df = to_frame(base).query("status == 'ok'")
+    target_df = to_frame(target).query("status == 'ok'")
+    df = base_df[keys + ["sec", "delta_peak_mb"]].merge(
+        target_df[keys + ["sec", "delta_peak_mb"]],
+        on=keys,
+        suffixes=("_base", "_target"),
+    )
+    df["sec_ratio"] = df["sec_target"] / df["sec_base"]
+    df["peak_mb_ratio"] = df["delta_peak_mb_target"] / df["delta_peak_mb_base"].where(
+        df["delta_peak_mb_base"] > 0
+    )
+    return df
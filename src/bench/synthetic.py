@@ -0,0 +1,141 @@
+from datetime import timedelta
+from typing import List, Mapping, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.train.backtest import origin_date, split_flags
+
+# 差分の目的変数を処方量に戻すのに使うカラム (LGBMTrainer._labels)
+LAG_COL = "lag_total_dose_by_yj_store"
+
+
+def _codes(prefix: str, n: int) -> np.ndarray:
+    return np.array([f"{prefix}{i:06d}" for i in range(n)], dtype=object)
+
+
+def _zipf_choice(rng: np.random.Generator, n: int, size: int, a: float) -> np.ndarray:
+    """少数のyj, 店舗に処方が集中するように、順位の-a乗に比例する確率で選ぶ"""
+    weights = 1.0 / np.arange(1, n + 1) ** a
+    return rng.choice(n, size=size, p=weights / weights.sum())
+
+
+def make_keys(
+    n_rows: int,
+    end_ts: str,
+    split_config: Mapping[str, int],
+    n_yj: int,
+    n_store: int,
+    rng: np.random.Generator,
+    zipf_a: float = 1.1,
+) -> pd.DataFrame:
+    """yj_code, store_code, dispensing_date, split_flagを作成する
+
+    dispensing_dateはtrain_dataset_*.sqlと同じ期間 (train + valid + test + 2 * sum_days日) から選び、
+    split_flagはその期間の区切りで付けるので、train, valid, test, 欠損の割合は実データと同じになる。
+    """
+    end_date = origin_date(end_ts) - timedelta(days=split_config["sum_days"])
+    span_days = (
+        split_config["train_days"]
+        + split_config["valid_days"]
+        + split_config["test_days"]
+        + 2 * split_config["sum_days"]
+    )
+    offsets = rng.integers(0, span_days + 1, n_rows)
+    dates = pd.Series(
+        pd.to_datetime(end_date) - pd.to_timedelta(offsets, unit="D"),
+        name="dispensing_date",
+    )
+    df = pd.DataFrame(
+        {
+            "yj_code": _codes("Y", n_yj)[_zipf_choice(rng, n_yj, n_rows, zipf_a)],
+            "store_code": _codes("S", n_store)[rng.integers(0, n_store, n_rows)],
+            "dispensing_date": dates,
+        }
+    )
+    flags = split_flags(dates, end_ts, split_config)
+    df["split_flag"] = flags.where(flags != "out", None)
+    return df
+
+
+def make_doses(
+    keys: pd.DataFrame, zero_rate: float, rng: np.random.Generator
+) -> np.ndarray:
+    """zero_rateの割合が0で、残りはyj, 店舗ごとの規模に比例する対数正規分布の処方量"""
+    n_rows = len(keys)
+    scale = (
+        pd.util.hash_array(keys["yj_code"].to_numpy()) % 1000
+        + pd.util.hash_array(keys["store_code"].to_numpy()) % 100
+    ) / 100.0 + 1.0
+    doses = rng.lognormal(mean=3.0, sigma=1.0, size=n_rows) * scale
+    doses[rng.random(n_rows) < zero_rate] = 0.0
+    return doses
+
+
+def make_frame(
+    numerical_cols: List[str],
+    cat_cols: List[str],
+    n_rows: int,
+    end_ts: str,
+    split_config: Mapping[str, int],
+    label_col: Optional[str] = None,
+    n_yj: int = 2000,
+    n_store: int = 300,
+    zero_rate: float = 0.7,
+    cat_cardinality: int = 50,
+    nan_rate: float = 0.05,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """expのyamlと同じカラムを持つ、train_dataset_*, predict_dataset_*と同じ形式のランダムなデータを作成する
+
+    処方量は0が多いzero-inflatedな分布で、数値特徴量の一部は処方量のlagや統計量のように目的変数と相関する。
+    カテゴリ変数はLabelEncoder前の値 (yj_code, store_codeはキー, その他はcat_cardinality種類の文字列)。
+
+    Args:
+        numerical_cols (List[str]): 数値特徴量 (feature.numerical_cols)
+        cat_cols (List[str]): カテゴリ変数 (feature.cat_cols)
+        n_rows (int): 行数
+        end_ts (str): 学習のend_ts。dispensing_dateの期間とsplit_flagの区切りに使う
+        split_config (Mapping[str, int]): sum_days, train_days, valid_days, test_days
+        label_col (Optional[str], optional): 目的変数のカラム。Noneの場合は予測データとして作成する
+        n_yj (int, optional): yj_codeの種類数. Defaults to 2000.
+        n_store (int, optional): store_codeの種類数. Defaults to 300.
+        zero_rate (float, optional): 処方量が0の割合. Defaults to 0.7.
+        cat_cardinality (int, optional): yj_code, store_code以外のカテゴリ変数の種類数. Defaults to 50.
+        nan_rate (float, optional): 数値特徴量の欠損の割合. Defaults to 0.05.
+        seed (int, optional): 乱数のseed. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: キー, split_flag, 特徴量, (目的変数)
+    """
+    rng = np.random.default_rng(seed)
+    df = make_keys(n_rows, end_ts, split_config, n_yj, n_store, rng)
+    doses = make_doses(df, zero_rate, rng)
+    lag = make_doses(df, zero_rate, rng) * 0.5 + doses * 0.5
+
+    # 先頭の数値特徴量ほど目的変数との相関が強い (lag, 過去の統計量に相当)
+    numerical = rng.normal(size=(n_rows, len(numerical_cols))).astype(np.float32)
+    n_informative = min(10, len(numerical_cols))
+    log_lag = np.log1p(lag).astype(np.float32)
+    for i in range(n_informative):
+        numerical[:, i] += log_lag * (1.0 - i / n_informative)
+    numerical[rng.random(numerical.shape) < nan_rate] = np.nan
+    features = pd.DataFrame(numerical, columns=numerical_cols)
+    for col in cat_cols:
+        if col in df.columns:
+            # yj_code, store_codeはキーの値をそのまま使う
+            continue
+        values = _codes(f"{col[:3]}_", cat_cardinality)
+        features[col] = values[rng.integers(0, cat_cardinality, n_rows)]
+    df = pd.concat([df, features], axis=1)
+
+    # 特徴量に含まれる場合も、目的変数と整合するように欠損の無いlagで上書きする
+    df[LAG_COL] = lag.astype(np.float32)
+    if label_col is not None:
+        if "diff" in label_col:
+            df[label_col] = doses - df[LAG_COL].to_numpy()
+        else:
+            df[label_col] = np.log1p(doses)
+    else:
+        df = df.drop(columns=["split_flag"])
+    return df
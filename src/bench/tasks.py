@@ -0,0 +1,207 @@
+import os
+from typing import Optional
+
+import pandas as pd
+from hydra import compose, initialize_config_dir
+from invoke import Collection, Context
+from src.bench.config_access import benchmark_config_access
+from src.bench.inference import (
+    benchmark_inference,
+    make_synthetic_features,
+    make_synthetic_model,
+)
+from src.bench.out_of_core import benchmark_out_of_core
+from src.bench.suite import (
+    compare_reports,
+    load_report,
+    run_suite,
+    save_report,
+    to_frame,
+)
+from src.utils import task, setup_logger
+
+bench_tasks = Collection("bench")
+
+
+@task
+def inference(
+    c: Context,
+    num_iterations: Optional[int] = None,
+    repeat: Optional[int] = None,
+):
+    """Booster.predictとNumPyに変換したモデル(CompiledForest)の予測速度を比較する
+
+    BQ, GCSを使わずに、実験と同じ特徴量の列とパラメータでランダムなデータから学習したモデルで計測する。
+
+    Args:
+        c (Context): invokeのContext
+        num_iterations (Optional[int], optional): モデルの木の数。指定されない場合、yamlの値が使用される
+        repeat (Optional[int], optional): バッチサイズごとの計測回数。指定されない場合、yamlの値が使用される
+    """
+    logger = setup_logger(c)
+    setting = c.bench.inference
+    if num_iterations is None:
+        num_iterations = setting.num_iterations
+    if repeat is None:
+        repeat = setting.repeat
+    lgbm_config = c.train.trainer.lgbm
+    numerical_cols = list(lgbm_config.numerical_cols)
+    cat_cols = list(lgbm_config.cat_cols)
+
+    bst = make_synthetic_model(
+        numerical_cols,
+        cat_cols,
+        lgbm_config.params,
+        num_iterations=int(num_iterations),
+        n_rows=setting.train_rows,
+        cardinality=setting.cardinality,
+    )
+    df = make_synthetic_features(
+        numerical_cols,
+        cat_cols,
+        n_rows=max(setting.batch_sizes),
+        cardinality=setting.cardinality,
+        seed=1,
+    )
+    report_df = benchmark_inference(bst, df, list(setting.batch_sizes), int(repeat))
+    print(report_df.to_string(index=False, float_format="{:.4f}".format))
+
+    os.makedirs(c.bench.report_dir, exist_ok=True)
+    report_path = f"{c.bench.report_dir}/inference_{c.execution_date}.csv"
+    report_df.to_csv(report_path, index=False)
+    logger.info(f"report was saved to {report_path}")
+
+
+@task
+def out_of_core(c: Context, n_rows: Optional[str] = None):
+    """DataFrame経由とParquetのshard (ParquetSequence) から作成したDatasetのピークRSSを比較する
+
+    実験と同じ特徴量の列でランダムな学習データのshardを書き出し、データサイズごとに計測する。
+
+    Args:
+        c (Context): invokeのContext
+        n_rows (Optional[str], optional): カンマ区切りの行数。指定されない場合、yamlの値が使用される
+    """
+    logger = setup_logger(c)
+    setting = c.bench.out_of_core
+    if n_rows is None:
+        n_rows_list = list(setting.n_rows)
+    else:
+        n_rows_list = [int(n) for n in n_rows.split(",")]
+    lgbm_config = c.train.trainer.lgbm
+
+    report_df = benchmark_out_of_core(
+        setting.shard_dir,
+        list(lgbm_config.numerical_cols),
+        list(lgbm_config.cat_cols),
+        n_rows_list,
+        n_shards=setting.n_shards,
+        row_group_size=setting.row_group_size,
+        batch_size=setting.batch_size,
+        cardinality=setting.cardinality,
+    )
+    print(report_df.to_string(index=False, float_format="{:.1f}".format))
+
+    os.makedirs(c.bench.report_dir, exist_ok=True)
+    report_path = f"{c.bench.report_dir}/out_of_core_{c.execution_date}.csv"
+    report_df.to_csv(report_path, index=False)
+    logger.info(f"report was saved to {report_path}")
+
+
+@task
+def suite(c: Context, exp_name: str, scales: Optional[str] = None):
+    """ランダムなデータで学習, 予測の各stageの時間とメモリをデータサイズごとに計測する
+
+    expのyamlと同じ特徴量の列, 目的変数, split_flagの分布を持つデータを作成し、
+    LGBMTrainer._preprocess, Datasetの作成, 学習, evaluate, LGBMPredictor._preprocess, 予測を計測する。
+    結果はbench.report_dirにJSONで保存され、bench.compareで比較できる。
+
+    Args:
+        c (Context): invokeのContext
+        exp_name (str): 実験名
+        scales (Optional[str], optional): カンマ区切りの行数。指定されない場合、yamlの値が使用される
+    """
+    logger = setup_logger(c)
+    setting = c.bench.suite
+    if scales is None:
+        scale_list = list(setting.scales)
+    else:
+        scale_list = [int(n) for n in scales.split(",")]
+    lgbm_config = c.train.trainer.lgbm
+    split_config = {
+        key: int(c.train.sql[key])
+        for key in ["sum_days", "train_days", "valid_days", "test_days"]
+    }
+
+    report = run_suite(
+        exp_name,
+        scale_list,
+        lgbm_config={
+            "numerical_cols": list(lgbm_config.numerical_cols),
+            "cat_cols": list(lgbm_config.cat_cols),
+            "label_col": lgbm_config.label_col,
+            "pred_col": c.predict.predictor.lgbm.pred_col,
+            "params": dict(lgbm_config.params),
+        },
+        data_config={
+            "end_ts": str(c.end_ts),
+            "split_config": split_config,
+            "n_yj": setting.n_yj,
+            "n_store": setting.n_store,
+            "zero_rate": setting.zero_rate,
+            "cat_cardinality": setting.cardinality,
+            "nan_rate": setting.nan_rate,
+            "seed": setting.seed,
+        },
+        num_iterations=setting.num_iterations,
+        compiled=c.predict.predictor.compiled,
+    )
+    print(to_frame(report).to_string(index=False, float_format="{:.2f}".format))
+
+    report_path = (
+        f"{c.bench.report_dir}/suite_{exp_name}_{c.execution_date}"
+        f"_{pd.Timestamp.now():%H%M%S}.json"
+    )
+    save_report(report, report_path)
+    logger.info(f"report was saved to {report_path}")
+
+
+@task
+def compare(c: Context, base: str, target: str):
+    """bench.suiteの2つの結果 (JSON) をデータサイズ, stageごとに比較する
+
+    Args:
+        c (Context): invokeのContext
+        base (str): 基準にする結果のパス
+        target (str): 比較する結果のパス
+    """
+    df = compare_reports(load_report(base), load_report(target))
+    print(df.to_string(index=False, float_format="{:.2f}".format))
+
+
+@task
+def config_access(c: Context, repeat: int = 100000):
+    """trainerの設定の参照1回あたりの時間を、OmegaConf, invokeのconfig, TrainerSettingで比較する
+
+    OmegaConfは${feature.cat_cols}などの補間を参照のたびに解決するので、
+    LGBMTrainer, LGBMPredictorはタスクの開始時にTrainerSetting, PredictorSettingに解決して使う。
+
+    Args:
+        c (Context): invokeのContext
+        repeat (int, optional): 1つの参照の繰り返し回数. Defaults to 100000.
+    """
+    # 補間を解決していないinvoke.yamlの設定
+    with initialize_config_dir(config_dir=os.getcwd()):
+        hydra_config = compose("invoke")
+    report_df = benchmark_config_access(
+        {"omegaconf": hydra_config.train.trainer, "invoke": c.train.trainer},
+        int(repeat),
+    )
+    print(report_df.to_string(index=False, float_format="{:.1f}".format))
+
+
+bench_tasks.add_task(inference)
+bench_tasks.add_task(out_of_core)
+bench_tasks.add_task(suite)
+bench_tasks.add_task(compare)
+bench_tasks.add_task(config_access)
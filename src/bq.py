@@ -1,20 +1,11 @@
-import logging
 import uuid
 
 from google.api_core.exceptions import NotFound
 from google.cloud import bigquery
 
-# TODO: cloud loggingにも飛ばす設定をする
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(
-    logging.Formatter(
-        "[%(asctime)s] [%(name)s] [L%(lineno)d] [%(levelname)s][%(funcName)s] %(message)s "
-    )
-)
-logger.addHandler(handler)
-logger.propagate = False
+from src.log import get_logger
+
+logger = get_logger(__name__)
 
 
 class BQClient:
@@ -60,6 +51,34 @@ class BQClient:
             logger.info(f"table: {dataset_id}.{table_id} not found.")
             return False
 
+    def table_metadata(self, dataset_id, table_id):
+        """テーブルの最終更新日時, 行数, byte数を取得する (テーブルが無い場合はNone)"""
+        ref = self.client.dataset(dataset_id).table(table_id)
+        try:
+            table = self.client.get_table(ref)
+        except NotFound:
+            return None
+        return {
+            "last_modified": table.modified.isoformat(),
+            "num_rows": table.num_rows,
+            "num_bytes": table.num_bytes,
+        }
+
+    def table_partitioning(self, dataset_id, table_id):
+        """テーブルのパーティション列を取得する
+
+        テーブルが無い場合はNone, パーティション分割されていない場合は空文字を返す
+        (取り込み時間でのパーティションは_PARTITIONTIME)。
+        """
+        ref = self.client.dataset(dataset_id).table(table_id)
+        try:
+            table = self.client.get_table(ref)
+        except NotFound:
+            return None
+        if table.time_partitioning is None:
+            return ""
+        return table.time_partitioning.field or "_PARTITIONTIME"
+
     def delete_table(self, dataset_id, table_id):
         if not self.exist_table(dataset_id, table_id):
             return
@@ -68,14 +87,22 @@ class BQClient:
         self.client.delete_table(ref)
         logger.info(f"table: {dataset_id}.{table_id} was deleted.")
 
+    def _make_schema(self, setting):
+        return [
+            bigquery.SchemaField(
+                field["name"],
+                field["type"],
+                mode=field["mode"],
+                description=field.get("description"),
+            )
+            for field in setting["schema"]["fields"]
+        ]
+
     def create_table(self, dataset_id, table_id, setting, description=""):
         dataset_ref = self.client.dataset(dataset_id)
         table_ref = dataset_ref.table(table_id)
 
-        schema = [
-            bigquery.SchemaField(field["name"], field["type"], mode=field["mode"])
-            for field in setting["schema"]["fields"]
-        ]
+        schema = self._make_schema(setting)
         table = bigquery.Table(table_ref, schema)
         table.description = description
 
@@ -93,7 +120,7 @@ class BQClient:
             f"Created table {table.project}.{table.dataset_id}.{table.table_id}"
         )
 
-    def execute_query(self, query):
+    def _make_query_job_config(self, labels=None, dry_run=False):
         if self.default_dataset is not None:
             default_dataset = self.project + "." + self.default_dataset
         else:
@@ -101,6 +128,15 @@ class BQClient:
 
         job_config = bigquery.job.QueryJobConfig(default_dataset=default_dataset)
         job_config.use_legacy_sql = False
+        if labels:
+            job_config.labels = labels
+        if dry_run:
+            job_config.dry_run = True
+            job_config.use_query_cache = False
+        return job_config
+
+    def execute_query(self, query, labels=None):
+        job_config = self._make_query_job_config(labels=labels)
         job_id = self._make_job_id(prefix="execute_")
         try:
             insert_job = self.client.query(query, job_id=job_id, job_config=job_config)
@@ -109,6 +145,65 @@ class BQClient:
         except KeyboardInterrupt as e:
             self.cancel_job(job_id)
             raise e
+        return insert_job
+
+    def dry_run_query(self, query):
+        """クエリをdry runし、スキャン予定のbyte数を返す"""
+        job_config = self._make_query_job_config(dry_run=True)
+        job = self.client.query(query, job_config=job_config)
+        return job.total_bytes_processed or 0
+
+    def job_statistics(self, job):
+        """実行済みjobの課金byte数とslot使用時間を取得する"""
+        # scriptの場合は親jobに子jobの合計値が入る
+        return {
+            "job_id": job.job_id,
+            "total_bytes_processed": job.total_bytes_processed or 0,
+            "total_bytes_billed": job.total_bytes_billed or 0,
+            "slot_millis": job.slot_millis or 0,
+        }
+
+    def load_partitions(self, df, dataset_id, table_id, setting, description=""):
+        """DataFrameをtimePartitioningのfieldの値ごとに、パーティション単位で上書きロードする
+
+        対象のパーティション以外のデータはそのまま残る。テーブルが無い場合はsettingから作成する。
+
+        Args:
+            df (pd.DataFrame): ロードするデータ
+            dataset_id (str): データセット名
+            table_id (str): テーブル名
+            setting (dict): create_tableと同じ形式のテーブル設定
+            description (str, optional): テーブル作成時のdescription
+        """
+        if not self.exist_table(dataset_id, table_id):
+            self.create_table(dataset_id, table_id, setting, description=description)
+        partition_col = setting["timePartitioning"]["field"]
+        job_config = bigquery.LoadJobConfig(
+            schema=self._make_schema(setting),
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+        jobs = []
+        try:
+            # パーティションごとのload jobは並列に実行される
+            for partition_value, partition_df in df.groupby(partition_col):
+                decorator = partition_value.strftime("%Y%m%d")
+                jobs.append(
+                    self.client.load_table_from_dataframe(
+                        partition_df,
+                        f"{self.project}.{dataset_id}.{table_id}${decorator}",
+                        job_id=self._make_job_id(prefix="load_"),
+                        job_config=job_config,
+                    )
+                )
+            for job in jobs:
+                job.result()
+        except KeyboardInterrupt as e:
+            for job in jobs:
+                self.cancel_job(job.job_id)
+            raise e
+        logger.info(
+            f"Loaded {len(df)} rows into {len(jobs)} partitions of {dataset_id}.{table_id}."
+        )
 
     def copy_table(self, src_project, src_dataset, tgt_dataset, table_id):
         if self.exist_table(tgt_dataset, table_id):
@@ -0,0 +1,257 @@
+import fcntl
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from src.bq import BQClient
+from src.cost import GIB
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class TableCache(object):
+    """BQのテーブルを読み込んだ結果をローカルにArrow(Feather)形式で保存するキャッシュ
+
+    キーはproject, dataset, table, クエリと、テーブルの最終更新日時, 行数。
+    テーブルが作り直されるとキーが変わるので、古いsnapshotは使われずに削除される。
+    snapshotは非圧縮のFeatherで保存し、memory mapで読み込む。
+    合計サイズがmax_bytesを超えた場合は、最後に使われたのが古いsnapshotから削除する (LRU)。
+    index.jsonにsnapshotの一覧とhit, missの回数を保存する。
+
+    Args:
+        cache_dir (str): snapshotを保存するディレクトリ
+        max_bytes (int): snapshotの合計サイズの上限
+        bq (Optional[BQClient], optional): テーブルの情報を取得するBQのclient. Defaults to None.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, bq: Optional[BQClient] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.bq = bq
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, "index.json")
+
+    @contextmanager
+    def _locked_index(self) -> Iterator[Dict[str, Any]]:
+        """複数プロセスから同時に使われても壊れないように、ロックしてindexを読み書きする"""
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self._read_index()
+            yield index
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(index, f, indent=2)
+            os.replace(tmp_path, self.index_path)
+
+    def _read_index(self) -> Dict[str, Any]:
+        if not os.path.exists(self.index_path):
+            return {"entries": {}, "stats": {"hits": 0, "misses": 0, "bytes_read": 0}}
+        with open(self.index_path, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def make_key(
+        project: str,
+        dataset_id: str,
+        table_id: str,
+        query: str,
+        metadata: Dict[str, Any],
+    ) -> str:
+        source = json.dumps(
+            [
+                project,
+                dataset_id,
+                table_id,
+                " ".join(query.split()),
+                metadata["last_modified"],
+                metadata["num_rows"],
+            ]
+        )
+        return hashlib.sha256(source.encode()).hexdigest()[:32]
+
+    def read(
+        self,
+        project: str,
+        dataset_id: str,
+        table_id: str,
+        query: str,
+        load: Callable[[], pd.DataFrame],
+    ) -> pd.DataFrame:
+        """キャッシュにあればsnapshotを読み込み、無ければloadの結果を保存して返す
+
+        Args:
+            project (str): GCPのproject
+            dataset_id (str): 読み込むテーブルのdataset
+            table_id (str): 読み込むテーブル
+            query (str): テーブルを読み込むクエリ (debugのdownsamplingなどで変わる)
+            load (Callable[[], pd.DataFrame]): キャッシュに無い場合にBQから読み込む関数
+
+        Returns:
+            pd.DataFrame: クエリの結果
+        """
+        bq = self.bq or BQClient(project)
+        metadata = bq.table_metadata(dataset_id, table_id)
+        if metadata is None:
+            return load()
+        key = self.make_key(project, dataset_id, table_id, query, metadata)
+        path = os.path.join(self.cache_dir, f"{key}.feather")
+
+        with self._locked_index() as index:
+            entry = index["entries"].get(key)
+            source = None
+            if entry is not None:
+                try:
+                    # ロック中に開いておけば、ロックを外した後に別のプロセスがevictで削除しても読み込める
+                    source = pa.memory_map(path)
+                except FileNotFoundError:
+                    pass
+            if source is not None:
+                entry["last_access"] = time.time()
+                entry["hits"] += 1
+                index["stats"]["hits"] += 1
+                index["stats"]["bytes_read"] += entry["bytes"]
+            else:
+                index["stats"]["misses"] += 1
+        if source is not None:
+            start = time.perf_counter()
+            with source:
+                df = feather.read_table(source).to_pandas()
+            logger.info(
+                f"[cache hit] {dataset_id}.{table_id} ({entry['bytes'] / GIB:.2f} GiB) "
+                f"was loaded from {path} in {time.perf_counter() - start:.1f} sec."
+            )
+            return df
+
+        df = load()
+        self._write(key, path, df, project, dataset_id, table_id, metadata)
+        return df
+
+    def _write(
+        self,
+        key: str,
+        path: str,
+        df: pd.DataFrame,
+        project: str,
+        dataset_id: str,
+        table_id: str,
+        metadata: Dict[str, Any],
+    ) -> None:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        feather.write_feather(
+            pa.Table.from_pandas(df, preserve_index=False),
+            tmp_path,
+            compression="uncompressed",
+        )
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._locked_index() as index:
+            entries = index["entries"]
+            # 同じテーブルの古いsnapshotはもう使われない
+            for old_key, entry in list(entries.items()):
+                if (
+                    old_key != key
+                    and (entry["project"], entry["dataset_id"], entry["table_id"])
+                    == (project, dataset_id, table_id)
+                    and entry["last_modified"] != metadata["last_modified"]
+                ):
+                    self._remove(entries, old_key)
+            entries[key] = {
+                "project": project,
+                "dataset_id": dataset_id,
+                "table_id": table_id,
+                "last_modified": metadata["last_modified"],
+                "num_rows": metadata["num_rows"],
+                "bytes": size,
+                "created": time.time(),
+                "last_access": time.time(),
+                "hits": 0,
+            }
+            self._evict(entries, keep=key)
+        logger.info(
+            f"[cache miss] {dataset_id}.{table_id} was saved to {path} ({size / GIB:.2f} GiB)."
+        )
+
+    def _remove(self, entries: Dict[str, Any], key: str) -> None:
+        path = os.path.join(self.cache_dir, f"{key}.feather")
+        if os.path.exists(path):
+            os.remove(path)
+        entry = entries.pop(key)
+        logger.info(
+            f"[cache evict] {entry['dataset_id']}.{entry['table_id']} ({entry['bytes'] / GIB:.2f} GiB)"
+        )
+
+    def _evict(self, entries: Dict[str, Any], keep: Optional[str] = None) -> None:
+        """合計サイズがmax_bytes以下になるまで、最後に使われたのが古いsnapshotから削除する"""
+        total = sum(entry["bytes"] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= entries[key]["bytes"]
+            self._remove(entries, key)
+
+    def stats(self) -> pd.DataFrame:
+        """snapshotごとのサイズ, hit回数, 最終使用日時"""
+        index = self._read_index()
+        rows: List[Dict[str, Any]] = [
+            {
+                "table": f"{entry['project']}.{entry['dataset_id']}.{entry['table_id']}",
+                "last_modified": entry["last_modified"],
+                "num_rows": entry["num_rows"],
+                "gib": entry["bytes"] / GIB,
+                "hits": entry["hits"],
+                "last_access": pd.Timestamp(entry["last_access"], unit="s"),
+                "key": key,
+            }
+            for key, entry in index["entries"].items()
+        ]
+        columns = [
+            "table",
+            "last_modified",
+            "num_rows",
+            "gib",
+            "hits",
+            "last_access",
+            "key",
+        ]
+        return pd.DataFrame(rows, columns=columns).sort_values(
+            "last_access", ascending=False
+        )
+
+    def summary(self) -> Dict[str, Any]:
+        index = self._read_index()
+        total = sum(entry["bytes"] for entry in index["entries"].values())
+        stats = index["stats"]
+        requests = stats["hits"] + stats["misses"]
+        return {
+            "snapshots": len(index["entries"]),
+            "total_gib": total / GIB,
+            "max_gib": self.max_bytes / GIB,
+            "hits": stats["hits"],
+            "misses": stats["misses"],
+            "hit_rate": stats["hits"] / requests if requests else 0.0,
+            "gib_served_from_cache": stats["bytes_read"] / GIB,
+        }
+
+    def clear(self) -> None:
+        with self._locked_index() as index:
+            for key in list(index["entries"]):
+                self._remove(index["entries"], key)
+
+
+def table_cache(
+    config: Any, project: str, bq: Optional[BQClient] = None
+) -> Optional[TableCache]:
+    """cacheの設定 (enabled, dir, max_gb) からTableCacheを作成する。無効な場合はNone"""
+    if not config.enabled:
+        return None
+    return TableCache(config.dir, int(config.max_gb * GIB), bq or BQClient(project))
@@ -0,0 +1,292 @@
+from dataclasses import dataclass, fields
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+# lgbm.second_stageで指定できる2段階目の学習方法 (LGBMTrainer._second_stage)
+SECOND_STAGES = ("retrain", "continue", "refit")
+# predictor.inverse_transformで指定できる予測値の逆変換 (src/predict/predictor.pyのINVERSE_TRANSFORMS)
+INVERSE_TRANSFORMS = ("log1p", "min_max", "diff")
+
+
+class _Frozen(object):
+    """frozenなdataclassに__slots__を使う場合のpickle対応
+
+    Python 3.9のdataclassにはslots=Trueが無いので、各クラスで__slots__を宣言する。
+    __slots__のみのインスタンスはpickleの復元時にsetattrするため、frozenの場合はobject.__setattr__で復元する。
+    """
+
+    __slots__ = ()
+
+    def __getstate__(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, f.name) for f in fields(self))
+
+    def __setstate__(self, state: Tuple[Any, ...]) -> None:
+        for f, value in zip(fields(self), state):
+            object.__setattr__(self, f.name, value)
+
+
+def _columns(values: Any, name: str) -> Tuple[str, ...]:
+    """カラムのリストを重複の無いtupleにする"""
+    columns = tuple(str(v) for v in values)
+    duplicated = sorted({col for col in columns if columns.count(col) > 1})
+    if duplicated:
+        raise ValueError(f"{name} has duplicated columns: {duplicated}")
+    return columns
+
+
+def _get(config: Any, name: str, default: Any = "") -> Any:
+    """任意の設定の値を取得する (無い場合はdefault)"""
+    value = config.get(name)
+    return default if value is None else value
+
+
+def _required(config: Any, name: str, prefix: str) -> str:
+    """必須の設定の値を取得する (無い場合はGCS, BQのエラーになる前にValueErrorにする)"""
+    value = config.get(name)
+    if value is None or str(value) == "":
+        raise ValueError(f"{prefix}.{name} is required")
+    return str(value)
+
+
+def _bool(config: Any, name: str, default: bool, prefix: str) -> bool:
+    """真偽値の設定を取得する (環境変数, CLIのoverrideの"True", "False"の文字列も扱う)"""
+    value = config.get(name)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+        return value.strip().lower() == "true"
+    raise ValueError(f"{prefix}.{name} must be a boolean, got {value!r}")
+
+
+def _params(values: Mapping[str, Any]) -> Tuple[Tuple[str, Any], ...]:
+    """LightGBMのパラメータを変更できないようにkey, valueのtupleにする (dict()でdictに戻せる)"""
+    return tuple((str(key), values[key]) for key in values)
+
+
+@dataclass(frozen=True)
+class LGBMSetting(_Frozen):
+    """trainer, predictorのlgbmの設定をタスクの開始時に1回だけ解決したもの
+
+    feature_colsはnumerical_cols + cat_colsで、学習, 予測のDataFrameの列の順序になる。
+    学習のみで使う設定 (label_col, params, num_iterationsなど) は、predictorではNoneになる。
+    """
+
+    __slots__ = (
+        "numerical_cols",
+        "cat_cols",
+        "feature_cols",
+        "label_col",
+        "pred_col",
+        "upload_cols",
+        "params",
+        "num_iterations",
+        "early_stopping_rounds",
+        "verbose_eval",
+        "second_stage",
+        "refit_decay_rate",
+    )
+    numerical_cols: Tuple[str, ...]
+    cat_cols: Tuple[str, ...]
+    feature_cols: Tuple[str, ...]
+    label_col: Optional[str]
+    pred_col: Optional[str]
+    upload_cols: Optional[Tuple[str, ...]]
+    params: Tuple[Tuple[str, Any], ...]
+    num_iterations: Optional[int]
+    early_stopping_rounds: Optional[int]
+    verbose_eval: Optional[int]
+    second_stage: Optional[str]
+    refit_decay_rate: Optional[float]
+
+    def __post_init__(self):
+        overlap = sorted(set(self.numerical_cols) & set(self.cat_cols))
+        if overlap:
+            raise ValueError(f"columns in both numerical_cols and cat_cols: {overlap}")
+        if self.feature_cols != self.numerical_cols + self.cat_cols:
+            raise ValueError("feature_cols must be numerical_cols + cat_cols")
+        if self.label_col is not None and self.label_col in self.feature_cols:
+            raise ValueError(f"label_col '{self.label_col}' is used as a feature")
+        if self.second_stage is not None and self.second_stage not in SECOND_STAGES:
+            raise ValueError(
+                f"second_stage must be one of {SECOND_STAGES}, got '{self.second_stage}'"
+            )
+        if self.refit_decay_rate is not None and not 0 <= self.refit_decay_rate <= 1:
+            raise ValueError(
+                f"refit_decay_rate must be in [0, 1], got {self.refit_decay_rate}"
+            )
+        for name in ["num_iterations", "early_stopping_rounds"]:
+            value = getattr(self, name)
+            if value is not None and value <= 0:
+                raise ValueError(f"{name} must be positive, got {value}")
+
+    @classmethod
+    def from_config(cls, config: Any) -> "LGBMSetting":
+        """trainer.lgbm, predictor.lgbmの設定 (DictConfig, invokeのconfig) から作成する"""
+        numerical_cols = _columns(config.numerical_cols, "numerical_cols")
+        cat_cols = _columns(config.cat_cols, "cat_cols")
+
+        def optional(name: str, cast: Any) -> Any:
+            value = config.get(name)
+            return None if value is None else cast(value)
+
+        upload_cols = config.get("upload_cols")
+        return cls(
+            numerical_cols=numerical_cols,
+            cat_cols=cat_cols,
+            feature_cols=numerical_cols + cat_cols,
+            label_col=optional("label_col", str),
+            pred_col=optional("pred_col", str),
+            upload_cols=None if upload_cols is None else tuple(upload_cols),
+            params=_params(config.get("params") or {}),
+            num_iterations=optional("num_iterations", int),
+            early_stopping_rounds=optional("early_stopping_rounds", int),
+            verbose_eval=optional("verbose_eval", int),
+            second_stage=optional("second_stage", str),
+            refit_decay_rate=optional("refit_decay_rate", float),
+        )
+
+
+@dataclass(frozen=True)
+class ExplainSetting(_Frozen):
+    """行ごとの特徴量の寄与 (pred_contrib) を書き出すexplainの設定 (src/predict/explain.py)"""
+
+    __slots__ = ("enabled", "top_k", "chunk_size", "n_workers")
+    enabled: bool
+    top_k: int
+    chunk_size: int
+    n_workers: int
+
+    def __post_init__(self):
+        for name in ["top_k", "chunk_size"]:
+            value = getattr(self, name)
+            if value <= 0:
+                raise ValueError(f"explain.{name} must be positive, got {value}")
+        if self.n_workers < 0:
+            raise ValueError(f"explain.n_workers must be >= 0, got {self.n_workers}")
+
+    @classmethod
+    def from_config(cls, config: Any) -> "ExplainSetting":
+        """explainの設定が無い場合 (ベンチマークなど) は無効にする"""
+        if config is None:
+            return cls(enabled=False, top_k=10, chunk_size=50000, n_workers=0)
+        return cls(
+            enabled=_bool(config, "enabled", False, "explain"),
+            top_k=int(_get(config, "top_k", 10)),
+            chunk_size=int(_get(config, "chunk_size", 50000)),
+            n_workers=int(_get(config, "n_workers", 0)),
+        )
+
+
+@dataclass(frozen=True)
+class TrainerSetting(_Frozen):
+    """LGBMTrainerのproject, dataset, bucketなどのパスとlgbmの設定"""
+
+    __slots__ = (
+        "gcp_project",
+        "dataset_id",
+        "bucket",
+        "latest_model_path",
+        "upload_cols",
+        "debug",
+        "upload_workers",
+        "explain",
+        "lgbm",
+    )
+    gcp_project: str
+    dataset_id: str
+    bucket: str
+    latest_model_path: str
+    upload_cols: Tuple[str, ...]
+    debug: bool
+    upload_workers: int
+    explain: ExplainSetting
+    lgbm: LGBMSetting
+
+    def __post_init__(self):
+        if self.lgbm.label_col is None:
+            raise ValueError("trainer.lgbm.label_col is required")
+        if self.upload_workers < 1:
+            raise ValueError(
+                f"trainer.upload_workers must be positive, got {self.upload_workers}"
+            )
+
+    @classmethod
+    def from_config(cls, config: Any) -> "TrainerSetting":
+        return cls(
+            gcp_project=_required(config, "gcp_project", "trainer"),
+            dataset_id=_required(config, "dataset_id", "trainer"),
+            bucket=_required(config, "bucket", "trainer"),
+            latest_model_path=_required(config, "latest_model_path", "trainer"),
+            upload_cols=tuple(_get(config, "upload_cols", [])),
+            debug=_bool(config, "debug", False, "trainer"),
+            upload_workers=int(_get(config, "upload_workers", 8)),
+            explain=ExplainSetting.from_config(config.get("explain")),
+            lgbm=LGBMSetting.from_config(config.lgbm),
+        )
+
+
+@dataclass(frozen=True)
+class PredictorSetting(_Frozen):
+    """LGBMPredictorのproject, dataset, bucketなどのパスとlgbmの設定"""
+
+    __slots__ = (
+        "gcp_project",
+        "dataset",
+        "train_bucket",
+        "bucket",
+        "latest_model_path",
+        "prediction_path",
+        "result_dataset",
+        "debug",
+        "compiled",
+        "inverse_transforms",
+        "explain",
+        "lgbm",
+    )
+    gcp_project: str
+    dataset: str
+    train_bucket: str
+    bucket: str
+    latest_model_path: str
+    prediction_path: str
+    result_dataset: str
+    debug: bool
+    compiled: bool
+    inverse_transforms: Tuple[Tuple[str, str], ...]
+    explain: ExplainSetting
+    lgbm: LGBMSetting
+
+    def __post_init__(self):
+        if self.lgbm.pred_col is None:
+            raise ValueError("predictor.lgbm.pred_col is required")
+        for exp_name, method in self.inverse_transforms:
+            if method not in INVERSE_TRANSFORMS:
+                raise ValueError(
+                    f"predictor.inverse_transform.{exp_name} must be one of "
+                    f"{INVERSE_TRANSFORMS}, got '{method}'"
+                )
+
+    def inverse_transform(self, exp_name: str) -> str:
+        """予測値を処方量に戻す変換。指定が無い実験はlog1p"""
+        return dict(self.inverse_transforms).get(exp_name, "log1p")
+
+    @classmethod
+    def from_config(cls, config: Any) -> "PredictorSetting":
+        inverse_transforms: Dict[str, str] = dict(_get(config, "inverse_transform", {}))
+        return cls(
+            gcp_project=_required(config, "gcp_project", "predictor"),
+            dataset=_required(config, "dataset", "predictor"),
+            train_bucket=_required(config, "train_bucket", "predictor"),
+            bucket=_required(config, "bucket", "predictor"),
+            latest_model_path=_required(config, "latest_model_path", "predictor"),
+            prediction_path=str(_get(config, "prediction_path")),
+            result_dataset=str(_get(config, "result_dataset")),
+            debug=_bool(config, "debug", False, "predictor"),
+            compiled=_bool(config, "compiled", False, "predictor"),
+            inverse_transforms=tuple(
+                (str(k), str(v)) for k, v in inverse_transforms.items()
+            ),
+            explain=ExplainSetting.from_config(config.get("explain")),
+            lgbm=LGBMSetting.from_config(config.lgbm),
+        )
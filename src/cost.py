@@ -0,0 +1,166 @@
+import re
+import threading
+from typing import Any, Dict, List, Mapping, Optional
+
+import pandas as pd
+
+from src.bq import BQClient
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+GIB = 1024**3
+
+# 同一プロセス内で実行したクエリの見積もりbyte数の累計 (per-runの上限チェック用)
+_run_bytes = 0
+_run_bytes_lock = threading.Lock()
+
+
+class BudgetExceededError(RuntimeError):
+    pass
+
+
+def to_label(value: Any) -> str:
+    """BigQueryのjob labelとして使える文字列に変換する (小文字英数字, _, - のみ, 63文字以内)"""
+    return re.sub(r"[^a-z0-9_-]", "_", str(value).lower())[:63]
+
+
+def make_job_labels(run_id: Any, task_name: str) -> Dict[str, str]:
+    """INFORMATION_SCHEMA.JOBSからrun毎に集計するためのlabel"""
+    return {"run_id": to_label(run_id), "task": to_label(task_name)}
+
+
+def task_budget(cost_config: Mapping, script_name: str) -> Optional[int]:
+    """タスク毎のスキャン量上限を返す。task_budgetsに無い場合はmax_bytes_per_taskを使う"""
+    task_budgets = dict(cost_config.get("task_budgets") or {})
+    if script_name in task_budgets:
+        return task_budgets[script_name]
+    return cost_config.get("max_bytes_per_task")
+
+
+def check_before_run(cost_config: Mapping, script_name: str, bytes_processed: int):
+    """実行前のdry run結果がタスク毎、run毎の上限を超えていればエラーにする
+
+    Args:
+        cost_config (Mapping): invoke.yamlのcostの設定
+        script_name (str): SQLのファイル名
+        bytes_processed (int): dry runで見積もったスキャン量
+
+    Raises:
+        BudgetExceededError: 上限を超えた場合
+    """
+    global _run_bytes
+    budget = task_budget(cost_config, script_name)
+    if budget is not None and bytes_processed > budget:
+        raise BudgetExceededError(
+            f"{script_name} will process {bytes_processed / GIB:.2f} GiB "
+            f"(budget: {budget / GIB:.2f} GiB)"
+        )
+    max_bytes_per_run = cost_config.get("max_bytes_per_run")
+    with _run_bytes_lock:
+        total = _run_bytes + bytes_processed
+        if max_bytes_per_run is not None and total > max_bytes_per_run:
+            raise BudgetExceededError(
+                f"this run will process {total / GIB:.2f} GiB in total "
+                f"(budget: {max_bytes_per_run / GIB:.2f} GiB)"
+            )
+        _run_bytes = total
+
+
+class CostEstimator(object):
+    def __init__(self, bq: BQClient, cost_config: Mapping):
+        self.bq = bq
+        self.cost_config = cost_config
+
+    def plan(self, queries: Dict[str, str]) -> pd.DataFrame:
+        """各タスクのクエリをdry runしてスキャン量を見積もる
+
+        Args:
+            queries (Dict[str, str]): タスク名とレンダリング済みクエリの辞書
+
+        Returns:
+            pd.DataFrame: タスク毎の見積もり結果
+        """
+        rows = []
+        for script_name, query in queries.items():
+            row = {
+                "task": script_name,
+                "bytes_processed": None,
+                "budget": task_budget(self.cost_config, script_name),
+                "error": None,
+            }
+            try:
+                row["bytes_processed"] = self.bq.dry_run_query(query)
+            except Exception as e:
+                # 前段のテーブルが未作成の場合などはdry runできないので記録だけする
+                row["error"] = str(e).splitlines()[0]
+                logger.warning(f"dry run failed: {script_name}: {row['error']}")
+            rows.append(row)
+        plan_df = pd.DataFrame(rows)
+        plan_df["gib_processed"] = plan_df["bytes_processed"] / GIB
+        plan_df["exceeded"] = [
+            budget is not None
+            and bytes_processed is not None
+            and bytes_processed > budget
+            for bytes_processed, budget in zip(
+                plan_df["bytes_processed"], plan_df["budget"]
+            )
+        ]
+        return plan_df
+
+    def check(self, plan_df: pd.DataFrame) -> None:
+        """planの結果がタスク毎、run毎の上限を超えていればエラーにする
+
+        Args:
+            plan_df (pd.DataFrame): planの結果
+
+        Raises:
+            BudgetExceededError: 上限を超えた場合
+        """
+        messages: List[str] = []
+        for _, row in plan_df[plan_df["exceeded"]].iterrows():
+            messages.append(
+                f"{row['task']}: {row['gib_processed']:.2f} GiB "
+                f"(budget: {row['budget'] / GIB:.2f} GiB)"
+            )
+        total = plan_df["bytes_processed"].fillna(0).sum()
+        max_bytes_per_run = self.cost_config.get("max_bytes_per_run")
+        if max_bytes_per_run is not None and total > max_bytes_per_run:
+            messages.append(
+                f"total: {total / GIB:.2f} GiB (budget: {max_bytes_per_run / GIB:.2f} GiB)"
+            )
+        if messages:
+            raise BudgetExceededError("budget exceeded.\n" + "\n".join(messages))
+
+    def run_report(self, run_id: str) -> pd.DataFrame:
+        """run_id labelが付いたjobの実績値をINFORMATION_SCHEMA.JOBSから集計する
+
+        Args:
+            run_id (str): SQLタスク実行時にlabelとして付与したrun_id (execution_date)
+
+        Returns:
+            pd.DataFrame: タスク毎のスキャン量, 課金byte数, slot使用時間
+        """
+        query = f"""
+        SELECT
+          (SELECT value FROM UNNEST(labels) WHERE key = "task") AS task,
+          COUNT(*) AS num_jobs,
+          SUM(total_bytes_processed) AS total_bytes_processed,
+          SUM(total_bytes_billed) AS total_bytes_billed,
+          SUM(total_slot_ms) AS total_slot_ms,
+          SUM(TIMESTAMP_DIFF(end_time, start_time, MILLISECOND)) AS elapsed_ms,
+        FROM
+          `{self.bq.project}.{self.cost_config.jobs_region}.INFORMATION_SCHEMA.JOBS_BY_PROJECT`
+        WHERE
+          creation_time >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {self.cost_config.lookback_days} DAY)
+          -- scriptの場合は親jobに子jobの合計値が入っている
+          AND parent_job_id IS NULL
+          AND EXISTS(
+            SELECT 1 FROM UNNEST(labels) WHERE key = "run_id" AND value = "{to_label(run_id)}"
+          )
+        GROUP BY task
+        ORDER BY total_bytes_billed DESC
+        """
+        report_df = pd.read_gbq(query, project_id=self.bq.project)
+        report_df["gib_billed"] = report_df["total_bytes_billed"] / GIB
+        return report_df
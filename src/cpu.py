@@ -0,0 +1,45 @@
+import math
+import os
+from typing import Optional
+
+
+def _cgroup_cpu_quota() -> Optional[float]:
+    """cgroupのCPUの上限 (コア数)。上限が無い場合はNone
+
+    kubernetesのcpu_limit (例: 2000m) はcgroupのquota / periodとしてコンテナに設定される。
+    """
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+    except (OSError, ValueError):
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return quota / period
+
+
+def available_cpus() -> int:
+    """このプロセスが使えるコア数
+
+    os.cpu_countはホストのコア数なので、CPUのaffinityとcgroupの上限 (コンテナのcpu_limit) で制限する。
+    """
+    try:
+        n_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n_cpus = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        n_cpus = min(n_cpus, math.ceil(quota))
+    return max(1, n_cpus)
@@ -1,19 +1,10 @@
 import os
-import logging
 from pathlib import Path
 from google.cloud import storage
 
-# TODO: cloud loggingにも飛ばす設定をする
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(
-    logging.Formatter(
-        "[%(asctime)s] [%(name)s] [L%(lineno)d] [%(levelname)s][%(funcName)s] %(message)s "
-    )
-)
-logger.addHandler(handler)
-logger.propagate = False
+from src.log import get_logger
+
+logger = get_logger(__name__)
 
 
 class GCSClient(object):
@@ -74,6 +65,14 @@ class GCSClient(object):
             "Blob {} downloaded to {}.".format(source_blob_name, destination_file_name)
         )
 
+    def blob_generation(self, bucket_name, blob_name):
+        """Return the generation of a blob (None if the blob does not exist)."""
+        bucket = self.client.bucket(bucket_name)
+        blob = bucket.get_blob(blob_name)
+        if blob is None:
+            return None
+        return blob.generation
+
     def delete_blob(self, bucket_name, blob_name):
         """Delete a blob in the bucket."""
         bucket = self.client.get_bucket(bucket_name)
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Optional
+
+import jpholiday
+import numpy as np
+import pandas as pd
+
+# day_type_sequenceの文字列 (前日, 当日, 翌日が休日か否かを3bitで表したものをindexにする)
+DAY_TYPE_SEQUENCES = np.array([format(i, "03b") for i in range(8)])
+
+HOLIDAY_TABLE_SCHEMA = [
+    {
+        "name": "jst_date",
+        "type": "DATE",
+        "mode": "REQUIRED",
+        "description": "JST基準の日付",
+    },
+    {
+        "name": "is_holiday",
+        "type": "BOOL",
+        "mode": "REQUIRED",
+        "description": "休日(土日 or 祝日)か否か",
+    },
+    {
+        "name": "dayofweek",
+        "type": "INT64",
+        "mode": "REQUIRED",
+        "description": "BQベースのdow",
+    },
+    {
+        "name": "day_type",
+        "type": "STRING",
+        "mode": "REQUIRED",
+        "description": "平日 or 土日 or 祝日",
+    },
+    {
+        "name": "day_type_sequence",
+        "type": "STRING",
+        "mode": "REQUIRED",
+        "description": "翌日と前日を考慮した区別",
+    },
+]
+
+
+class NewYearHoliday(jpholiday.OriginalHoliday):
+    def _is_holiday(self, date):
+        # 12/29-01/03 は年末年始休暇とする
+        if (date.month == 1 and date.day < 4) or (date.month == 12 and date.day > 28):
+            return True
+        return False
+
+    def _is_holiday_name(self, date):
+        return "年末年始休暇"
+
+
+def _cache_path(cache_dir: str, year: int) -> str:
+    # jpholidayの更新やOriginalHolidayの追加で祝日が変わるので、それらをキーに含める
+    registry = "-".join(
+        sorted(
+            type(h).__name__ for h in jpholiday.registry.RegistryHolder.get_registry()
+        )
+    )
+    key = f"{jpholiday.__version__}_{hashlib.md5(registry.encode()).hexdigest()[:8]}"
+    return os.path.join(cache_dir, key, f"{year}.json")
+
+
+@lru_cache(maxsize=None)
+def year_holiday_names(year: int, cache_dir: Optional[str] = None) -> Dict[str, str]:
+    """その年の祝日(NewYearHolidayを含む)の日付と祝日名の辞書を返す
+
+    jpholidayは1日ずつ判定するため遅いので、年単位でメモリとcache_dirにキャッシュする。
+
+    Args:
+        year (int): 年
+        cache_dir (Optional[str], optional): キャッシュを保存するディレクトリ. Defaults to None.
+
+    Returns:
+        Dict[str, str]: ISO形式の日付と祝日名の辞書
+    """
+    path = _cache_path(cache_dir, year) if cache_dir is not None else None
+    if path is not None and os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    names = {d.isoformat(): name for d, name in jpholiday.year_holidays(year)}
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(names, f, ensure_ascii=False)
+    return names
+
+
+def holiday_names(
+    start_date: date, end_date: date, cache_dir: Optional[str] = None
+) -> pd.Series:
+    """期間内の祝日名をDatetimeIndexのSeriesで返す"""
+    names = {}
+    for year in range(start_date.year, end_date.year + 1):
+        names.update(year_holiday_names(year, cache_dir))
+    series = pd.Series(names, dtype=object)
+    series.index = pd.to_datetime(series.index)
+    return series
+
+
+def build_holiday_master(
+    start_date: str, end_date: str, cache_dir: Optional[str] = None
+) -> pd.DataFrame:
+    """start_dateからend_dateまで(両端を含む)のholiday_masterを作成する
+
+    Args:
+        start_date (str): 開始日 (ISO形式)
+        end_date (str): 終了日 (ISO形式)
+        cache_dir (Optional[str], optional): 祝日のキャッシュを保存するディレクトリ. Defaults to None.
+
+    Returns:
+        pd.DataFrame: holiday_masterのDataFrame
+    """
+    # 前後の日の情報を使うので1日バッファを持って多く生成
+    base_date = datetime.fromisoformat(start_date) - timedelta(days=1)
+    last_date = datetime.fromisoformat(end_date) + timedelta(days=1)
+    dates = pd.date_range(base_date, last_date)
+    names = holiday_names(base_date, last_date, cache_dir).reindex(dates).to_numpy()
+
+    dayofweek = (dates.dayofweek.to_numpy() + 1) % 7 + 1
+    # 優先順位: 土日、祝日、平日
+    # NOTE: BQベースのdayofweekの{5, 6}を土日としている (従来のholiday_masterと同じ値にするため)
+    is_weekend = np.isin(dayofweek, [5, 6])
+    is_national_holiday = pd.notna(names)
+    day_type = np.where(
+        is_weekend, "土日", np.where(is_national_holiday, names, "平日")
+    ).astype(object)
+    is_holiday = (is_weekend | is_national_holiday).astype(np.int64)
+    # 前日, 当日, 翌日の休日フラグを3bitにしてday_type_sequenceを引く
+    sequence = DAY_TYPE_SEQUENCES[
+        (is_holiday[:-2] << 2) | (is_holiday[1:-1] << 1) | is_holiday[2:]
+    ]
+
+    # shift用に作成した前後の日付を削除
+    return pd.DataFrame(
+        {
+            "jst_date": dates[1:-1].date,
+            "is_holiday": is_holiday[1:-1].astype(bool),
+            "dayofweek": dayofweek[1:-1],
+            "day_type": day_type[1:-1],
+            "day_type_sequence": sequence,
+        }
+    )
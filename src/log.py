@@ -0,0 +1,267 @@
+import atexit
+import contextvars
+import copy
+import hashlib
+import json
+import logging
+import multiprocessing.util
+import os
+import queue
+import sys
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Iterator, List, Mapping, Optional
+
+# プロセスで1回だけ設定するログの設定
+# 各moduleはget_logger(__name__)でloggerを取得し、ルートロガーに伝播させる。
+# handlerの設定はimportでは行わず、taskの開始時 (src/utils.pyのsetup_logger) にconfigureで1回だけ行う。
+# ルートロガーにはQueueHandlerだけを付け、出力 (標準エラー, ローカルのJSON Lines, Cloud Logging) は
+# QueueListenerのスレッドで行うので、呼び出し元のスレッドはI/Oを待たない。
+
+TEXT_FORMAT = (
+    "[%(asctime)s] [%(name)s] [L%(lineno)d] [%(levelname)s][%(funcName)s] %(message)s "
+)
+FORMATS = ("json", "text")
+SINKS = ("none", "local", "cloud")
+
+DEFAULT_SETTING = {
+    "level": "INFO",
+    # 標準エラーに出力する形式 (json or text)
+    "format": "text",
+    # 構造化ログの出力先 (none, local: local_dirのJSON Lines, cloud: Cloud Logging)
+    "sink": "none",
+    "local_dir": "logs",
+    "log_name": "sugi",
+    # これより長いメッセージは先頭だけ残してsha1を付ける
+    "max_message_chars": 4000,
+    # repo外のlibraryのloggerはこのlevel以上だけ出力する
+    "library_level": "WARNING",
+}
+# repoのloggerの名前の先頭 (それ以外はlibraryのloggerとして扱う)
+PROJECT_LOGGERS = ("src", "dags", "tasks", "__main__")
+
+# 全レコードに付けるcontext (プロセス単位) と、task, exp_nameなどのcontext (スレッド, with単位)
+RUN_ID_ENV = "SUGI_RUN_ID"
+_process_context: Dict[str, Any] = {
+    "run_id": os.getenv(RUN_ID_ENV) or uuid.uuid4().hex[:12]
+}
+_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default={})
+
+_lock = threading.RLock()
+_state: Dict[str, Any] = {"listener": None, "setting": None, "explicit": False}
+
+
+def get_logger(name: str) -> logging.Logger:
+    """ルートロガーに伝播するloggerを返す (handlerの設定は変更しない)"""
+    return logging.getLogger(name)
+
+
+def truncate(text: str, limit: int) -> str:
+    """limit文字より長い場合は先頭limit文字と全体の長さ, sha1にする"""
+    if limit <= 0 or len(text) <= limit:
+        return text
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+    return f"{text[:limit]}... [truncated {len(text)} chars, sha1={digest}]"
+
+
+def current_context() -> Dict[str, Any]:
+    return {**_process_context, **_context.get()}
+
+
+def set_context(**fields: Any) -> None:
+    """プロセスの全てのレコードに付けるcontextを設定する (Noneのfieldは削除する)"""
+    for key, value in fields.items():
+        if value is None:
+            _process_context.pop(key, None)
+        else:
+            _process_context[key] = value
+
+
+@contextmanager
+def log_context(**fields: Any) -> Iterator[None]:
+    """withの中で出力したレコードにfieldsを付ける (スレッドプールのworkerには引き継がれない)"""
+    token = _context.set(
+        {**_context.get(), **{k: v for k, v in fields.items() if v is not None}}
+    )
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextQueueHandler(QueueHandler):
+    """呼び出し元のスレッドでcontextを付け、メッセージを切り詰めてからqueueに入れる"""
+
+    def __init__(self, log_queue: Any, max_message_chars: int, library_level: int):
+        super().__init__(log_queue)
+        self.max_message_chars = max_message_chars
+        self.library_level = library_level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.library_level:
+            if record.name.split(".")[0] not in PROJECT_LOGGERS:
+                return False
+        return super().filter(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # 例外のtracebackは切り詰めずにmessageの後ろに付ける
+        record.msg = truncate(record.getMessage(), self.max_message_chars)
+        record.args = None
+        record.context = current_context()
+        # google-cloud-loggingのCloudLoggingHandlerはjson_fieldsをjsonPayloadに入れる
+        record.json_fields = record.context
+        return super().prepare(record)
+
+
+def _payload(record: logging.LogRecord) -> Dict[str, Any]:
+    """Cloud Loggingの構造化ログ (jsonPayload) と同じ形式のdict"""
+    payload = {
+        "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+        "severity": record.levelname,
+        "logger": record.name,
+        "message": record.getMessage(),
+        "logging.googleapis.com/sourceLocation": {
+            "file": record.pathname,
+            "line": record.lineno,
+            "function": record.funcName,
+        },
+        "thread": record.threadName,
+        "process": record.process,
+    }
+    payload.update(getattr(record, "context", {}))
+    return payload
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONにする"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        # QueueHandler.prepareで例外はmessageに含めてある
+        return json.dumps(_payload(record), ensure_ascii=False, default=str)
+
+
+class LocalSink(logging.FileHandler):
+    """Cloud Loggingの代わりに、同じ構造化ログを{local_dir}/{run_id}.jsonlに書き出す"""
+
+    def __init__(self, local_dir: str):
+        os.makedirs(local_dir, exist_ok=True)
+        super().__init__(
+            f"{local_dir}/{_process_context['run_id']}.jsonl", encoding="utf-8"
+        )
+        self.setFormatter(JsonFormatter())
+
+
+def _cloud_sink(log_name: str, gcp_project: Optional[str]) -> logging.Handler:
+    """Cloud Loggingに送るhandler (送信はgoogle-cloud-loggingのbackgroundのスレッドで行う)"""
+    from google.cloud.logging import Client
+    from google.cloud.logging.handlers import CloudLoggingHandler
+
+    return CloudLoggingHandler(Client(project=gcp_project), name=log_name)
+
+
+def _handlers(
+    setting: Mapping[str, Any], gcp_project: Optional[str]
+) -> List[logging.Handler]:
+    console = logging.StreamHandler(sys.stderr)
+    if setting["format"] == "json":
+        console.setFormatter(JsonFormatter())
+    else:
+        console.setFormatter(logging.Formatter(TEXT_FORMAT))
+    handlers = [console]
+    if setting["sink"] == "local":
+        handlers.append(LocalSink(setting["local_dir"]))
+    elif setting["sink"] == "cloud":
+        handlers.append(_cloud_sink(setting["log_name"], gcp_project))
+    return handlers
+
+
+def _start(setting: Dict[str, Any]) -> None:
+    """ルートロガーのhandlerをQueueHandler 1つにし、出力するhandlerをlistenerのスレッドで動かす"""
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        if isinstance(h, ContextQueueHandler):
+            root.removeHandler(h)
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(
+        log_queue,
+        *_handlers(setting, setting.get("gcp_project")),
+        respect_handler_level=True,
+    )
+    listener.start()
+    root.addHandler(
+        ContextQueueHandler(
+            log_queue,
+            int(setting["max_message_chars"]),
+            logging.getLevelName(setting["library_level"]),
+        )
+    )
+    root.setLevel(setting["level"])
+    _state.update(listener=listener, setting=setting)
+    # multiprocessingの子プロセスはatexitを実行せずに終了するので、終了時にqueueを出力する
+    multiprocessing.util.Finalize(None, _stop, exitpriority=0)
+
+
+def _stop() -> None:
+    """queueに残ったレコードを出力してからlistenerを止める"""
+    listener = _state["listener"]
+    if listener is not None:
+        listener.stop()
+        for h in listener.handlers:
+            h.close()
+        _state["listener"] = None
+
+
+def configure(
+    setting: Optional[Mapping[str, Any]] = None, gcp_project: Optional[str] = None
+) -> None:
+    """ログを設定する (何度呼んでもhandlerは増えない)
+
+    settingを指定しない呼び出し (taskを使わないscriptなど) はdefaultで1回だけ設定する。
+    invoke.yamlのloggingを指定した最初の呼び出しでは、defaultの設定を置き換える。
+
+    Args:
+        setting (Optional[Mapping[str, Any]], optional): invoke.yamlのloggingの設定
+        gcp_project (Optional[str], optional): Cloud Loggingに送るproject
+    """
+    with _lock:
+        if _state["explicit"] or (setting is None and _state["listener"] is not None):
+            return
+        merged = {**DEFAULT_SETTING, **dict(setting or {}), "gcp_project": gcp_project}
+        for key, choices in [("format", FORMATS), ("sink", SINKS)]:
+            if merged[key] not in choices:
+                raise ValueError(
+                    f"logging.{key} must be one of {choices}, got '{merged[key]}'"
+                )
+        _stop()
+        _start(merged)
+        _state["explicit"] = setting is not None
+
+
+def worker_state() -> Dict[str, Any]:
+    """spawnした子プロセスに渡すログの設定とプロセスのcontext (init_workerに渡す)"""
+    with _lock:
+        return {"setting": _state["setting"], "context": dict(_process_context)}
+
+
+def init_worker(state: Mapping[str, Any]) -> None:
+    """spawnした子プロセスのログを親プロセスと同じ設定, run_idにする (プロセスプールのinitializerで呼ぶ)"""
+    set_context(**state["context"])
+    setting = state["setting"]
+    if setting is not None:
+        configure(setting, setting["gcp_project"])
+
+
+def _restart_in_child() -> None:
+    # forkした子プロセスにはlistenerのスレッドが無いので、同じ設定で作り直す
+    # (Cloud Loggingのclientもforkをまたいで使えない)
+    if _state["setting"] is not None:
+        _state["listener"] = None
+        _start(_state["setting"])
+
+
+os.register_at_fork(after_in_child=_restart_in_child)
+atexit.register(_stop)
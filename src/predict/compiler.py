@@ -0,0 +1,269 @@
+from typing import Any, Dict, List, Optional
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+
+# LightGBMのmissing_type
+MISSING_NONE = 0
+MISSING_ZERO = 1
+MISSING_NAN = 2
+MISSING_TYPES = {"None": MISSING_NONE, "Zero": MISSING_ZERO, "NaN": MISSING_NAN}
+# LightGBMがzeroとみなす閾値 (kZeroThreshold, float32の1e-35をdoubleにした値)
+ZERO_THRESHOLD = float(np.float32(1e-35))
+
+
+def _float32_floor(values: np.ndarray) -> np.ndarray:
+    """float64の閾値を超えない最大のfloat32に変換する
+
+    float32の入力xに対して x <= t と x <= _float32_floor(t) が同値になるので、
+    float32で比較してもBooster.predictと同じ分岐になる。
+    """
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(over="ignore"):
+        rounded = values.astype(np.float32)
+    over = rounded.astype(np.float64) > values
+    rounded[over] = np.nextafter(rounded[over], np.float32(-np.inf))
+    return rounded
+
+
+def as_float_array(data: Any) -> np.ndarray:
+    """Booster.predictと同じ規則で特徴量を2次元の配列にする
+
+    float32, float64の配列はそのままの精度で比較されるので、同じdtypeのまま評価する
+    (float64の入力をfloat32にすると、閾値の近くの値で分岐が変わる)。それ以外のdtypeはfloat32にする。
+    """
+    if isinstance(data, pd.DataFrame):
+        data = data.values
+    data = np.asarray(data)
+    if data.dtype != np.float32 and data.dtype != np.float64:
+        data = data.astype(np.float32)
+    if data.ndim == 1:
+        data = data.reshape(1, -1)
+    return np.ascontiguousarray(data)
+
+
+class CompiledForest(object):
+    """学習済みのlgb.Boosterを平坦なNumPy配列に変換し、LightGBMを使わずに予測する
+
+    全ての木のノードを1つの配列に並べ、(行, 木)ごとの現在のノードを木の深さ分だけ
+    まとめて進めることで、バッチ全体と全ての木を同時に評価する。
+    葉は自分自身を子に持つので、深さの異なる木も同じ回数だけ進めればよい。
+
+    Args:
+        nodes (Dict[str, np.ndarray]): ノードごとの配列 (feature, threshold, left, right, ...)
+        roots (np.ndarray): 木ごとの根のノード番号
+        cat_bitsets (np.ndarray): カテゴリ分岐ごとの左に進むカテゴリのbitset (uint32)
+        max_depth (int): 木の最大の深さ
+        feature_names (List[str]): 学習時の特徴量名
+        objective (str): 目的関数 (出力の変換に使う)
+        average_output (bool): 木の出力を平均するか (random forest)
+    """
+
+    def __init__(
+        self,
+        nodes: Dict[str, np.ndarray],
+        roots: np.ndarray,
+        cat_bitsets: np.ndarray,
+        max_depth: int,
+        feature_names: List[str],
+        objective: str = "regression",
+        average_output: bool = False,
+    ):
+        self.feature = nodes["feature"]
+        self.threshold = nodes["threshold"]
+        # float32の入力と比較する閾値
+        self.threshold32 = _float32_floor(self.threshold)
+        self.left = nodes["left"]
+        self.right = nodes["right"]
+        self.default_left = nodes["default_left"]
+        self.missing_type = nodes["missing_type"]
+        self.cat_index = nodes["cat_index"]
+        self.value = nodes["value"]
+        self.roots = roots
+        self.cat_bitsets = cat_bitsets
+        self.max_depth = max_depth
+        self.feature_names = feature_names
+        # 例) "binary sigmoid:1", "regression"
+        self.objective, *options = objective.split(" ")
+        self.sigmoid = 1.0
+        for option in options:
+            if option.startswith("sigmoid:"):
+                self.sigmoid = float(option.split(":")[1])
+        self.average_output = average_output
+
+        # 分岐の度に評価しなくて済むように、ノードごとの結果を事前に計算しておく
+        is_numerical = self.cat_index < 0
+        # NaNの行が左に進むか (NaN以外のmissing_typeではNaNを0として扱い、カテゴリ分岐では常に右)
+        self.nan_left = is_numerical & np.where(
+            self.missing_type == MISSING_NONE, self.threshold >= 0, self.default_left
+        )
+        # missing_typeがZeroのノードは0をdefault_leftの方向に進める
+        self.has_zero_missing = bool((self.missing_type == MISSING_ZERO).any())
+        self.has_categorical = bool((~is_numerical).any())
+        # node * 2 + (左に進むか) で次のノードを引く
+        self.children = np.column_stack([self.right, self.left]).ravel()
+
+    @property
+    def num_trees(self) -> int:
+        return len(self.roots)
+
+    @classmethod
+    def from_booster(
+        cls, bst: lgb.Booster, num_iteration: Optional[int] = None
+    ) -> "CompiledForest":
+        """lgb.Boosterを変換する
+
+        Args:
+            bst (lgb.Booster): 学習済みモデル
+            num_iteration (Optional[int], optional): 使用するiteration数. Defaults to None (Booster.predictと同じ).
+
+        Returns:
+            CompiledForest: 変換したモデル
+        """
+        model = bst.dump_model(num_iteration=num_iteration)
+        if model.get("num_tree_per_iteration", 1) != 1:
+            raise NotImplementedError("multiclass models are not supported.")
+
+        columns: Dict[str, List[Any]] = {
+            "feature": [],
+            "threshold": [],
+            "left": [],
+            "right": [],
+            "default_left": [],
+            "missing_type": [],
+            "cat_index": [],
+            "value": [],
+        }
+        cat_sets: List[List[int]] = []
+        roots = []
+        max_depth = 0
+
+        def add_node(node: Dict[str, Any], depth: int) -> int:
+            nonlocal max_depth
+            index = len(columns["feature"])
+            for values in columns.values():
+                values.append(0)
+            columns["cat_index"][index] = -1
+            if "leaf_value" in node:
+                # 葉は自分自身を子に持つ
+                max_depth = max(max_depth, depth)
+                columns["feature"][index] = 0
+                columns["left"][index] = index
+                columns["right"][index] = index
+                columns["value"][index] = node["leaf_value"]
+                return index
+            columns["feature"][index] = node["split_feature"]
+            columns["default_left"][index] = node["default_left"]
+            columns["missing_type"][index] = MISSING_TYPES[node["missing_type"]]
+            if node["decision_type"] == "==":
+                columns["cat_index"][index] = len(cat_sets)
+                cat_sets.append([int(v) for v in str(node["threshold"]).split("||")])
+            else:
+                columns["threshold"][index] = node["threshold"]
+            columns["left"][index] = add_node(node["left_child"], depth + 1)
+            columns["right"][index] = add_node(node["right_child"], depth + 1)
+            return index
+
+        for tree in model["tree_info"]:
+            roots.append(add_node(tree["tree_structure"], 0))
+
+        nodes = {
+            "feature": np.asarray(columns["feature"], dtype=np.int32),
+            "threshold": np.asarray(columns["threshold"], dtype=np.float64),
+            "left": np.asarray(columns["left"], dtype=np.int32),
+            "right": np.asarray(columns["right"], dtype=np.int32),
+            "default_left": np.asarray(columns["default_left"], dtype=bool),
+            "missing_type": np.asarray(columns["missing_type"], dtype=np.int8),
+            "cat_index": np.asarray(columns["cat_index"], dtype=np.int32),
+            "value": np.asarray(columns["value"], dtype=np.float64),
+        }
+        # カテゴリ分岐ごとのbitset (32bit単位)
+        n_words = max([max(cats) // 32 + 1 for cats in cat_sets], default=1)
+        cat_bitsets = np.zeros((max(len(cat_sets), 1), n_words), dtype=np.uint32)
+        for i, cats in enumerate(cat_sets):
+            for cat in cats:
+                cat_bitsets[i, cat // 32] |= np.uint32(1 << (cat % 32))
+        return cls(
+            nodes,
+            np.asarray(roots, dtype=np.int32),
+            cat_bitsets,
+            max_depth,
+            feature_names=model["feature_names"],
+            objective=model.get("objective", "regression"),
+            average_output=model.get("average_output", False),
+        )
+
+    def _go_left(
+        self,
+        node: np.ndarray,
+        flat_X: np.ndarray,
+        offsets: np.ndarray,
+        threshold: np.ndarray,
+        has_nan: bool,
+    ) -> np.ndarray:
+        """LightGBMのNumericalDecision, CategoricalDecisionと同じ分岐を行う"""
+        fval = flat_X.take(offsets + self.feature.take(node))
+        go_left = fval <= threshold.take(node)
+        if self.has_zero_missing:
+            is_zero = (np.abs(fval) <= ZERO_THRESHOLD) & (
+                self.missing_type.take(node) == MISSING_ZERO
+            )
+            go_left = np.where(is_zero, self.default_left.take(node), go_left)
+        if has_nan:
+            go_left = np.where(np.isnan(fval), self.nan_left.take(node), go_left)
+
+        if self.has_categorical:
+            # マスクで取り出すより全要素で計算した方が速いので、数値の分岐も含めてbitsetを引く
+            cat_index = self.cat_index.take(node)
+            # カテゴリ分岐ではNaNと負の値は常に右に進む (NaNはnan_leftで右に進めている)
+            int_fval = np.nan_to_num(fval, nan=-1.0).astype(np.int64)
+            n_words = self.cat_bitsets.shape[1]
+            position = np.maximum(cat_index, 0) * n_words + np.clip(
+                int_fval >> 5, 0, n_words - 1
+            )
+            in_set = (self.cat_bitsets.take(position) >> (int_fval & 31)) & 1
+            is_valid = (int_fval >= 0) & (int_fval < n_words * 32)
+            go_left = np.where(cat_index >= 0, is_valid & (in_set == 1), go_left)
+        return go_left
+
+    def predict_raw(self, X: Any, batch_size: int = 4096) -> np.ndarray:
+        """木の出力の合計 (raw score) を計算する
+
+        Args:
+            X (Any): 特徴量 (学習時と同じ列順のnp.ndarray or pd.DataFrame)
+            batch_size (int, optional): 1回に評価する行数 (行数 x 木の数のノード番号を保持する). Defaults to 4096.
+
+        Returns:
+            np.ndarray: raw score
+        """
+        X = as_float_array(X)
+        threshold = self.threshold32 if X.dtype == np.float32 else self.threshold
+        scores = np.empty(len(X), dtype=np.float64)
+        for start in range(0, len(X), batch_size):
+            batch = X[start : start + batch_size]
+            n_rows = len(batch)
+            node = np.tile(self.roots, n_rows)
+            # (行, 木)ごとの行の先頭位置 (flattenしたbatchでの位置)
+            offsets = np.repeat(np.arange(n_rows) * X.shape[1], self.num_trees)
+            # LightGBMは絶対値がZERO_THRESHOLD以下の値を0として読み込む
+            flat_X = np.where(np.abs(batch) <= ZERO_THRESHOLD, 0, batch).ravel()
+            has_nan = bool(np.isnan(flat_X).any())
+            for _ in range(self.max_depth):
+                go_left = self._go_left(node, flat_X, offsets, threshold, has_nan)
+                node = self.children.take(node * 2 + go_left)
+            scores[start : start + n_rows] = (
+                self.value.take(node).reshape(n_rows, self.num_trees).sum(axis=1)
+            )
+        if self.average_output:
+            scores /= self.num_trees
+        return scores
+
+    def predict(self, X: Any, batch_size: int = 4096) -> np.ndarray:
+        """Booster.predictと同じ出力を返す"""
+        scores = self.predict_raw(X, batch_size=batch_size)
+        if self.objective in ("binary", "cross_entropy"):
+            return 1.0 / (1.0 + np.exp(-self.sigmoid * scores))
+        if self.objective in ("poisson", "gamma", "tweedie"):
+            return np.exp(scores)
+        return scores
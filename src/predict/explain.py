@@ -0,0 +1,259 @@
+import os
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from typing import Any, Iterator, List, Optional, Tuple
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.cpu import available_cpus
+from src.gcs import GCSClient
+from src.log import get_logger
+from src.predict.routed import RoutedBooster
+
+logger = get_logger(__name__)
+
+KEY_COLS = ["yj_code", "store_code", "dispensing_date"]
+# top-k以外の特徴量の寄与の合計と、モデルの期待値 (全行の寄与の合計が逆変換前の予測値になる)
+OTHERS = "(others)"
+BIAS = "(bias)"
+
+# workerのプロセスでinitializerが読み込んだモデル
+_boosters: Optional[List[lgb.Booster]] = None
+_num_threads: int = 0
+
+
+def _init_worker(model_strs: List[str], num_threads: int) -> None:
+    """モデルの文字列から各workerで1回だけBoosterを作る"""
+    global _boosters, _num_threads
+    _boosters = [lgb.Booster(model_str=model_str) for model_str in model_strs]
+    _num_threads = num_threads
+
+
+def top_k_contributions(
+    contrib: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """pred_contribの結果から、行ごとに絶対値の大きいk個の特徴量の寄与を取り出す
+
+    Args:
+        contrib (np.ndarray): (行数, 特徴量数 + 1) のpred_contrib (最後の列は期待値)
+        k (int): 残す特徴量の数
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+            (行数, k) の特徴量の番号と寄与 (絶対値の降順), 残りの特徴量の寄与の合計, 期待値
+    """
+    values = contrib[:, :-1]
+    k = min(k, values.shape[1])
+    # 全列のsortは不要なので、上位k個を選んでからk個だけ並べる
+    index = np.argpartition(-np.abs(values), k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(values, index, axis=1)
+    order = np.argsort(-np.abs(top), axis=1, kind="stable")
+    index = np.take_along_axis(index, order, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    others = values.sum(axis=1) - top.sum(axis=1)
+    return (
+        index.astype(np.int32),
+        top.astype(np.float32),
+        others.astype(np.float32),
+        contrib[:, -1].astype(np.float32),
+    )
+
+
+def _explain_chunk(
+    chunk_id: int, model_index: int, X: np.ndarray, k: int
+) -> Tuple[int, Tuple[np.ndarray, ...]]:
+    """1つのchunkのpred_contribを計算してtop-kだけを返す (workerのプロセスで実行される)"""
+    kwargs = {"num_threads": _num_threads} if _num_threads > 0 else {}
+    contrib = _boosters[model_index].predict(X, pred_contrib=True, **kwargs)
+    return chunk_id, top_k_contributions(contrib, k)
+
+
+class ContributionExplainer(object):
+    """行ごとの特徴量の寄与 (pred_contrib, TreeSHAP) をchunkに分けてプロセスプールで計算する
+
+    workerはinitializerでモデルの文字列からBoosterを1回だけ作り、chunkの特徴量だけを受け取る。
+    行数 x 特徴量数の寄与はworkerの中でtop-kに絞ってから返すので、親プロセスに載るのは
+    chunkの特徴量と行数 x (k + 2) の結果だけになる。同時に投入するchunkは2 * n_workersまで。
+    segmentごとのモデル (RoutedBooster) は行をモデルごとに並べてからchunkに分ける。
+
+    Args:
+        bst (Any): lgb.Booster or RoutedBooster
+        feature_names (List[str]): 特徴量の列 (predictorのfeature_cols)
+        top_k (int): 行ごとに残す特徴量の数
+        chunk_size (int): 1つのchunkの行数
+        n_workers (int): workerのプロセス数 (0の場合はCPU数)
+    """
+
+    def __init__(
+        self,
+        bst: Any,
+        feature_names: List[str],
+        top_k: int,
+        chunk_size: int,
+        n_workers: int,
+    ):
+        self.bst = bst
+        self.feature_names = np.array(
+            list(feature_names) + [OTHERS, BIAS], dtype=object
+        )
+        self.top_k = min(top_k, len(feature_names))
+        self.chunk_size = chunk_size
+        self.n_workers = n_workers if n_workers > 0 else available_cpus()
+
+    def _chunks(
+        self, n_rows: int, segments: Optional[np.ndarray]
+    ) -> List[Tuple[int, np.ndarray]]:
+        """(モデルの番号, 行番号) のchunk"""
+        if not isinstance(self.bst, RoutedBooster):
+            return [
+                (0, np.arange(start, min(start + self.chunk_size, n_rows)))
+                for start in range(0, n_rows, self.chunk_size)
+            ]
+        if segments is None:
+            raise ValueError("segments are required for segmented models.")
+        routes = self.bst.route(segments)
+        order = np.argsort(routes, kind="stable")
+        bounds = np.concatenate(
+            [[0], np.cumsum(np.bincount(routes, minlength=len(self.bst.boosters)))]
+        )
+        chunks = []
+        for model_index in range(len(self.bst.boosters)):
+            for start in range(
+                bounds[model_index], bounds[model_index + 1], self.chunk_size
+            ):
+                end = min(start + self.chunk_size, bounds[model_index + 1])
+                chunks.append((model_index, order[start:end]))
+        return chunks
+
+    def explain(
+        self, feature_df: pd.DataFrame, segments: Optional[np.ndarray] = None
+    ) -> Iterator[Tuple[np.ndarray, Tuple[np.ndarray, ...]]]:
+        """chunkごとに、行番号と (特徴量の番号, 寄与, 残りの寄与, 期待値) を完了した順に返す
+
+        Args:
+            feature_df (pd.DataFrame): _preprocess済みの特徴量
+            segments (Optional[np.ndarray], optional): segmentごとのモデルの場合の行のsegment
+        """
+        boosters = (
+            self.bst.boosters if isinstance(self.bst, RoutedBooster) else [self.bst]
+        )
+        chunks = self._chunks(len(feature_df), segments)
+        num_threads = max(1, available_cpus() // self.n_workers)
+        n_workers = max(1, min(self.n_workers, len(chunks)))
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            # LightGBM (OpenMP) を使った後のforkは子プロセスが止まることがあるのでspawnにする
+            mp_context=get_context("spawn"),
+            initializer=_init_worker,
+            initargs=([bst.model_to_string() for bst in boosters], num_threads),
+        ) as executor:
+            pending = set()
+            next_chunk = 0
+            while next_chunk < len(chunks) or pending:
+                while next_chunk < len(chunks) and len(pending) < 2 * n_workers:
+                    model_index, rows = chunks[next_chunk]
+                    # 全行の配列は作らず、投入するchunkの分だけ変換する
+                    X = feature_df.iloc[rows].to_numpy(dtype=np.float64)
+                    pending.add(
+                        executor.submit(
+                            _explain_chunk, next_chunk, model_index, X, self.top_k
+                        )
+                    )
+                    next_chunk += 1
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk_id, result = future.result()
+                    yield chunks[chunk_id][1], result
+
+    def to_long(
+        self, keys_df: pd.DataFrame, rows: np.ndarray, result: Tuple[np.ndarray, ...]
+    ) -> pd.DataFrame:
+        """1つのchunkの結果をキーごとにk + 2行の縦持ちにする
+
+        rankは寄与の絶対値の順位 (1始まり)。othersはk + 1, biasは0。
+        """
+        index, top, others, bias = result
+        n_rows, k = index.shape
+        n_features = len(self.feature_names) - 2
+        feature_index = np.concatenate(
+            [
+                index,
+                np.full((n_rows, 1), n_features),
+                np.full((n_rows, 1), n_features + 1),
+            ],
+            axis=1,
+        )
+        contribution = np.concatenate([top, others[:, None], bias[:, None]], axis=1)
+        rank = np.tile(np.r_[np.arange(1, k + 1), k + 1, 0].astype(np.int16), n_rows)
+        long_df = keys_df.iloc[np.repeat(rows, k + 2)].reset_index(drop=True)
+        long_df["rank"] = rank
+        long_df["feature"] = pd.Categorical.from_codes(
+            feature_index.ravel(), categories=self.feature_names
+        )
+        long_df["contribution"] = contribution.ravel()
+        return long_df
+
+    def write_parquet(
+        self,
+        keys_df: pd.DataFrame,
+        feature_df: pd.DataFrame,
+        output_dir: str,
+        segments: Optional[np.ndarray] = None,
+    ) -> int:
+        """寄与をdispensing_dateでpartitionしたParquet (output_dir/dispensing_date=YYYY-MM-DD/part-*.parquet) に書き出す
+
+        chunkごとに書き出すので、全行の結果をメモリに載せない。
+
+        Args:
+            keys_df (pd.DataFrame): エンコード前のyj_code, store_code, dispensing_date (feature_dfと同じ行の順)
+            feature_df (pd.DataFrame): _preprocess済みの特徴量
+            output_dir (str): 書き出すローカルのディレクトリ
+            segments (Optional[np.ndarray], optional): segmentごとのモデルの場合の行のsegment
+
+        Returns:
+            int: 書き出した行数
+        """
+        keys_df = keys_df[KEY_COLS].reset_index(drop=True)
+        keys_df["dispensing_date"] = pd.to_datetime(keys_df["dispensing_date"]).dt.date
+        start = time.perf_counter()
+        n_written = 0
+        for i, (rows, result) in enumerate(self.explain(feature_df, segments)):
+            long_df = self.to_long(keys_df, rows, result)
+            for date, date_df in long_df.groupby("dispensing_date", sort=False):
+                partition_dir = f"{output_dir}/dispensing_date={date:%Y-%m-%d}"
+                os.makedirs(partition_dir, exist_ok=True)
+                pq.write_table(
+                    pa.Table.from_pandas(
+                        date_df.drop(columns=["dispensing_date"]), preserve_index=False
+                    ),
+                    f"{partition_dir}/part-{i:05d}.parquet",
+                )
+            n_written += len(long_df)
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"contributions of {len(feature_df)} rows ({n_written} long rows) were written "
+            f"in {elapsed:.1f} sec ({len(feature_df) / max(elapsed, 1e-9):.0f} rows/sec)."
+        )
+        return n_written
+
+
+def upload_contributions(
+    explainer: ContributionExplainer,
+    gcs: GCSClient,
+    bucket: str,
+    destination_dir: str,
+    keys_df: pd.DataFrame,
+    feature_df: pd.DataFrame,
+    segments: Optional[np.ndarray] = None,
+) -> None:
+    """寄与のParquetを一時ディレクトリに書き出してGCSのdestination_dirにアップロードする"""
+    with tempfile.TemporaryDirectory() as tmp_d:
+        explainer.write_parquet(keys_df, feature_df, tmp_d, segments=segments)
+        gcs.upload_directory(bucket, tmp_d, destination_dir)
+    logger.info(f"contributions were uploaded to gs://{bucket}/{destination_dir}")
@@ -0,0 +1,135 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import pandas as pd
+from omegaconf import DictConfig
+
+from src.bq import BQClient
+from src.cpu import available_cpus
+from src.gcs import GCSClient
+from src.log import get_logger, log_context
+from src.predict.predictor import LGBMPredictor
+
+logger = get_logger(__name__)
+
+STEPS = [
+    "load_model",
+    "load_data",
+    "preprocess",
+    "predict",
+    "explain",
+    "upload",
+    "insert",
+]
+
+
+class MultiModelPredictor(object):
+    """複数の実験のモデルを1つのプロセスに読み込み、スレッドプールで並行に予測する
+
+    実験ごとのcomponentで毎回行っていたコンテナの起動, import, 設定の読み込みを1回にし、
+    GCS, BQのclientとテーブルのキャッシュを全実験で共有する。
+    BQからの読み込みとGCS, BQへの書き込みはI/O待ち、LightGBMの予測はGILを解放するので、スレッドで並行に実行できる。
+    予測結果はメモリ上のDataFrameからGCSのCSVとBQのパーティションに1回で書き込む (insert-predictionのcomponentは不要)。
+
+    Args:
+        config (DictConfig): predict.predictorの設定
+        exp_names (List[str]): 予測する実験名
+        n_workers (int): 同時に予測する実験数
+        gcs (Optional[GCSClient], optional): 共有するGCSのclient. Defaults to None.
+        bq (Optional[BQClient], optional): 共有するBQのclient. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        config: DictConfig,
+        exp_names: List[str],
+        n_workers: int,
+        gcs: Optional[GCSClient] = None,
+        bq: Optional[BQClient] = None,
+    ):
+        self.config = config
+        self.exp_names = list(exp_names)
+        self.n_workers = max(1, min(n_workers, len(self.exp_names)))
+        self.gcs = gcs or GCSClient(config.gcp_project)
+        self.bq = bq or BQClient(config.gcp_project)
+        # 並行に予測するモデルでコアを等分する
+        self.num_threads = max(1, available_cpus() // self.n_workers)
+
+    @staticmethod
+    def _timed(timings: Dict[str, Any], step: str, func: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        result = func()
+        timings[f"{step}_sec"] = time.perf_counter() - start
+        return result
+
+    def _run_one(self, exp_name: str, insert: bool) -> Dict[str, Any]:
+        """1つの実験のモデルの読み込みから予測結果の書き込みまでを行う"""
+        timings: Dict[str, Any] = {"exp_name": exp_name}
+        start = time.perf_counter()
+        with log_context(exp_name=exp_name):
+            self._run_steps(exp_name, insert, timings)
+        timings["total_sec"] = time.perf_counter() - start
+        logger.info(f"[done] {exp_name} prediction ({timings['total_sec']:.1f} sec).")
+        return timings
+
+    def _run_steps(self, exp_name: str, insert: bool, timings: Dict[str, Any]) -> None:
+        try:
+            predictor = self._timed(
+                timings,
+                "load_model",
+                lambda: LGBMPredictor(
+                    self.config, exp_name=exp_name, gcs=self.gcs, bq=self.bq
+                ),
+            )
+            predictor.num_threads = self.num_threads
+            df = self._timed(timings, "load_data", predictor._load_data)
+            # encodeしてしまうと, yj_code, store_codeが復元できなくなる場合があるためcopyする
+            segments, feature_df = self._timed(
+                timings,
+                "preprocess",
+                lambda: (predictor.segments(df), predictor._preprocess(df.copy())),
+            )
+            df[predictor.setting.lgbm.pred_col] = self._timed(
+                timings,
+                "predict",
+                lambda: predictor.predict_features(feature_df, segments),
+            )
+            if predictor.setting.explain.enabled:
+                self._timed(
+                    timings,
+                    "explain",
+                    lambda: predictor.upload_contributions(df, feature_df, segments),
+                )
+            del feature_df
+            self._timed(timings, "upload", lambda: predictor.upload_prediction(df))
+            if insert:
+                self._timed(timings, "insert", lambda: predictor.insert_prediction(df))
+            timings.update(status="ok", n_rows=len(df))
+        except Exception as e:
+            # 他の実験の予測は続ける
+            logger.exception(f"[failed] {exp_name} prediction.")
+            timings.update(status="failed", error=repr(e))
+
+    def run(self, insert: bool = True) -> pd.DataFrame:
+        """全実験を予測し、実験ごとのstepの時間をまとめた表を返す
+
+        Args:
+            insert (bool, optional): 予測結果をBQのパーティションにロードするか. Defaults to True.
+
+        Returns:
+            pd.DataFrame: exp_name, status, n_rows, stepごとの時間(秒), total_sec
+        """
+        logger.info(
+            f"predict {self.exp_names} with {self.n_workers} workers "
+            f"({self.num_threads} threads per model)."
+        )
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            rows = list(
+                executor.map(
+                    lambda exp_name: self._run_one(exp_name, insert), self.exp_names
+                )
+            )
+        columns = ["exp_name", "status", "n_rows"] + [f"{step}_sec" for step in STEPS]
+        columns += ["total_sec", "error"]
+        return pd.DataFrame(rows).reindex(columns=columns)
@@ -1,8 +1,7 @@
-import logging
 import pickle
 import tempfile
 import uuid
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 
 import lightgbm as lgb
 import numpy as np
@@ -12,33 +11,120 @@ from omegaconf import DictConfig
 from sklearn.preprocessing import LabelEncoder
 
 from src.bq import BQClient
+from src.cache import table_cache
+from src.config import PredictorSetting
 from src.gcs import GCSClient
+from src.log import get_logger
+from src.predict.compiler import CompiledForest
+from src.predict.explain import ContributionExplainer, upload_contributions
+from src.predict.routed import RoutedBooster
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(
-    logging.Formatter(
-        "[%(asctime)s] [%(name)s] [L%(lineno)d] [%(levelname)s][%(funcName)s] %(message)s "
-    )
-)
-logger.addHandler(handler)
+logger = get_logger(__name__)
+
+# prediction_model_result_{exp_name}のテーブル設定 (BQClient.create_tableのsetting)
+PREDICTION_TABLE_SETTING = {
+    "schema": {
+        "fields": [
+            {
+                "name": "yj_code",
+                "type": "STRING",
+                "mode": "REQUIRED",
+                "description": "YJコード",
+            },
+            {
+                "name": "store_code",
+                "type": "STRING",
+                "mode": "REQUIRED",
+                "description": "店舗コード",
+            },
+            {
+                "name": "dispensing_date",
+                "type": "DATE",
+                "mode": "REQUIRED",
+                "description": "処方日",
+            },
+            {
+                "name": "predicted_total_dose",
+                "type": "FLOAT64",
+                "mode": "NULLABLE",
+                "description": "yj_code, store_code単位の(当日含め)未来の予測処方量",
+            },
+        ]
+    },
+    "timePartitioning": {"field": "dispensing_date"},
+}
+
+
+def inverse_log1p(df: pd.DataFrame, pred: np.ndarray) -> np.ndarray:
+    """log(1 + x)で学習したモデルの予測値を戻す (exp042)"""
+    return np.exp(pred) - 1
+
+
+def inverse_min_max(df: pd.DataFrame, pred: np.ndarray) -> np.ndarray:
+    """min-max scalingした値で学習したモデルの予測値を戻す (exp046)"""
+    min_value = df["min_total_dose_by_yj_store"].to_numpy(dtype=np.float64)
+    max_value = df["max_total_dose_by_yj_store"].to_numpy(dtype=np.float64)
+    return pred * (max_value - min_value) + min_value
+
+
+def inverse_diff(df: pd.DataFrame, pred: np.ndarray) -> np.ndarray:
+    """lagとの差分で学習したモデルの予測値にlagを足して戻す (exp047)"""
+    return pred + df["total_dose_by_yj_store"].to_numpy(dtype=np.float64)
+
+
+INVERSE_TRANSFORMS = {
+    "log1p": inverse_log1p,
+    "min_max": inverse_min_max,
+    "diff": inverse_diff,
+}
 
 
 class LGBMPredictor(object):
     def __init__(
-        self, config: DictConfig, exp_name: str,
+        self,
+        config: DictConfig,
+        exp_name: str,
+        model: Optional[Tuple[Dict[str, LabelEncoder], lgb.Booster]] = None,
+        gcs: Optional[GCSClient] = None,
+        bq: Optional[BQClient] = None,
     ):
         self.config = config
         self.exp_name = exp_name
-        self.feature_cols = self.config.lgbm.numerical_cols + self.config.lgbm.cat_cols
-        # GCSから取得した訓練済みモデル
-        self.le_dict, self.bst = self._load_model()
+        # ループの中で参照するパス, カラムは開始時に1回だけ解決して使う
+        self.setting = PredictorSetting.from_config(config)
+        self.feature_cols = list(self.setting.lgbm.feature_cols)
+        # predict-allでは複数の実験のpredictorでclientを共有する (指定されない場合は使う時に作成する)
+        self._gcs = gcs
+        self._bq = bq
+        # LightGBMの予測に使うスレッド数 (0はLightGBMのdefault)。複数モデルを並行に予測する場合に分ける
+        self.num_threads = 0
+        # GCSから取得した訓練済みモデル (ベンチマークなどではmodelで直接渡す)
+        self.le_dict, self.bst = model if model is not None else self._load_model()
+        # train.train --segmentedのモデルは行のsegmentごとのモデルで予測する
+        self.routed = isinstance(self.bst, RoutedBooster)
+        if self.routed and self.setting.compiled:
+            raise ValueError("compiled prediction does not support segmented models.")
+        # Trueの場合はNumPy配列に変換したモデルで予測する (LightGBMを使わない)
+        self.compiled = (
+            CompiledForest.from_booster(self.bst) if self.setting.compiled else None
+        )
         # 大容量のクエリ結果を一時格納するテーブル
         self.dest_table_id = (
             f"tmp_prediction_dataset_{self.exp_name}_{str(uuid.uuid4())[0:8]}"
         )
 
+    @property
+    def gcs(self) -> GCSClient:
+        if self._gcs is None:
+            self._gcs = GCSClient(self.setting.gcp_project)
+        return self._gcs
+
+    @property
+    def bq(self) -> BQClient:
+        if self._bq is None:
+            self._bq = BQClient(self.setting.gcp_project)
+        return self._bq
+
     def _load_model(self) -> Tuple[Dict[str, LabelEncoder], lgb.Booster]:
         """
         現行のデプロイモデルをdownloadする
@@ -47,11 +133,10 @@ class LGBMPredictor(object):
             Tuple[Dict[str, LabelEncoder], lgb.Booster]: デプロイ済みモデルとエンコーダ
         """
         with tempfile.TemporaryDirectory() as tmp_d:
-            gcs = GCSClient(self.config.gcp_project)
             local_path = f"{tmp_d}/{self.exp_name}.pkl"
-            gcs.download_blob(
-                self.config.train_bucket,
-                f"{self.config.latest_model_path}/model_{self.exp_name}.pkl",
+            self.gcs.download_blob(
+                self.setting.train_bucket,
+                f"{self.setting.latest_model_path}/model_{self.exp_name}.pkl",
                 local_path,
             )
             with open(local_path, "rb") as fin:
@@ -60,30 +145,42 @@ class LGBMPredictor(object):
 
     def _load_data(self) -> pd.DataFrame:
         query = f"""
-        SELECT * FROM {self.config.dataset}.predict_dataset_{self.exp_name}
+        SELECT * FROM {self.setting.dataset}.predict_dataset_{self.exp_name}
         """
-        if self.config.debug:
+        if self.setting.debug:
             # デバッグ用にdownsamplingする
             query += f"""
                 WHERE yj_code in (
                     SELECT DISTINCT yj_code
-                    FROM {self.config.dataset}.predict_dataset_{self.exp_name}
+                    FROM {self.setting.dataset}.predict_dataset_{self.exp_name}
                     ORDER BY 1
                     LIMIT 10
                 )
                 """
+        cache = table_cache(self.config.cache, self.setting.gcp_project, bq=self.bq)
+        if cache is not None:
+            return cache.read(
+                self.setting.gcp_project,
+                self.setting.dataset,
+                f"predict_dataset_{self.exp_name}",
+                query,
+                lambda: self._read_gbq(query),
+            )
+        return self._read_gbq(query)
 
+    def _read_gbq(self, query: str) -> pd.DataFrame:
+        """大容量のクエリ結果を一時テーブル経由で読み込む"""
         df = pd.read_gbq(
             query,
-            project_id=self.config.gcp_project,
+            project_id=self.setting.gcp_project,
             use_bqstorage_api=True,
             progress_bar_type="tqdm",
             configuration={
                 "query": {
                     "allowLargeResults": True,
                     "destinationTable": {
-                        "projectId": self.config.gcp_project,
-                        "datasetId": self.config.dataset,
+                        "projectId": self.setting.gcp_project,
+                        "datasetId": self.setting.dataset,
                         "tableId": self.dest_table_id,
                     },
                 },
@@ -92,14 +189,13 @@ class LGBMPredictor(object):
         df_bytes = df.memory_usage(index=True).sum()
         logger.info(f"Data size: {df_bytes / 1024 / 1024} MB")
         logger.info(f"DataFrame Shape: {df.shape}")
-        bq = BQClient(self.config.gcp_project)
-        bq.delete_table(self.config.dataset, self.dest_table_id)
+        self.bq.delete_table(self.setting.dataset, self.dest_table_id)
 
         return df
 
     def _preprocess(self, df: pd.DataFrame) -> pd.DataFrame:
         # 共通して登場しないカテゴリは削除
-        for col in self.config.lgbm.cat_cols:
+        for col in self.setting.lgbm.cat_cols:
             cats = self.le_dict[col].classes_
             if pd.api.types.is_numeric_dtype(df[col]):
                 df.loc[df.query(f"{col} not in @cats").index, col] = -20000
@@ -115,14 +211,114 @@ class LGBMPredictor(object):
         Args:
             df (pd.DataFrame): 予測結果を含めたDataFrame
         """
-        df[self.config.lgbm.upload_cols].to_csv(
-            f"gs://{self.config.bucket}/{self.config.prediction_path}/predict_result_{self.exp_name}.csv",
+        df[list(self.setting.lgbm.upload_cols)].to_csv(
+            f"gs://{self.setting.bucket}/{self.setting.prediction_path}/predict_result_{self.exp_name}.csv",
             index=False,
         )
 
+    def inverse_transform(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        予測値を処方量のスケールに戻す。
+        insert_prediction_result.sqlと同じ変換を行い、負の値は0にする (欠損はそのまま)。
+
+        Args:
+            df (pd.DataFrame): 予測結果を含めたDataFrame
+
+        Returns:
+            np.ndarray: 処方量のスケールに戻した予測値
+        """
+        method = self.setting.inverse_transform(self.exp_name)
+        pred = df[self.setting.lgbm.pred_col].to_numpy(dtype=np.float64)
+        return np.maximum(INVERSE_TRANSFORMS[method](df, pred), 0)
+
+    def insert_prediction(self, df: pd.DataFrame) -> None:
+        """
+        逆変換した予測結果をprediction_model_result_{exp_name}の
+        該当するdispensing_dateのパーティションに上書きでロードする
+
+        Args:
+            df (pd.DataFrame): 予測結果を含めたDataFrame
+        """
+        result_df = pd.DataFrame(
+            {
+                "yj_code": df["yj_code"],
+                "store_code": df["store_code"],
+                "dispensing_date": pd.to_datetime(df["dispensing_date"]).dt.date,
+                "predicted_total_dose": self.inverse_transform(df),
+            }
+        )
+        self.bq.load_partitions(
+            result_df,
+            self.setting.result_dataset,
+            f"prediction_model_result_{self.exp_name}",
+            PREDICTION_TABLE_SETTING,
+            description=f"{self.exp_name}のモデルによる予測結果を格納したテーブル",
+        )
+
+    def segments(self, df: pd.DataFrame) -> Optional[np.ndarray]:
+        """segmentごとのモデルの場合に、エンコード前のデータから行のsegmentを求める"""
+        if not self.routed:
+            return None
+        return self.bst.segment_key.assign(df, self.setting.gcp_project)
+
+    def predict_features(
+        self, feature_df: pd.DataFrame, segments: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """_preprocess済みの特徴量から予測値を計算する
+
+        Args:
+            feature_df (pd.DataFrame): _preprocess済みの特徴量
+            segments (Optional[np.ndarray], optional): segmentごとのモデルの場合の行のsegment. Defaults to None.
+        """
+        if self.compiled is not None:
+            # lightgbmと同じく、DataFrameの値をそのままのdtypeで評価する
+            return self.compiled.predict(feature_df)
+        kwargs = {"num_threads": self.num_threads} if self.num_threads > 0 else {}
+        if self.routed:
+            if segments is None:
+                raise ValueError("segments are required for segmented models.")
+            return self.bst.predict(feature_df, segments, **kwargs)
+        return self.bst.predict(feature_df, **kwargs)
+
+    def upload_contributions(
+        self,
+        df: pd.DataFrame,
+        feature_df: pd.DataFrame,
+        segments: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        行ごとの特徴量の寄与のtop-kを予測結果と同じ場所の
+        contributions_{exp_name}/dispensing_date=*/にParquetでアップロードする
+
+        Args:
+            df (pd.DataFrame): エンコード前のyj_code, store_code, dispensing_dateを含むDataFrame
+            feature_df (pd.DataFrame): _preprocess済みの特徴量
+            segments (Optional[np.ndarray], optional): segmentごとのモデルの場合の行のsegment
+        """
+        setting = self.setting.explain
+        explainer = ContributionExplainer(
+            self.bst,
+            self.feature_cols,
+            top_k=setting.top_k,
+            chunk_size=setting.chunk_size,
+            n_workers=setting.n_workers,
+        )
+        upload_contributions(
+            explainer,
+            self.gcs,
+            self.setting.bucket,
+            f"{self.setting.prediction_path}/contributions_{self.exp_name}",
+            df,
+            feature_df,
+            segments=segments,
+        )
+
     def predict(self) -> pd.DataFrame:
         df = self._load_data()
+        segments = self.segments(df)
         # encodeしてしまうと, yj_code, store_codeが復元できなくなる場合があるためcopyする
         feature_df = self._preprocess(df.copy())
-        df[self.config.lgbm.pred_col] = self.bst.predict(feature_df)
+        df[self.setting.lgbm.pred_col] = self.predict_features(feature_df, segments)
+        if self.setting.explain.enabled:
+            self.upload_contributions(df, feature_df, segments)
         return df
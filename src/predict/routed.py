@@ -0,0 +1,185 @@
+from typing import Any, Dict, List, Optional
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+
+# segmentごとのモデルの学習, 評価で使う、行のsegmentを格納するカラム
+SEGMENT_COL = "model_segment"
+
+SEGMENT_KINDS = ("abc", "column")
+
+
+class SegmentKey(object):
+    """行をsegmentに振り分けるkey
+
+    abc: 行の (dispensing_date, yj_code, store_code) のabc_col (date_store_yj_abc.sqlのABCフラグ)。
+        prediction_result.sqlと同様に前日のフラグを使う (学習と予測で同じ日付の基準で振り分け、未来のフラグを使わない)
+    column: columnの値の先頭prefix_length文字 (yj_codeの先頭4文字は薬効分類)
+
+    学習時と予測時で同じ振り分けをするため、RoutedBoosterと一緒にpickleされる。
+
+    Args:
+        kind (str): abc or column
+        column (str, optional): kindがcolumnの場合に使うカラム. Defaults to "yj_code".
+        prefix_length (int, optional): 0の場合は値をそのまま使う. Defaults to 0.
+        abc_table (Optional[str], optional): kindがabcの場合に読み込むテーブル. Defaults to None.
+        abc_col (str, optional): kindがabcの場合に使うABCフラグのカラム. Defaults to "model_abc_flag".
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        column: str = "yj_code",
+        prefix_length: int = 0,
+        abc_table: Optional[str] = None,
+        abc_col: str = "model_abc_flag",
+    ):
+        if kind not in SEGMENT_KINDS:
+            raise ValueError(
+                f"segment key must be one of {SEGMENT_KINDS}, got '{kind}'"
+            )
+        if kind == "abc" and not abc_table:
+            raise ValueError("abc_table is required for the abc segment key")
+        self.kind = kind
+        self.column = column
+        self.prefix_length = prefix_length
+        self.abc_table = abc_table
+        self.abc_col = abc_col
+
+    @classmethod
+    def from_config(cls, config: Any) -> "SegmentKey":
+        """train.trainer.segmentedの設定から作成する"""
+        return cls(
+            kind=str(config.key),
+            column=str(config.column),
+            prefix_length=int(config.prefix_length),
+            abc_table=config.get("abc_table"),
+            abc_col=str(config.abc_col),
+        )
+
+    def _load_abc_flags(
+        self, gcp_project: str, min_date: pd.Timestamp, max_date: pd.Timestamp
+    ) -> pd.Series:
+        """min_dateからmax_dateまでの (dispensing_date, yj_code, store_code) ごとのABCフラグ"""
+        # prediction_result.sqlと同様に1日ずらして結合する
+        query = f"""
+        SELECT
+          DATE_ADD(dispensing_date, INTERVAL 1 DAY) AS dispensing_date,
+          yj_code,
+          store_code,
+          {self.abc_col} AS segment,
+        FROM `{self.abc_table}`
+        WHERE
+          DATE_ADD(dispensing_date, INTERVAL 1 DAY)
+            BETWEEN "{min_date:%Y-%m-%d}" AND "{max_date:%Y-%m-%d}"
+        """
+        abc_df = pd.read_gbq(query, project_id=gcp_project, use_bqstorage_api=True)
+        abc_df["dispensing_date"] = pd.to_datetime(abc_df["dispensing_date"])
+        abc_df = abc_df.drop_duplicates(["dispensing_date", "yj_code", "store_code"])
+        return abc_df.set_index(["dispensing_date", "yj_code", "store_code"])["segment"]
+
+    def assign(self, df: pd.DataFrame, gcp_project: str) -> np.ndarray:
+        """エンコード前の行のsegment (ABCフラグが無い行はNone)
+
+        Args:
+            df (pd.DataFrame): yj_code, store_code, dispensing_dateを含む学習, 予測データ
+            gcp_project (str): abc_tableを読み込むproject
+
+        Returns:
+            np.ndarray: 行ごとのsegment (dtype=object)
+        """
+        if self.kind == "column":
+            values = df[self.column].astype(str)
+            if self.prefix_length > 0:
+                values = values.str[: self.prefix_length]
+            return values.to_numpy(dtype=object)
+        dates = pd.to_datetime(df["dispensing_date"])
+        flags = self._load_abc_flags(gcp_project, dates.min(), dates.max())
+        keys = pd.MultiIndex.from_arrays([dates, df["yj_code"], df["store_code"]])
+        segments = flags.reindex(keys).to_numpy(dtype=object)
+        return np.where(pd.isna(segments), None, segments)
+
+
+class RoutedBooster(object):
+    """segmentごとに学習したlgb.Boosterをまとめ、行のsegmentのモデルで予測するモデル
+
+    学習に無いsegmentとsegmentが無い行はdefaultのモデルで予測する。
+    予測では行をsegment順に1回だけ並べ替え、連続したブロックをそれぞれのモデルに渡す。
+
+    Args:
+        boosters (Dict[str, lgb.Booster]): segmentごとの学習済みモデル
+        segment_key (SegmentKey): 行をsegmentに振り分けるkey
+        default (str): 振り分け先が無い行を予測するsegment
+    """
+
+    def __init__(
+        self, boosters: Dict[str, lgb.Booster], segment_key: SegmentKey, default: str
+    ):
+        if default not in boosters:
+            raise ValueError(f"default segment '{default}' has no model")
+        self.segments: List[str] = sorted(boosters)
+        self.boosters = [boosters[segment] for segment in self.segments]
+        self.segment_key = segment_key
+        self.default = default
+
+    def booster(self, segment: str) -> lgb.Booster:
+        return self.boosters[self.segments.index(segment)]
+
+    def feature_name(self) -> List[str]:
+        return self.boosters[0].feature_name()
+
+    def feature_importance(self, importance_type: str = "split") -> np.ndarray:
+        """全segmentのモデルの特徴量重要度の合計"""
+        return np.sum(
+            [
+                bst.feature_importance(importance_type=importance_type)
+                for bst in self.boosters
+            ],
+            axis=0,
+        )
+
+    def route(self, segments: np.ndarray) -> np.ndarray:
+        """行のsegmentをモデルの番号に変換する"""
+        codes, uniques = pd.factorize(np.asarray(segments, dtype=object))
+        default = self.segments.index(self.default)
+        index = {segment: i for i, segment in enumerate(self.segments)}
+        lookup = np.array(
+            [index.get(segment, default) for segment in uniques] + [default],
+            dtype=np.int64,
+        )
+        # 欠損はfactorizeで-1になるので、末尾のdefaultを参照する
+        return lookup[codes]
+
+    def predict(self, data: Any, segments: np.ndarray, **kwargs: Any) -> np.ndarray:
+        """行のsegmentのモデルで予測する
+
+        Args:
+            data (Any): 特徴量 (pd.DataFrame or np.ndarray)
+            segments (np.ndarray): 行のsegment (SegmentKey.assignの結果)
+            **kwargs: lgb.Booster.predictに渡す引数 (num_threadsなど)
+
+        Returns:
+            np.ndarray: 予測値 (dataの行の順)
+        """
+        routes = self.route(segments)
+        order = np.argsort(routes, kind="stable")
+        bounds = np.concatenate(
+            [[0], np.cumsum(np.bincount(routes, minlength=len(self.boosters)))]
+        )
+        if isinstance(data, pd.DataFrame):
+            data = data.iloc[order]
+        else:
+            data = np.asarray(data)[order]
+        preds = np.empty(len(routes), dtype=np.float64)
+        for i, bst in enumerate(self.boosters):
+            start, end = bounds[i], bounds[i + 1]
+            if start == end:
+                continue
+            block = (
+                data.iloc[start:end]
+                if isinstance(data, pd.DataFrame)
+                else data[start:end]
+            )
+            preds[order[start:end]] = bst.predict(block, **kwargs)
+        return preds
@@ -0,0 +1,399 @@
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib import request as urllib_request
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from omegaconf import DictConfig
+
+from src.gcs import GCSClient
+from src.log import get_logger
+from src.predict.predictor import LGBMPredictor
+
+logger = get_logger(__name__)
+
+
+def snapshot_path(snapshot_dir: str, exp_name: str) -> str:
+    return os.path.join(snapshot_dir, exp_name, "features.parquet")
+
+
+def write_snapshot(config: DictConfig, exp_name: str, path: str) -> None:
+    """predict_dataset_{exp_name}から(yj_code, store_code)ごとの最新の行をParquetに保存する"""
+    query = f"""
+    SELECT *
+    FROM {config.dataset}.predict_dataset_{exp_name}
+    WHERE TRUE
+    QUALIFY ROW_NUMBER() OVER (
+      PARTITION BY yj_code, store_code ORDER BY dispensing_date DESC
+    ) = 1
+    """
+    df = pd.read_gbq(query, project_id=config.gcp_project, use_bqstorage_api=True)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 読み込み中のサーバーが書きかけのファイルを読まないように、書き終わってから置き換える
+    tmp_path = f"{path}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    logger.info(f"snapshot of {len(df)} keys was saved to {path}")
+
+
+class ModelBundle(object):
+    """モデルと、そのエンコーダで変換済みの特徴量のスナップショットの組
+
+    モデルを更新する際は新しいModelBundleを作って差し替えるので、予測中に
+    エンコーダと特徴量の対応がずれることはない。
+
+    Args:
+        predictor (LGBMPredictor): GCSのlatest/modelを読み込んだpredictor
+        snapshot_df (pd.DataFrame): (yj_code, store_code)ごとの最新の特徴量
+        generation (Optional[int]): 読み込んだモデルのblobのgeneration
+    """
+
+    def __init__(
+        self,
+        predictor: LGBMPredictor,
+        snapshot_df: pd.DataFrame,
+        generation: Optional[int],
+    ):
+        self.predictor = predictor
+        self.generation = generation
+        self.snapshot_df = snapshot_df.reset_index(drop=True)
+        # 予測の度にエンコードしなくて済むように、float32の配列にしておく
+        # segmentごとのモデルの場合の行のsegment
+        self.segments = predictor.segments(self.snapshot_df)
+        self.features = predictor._preprocess(self.snapshot_df.copy()).to_numpy(
+            dtype=np.float32
+        )
+        self.positions = {
+            key: i
+            for i, key in enumerate(
+                zip(self.snapshot_df["yj_code"], self.snapshot_df["store_code"])
+            )
+        }
+
+    def predict(self, positions: np.ndarray) -> np.ndarray:
+        """スナップショットの行番号の予測値 (処方量のスケール) を返す"""
+        predictor = self.predictor
+        feature_df = pd.DataFrame(
+            self.features[positions], columns=predictor.feature_cols
+        )
+        df = self.snapshot_df.iloc[positions].copy()
+        segments = self.segments[positions] if self.segments is not None else None
+        df[predictor.setting.lgbm.pred_col] = predictor.predict_features(
+            feature_df, segments
+        )
+        return predictor.inverse_transform(df)
+
+
+class MicroBatcher(object):
+    """同時に来たリクエストをまとめて1回の予測で処理する
+
+    最初のリクエストからmax_wait_ms待つか、max_batch_size行集まった時点で予測する。
+    行番号はそれを引いたModelBundleと一緒に受け取り、同じModelBundleのリクエストごとにまとめて予測する
+    (まとめている間にモデルやスナップショットが更新されても、行番号が別のスナップショットの行を指さない)。
+
+    Args:
+        predict_fn (Callable[[ModelBundle, np.ndarray], np.ndarray]): ModelBundleと行番号を受け取り予測値を返す関数
+        max_batch_size (int): 1回の予測の最大行数
+        max_wait_ms (float): リクエストをまとめるために待つ最大時間
+    """
+
+    def __init__(
+        self,
+        predict_fn: Callable[["ModelBundle", np.ndarray], np.ndarray],
+        max_batch_size: int,
+        max_wait_ms: float,
+    ):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "queue.Queue[Tuple[ModelBundle, np.ndarray, Future]]" = (
+            queue.Queue()
+        )
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, bundle: "ModelBundle", positions: np.ndarray) -> Future:
+        future: Future = Future()
+        self._queue.put((bundle, positions, future))
+        return future
+
+    def _collect(self) -> List[Tuple["ModelBundle", np.ndarray, Future]]:
+        items = [self._queue.get()]
+        n_rows = len(items[0][1])
+        deadline = time.perf_counter() + self.max_wait
+        while n_rows < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            items.append(item)
+            n_rows += len(item[1])
+        return items
+
+    def _predict_group(
+        self, bundle: "ModelBundle", items: List[Tuple[np.ndarray, Future]]
+    ) -> None:
+        try:
+            preds = self.predict_fn(
+                bundle, np.concatenate([positions for positions, _ in items])
+            )
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+        offset = 0
+        for positions, future in items:
+            future.set_result(preds[offset : offset + len(positions)])
+            offset += len(positions)
+
+    def _loop(self) -> None:
+        while True:
+            groups: Dict[int, Tuple[ModelBundle, List[Tuple[np.ndarray, Future]]]] = {}
+            for bundle, positions, future in self._collect():
+                groups.setdefault(id(bundle), (bundle, []))[1].append(
+                    (positions, future)
+                )
+            for bundle, items in groups.values():
+                self._predict_group(bundle, items)
+
+
+class PredictionService(object):
+    """LGBMPredictorを常駐させてオンラインで予測するサービス
+
+    GCSのlatest/modelのgenerationをreload_interval秒ごとに確認し、更新されていれば
+    モデルを読み込み直す。特徴量のスナップショットはsnapshot_ttl_hoursごとに作り直す。
+
+    Args:
+        config (DictConfig): predict.predictorの設定
+        server_config (DictConfig): predict.serverの設定
+        exp_name (str): 実験名
+    """
+
+    def __init__(self, config: DictConfig, server_config: DictConfig, exp_name: str):
+        self.config = config
+        self.server_config = server_config
+        self.exp_name = exp_name
+        self.model_blob = f"{config.latest_model_path}/model_{exp_name}.pkl"
+        self.snapshot_path = snapshot_path(server_config.snapshot_dir, exp_name)
+        self._lock = threading.Lock()
+        self.bundle = self._load_bundle(self._model_generation())
+        self.batcher = MicroBatcher(
+            lambda bundle, positions: bundle.predict(positions),
+            max_batch_size=server_config.max_batch_size,
+            max_wait_ms=server_config.max_wait_ms,
+        )
+        self._stop = threading.Event()
+        self._reloader = threading.Thread(target=self._reload_loop, daemon=True)
+        self._reloader.start()
+
+    def _model_generation(self) -> Optional[int]:
+        gcs = GCSClient(self.config.gcp_project)
+        return gcs.blob_generation(self.config.train_bucket, self.model_blob)
+
+    def _snapshot_is_stale(self) -> bool:
+        if not os.path.exists(self.snapshot_path):
+            return True
+        age = time.time() - os.path.getmtime(self.snapshot_path)
+        return age > self.server_config.snapshot_ttl_hours * 3600
+
+    def _load_bundle(
+        self, generation: Optional[int], predictor: Optional[LGBMPredictor] = None
+    ) -> ModelBundle:
+        if self._snapshot_is_stale():
+            write_snapshot(self.config, self.exp_name, self.snapshot_path)
+        # 特徴量のスナップショットはmemory mapで読み込む
+        snapshot_df = pq.read_table(self.snapshot_path, memory_map=True).to_pandas()
+        if predictor is None:
+            predictor = LGBMPredictor(self.config, exp_name=self.exp_name)
+            logger.info(
+                f"model {self.model_blob} (generation: {generation}) was loaded."
+            )
+        return ModelBundle(predictor, snapshot_df, generation)
+
+    def _reload_loop(self) -> None:
+        while not self._stop.wait(self.server_config.reload_interval):
+            try:
+                generation = self._model_generation()
+                if generation is not None and generation != self.bundle.generation:
+                    bundle = self._load_bundle(generation)
+                elif self._snapshot_is_stale():
+                    # predict_datasetは毎日更新されるので、モデルはそのままで特徴量だけ読み込み直す
+                    bundle = self._load_bundle(
+                        self.bundle.generation, predictor=self.bundle.predictor
+                    )
+                else:
+                    continue
+                with self._lock:
+                    self.bundle = bundle
+            except Exception:
+                # 読み込みに失敗した場合は現在のモデルで予測を続ける
+                logger.exception("failed to reload the model.")
+
+    def predict(self, keys: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        """(yj_code, store_code)のリストの予測値を返す。スナップショットに無いキーはNoneになる"""
+        with self._lock:
+            bundle = self.bundle
+        positions = [bundle.positions.get(key) for key in keys]
+        found = np.asarray([i for i in positions if i is not None], dtype=np.int64)
+        # 行番号はこのbundleのスナップショットの行なので、同じbundleで予測する
+        preds = iter(self.batcher.submit(bundle, found).result() if len(found) else [])
+        results = []
+        for (yj_code, store_code), position in zip(keys, positions):
+            results.append(
+                {
+                    "yj_code": yj_code,
+                    "store_code": store_code,
+                    "predicted_total_dose": None
+                    if position is None
+                    else float(next(preds)),
+                }
+            )
+        return results
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """GET /predict?yj_code=..&store_code=.., POST /predict, GET /healthz"""
+
+    service: PredictionService
+
+    def _send_json(self, status: int, body: Dict[str, Any]) -> None:
+        payload = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_predictions(self, keys: List[Tuple[str, str]]) -> None:
+        try:
+            predictions = self.service.predict(keys)
+        except Exception:
+            # 予測に失敗した場合もレスポンスは返す (接続を切らない)
+            logger.exception(f"failed to predict {len(keys)} keys.")
+            self._send_json(500, {"error": "failed to predict."})
+            return
+        self._send_json(200, {"predictions": predictions})
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if url.path == "/healthz":
+            bundle = self.service.bundle
+            self._send_json(
+                200,
+                {
+                    "exp_name": self.service.exp_name,
+                    "model_generation": bundle.generation,
+                    "num_keys": len(bundle.positions),
+                },
+            )
+        elif url.path == "/predict":
+            params = parse_qs(url.query)
+            try:
+                key = (params["yj_code"][0], params["store_code"][0])
+            except KeyError:
+                self._send_json(400, {"error": "yj_code and store_code are required."})
+                return
+            self._send_predictions([key])
+        else:
+            self._send_json(404, {"error": f"{url.path} is not found."})
+
+    def do_POST(self) -> None:
+        if urlparse(self.path).path != "/predict":
+            self._send_json(404, {"error": f"{self.path} is not found."})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            keys = [(item["yj_code"], item["store_code"]) for item in body["items"]]
+        except (ValueError, KeyError, TypeError):
+            self._send_json(
+                400, {"error": "body must be {items: [{yj_code, store_code}]}."}
+            )
+            return
+        self._send_predictions(keys)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # リクエストごとのアクセスログは出さない
+        pass
+
+
+class PredictionServer(ThreadingHTTPServer):
+    # 同時接続が多いとlistenのbacklog(デフォルト5)が溢れて接続の再送待ちが起きる
+    request_queue_size = 128
+
+
+def serve(service: PredictionService, host: str, port: int) -> None:
+    PredictionHandler.service = service
+    server = PredictionServer((host, port), PredictionHandler)
+    logger.info(f"serving {service.exp_name} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+
+
+def run_load_test(
+    url: str,
+    keys: List[Tuple[str, str]],
+    n_requests: int,
+    concurrency: int,
+    batch_size: int = 1,
+    seed: int = 0,
+) -> Dict[str, float]:
+    """予測サーバーに並列でリクエストを送り、レイテンシを計測する
+
+    Args:
+        url (str): サーバーのURL (例: http://localhost:8080)
+        keys (List[Tuple[str, str]]): リクエストする(yj_code, store_code)の候補
+        n_requests (int): リクエスト数
+        concurrency (int): 同時に送るリクエスト数
+        batch_size (int, optional): 1リクエストあたりのキー数. Defaults to 1.
+        seed (int, optional): キーを選ぶ乱数のseed. Defaults to 0.
+
+    Returns:
+        Dict[str, float]: p50, p90, p99のレイテンシ(ms)とスループット
+    """
+    rng = np.random.default_rng(seed)
+    choices = rng.integers(len(keys), size=(n_requests, batch_size))
+
+    def _request(i: int) -> float:
+        items = [{"yj_code": keys[j][0], "store_code": keys[j][1]} for j in choices[i]]
+        req = urllib_request.Request(
+            f"{url}/predict",
+            data=json.dumps({"items": items}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        start = time.perf_counter()
+        with urllib_request.urlopen(req) as res:
+            res.read()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.asarray(list(executor.map(_request, range(n_requests))))
+    elapsed = time.perf_counter() - start
+    return {
+        "n_requests": n_requests,
+        "concurrency": concurrency,
+        "batch_size": batch_size,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p90_ms": float(np.percentile(latencies, 90) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "requests_per_sec": n_requests / elapsed,
+    }
@@ -30,14 +30,14 @@ WITH BASE AS (
 )
 
 SELECT
-  * except(dispensing_date),
+  * except(dispensing_date{% for col in dropped_cols %}, {{ col }}{% endfor %}),
   -- 予測時の日時に変更する
   DATE_ADD(dispensing_date, INTERVAL {{sum_days}} DAY) AS dispensing_date,
 FROM BASE 
-LEFT JOIN `{{project_id}}.train_internal.predict_monthly_target_feature` USING(yj_code, store_code, dispensing_date)
-LEFT JOIN `{{project_id}}.train_internal.predict_monthly_category_feature` USING(yj_code, store_code, dispensing_date)
-LEFT JOIN `{{project_id}}.train_internal.predict_monthly_holiday_feature` USING(yj_code, store_code, dispensing_date)
-LEFT JOIN `{{project_id}}.train_internal.predict_monthly_last_prescription_feature` USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.train_internal.predict_monthly_target_feature` WHERE dispensing_date >= START_DATE AND dispensing_date < END_DATE) USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.train_internal.predict_monthly_category_feature` WHERE dispensing_date >= START_DATE AND dispensing_date < END_DATE) USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.train_internal.predict_monthly_holiday_feature` WHERE dispensing_date >= START_DATE AND dispensing_date < END_DATE) USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.train_internal.predict_monthly_last_prescription_feature` WHERE dispensing_date >= START_DATE AND dispensing_date < END_DATE) USING(yj_code, store_code, dispensing_date)
 LEFT JOIN `{{project_id}}.train_internal.doctor_feature` USING(yj_code, store_code)
 LEFT JOIN (SELECT jst_date AS dispensing_date, is_holiday, day_type, day_type_sequence FROM`{{project_id}}.import.holiday_master`) USING (dispensing_date)
 
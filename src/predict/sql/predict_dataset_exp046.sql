@@ -31,19 +31,28 @@ WITH BASE AS (
     scaled_total_dose_by_yj_store AS total_dose_monthly,
   FROM `{{project_id}}.train_internal.scaled_monthly_prescription` 
   WHERE dispensing_date >= START_DATE AND dispensing_date < END_DATE
-)
-
+), DATASET AS (
 SELECT
-  * except(dispensing_date),
+  * except(dispensing_date{% for col in dropped_cols %}, {{ col }}{% endfor %}),
   -- 予測時の日時に変更する
   DATE_ADD(dispensing_date, INTERVAL {{sum_days}} DAY) AS dispensing_date,
 FROM BASE 
-LEFT JOIN `{{project_id}}.train_internal.predict_scaled_monthly_target_feature` USING(yj_code, store_code, dispensing_date)
-LEFT JOIN `{{project_id}}.train_internal.predict_scaled_monthly_category_feature` USING(yj_code, store_code, dispensing_date)
-LEFT JOIN `{{project_id}}.train_internal.predict_scaled_monthly_holiday_feature` USING(yj_code, store_code, dispensing_date)
-LEFT JOIN `{{project_id}}.train_internal.predict_monthly_last_prescription_feature` USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.train_internal.predict_scaled_monthly_target_feature` WHERE dispensing_date >= START_DATE AND dispensing_date < END_DATE) USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.train_internal.predict_scaled_monthly_category_feature` WHERE dispensing_date >= START_DATE AND dispensing_date < END_DATE) USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.train_internal.predict_scaled_monthly_holiday_feature` WHERE dispensing_date >= START_DATE AND dispensing_date < END_DATE) USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.train_internal.predict_monthly_last_prescription_feature` WHERE dispensing_date >= START_DATE AND dispensing_date < END_DATE) USING(yj_code, store_code, dispensing_date)
 LEFT JOIN `{{project_id}}.train_internal.doctor_feature` USING(yj_code, store_code)
 LEFT JOIN (SELECT jst_date AS dispensing_date, is_holiday, day_type, day_type_sequence FROM`{{project_id}}.import.holiday_master`) USING (dispensing_date)
+)
+
+SELECT
+  dataset.*,
+  -- 予測値のscalingを戻すのに使用する (LGBMPredictor.inverse_transform)
+  scaler.min_total_dose_by_yj_store,
+  scaler.max_total_dose_by_yj_store,
+FROM DATASET AS dataset
+LEFT JOIN `{{min_max_scaler_table}}` AS scaler
+USING (yj_code, store_code, dispensing_date)
 
 ;
 
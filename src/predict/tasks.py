@@ -1,9 +1,20 @@
+import json
 from typing import Optional
 from glob import glob
 
+import pandas as pd
+
 from invoke import Collection, Context
 from src.bq import BQClient
+from src.predict.multi import MultiModelPredictor
 from src.predict.predictor import LGBMPredictor
+from src.predict.server import (
+    PredictionService,
+    run_load_test,
+    serve as serve_forever,
+    snapshot_path,
+    write_snapshot,
+)
 from src.utils import add_create_delete_task, render_template, task, setup_logger
 
 predict_tasks = Collection("predict")
@@ -32,6 +43,55 @@ def predict(
     df = predictor.predict()
     predictor.upload_prediction(df)
     logger.info(f"[done] {exp_name} prediction.")
+    if c.predict.predictor.direct_insert:
+        predictor.insert_prediction(df)
+        logger.info(f"[done] insert {exp_name} prediction to BQ.")
+
+
+@task
+def predict_all(
+    c: Context,
+    exp_names: Optional[str] = None,
+    execution_date: Optional[str] = None,
+    n_workers: Optional[int] = None,
+    insert: bool = True,
+):
+    """複数の実験のモデルを1つのプロセスで並行に予測し、予測結果をGCSとBQに書き込むtask
+
+    実験ごとのpredict, insert-predictionのcomponentの代わりに使う。
+    実験ごとのstepの時間は{prediction_path}/predict_all_timings.csvに保存する。
+
+    Args:
+        c (Context): invokeのContext
+        exp_names (Optional[str], optional): カンマ区切りの実験名。指定されない場合、yamlの値が使用される
+        execution_date (str): 予測実行日
+        n_workers (Optional[int], optional): 同時に予測する実験数。指定されない場合、yamlの値が使用される
+        insert (bool, optional): 予測結果をBQのパーティションにロードするか. Defaults to True.
+    """
+    if execution_date is not None:
+        c.execution_date = execution_date
+        c.predict.predictor.prediction_path = f"{execution_date}/result"
+    logger = setup_logger(c)
+    setting = c.predict.predict_all
+    if exp_names is None:
+        exp_name_list = list(setting.exp_names)
+    else:
+        exp_name_list = [name.strip() for name in exp_names.split(",") if name.strip()]
+    if n_workers is None:
+        n_workers = setting.n_workers
+
+    runner = MultiModelPredictor(c.predict.predictor, exp_name_list, int(n_workers))
+    timings_df = runner.run(insert=insert)
+    print(timings_df.to_string(index=False, float_format="{:.1f}".format))
+    predictor_config = c.predict.predictor
+    timings_df.to_csv(
+        f"gs://{predictor_config.bucket}/{predictor_config.prediction_path}/predict_all_timings.csv",
+        index=False,
+    )
+    failed = timings_df.query("status != 'ok'")["exp_name"].tolist()
+    if failed:
+        raise RuntimeError(f"prediction failed: {failed}")
+    logger.info(f"[done] {exp_name_list} prediction.")
 
 
 @task
@@ -51,7 +111,7 @@ def insert_prediction(c: Context, exp_name: str, execution_date: Optional[str] =
     query = render_template(
         "./src/predict/sql/insert_prediction_result.sql",
         params={
-            "dataset_id": "predicted",
+            "dataset_id": c.predict.predictor.result_dataset,
             "bucket": c.predict.predictor.bucket,
             "execution_date": c.execution_date,
             "prediction_path": c.predict.predictor.prediction_path,
@@ -63,5 +123,80 @@ def insert_prediction(c: Context, exp_name: str, execution_date: Optional[str] =
     logger.info(f"[done] insert {exp_name} prediction to BQ.")
 
 
+@task
+def serve(
+    c: Context,
+    exp_name: str,
+    port: Optional[int] = None,
+    refresh: bool = False,
+):
+    """モデルと特徴量を常駐させたオンライン予測サーバーを起動するtask
+
+    GET /predict?yj_code=..&store_code=.. か POST /predict ({"items": [{"yj_code", "store_code"}]}) で
+    処方量のスケールに戻した予測値を返す。
+
+    Args:
+        c (Context): invokeのContext
+        exp_name (str): 予測を行う実験名
+        port (Optional[int], optional): 待ち受けるport。指定されない場合、yamlの値が使用される
+        refresh (bool, optional): 起動時に特徴量のスナップショットを作り直すか. Defaults to False.
+    """
+    setup_logger(c)
+    server_config = c.predict.server
+    if refresh:
+        write_snapshot(
+            c.predict.predictor,
+            exp_name,
+            snapshot_path(server_config.snapshot_dir, exp_name),
+        )
+    service = PredictionService(c.predict.predictor, server_config, exp_name=exp_name)
+    serve_forever(
+        service,
+        server_config.host,
+        int(port) if port is not None else server_config.port,
+    )
+
+
+@task
+def load_test(
+    c: Context,
+    exp_name: str,
+    url: Optional[str] = None,
+    n_requests: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    batch_size: int = 1,
+):
+    """予測サーバーに負荷をかけ、p50, p99のレイテンシを出力するtask
+
+    リクエストするキーはローカルの特徴量のスナップショットから選ぶ。
+
+    Args:
+        c (Context): invokeのContext
+        exp_name (str): サーバーで予測している実験名
+        url (Optional[str], optional): サーバーのURL。指定されない場合、http://localhost:{port}
+        n_requests (Optional[int], optional): リクエスト数。指定されない場合、yamlの値が使用される
+        concurrency (Optional[int], optional): 同時に送るリクエスト数。指定されない場合、yamlの値が使用される
+        batch_size (int, optional): 1リクエストあたりのキー数. Defaults to 1.
+    """
+    server_config = c.predict.server
+    if url is None:
+        url = f"http://localhost:{server_config.port}"
+    keys_df = pd.read_parquet(
+        snapshot_path(server_config.snapshot_dir, exp_name),
+        columns=["yj_code", "store_code"],
+    )
+    result = run_load_test(
+        url,
+        list(zip(keys_df["yj_code"], keys_df["store_code"])),
+        n_requests=int(n_requests or server_config.load_test.n_requests),
+        concurrency=int(concurrency or server_config.load_test.concurrency),
+        batch_size=int(batch_size),
+    )
+    print(json.dumps(result, indent=2))
+
+
 predict_tasks.add_task(predict)
+predict_tasks.add_task(predict_all)
 predict_tasks.add_task(insert_prediction)
+predict_tasks.add_task(serve)
+predict_tasks.add_task(load_test)
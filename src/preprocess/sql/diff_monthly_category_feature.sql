@@ -6,6 +6,7 @@ DECLARE END_DATE DATE DEFAULT DATE_SUB(DATE("{{end_ts}}", "Asia/Tokyo"), INTERVA
 DECLARE START_DATE DATE DEFAULT DATE_SUB(END_DATE, INTERVAL {{train_days + valid_days + test_days + 2 * sum_days}} DAY);
 
 CREATE OR REPLACE TABLE `{{project_id}}.{{dataset_id}}.{{script_name}}`
+{{table_layout}}
 
 AS
 SELECT
@@ -6,6 +6,7 @@ DECLARE TRAIN_START_DATE DATE DEFAULT DATE_SUB(END_DATE, INTERVAL {{train_days +
 DECLARE TRAIN_END_DATE DATE DEFAULT DATE_SUB(END_DATE, INTERVAL {{valid_days + test_days + 2 * sum_days}} DAY);
 
 CREATE OR REPLACE TABLE `{{project_id}}.{{dataset_id}}.{{script_name}}`
+{{table_layout}}
 
 AS
 
@@ -0,0 +1,54 @@
+/*
+  monthly_prescriptionを1回だけ読み込み、生の値, min-max scaling, 差分の3種類の処方量から
+  target, category, holidayの特徴量テーブルをまとめて作成する。
+  scaled_monthly_prescription, diff_monthly_prescriptionを経由した場合と同じ特徴量になる。
+
+  - scaled_*: {{min_max_scaler_table}}のmin, maxで処方量をscalingした値
+  - diff_*: 処方量と{{sum_days - 1}}日前の処方量との差分
+*/
+DECLARE END_DATE DATE DEFAULT DATE_SUB(DATE("{{end_ts}}", "Asia/Tokyo"), INTERVAL {{sum_days - 1}} DAY);
+DECLARE START_DATE DATE DEFAULT DATE_SUB(END_DATE, INTERVAL {{train_days + valid_days + test_days + 2 * sum_days}} DAY);
+
+-- lag_non_zero系の特徴量は全期間の値を参照するため、期間は絞らずに作成する
+CREATE TEMP TABLE FUSED_BASE
+CLUSTER BY yj_code, store_code
+AS
+SELECT
+  *,
+  total_dose_by_yj_store - lag_total_dose_by_yj_store AS diff_total_dose_by_yj_store,
+  total_dose_by_yj - lag_total_dose_by_yj AS diff_total_dose_by_yj,
+FROM (
+  SELECT
+    base.*,
+    SAFE_DIVIDE(
+      base.total_dose_by_yj_store - scaler.min_total_dose_by_yj_store,
+      scaler.max_total_dose_by_yj_store - scaler.min_total_dose_by_yj_store
+    ) AS scaled_total_dose_by_yj_store,
+    SAFE_DIVIDE(
+      base.total_dose_by_yj - scaler.min_total_dose_by_yj,
+      scaler.max_total_dose_by_yj - scaler.min_total_dose_by_yj
+    ) AS scaled_total_dose_by_yj,
+    LAG(base.total_dose_by_yj_store, {{sum_days - 1}}) OVER (yj_store_window) AS lag_total_dose_by_yj_store,
+    LAG(base.total_dose_by_yj, {{sum_days - 1}}) OVER (yj_store_window) AS lag_total_dose_by_yj,
+  FROM
+    `{{project_id}}.{{dataset_id}}.monthly_prescription` AS base
+  LEFT JOIN `{{min_max_scaler_table}}` AS scaler
+  USING (yj_code, store_code, dispensing_date)
+  WINDOW
+    yj_store_window AS (PARTITION BY yj_code, store_code ORDER BY dispensing_date)
+)
+;
+
+{% for variant in fused_variants %}
+{% for feature_name in ["monthly_target_feature", "monthly_category_feature", "monthly_holiday_feature"] %}
+{% with
+  fused=True,
+  source_table="FUSED_BASE",
+  dose_prefix=variant.dose_prefix,
+  script_name=variant.table_prefix ~ feature_name
+%}
+{% include feature_name ~ ".sql" %}
+;
+{% endwith %}
+{% endfor %}
+{% endfor %}
@@ -2,10 +2,16 @@
   祝日に関する特徴量を算出 (total_dose)
 */
 
+{#- fused_monthly_featureからincludeする場合は、読み込み元と処方量のカラムを差し替え、DECLAREは呼び出し元で行う #}
+{%- set source_table = source_table | default(project_id ~ "." ~ dataset_id ~ ".monthly_prescription") %}
+{%- set dose_prefix = dose_prefix | default("") %}
+{%- if not fused %}
 DECLARE END_DATE DATE DEFAULT DATE_SUB(DATE("{{end_ts}}", "Asia/Tokyo"), INTERVAL {{sum_days - 1}} DAY);
 DECLARE START_DATE DATE DEFAULT DATE_SUB(END_DATE, INTERVAL {{train_days + valid_days + test_days + 2 * sum_days}} DAY);
+{%- endif %}
 
 CREATE OR REPLACE TABLE `{{project_id}}.{{dataset_id}}.{{script_name}}`
+{{table_layout}}
 AS
 
 SELECT
@@ -19,7 +25,7 @@ FROM (
     {% for op in category_ops %}
       {% for day in preceding_days %}
         -- yj_code, store, day_type_sequence単位の特徴 (あんま曜日の時系列性なさそう？)
-        {{op}}(total_dose_by_yj_store) OVER (
+        {{op}}({{dose_prefix}}total_dose_by_yj_store) OVER (
             PARTITION BY yj_code, store_code, day_type_sequence
             {% if is_prediction %}
             -- 予測時には、予測したい日付の{{sum_days}}日前までしかmonthly_prescriptionにデータが挿入されていない。
@@ -30,7 +36,7 @@ FROM (
             {% endif %}
         ) AS total_dose_by_yj_store_dts_{{op}}_{{day}},
         -- yj_code, day_type_sequence単位の特徴 (あんま曜日の時系列性なさそう？)
-        {{op}}(total_dose_by_yj) OVER (
+        {{op}}({{dose_prefix}}total_dose_by_yj) OVER (
             PARTITION BY yj_code, day_type_sequence
             {% if is_prediction %}
             -- 予測時には、予測したい日付の{{sum_days}}日前までしかmonthly_prescriptionにデータが挿入されていない。
@@ -41,7 +47,7 @@ FROM (
             {% endif %}
         ) AS total_dose_by_yj_dts_{{op}}_{{day}},
         -- general_name, store_code, day_type_sequence単位の特徴
-        {{op}}(total_dose_by_yj_store) OVER (
+        {{op}}({{dose_prefix}}total_dose_by_yj_store) OVER (
             PARTITION BY general_name, store_code, day_type_sequence
             {% if is_prediction %}
             -- 予測時には、予測したい日付の{{sum_days}}日前までしかmonthly_prescriptionにデータが挿入されていない。
@@ -54,7 +60,7 @@ FROM (
       {% endfor %}
     {% endfor %}
   FROM
-    `{{project_id}}.{{dataset_id}}.monthly_prescription` AS base
+    `{{source_table}}` AS base
   LEFT JOIN `{{project_id}}.import.holiday_master` AS holiday ON base.dispensing_date = holiday.jst_date
   WHERE
     -- 統計量算出に使用するデータまで読み込む
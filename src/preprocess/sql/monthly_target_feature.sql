@@ -1,10 +1,16 @@
 /*
   target関連に関する特徴量を算出 (total_dose, total_price, nunique_patient, age)
 */
+{#- fused_monthly_featureからincludeする場合は、読み込み元と処方量のカラムを差し替え、DECLAREは呼び出し元で行う #}
+{%- set source_table = source_table | default(project_id ~ "." ~ dataset_id ~ ".monthly_prescription") %}
+{%- set dose_prefix = dose_prefix | default("") %}
+{%- if not fused %}
 DECLARE END_DATE DATE DEFAULT DATE_SUB(DATE("{{end_ts}}", "Asia/Tokyo"), INTERVAL {{sum_days - 1}} DAY);
 DECLARE START_DATE DATE DEFAULT DATE_SUB(END_DATE, INTERVAL {{train_days + valid_days + test_days + 2 * sum_days}} DAY);
+{%- endif %}
 
 CREATE OR REPLACE TABLE `{{project_id}}.{{dataset_id}}.{{script_name}}`
+{{table_layout}}
 
 AS
 
@@ -12,7 +18,7 @@ WITH BASE AS(
   SELECT
     *
   FROM
-    `{{project_id}}.{{dataset_id}}.monthly_prescription`
+    `{{source_table}}`
   WHERE
     -- 統計量算出に使用するデータまで読み込む
     -- 基本的にlagに必要なデータ < 統計値算出に必要なデータなのでこれで問題ない。
@@ -26,11 +32,11 @@ WITH BASE AS(
     {% for op in ops %}
       {% for day in preceding_days %}
         -- yj_code, store単位の特徴
-        {{op}}(total_dose_by_yj_store) OVER (yj_store_window_{{day}}) AS total_dose_by_yj_store_{{op}}_{{day}},
+        {{op}}({{dose_prefix}}total_dose_by_yj_store) OVER (yj_store_window_{{day}}) AS total_dose_by_yj_store_{{op}}_{{day}},
         {{op}}(total_price_by_yj_store) OVER (yj_store_window_{{day}}) AS total_price_by_yj_store_{{op}}_{{day}},
         {{op}}(nunique_patient_by_yj_store) OVER (yj_store_window_{{day}}) AS nunique_patient_by_yj_store_{{op}}_{{day}},
         -- yj_code単位の特徴
-        {{op}}(total_dose_by_yj) OVER (yj_window_{{day}}) AS total_dose_by_yj_{{op}}_{{day}},
+        {{op}}({{dose_prefix}}total_dose_by_yj) OVER (yj_window_{{day}}) AS total_dose_by_yj_{{op}}_{{day}},
         {{op}}(total_price_by_yj) OVER (yj_window_{{day}}) AS total_price_by_yj_{{op}}_{{day}},
         {{op}}(nunique_patient_by_yj) OVER (yj_window_{{day}}) AS nunique_patient_by_yj_{{op}}_{{day}},
       {% endfor %}
@@ -68,11 +74,11 @@ WITH BASE AS(
     dispensing_date,
     {% for day in lag_days %}
       -- yj_code, store単位の特徴
-      LAST_VALUE(total_dose_by_yj_store) OVER (yj_store_window_{{day}}) AS lag{{day}}_total_dose_by_yj_store,
+      LAST_VALUE({{dose_prefix}}total_dose_by_yj_store) OVER (yj_store_window_{{day}}) AS lag{{day}}_total_dose_by_yj_store,
       LAST_VALUE(total_price_by_yj_store) OVER (yj_store_window_{{day}}) AS lag{{day}}_total_price_by_yj_store,
       LAST_VALUE(nunique_patient_by_yj_store) OVER (yj_store_window_{{day}}) AS lag{{day}}_nunique_patient_by_yj_store,
       -- yj_code単位の特徴
-      LAST_VALUE(total_dose_by_yj) OVER (yj_store_window_{{day}}) AS lag{{day}}_total_dose_by_yj,
+      LAST_VALUE({{dose_prefix}}total_dose_by_yj) OVER (yj_store_window_{{day}}) AS lag{{day}}_total_dose_by_yj,
       LAST_VALUE(total_price_by_yj) OVER (yj_store_window_{{day}}) AS lag{{day}}_total_price_by_yj,
       LAST_VALUE(nunique_patient_by_yj) OVER (yj_store_window_{{day}}) AS lag{{day}}_nunique_patient_by_yj,
     {% endfor %}
@@ -118,14 +124,14 @@ WITH BASE AS(
         RANGE BETWEEN UNBOUNDED PRECEDING AND {{sum_days}} PRECEDING
         {% endif %}
     ) AS lag_non_zero_total_dose_by_yj,
-  FROM `{{project_id}}.{{dataset_id}}.monthly_prescription`
+  FROM `{{source_table}}`
   LEFT JOIN (
     SELECT
       yj_code,
       store_code,
       dispensing_date,
       -- yj_code, store_code単位の特徴 (ゼロじゃない値)
-      LAST_VALUE(total_dose_by_yj_store) OVER (
+      LAST_VALUE({{dose_prefix}}total_dose_by_yj_store) OVER (
           PARTITION BY yj_code, store_code  
           ORDER BY UNIX_DATE(dispensing_date)
           {% if is_prediction %}
@@ -135,7 +141,7 @@ WITH BASE AS(
           {% endif %}
       ) AS lag_non_zero_total_dose_by_yj_store,
       -- yj_code単位の特徴 (ゼロじゃない値)
-      LAST_VALUE(total_dose_by_yj) OVER (
+      LAST_VALUE({{dose_prefix}}total_dose_by_yj) OVER (
           PARTITION BY yj_code  
           ORDER BY UNIX_DATE(dispensing_date)
           {% if is_prediction %}
@@ -145,9 +151,9 @@ WITH BASE AS(
           {% endif %}
       ) AS lag_non_zero_total_dose_by_yj,
     FROM 
-      `{{project_id}}.{{dataset_id}}.monthly_prescription`
+      `{{source_table}}`
     WHERE 
-      total_dose_by_yj_store != 0
+      {{dose_prefix}}total_dose_by_yj_store != 0
   )
   USING (yj_code, store_code, dispensing_date)
   WHERE
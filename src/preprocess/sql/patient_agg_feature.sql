@@ -1,6 +1,7 @@
 
 -- window系の特徴も追加
 CREATE OR REPLACE TABLE `{{project_id}}.{{dataset_id}}.{{script_name}}`
+{{table_layout}}
 
 AS
 
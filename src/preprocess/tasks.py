@@ -8,19 +8,39 @@ preprocess_tasks = Collection("preprocess")
 sql_paths = glob("src/preprocess/sql/*.sql")
 add_create_delete_task(preprocess_tasks, sql_paths)
 
+# fused-monthly-featureでまとめて作成される特徴量のタスク
+FUSED_FEATURE_TASKS = [
+    f"{prefix}monthly-{name}-feature"
+    for prefix in ["", "scaled-", "diff-"]
+    for name in ["target", "category", "holiday"]
+]
+# 日付のパーティションを持たず、end_tsに対する期間で集計するテーブルのタスク
+# (複数の実行日をまとめて作成できないので、backfillでは実行日ごとに作成する)
+DATE_RELATIVE_TASKS = ["doctor-feature"]
+
 
 @task
-def all(c: Context, start_ts: str = None, end_ts: str = None):
+def all(c: Context, start_ts: str = None, end_ts: str = None, exclude: str = ""):
+    """monthly-prescription, scaled-monthly-prescriptionを作成してから、残りの特徴量のタスクを並列に実行する
+
+    Args:
+        c (Context): invokeのContext
+        start_ts (str, optional): sqlの実行開始日. デフォルトでyamlの値を使用
+        end_ts (str, optional): sqlの実行終了日. デフォルトでyamlの値を使用
+        exclude (str, optional): 実行しないタスク名 (カンマ区切り). Defaults to "".
+    """
     preprocess_tasks["monthly-prescription"](c, start_ts, end_ts)
     preprocess_tasks["scaled-monthly-prescription"](c, start_ts, end_ts)
     thread_executor = ThreadPoolExecutor()
     jobs = []
+    skip_tasks = ["monthly-prescription", "scaled-monthly-prescription", "all"]
+    skip_tasks += [name for name in exclude.split(",") if name]
+    if c.preprocess.fused_features:
+        skip_tasks += FUSED_FEATURE_TASKS
+    else:
+        skip_tasks += ["fused-monthly-feature"]
     for task_name in preprocess_tasks.tasks.keys():
-        if task_name not in [
-            "monthly-prescription",
-            "scaled-monthly-prescription",
-            "all",
-        ]:
+        if task_name not in skip_tasks:
             jobs.append(
                 thread_executor.submit(preprocess_tasks[task_name], c, start_ts, end_ts)
             )
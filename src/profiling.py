@@ -0,0 +1,355 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import invoke
+import pandas as pd
+from invoke import Context
+
+from src.gcs import GCSClient
+from src.log import get_logger, log_context
+
+logger = get_logger(__name__)
+
+# カンマ区切りでprofilerを指定する環境変数 (例: SUGI_PROFILE=sample,memory)
+PROFILE_ENV = "SUGI_PROFILE"
+MODES = ["sample", "cprofile", "memory"]
+# SUGI_PROFILE=1などの場合はオーバーヘッドの小さいsampleとmemoryを使う
+DEFAULT_MODES = ["sample", "memory"]
+
+DEFAULT_SETTING = {
+    "interval": 0.01,
+    "top_n": 30,
+    "local_dir": "profiles",
+    "upload": True,
+}
+
+# taskの中で別のtaskを呼ぶ場合は、外側のtaskだけprofileする
+_active = False
+
+
+def profile_modes() -> List[str]:
+    """SUGI_PROFILEから使うprofilerを取得する。設定されていない場合は空のリスト"""
+    value = os.getenv(PROFILE_ENV, "").strip().lower()
+    if value in ["", "0", "false", "off"]:
+        return []
+    if value in ["1", "true", "on"]:
+        return list(DEFAULT_MODES)
+    if value == "all":
+        return list(MODES)
+    modes = [mode.strip() for mode in value.split(",") if mode.strip()]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        raise ValueError(
+            f"{PROFILE_ENV} must be a comma separated subset of {MODES}, got {sorted(unknown)}"
+        )
+    return modes
+
+
+def _frame_name(frame: Any) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    # repo内のファイルは相対パス, ライブラリはファイル名だけにする
+    if filename.startswith(os.getcwd()):
+        filename = os.path.relpath(filename)
+    else:
+        filename = os.path.basename(filename)
+    # folded stackの区切り文字はframe名に含めない
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+class SamplingProfiler(object):
+    """一定間隔で対象スレッドのスタックを取得し、関数ごとの呼び出し経路の出現回数を数える
+
+    結果はflamegraph.pl, speedscopeなどで読めるfolded stack形式 (`a;b;c 回数`) で出力する。
+    決定的profiler (cProfile) と違い、関数呼び出しごとのオーバーヘッドが無いので本番相当の処理にも使える。
+    子プロセス (ProcessPoolExecutorなど) の中の処理は計測されない。
+
+    Args:
+        interval (float, optional): スタックを取得する間隔 (秒). Defaults to 0.01.
+        thread_id (Optional[int], optional): 対象のスレッド。指定されない場合は呼び出したスレッド. Defaults to None.
+    """
+
+    def __init__(self, interval: float = 0.01, thread_id: Optional[int] = None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stacks: Counter = Counter()
+        self.n_samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(names))] += 1
+            self.n_samples += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self) -> str:
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.stacks.most_common()
+        )
+
+    def call_tree(self, min_share: float = 0.01) -> str:
+        """呼び出し経路ごとのサンプルの割合をインデントした木で表示する (min_share未満の経路は省略)"""
+        tree: Dict[str, Any] = {}
+        for stack, count in self.stacks.items():
+            node = tree
+            for name in stack.split(";"):
+                child = node.setdefault(name, {"count": 0, "children": {}})
+                child["count"] += count
+                node = child["children"]
+        total = max(self.n_samples, 1)
+        lines = [f"total samples: {self.n_samples} (interval {self.interval} sec)"]
+
+        def render(node: Dict[str, Any], depth: int) -> None:
+            for name, child in sorted(node.items(), key=lambda kv: -kv[1]["count"]):
+                share = child["count"] / total
+                if share < min_share:
+                    continue
+                lines.append(f"{'  ' * depth}{share * 100:5.1f}% {name}")
+                render(child["children"], depth + 1)
+
+        render(tree, 0)
+        return "\n".join(lines) + "\n"
+
+
+class PeakMemorySnapshot(object):
+    """tracemallocの確保量が最大に近い時点のsnapshotを保持する
+
+    タスクの終了時には大きな配列は解放されていることが多いので、interval秒ごとに確保量を確認し、
+    これまでの最大をgrowthの割合以上更新した場合にsnapshotを取り直す。
+
+    Args:
+        interval (float, optional): 確保量を確認する間隔 (秒). Defaults to 0.5.
+        growth (float, optional): snapshotを取り直す確保量の増加率. Defaults to 0.1.
+    """
+
+    def __init__(self, interval: float = 0.5, growth: float = 0.1):
+        self.interval = interval
+        self.growth = growth
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.snapshot_mib = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            current = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+            if current > max(self.snapshot_mib * (1 + self.growth), 1.0):
+                self.snapshot = tracemalloc.take_snapshot()
+                self.snapshot_mib = current
+
+    def start(self) -> None:
+        tracemalloc.start(25)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def report(self, top_n: int) -> str:
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"current: {current / 1024 / 1024:.1f} MiB, peak: {peak / 1024 / 1024:.1f} MiB",
+            "(NumPy, pandasの配列はtraceされるが、LightGBMなどC++側の確保はtraceされない)",
+        ]
+        if self.snapshot is None:
+            return "\n".join(lines) + "\n"
+        snapshot = self.snapshot.filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ]
+        )
+        lines += [
+            f"snapshot: {self.snapshot_mib:.1f} MiB (最大に近い時点)",
+            "",
+            f"[top {top_n} lines]",
+        ]
+        for stat in snapshot.statistics("lineno")[:top_n]:
+            lines.append(
+                f"{stat.size / 1024 / 1024:10.1f} MiB {stat.count:>9} blocks  {stat.traceback[0]}"
+            )
+        lines += ["", f"[top {min(top_n, 10)} tracebacks]"]
+        for stat in snapshot.statistics("traceback")[: min(top_n, 10)]:
+            lines.append(f"{stat.size / 1024 / 1024:.1f} MiB {stat.count} blocks")
+            lines += [f"    {line}" for line in stat.traceback.format()]
+        return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def profile(
+    output_dir: str,
+    modes: List[str],
+    interval: float = 0.01,
+    top_n: int = 30,
+    metadata: Optional[Dict[str, Any]] = None,
+) -> Iterator[None]:
+    """withの中の処理をprofileし、output_dirに結果を書き出す
+
+    - sample: folded stack (stacks.folded) と呼び出しの木 (call_tree.txt)
+    - cprofile: pstats (cprofile.prof) と累積時間の上位 (cprofile.txt)
+    - memory: tracemallocで確保量が最大に近い時点の確保量の多い行, traceback (memory.txt)
+
+    Args:
+        output_dir (str): 結果を書き出すディレクトリ
+        modes (List[str]): 使うprofiler (sample, cprofile, memory)
+        interval (float, optional): sampleでスタックを取得する間隔 (秒). Defaults to 0.01.
+        top_n (int, optional): cprofile, memoryで出力する上位の数. Defaults to 30.
+        metadata (Optional[Dict[str, Any]], optional): summary.jsonに書き出す情報. Defaults to None.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    sampler = SamplingProfiler(interval) if "sample" in modes else None
+    profiler = cProfile.Profile() if "cprofile" in modes else None
+    memory = PeakMemorySnapshot() if "memory" in modes else None
+    if memory is not None:
+        memory.start()
+    if sampler is not None:
+        sampler.start()
+    if profiler is not None:
+        profiler.enable()
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "failed"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+        if sampler is not None:
+            sampler.stop()
+        if memory is not None:
+            memory.stop()
+        summary = {
+            **(metadata or {}),
+            "modes": modes,
+            "status": status,
+            "wall_sec": elapsed,
+        }
+        if sampler is not None:
+            with open(f"{output_dir}/stacks.folded", "w") as f:
+                f.write(sampler.folded())
+            with open(f"{output_dir}/call_tree.txt", "w") as f:
+                f.write(sampler.call_tree())
+            summary["samples"] = sampler.n_samples
+        if profiler is not None:
+            profiler.dump_stats(f"{output_dir}/cprofile.prof")
+            stream = io.StringIO()
+            stats = pstats.Stats(profiler, stream=stream).sort_stats("cumulative")
+            stats.print_stats(top_n)
+            stats.print_callees(top_n)
+            with open(f"{output_dir}/cprofile.txt", "w") as f:
+                f.write(stream.getvalue())
+        if memory is not None:
+            summary["traced_peak_mib"] = (
+                tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            )
+            with open(f"{output_dir}/memory.txt", "w") as f:
+                f.write(memory.report(top_n))
+            tracemalloc.stop()
+        with open(f"{output_dir}/summary.json", "w") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False, default=str)
+
+
+def _setting(c: Context) -> Dict[str, Any]:
+    setting = dict(DEFAULT_SETTING)
+    setting.update(dict(c.config.get("profile") or {}))
+    return setting
+
+
+class ProfiledTask(invoke.Task):
+    """SUGI_PROFILEが設定されている場合に、taskの本体をprofilerの下で実行するinvokeのTask
+
+    結果はprofile.local_dir/{execution_date}/{task}_{時刻}に書き出し、
+    gs://{env.train_bucket}/{exp_name}/profiles/{execution_date}/{task}_{時刻}にアップロードする
+    (exp_nameを引数に持たないtaskはgs://{env.train_bucket}/profiles/...)。
+    Vertexのジョブ, パイプラインのcomponentには環境変数でSUGI_PROFILEを渡す。
+    """
+
+    def __call__(self, *args, **kwargs):
+        # taskの中で出力したログにtask名と実験名を付ける
+        with log_context(task=self.name, exp_name=kwargs.get("exp_name")):
+            return self._profiled_call(*args, **kwargs)
+
+    def _profiled_call(self, *args, **kwargs):
+        global _active
+        modes = profile_modes()
+        if not modes or _active or not (args and isinstance(args[0], Context)):
+            return super().__call__(*args, **kwargs)
+        c = args[0]
+        setting = _setting(c)
+        execution_date = c.config.get("execution_date", "unknown")
+        run_name = f"{self.name}_{pd.Timestamp.now():%H%M%S}_{os.getpid()}".replace(
+            ".", "_"
+        )
+        local_dir = f"{setting['local_dir']}/{execution_date}/{run_name}"
+        metadata = {
+            "task": self.name,
+            "kwargs": kwargs,
+            "execution_date": execution_date,
+            "pid": os.getpid(),
+        }
+        logger.info(f"[profile] {self.name} is profiled with {modes}.")
+        _active = True
+        try:
+            with profile(
+                local_dir,
+                modes,
+                interval=setting["interval"],
+                top_n=setting["top_n"],
+                metadata=metadata,
+            ):
+                return super().__call__(*args, **kwargs)
+        finally:
+            _active = False
+            logger.info(f"[profile] results were saved to {local_dir}")
+            if setting["upload"]:
+                self._upload(
+                    c, local_dir, kwargs.get("exp_name"), execution_date, run_name
+                )
+
+    @staticmethod
+    def _upload(
+        c: Context,
+        local_dir: str,
+        exp_name: Optional[str],
+        execution_date: str,
+        run_name: str,
+    ) -> None:
+        # profileの失敗でtaskを失敗させない
+        try:
+            env = c.config.env
+            prefix = f"{exp_name}/profiles" if exp_name else "profiles"
+            destination = f"{prefix}/{execution_date}/{run_name}"
+            GCSClient(env.gcp_project).upload_directory(
+                env.train_bucket, local_dir, destination
+            )
+            logger.info(f"[profile] uploaded to gs://{env.train_bucket}/{destination}")
+        except Exception as e:
+            logger.warning(f"[profile] failed to upload {local_dir}: {e}")
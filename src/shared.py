@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+from typing import Dict, Mapping, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+# 共有メモリ (tmpfs) のディレクトリ。空きが足りない場合はtempfileのディレクトリ (ディスク) を使う
+SHM_DIR = "/dev/shm"
+
+
+class SharedFrames(object):
+    """spawnした子プロセスとDataFrameを共有するための非圧縮のArrow(Feather)ファイル
+
+    LightGBM (OpenMP) を使った後のforkは子プロセスが止まることがあるので、プロセスプールはspawnにし、
+    データはpickleせずにファイルに1回だけ書き出す。子プロセスはread_sharedでmemory mapして必要な行だけを
+    DataFrameにするので、ファイルのページは全プロセスで共有され、プロセスごとのメモリは取り出した行の分になる。
+    withを抜けるとファイルを削除する。
+
+    Args:
+        frames (Mapping[str, pd.DataFrame]): 名前とDataFrame
+    """
+
+    def __init__(self, frames: Mapping[str, pd.DataFrame]):
+        self.frames = frames
+        self.directory: Optional[str] = None
+        self.paths: Dict[str, str] = {}
+
+    def _parent_dir(self) -> Optional[str]:
+        n_bytes = sum(
+            int(df.memory_usage(index=True, deep=True).sum())
+            for df in self.frames.values()
+        )
+        if os.path.isdir(SHM_DIR) and shutil.disk_usage(SHM_DIR).free > 2 * n_bytes:
+            return SHM_DIR
+        return None
+
+    def __enter__(self) -> Dict[str, str]:
+        self.directory = tempfile.mkdtemp(
+            prefix="shared_frames_", dir=self._parent_dir()
+        )
+        try:
+            for name, df in self.frames.items():
+                path = os.path.join(self.directory, f"{name}.arrow")
+                feather.write_feather(df, path, compression="uncompressed")
+                self.paths[name] = path
+        except BaseException:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            raise
+        # 書き出した後は子プロセスがファイルから読むので、DataFrameへの参照を残さない
+        self.frames = {}
+        return self.paths
+
+    def __exit__(self, *exc) -> None:
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+def read_shared(
+    path: str,
+    rows: Optional[np.ndarray] = None,
+    columns: Optional[Sequence[str]] = None,
+) -> pd.DataFrame:
+    """SharedFramesのファイルをmemory mapし、rowsの行 (Noneは全行) とcolumnsの列だけをDataFrameにする"""
+    table = feather.read_table(
+        path, columns=None if columns is None else list(columns), memory_map=True
+    )
+    if rows is not None:
+        table = table.take(rows)
+    return table.to_pandas()
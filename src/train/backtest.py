@@ -0,0 +1,175 @@
+import copy
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, timedelta
+from multiprocessing import get_context
+from typing import Any, Dict, List, Mapping, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.cpu import available_cpus
+from src.log import get_logger, init_worker, worker_state
+from src.shared import SharedFrames, read_shared
+from src.train.trainer import LGBMTrainer
+
+logger = get_logger(__name__)
+
+# 集計する評価指標
+METRIC_COLS = ["rmse", "mae", "r2"]
+
+# workerのプロセスでinitializerが設定するtrainerとsplitの設定
+# 全originの期間を含む学習データはSharedFramesのファイルのパス
+_fold_path: Optional[str] = None
+_fold_trainer: Optional[LGBMTrainer] = None
+_fold_split_config: Optional[Dict[str, int]] = None
+
+
+def origin_date(end_ts: str) -> date:
+    """end_tsをSQLのDATE("{{end_ts}}", "Asia/Tokyo")と同じ日付に変換する"""
+    ts = pd.Timestamp(end_ts)
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert("Asia/Tokyo")
+    return ts.date()
+
+
+def split_flags(
+    dates: pd.Series, end_ts: str, split_config: Mapping[str, int]
+) -> pd.Series:
+    """train_dataset_*.sqlと同じ期間でsplit_flagを付ける
+
+    Args:
+        dates (pd.Series): dispensing_date (datetime64)
+        end_ts (str): 学習のend_ts (origin)
+        split_config (Mapping[str, int]): sum_days, train_days, valid_days, test_days
+
+    Returns:
+        pd.Series: train, valid, test。train, validの間などはNone, 対象期間外は"out"
+    """
+    sum_days = split_config["sum_days"]
+    valid_days = split_config["valid_days"]
+    test_days = split_config["test_days"]
+    end_date = pd.Timestamp(origin_date(end_ts) - timedelta(days=sum_days))
+    train_start_date = end_date - pd.Timedelta(
+        days=split_config["train_days"] + valid_days + test_days + 2 * sum_days
+    )
+    train_end_date = end_date - pd.Timedelta(days=valid_days + test_days + 2 * sum_days)
+    valid_start_date = end_date - pd.Timedelta(days=valid_days + test_days + sum_days)
+    valid_end_date = end_date - pd.Timedelta(days=test_days + sum_days)
+    test_start_date = end_date - pd.Timedelta(days=test_days)
+    conditions = [
+        (dates < train_start_date) | (dates > end_date),
+        (dates >= train_start_date) & (dates < train_end_date),
+        (dates >= valid_start_date) & (dates < valid_end_date),
+        dates >= test_start_date,
+    ]
+    flags = np.select(conditions, ["out", "train", "valid", "test"], default=None)
+    return pd.Series(flags, index=dates.index)
+
+
+def _init_worker(
+    path: str,
+    trainer: LGBMTrainer,
+    split_config: Dict[str, int],
+    log_state: Dict[str, Any],
+) -> None:
+    global _fold_path, _fold_trainer, _fold_split_config
+    init_worker(log_state)
+    _fold_path = path
+    _fold_trainer = trainer
+    _fold_split_config = split_config
+
+
+def _run_fold(end_ts: str) -> Dict[str, Any]:
+    """1つのoriginについて学習, testデータの予測, 評価を行う (子プロセスで実行される)"""
+    dates = read_shared(_fold_path, columns=["dispensing_date"])["dispensing_date"]
+    flags = split_flags(dates, end_ts, _fold_split_config)
+    # foldの期間の行だけをDataFrameにする
+    rows = np.flatnonzero((flags != "out").to_numpy())
+    fold_df = read_shared(_fold_path, rows).reset_index(drop=True)
+    fold_df["split_flag"] = flags.iloc[rows].to_numpy()
+    le_dict, bst, test_df = _fold_trainer.fit(fold_df)
+    metrics, _ = _fold_trainer.evaluate(le_dict, bst, test_df.copy())
+    metrics.update(
+        {
+            "origin": end_ts,
+            "num_iterations": bst.current_iteration(),
+            "num_train": int((fold_df["split_flag"] != "test").sum()),
+            "num_test": len(test_df),
+        }
+    )
+    return metrics
+
+
+class Backtester(object):
+    """複数のorigin (end_ts)で学習と評価を行うrolling-origin backtest
+
+    全originの期間を含む学習データを1回だけ読み込み、originごとにsplit_flagを付け直して
+    foldをプロセスプールで並列に実行する。データはSharedFramesで共有し、各プロセスはfoldの期間の行だけを取り出す。
+
+    Args:
+        trainer (LGBMTrainer): 学習に使用するtrainer
+        split_config (Mapping[str, int]): sum_days, train_days, valid_days, test_days
+        origins (List[str]): backtestするend_tsのリスト
+        n_parallel (int): 同時に実行するfold数 (コアをfold間で等分する)
+    """
+
+    def __init__(
+        self,
+        trainer: LGBMTrainer,
+        split_config: Mapping[str, int],
+        origins: List[str],
+        n_parallel: int,
+    ):
+        self.trainer = trainer
+        self.split_config = dict(split_config)
+        self.origins = sorted(origins, key=origin_date)
+        self.n_parallel = max(1, min(n_parallel, len(origins)))
+
+    def run(self, df: pd.DataFrame) -> pd.DataFrame:
+        """全originのfoldを実行し、originごとの評価指標と集計値をまとめたレポートを返す
+
+        Args:
+            df (pd.DataFrame): 全originの期間を含む学習データ
+
+        Returns:
+            pd.DataFrame: originごとの評価指標と、mean, stdの行
+        """
+        df = df.copy()
+        df["dispensing_date"] = pd.to_datetime(df["dispensing_date"])
+        # fold間でコアを分け合う (self.trainerのparamsは変更しない)
+        trainer = copy.copy(self.trainer)
+        trainer.params = {
+            **self.trainer.params,
+            "num_thread": max(1, available_cpus() // self.n_parallel),
+        }
+
+        rows = []
+        with SharedFrames({"df": df}) as paths:
+            del df
+            with ProcessPoolExecutor(
+                max_workers=self.n_parallel,
+                # LightGBM (OpenMP) を使った後のforkは子プロセスが止まることがあるのでspawnにする
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(paths["df"], trainer, self.split_config, worker_state()),
+            ) as executor:
+                jobs = {
+                    executor.submit(_run_fold, end_ts): end_ts
+                    for end_ts in self.origins
+                }
+                for future in as_completed(jobs):
+                    metrics = future.result()
+                    logger.info(
+                        f"[done] origin {jobs[future]}: "
+                        + ", ".join(f"{col}={metrics[col]:.4f}" for col in METRIC_COLS)
+                    )
+                    rows.append(metrics)
+        return self.report(rows)
+
+    def report(self, rows: List[Dict[str, Any]]) -> pd.DataFrame:
+        report_df = pd.DataFrame(rows)
+        report_df = report_df.set_index("origin").loc[self.origins].reset_index()
+        aggregated = report_df[METRIC_COLS].agg(["mean", "std"])
+        aggregated["model_version"] = self.trainer.exp_name
+        aggregated = aggregated.rename_axis("origin").reset_index()
+        return pd.concat([report_df, aggregated], ignore_index=True)
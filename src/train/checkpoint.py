@@ -0,0 +1,185 @@
+import json
+import os
+import tempfile
+import time
+from operator import gt, lt
+from typing import Any, Dict, List, Optional
+
+import lightgbm as lgb
+
+from src.gcs import GCSClient
+from src.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class ResumableEarlyStopping(object):
+    """状態を保存, 復元できるlgb.early_stoppingと同じ動作のcallback
+
+    lgb.early_stoppingは最良のiterationをクロージャ内に持つため、init_modelで学習を再開すると
+    最良の値が失われる。checkpointに状態を保存しておき、再開時に引き継ぐ。
+
+    Args:
+        stopping_rounds (int): この回数validが改善しなければ学習を止める
+        state (Optional[Dict[str, Any]], optional): checkpointに保存した状態. Defaults to None.
+    """
+
+    order = 30
+
+    def __init__(self, stopping_rounds: int, state: Optional[Dict[str, Any]] = None):
+        self.stopping_rounds = stopping_rounds
+        state = state or {}
+        self.best_score: List[float] = state.get("best_score", [])
+        self.best_iter: List[int] = state.get("best_iter", [])
+        self.best_score_list: List[Optional[List]] = state.get("best_score_list", [])
+        self.higher_better: List[bool] = state.get("higher_better", [])
+
+    def state(self) -> Dict[str, Any]:
+        return {
+            "best_score": self.best_score,
+            "best_iter": self.best_iter,
+            "best_score_list": self.best_score_list,
+            "higher_better": self.higher_better,
+        }
+
+    def _init(self, env: lgb.callback.CallbackEnv) -> None:
+        if not env.evaluation_result_list:
+            raise ValueError(
+                "For early stopping, at least one dataset and eval metric is required for evaluation"
+            )
+        logger.info(
+            f"Training until validation scores don't improve for {self.stopping_rounds} rounds"
+        )
+        for _, _, _, higher_better in env.evaluation_result_list:
+            self.best_iter.append(0)
+            self.best_score_list.append(None)
+            self.higher_better.append(bool(higher_better))
+            self.best_score.append(float("-inf") if higher_better else float("inf"))
+
+    def __call__(self, env: lgb.callback.CallbackEnv) -> None:
+        if not self.best_iter:
+            self._init(env)
+        for i, (data_name, _, score, _) in enumerate(env.evaluation_result_list):
+            is_better = gt if self.higher_better[i] else lt
+            if self.best_score_list[i] is None or is_better(score, self.best_score[i]):
+                self.best_score[i] = score
+                self.best_iter[i] = env.iteration
+                self.best_score_list[i] = [list(r) for r in env.evaluation_result_list]
+            # 学習データは早期終了の判定に使わない
+            if data_name == env.model._train_data_name:
+                self._final_iteration_check(env, i)
+                continue
+            if env.iteration - self.best_iter[i] >= self.stopping_rounds:
+                logger.info(
+                    f"Early stopping, best iteration is: [{self.best_iter[i] + 1}]"
+                )
+                raise lgb.callback.EarlyStopException(
+                    self.best_iter[i], self.best_score_list[i]
+                )
+            self._final_iteration_check(env, i)
+
+    def _final_iteration_check(self, env: lgb.callback.CallbackEnv, i: int) -> None:
+        if env.iteration == env.end_iteration - 1:
+            logger.info(
+                f"Did not meet early stopping. Best iteration is: [{self.best_iter[i] + 1}]"
+            )
+            raise lgb.callback.EarlyStopException(
+                self.best_iter[i], self.best_score_list[i]
+            )
+
+
+class CheckpointStore(object):
+    """学習途中のモデルと状態をGCSに保存, 復元する
+
+    {prefix}/state.jsonが最新のcheckpointのモデル(model_{iteration}.txt)を指す。
+    モデルを書き終えてからstate.jsonを更新するので、途中で落ちても前のcheckpointが壊れることはない。
+
+    Args:
+        gcs (GCSClient): GCSのclient
+        bucket (str): 保存先のbucket
+        prefix (str): 保存先のpath ({exp_name}/checkpoints/{execution_date}/{stage})
+    """
+
+    def __init__(self, gcs: GCSClient, bucket: str, prefix: str):
+        self.gcs = gcs
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """最新のcheckpointを読み込む。checkpointが無い場合はNoneを返す
+
+        Returns:
+            Optional[Dict[str, Any]]: iteration, completed, early_stoppingなどの状態と
+                model(lgb.Booster)の辞書
+        """
+        if self.gcs.blob_generation(self.bucket, f"{self.prefix}/state.json") is None:
+            return None
+        with tempfile.TemporaryDirectory() as tmp_d:
+            state_path = os.path.join(tmp_d, "state.json")
+            self.gcs.download_blob(self.bucket, f"{self.prefix}/state.json", state_path)
+            with open(state_path, "r") as f:
+                state = json.load(f)
+            model_path = os.path.join(tmp_d, state["model"])
+            self.gcs.download_blob(
+                self.bucket, f"{self.prefix}/{state['model']}", model_path
+            )
+            bst = lgb.Booster(model_file=model_path)
+        if state.get("best_iteration") is not None:
+            bst.best_iteration = state["best_iteration"]
+        state["booster"] = bst
+        logger.info(
+            f"checkpoint gs://{self.bucket}/{self.prefix} (iteration: {state['iteration']}) was loaded."
+        )
+        return state
+
+    def save(self, bst: lgb.Booster, state: Dict[str, Any]) -> None:
+        """モデルと状態を保存する
+
+        Args:
+            bst (lgb.Booster): 学習途中のモデル
+            state (Dict[str, Any]): iteration, completed, early_stoppingなどの状態
+        """
+        state = dict(state)
+        state["model"] = f"model_{state['iteration']}.txt"
+        with tempfile.TemporaryDirectory() as tmp_d:
+            model_path = os.path.join(tmp_d, state["model"])
+            # best_iterationで切り詰めずに全ての木を保存する
+            bst.save_model(model_path, num_iteration=-1)
+            self.gcs.upload_blob(
+                self.bucket, model_path, f"{self.prefix}/{state['model']}"
+            )
+            state_path = os.path.join(tmp_d, "state.json")
+            with open(state_path, "w") as f:
+                json.dump(state, f)
+            self.gcs.upload_blob(self.bucket, state_path, f"{self.prefix}/state.json")
+        # 古いcheckpointのモデルを削除する
+        for blob in self.gcs.fetch_list_blobs(self.bucket, f"{self.prefix}/model_"):
+            if os.path.basename(blob) != state["model"]:
+                self.gcs.delete_blob(self.bucket, blob)
+
+
+def checkpoint_callback(
+    store: CheckpointStore,
+    interval_sec: float,
+    early_stopping: Optional[ResumableEarlyStopping] = None,
+):
+    """interval_sec秒ごとに学習途中のモデルとearly stoppingの状態を保存するcallback"""
+    last_saved = [time.time()]
+
+    def _callback(env: lgb.callback.CallbackEnv) -> None:
+        if time.time() - last_saved[0] < interval_sec:
+            return
+        store.save(
+            env.model,
+            {
+                "iteration": env.iteration + 1,
+                "completed": False,
+                "early_stopping": early_stopping.state() if early_stopping else None,
+            },
+        )
+        last_saved[0] = time.time()
+        logger.info(f"checkpoint was saved at iteration {env.iteration + 1}.")
+
+    # early stoppingの状態を更新した後に保存する
+    _callback.order = 40
+    return _callback
@@ -0,0 +1,206 @@
+import json
+import os
+import socket
+from typing import Any, Dict, Iterable, List, Tuple
+
+import lightgbm as lgb
+import pandas as pd
+from omegaconf import DictConfig
+from sklearn.preprocessing import LabelEncoder
+
+from src.log import get_logger
+from src.train.trainer import LGBMTrainer
+
+logger = get_logger(__name__)
+
+
+class ClusterSpec(object):
+    """data-parallel学習に参加するワーカーの一覧と自身のrank
+
+    Args:
+        hosts (List[str]): rank順のワーカーのhost
+        rank (int): 自身のrank (0がchief)
+        base_port (int): LightGBMの通信に使うport。rank iのワーカーはbase_port + iをlistenする
+    """
+
+    def __init__(self, hosts: List[str], rank: int, base_port: int):
+        self.hosts = hosts
+        self.rank = rank
+        self.base_port = base_port
+
+    @classmethod
+    def from_env(cls, base_port: int) -> "ClusterSpec":
+        """Vertex AI Trainingが設定するCLUSTER_SPEC環境変数から作成する
+
+        workerpool0 (chief) をrank 0, workerpool1のi番目をrank 1 + iとする。
+        CLUSTER_SPECが無い場合は1台で学習する。
+        """
+        cluster_spec = os.getenv("CLUSTER_SPEC")
+        if cluster_spec is None:
+            return cls(["127.0.0.1"], 0, base_port)
+        spec = json.loads(cluster_spec)
+        pools = [
+            spec["cluster"].get(pool, []) for pool in ["workerpool0", "workerpool1"]
+        ]
+        addresses = pools[0] + pools[1]
+        task = spec["task"]
+        rank = int(task["index"])
+        if task["type"] == "workerpool1":
+            rank += len(pools[0])
+        elif task["type"] != "workerpool0":
+            raise ValueError(f"unsupported worker pool: {task['type']}")
+        # CLUSTER_SPECのportはTF用なので使わず、host名をIPに解決する
+        hosts = [socket.gethostbyname(address.split(":")[0]) for address in addresses]
+        return cls(hosts, rank, base_port)
+
+    @property
+    def num_machines(self) -> int:
+        return len(self.hosts)
+
+    @property
+    def is_chief(self) -> bool:
+        return self.rank == 0
+
+    def lgbm_params(self, tree_learner: str, time_out: int) -> Dict[str, Any]:
+        """LightGBMの分散学習用のパラメータ"""
+        if self.num_machines == 1:
+            return {}
+        machines = [
+            f"{host}:{self.base_port + rank}" for rank, host in enumerate(self.hosts)
+        ]
+        return {
+            "tree_learner": tree_learner,
+            "num_machines": self.num_machines,
+            "machines": ",".join(machines),
+            "local_listen_port": self.base_port + self.rank,
+            "time_out": time_out,
+            # 各ワーカーは自分のshardだけを読み込んでいる
+            "pre_partition": True,
+        }
+
+
+class DistributedLGBMTrainer(LGBMTrainer):
+    """複数ワーカーでLightGBMのdata-parallel学習を行うTrainer
+
+    学習データはshard_keyのhashでワーカーに振り分け、各ワーカーは自分のshardだけを読み込む。
+    binの境界はLightGBMがワーカー間で同期し、各iterationのヒストグラムを集約して1つのモデルを学習する。
+    early stoppingの判定と2段階目のiteration数が全ワーカーで一致するように、
+    validデータは全ワーカーが全件を読み込み、カテゴリとデータ数はBQで全体から集計する。
+    モデルのアップロードとtestデータの評価はchief (rank 0) だけが行う。
+
+    Args:
+        config (DictConfig): train.trainerの設定
+        exp_name (str): 実験名
+        cluster (ClusterSpec): ワーカーの一覧と自身のrank
+    """
+
+    def __init__(self, config: DictConfig, exp_name: str, cluster: ClusterSpec):
+        super().__init__(config, exp_name)
+        if self.setting.lgbm.second_stage != "retrain":
+            raise ValueError(
+                "distributed training supports only second_stage: retrain."
+            )
+        self.cluster = cluster
+        setting = self.config.distributed
+        self.params.update(
+            cluster.lgbm_params(setting.tree_learner, int(setting.time_out))
+        )
+
+    @property
+    def _table(self) -> str:
+        return f"{self.setting.dataset_id}.train_dataset_{self.exp_name}"
+
+    def _shard_condition(self) -> str:
+        setting = self.config.distributed
+        return f"MOD(ABS(FARM_FINGERPRINT({setting.shard_key})), {self.cluster.num_machines}) = {self.cluster.rank}"
+
+    def _load_data(self) -> pd.DataFrame:
+        """自分のshardの学習データと全件のvalidデータ (chiefはtestデータも) を読み込む
+
+        in_shardは自分のshardの行かどうかを表し、valid期間まで含めた再学習ではin_shardの行だけを使う。
+        """
+        test_condition = 'split_flag = "test"' if self.cluster.is_chief else "FALSE"
+        query = f"""
+        SELECT
+          *,
+          {self._shard_condition()} AS in_shard,
+        FROM {self._table}
+        WHERE
+          {self._debug_condition()}
+          AND (
+            ({self._shard_condition()} AND IFNULL(split_flag, "") != "test")
+            OR split_flag = "valid"
+            OR {test_condition}
+          )
+        """
+        return self._read_gbq(query)
+
+    def _load_vocab(self) -> Dict[str, Iterable]:
+        """train, validに共通して登場するカテゴリを全データから取得する"""
+        vocab = {}
+        for col in self.setting.lgbm.cat_cols:
+            query = f"""
+            SELECT DISTINCT {col} FROM {self._table}
+            WHERE {self._debug_condition()} AND split_flag = "train"
+            INTERSECT DISTINCT
+            SELECT DISTINCT {col} FROM {self._table}
+            WHERE {self._debug_condition()} AND split_flag = "valid"
+            """
+            vocab[col] = pd.read_gbq(
+                query, project_id=self.setting.gcp_project, use_bqstorage_api=True
+            )[col].tolist()
+        return vocab
+
+    def _load_split_counts(self) -> Tuple[int, int]:
+        """全データのtrain, valid期間まで含めたデータの行数"""
+        query = f"""
+        SELECT
+          COUNTIF(split_flag = "train") AS n_train,
+          COUNTIF(IFNULL(split_flag, "") != "test") AS n_train_valid,
+        FROM {self._table}
+        WHERE {self._debug_condition()}
+        """
+        counts = pd.read_gbq(
+            query, project_id=self.setting.gcp_project, use_bqstorage_api=True
+        )
+        return int(counts["n_train"][0]), int(counts["n_train_valid"][0])
+
+    def fit(
+        self, df: pd.DataFrame, resume: bool = False
+    ) -> Tuple[Dict[str, LabelEncoder], lgb.Booster, pd.DataFrame]:
+        """全ワーカーで同じカテゴリのエンコードとiteration数を使って2段階の学習を行う
+
+        Args:
+            df (pd.DataFrame): _load_dataで読み込んだshardのデータ
+            resume (bool, optional): 分散学習ではcheckpointに対応していないため使用しない
+
+        Returns:
+            Tuple[Dict[str, LabelEncoder], lgb.Booster, pd.DataFrame]: エンコーダ, 学習済みモデル, testデータ
+        """
+        if resume:
+            logger.warning("checkpoint is not supported in distributed training.")
+        train_df, valid_df, train_valid_df, test_df, le_dict = self._preprocess(
+            df, vocab=self._load_vocab()
+        )
+        train_valid_df = train_valid_df[train_valid_df["in_shard"]].reset_index(
+            drop=True
+        )
+        logger.info(
+            f"[rank {self.cluster.rank}/{self.cluster.num_machines}] "
+            f"train: {len(train_df)}, valid: {len(valid_df)}, train_valid: {len(train_valid_df)}"
+        )
+        bst = self._first_train(train_df, valid_df)
+        n_train, n_train_valid = self._load_split_counts()
+        best_iterations = int(bst.current_iteration() * n_train_valid / n_train)
+        bst.free_network()
+        bst = self._second_train(train_valid_df, num_iterations=best_iterations)
+        bst.free_network()
+        return le_dict, bst, test_df
+
+    def execute(self):
+        df = self._load_data()
+        le_dict, bst, test_df = self.fit(df)
+        if not self.cluster.is_chief:
+            logger.info(f"[rank {self.cluster.rank}] training was finished.")
+            return
+        self._report(le_dict, bst, test_df.drop(columns=["in_shard"]))
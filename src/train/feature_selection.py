@@ -0,0 +1,59 @@
+from typing import Iterable, List, Optional
+
+import pandas as pd
+from omegaconf import OmegaConf
+
+
+def select_by_cumulative_gain(
+    gain: pd.Series, cumulative_gain: float, candidates: Optional[Iterable[str]] = None
+) -> pd.DataFrame:
+    """gainの大きい順に、累積割合がcumulative_gainに達するまでの特徴量を残す
+
+    Args:
+        gain (pd.Series): 特徴量名をindexとするgain
+        cumulative_gain (float): 残す特徴量のgainの累積割合 (0 ~ 1)
+        candidates (Optional[Iterable[str]], optional): 削除の対象にする特徴量。
+            指定されない場合は全ての特徴量を対象にする. Defaults to None.
+
+    Returns:
+        pd.DataFrame: feature, gain, share, cumulative_share, keepのgainの大きい順の表
+    """
+    report_df = (
+        gain.rename("gain")
+        .rename_axis("feature")
+        .reset_index()
+        .sort_values(["gain", "feature"], ascending=[False, True])
+        .reset_index(drop=True)
+    )
+    total = report_df["gain"].sum()
+    report_df["share"] = report_df["gain"] / total if total > 0 else 0.0
+    report_df["cumulative_share"] = report_df["share"].cumsum()
+    # 累積割合がcumulative_gainを超える特徴量までを残す (gainが0の特徴量は残さない)
+    previous_share = report_df["cumulative_share"] - report_df["share"]
+    report_df["keep"] = (previous_share < cumulative_gain) & (report_df["gain"] > 0)
+    if candidates is not None:
+        report_df.loc[~report_df["feature"].isin(list(candidates)), "keep"] = True
+    return report_df
+
+
+def feature_override_yaml(
+    numerical_cols: List[str],
+    dropped_cols: List[str],
+    header: str,
+    base_config: Optional[str] = None,
+) -> str:
+    """選択した特徴量をexps/*.yamlに重ねるoverride yamlの文字列にする
+
+    Args:
+        numerical_cols (List[str]): 残す数値特徴量 (元の順序)
+        dropped_cols (List[str]): 削除する特徴量。学習, 予測データのSQLでEXCEPTされる
+        header (str): 先頭に書くコメント
+        base_config (Optional[str], optional): 重ねる元のexpのyaml名 (例: exp006). Defaults to None.
+    """
+    override = {
+        "feature": {"numerical_cols": numerical_cols, "dropped_cols": dropped_cols}
+    }
+    if base_config is not None:
+        # inv -f exps/{exp}_selected.yamlで元のexpのyamlに重ねて読み込む
+        override = {"defaults": [base_config, "_self_"], **override}
+    return header + OmegaConf.to_yaml(OmegaConf.create(override))
@@ -0,0 +1,170 @@
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# グループごとに集計する十分統計量 (この順にstatsの列に並ぶ)
+STAT_COLS = [
+    "n",
+    "sum_error",
+    "sum_abs_error",
+    "sum_squared_error",
+    "sum_label",
+    "sum_abs_label",
+    "sum_pred",
+]
+METRIC_COLS = ["rmse", "mae", "wape", "bias"]
+
+
+def group_sums(keys: np.ndarray, stats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """keysでソートしてグループの境界ごとにstatsを合計する
+
+    Args:
+        keys (np.ndarray): グループのキー (n,)
+        stats (np.ndarray): 行ごとの統計量 (n, k)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: ユニークなキー (g,) とグループごとの合計 (g, k)
+    """
+    if len(keys) == 0:
+        return keys[:0], np.zeros((0, stats.shape[1]))
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(
+        np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])
+    )
+    return sorted_keys[starts], np.add.reduceat(stats[order], starts, axis=0)
+
+
+def row_stats(labels: np.ndarray, preds: np.ndarray) -> np.ndarray:
+    """行ごとの十分統計量 (STAT_COLSの順) を作成する"""
+    labels = np.asarray(labels, dtype=np.float64)
+    preds = np.asarray(preds, dtype=np.float64)
+    error = preds - labels
+    return np.column_stack(
+        [
+            np.ones_like(labels),
+            error,
+            np.abs(error),
+            error * error,
+            labels,
+            np.abs(labels),
+            preds,
+        ]
+    )
+
+
+class SegmentMetrics(object):
+    """セグメント (yj_code, store_code, ABCフラグ, horizonなど) ごとの評価指標を計算する
+
+    十分統計量をグループごとに合計しておき、最後に評価指標に変換する。
+    チャンクごとにupdateすれば、testデータ全体をメモリに載せずに集計できる。
+
+    Args:
+        segment_cols (List[str]): 集計するセグメントのカラム名
+    """
+
+    def __init__(self, segment_cols: List[str]):
+        self.segment_cols = list(segment_cols)
+        self._partials: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def update(
+        self,
+        segments: Mapping[str, Iterable],
+        labels: np.ndarray,
+        preds: np.ndarray,
+    ) -> None:
+        """1チャンク分の集計を足し込む
+
+        Args:
+            segments (Mapping[str, Iterable]): セグメントのカラム名と行ごとの値
+            labels (np.ndarray): 正解値
+            preds (np.ndarray): 予測値
+        """
+        stats = row_stats(labels, preds)
+        self._merge("all", np.zeros(len(stats), dtype=np.int64), stats)
+        for col in self.segment_cols:
+            keys = np.asarray(segments[col])
+            if keys.dtype == object:
+                # 欠損値はソートできないので文字列にする
+                keys = pd.Series(keys).fillna("unknown").astype(str).to_numpy()
+            self._merge(col, keys, stats)
+
+    def _merge(self, col: str, keys: np.ndarray, stats: np.ndarray) -> None:
+        uniques, sums = group_sums(keys, stats)
+        if col in self._partials:
+            prev_uniques, prev_sums = self._partials[col]
+            uniques, sums = group_sums(
+                np.concatenate([prev_uniques, uniques]), np.vstack([prev_sums, sums])
+            )
+        self._partials[col] = (uniques, sums)
+
+    def result(self) -> pd.DataFrame:
+        """セグメントごとの評価指標をまとめたlong形式のDataFrameを返す
+
+        Returns:
+            pd.DataFrame: segment, segment_value, n, rmse, mae, wape, bias, sum_label, sum_pred
+        """
+        frames = []
+        for col in ["all"] + self.segment_cols:
+            if col not in self._partials:
+                continue
+            uniques, sums = self._partials[col]
+            stats = dict(zip(STAT_COLS, sums.T))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                frames.append(
+                    pd.DataFrame(
+                        {
+                            "segment": col,
+                            "segment_value": uniques.astype(str),
+                            "n": stats["n"].astype(np.int64),
+                            "rmse": np.sqrt(stats["sum_squared_error"] / stats["n"]),
+                            "mae": stats["sum_abs_error"] / stats["n"],
+                            # 実績の絶対値の合計に対する誤差の割合
+                            "wape": stats["sum_abs_error"] / stats["sum_abs_label"],
+                            # 正なら過大予測, 負なら過小予測
+                            "bias": stats["sum_error"] / stats["sum_abs_label"],
+                            "sum_label": stats["sum_label"],
+                            "sum_pred": stats["sum_pred"],
+                        }
+                    )
+                )
+        df = pd.concat(frames, ignore_index=True)
+        df["segment"] = df["segment"].astype("category")
+        for col in METRIC_COLS + ["sum_label", "sum_pred"]:
+            df[col] = df[col].astype(np.float32)
+        return df
+
+
+def segment_metrics(
+    df: pd.DataFrame,
+    segment_cols: List[str],
+    labels: np.ndarray,
+    preds: np.ndarray,
+    chunk_size: Optional[int] = None,
+) -> pd.DataFrame:
+    """dfのsegment_colsごとの評価指標を計算する
+
+    Args:
+        df (pd.DataFrame): セグメントのカラムを含むDataFrame
+        segment_cols (List[str]): 集計するセグメントのカラム名
+        labels (np.ndarray): 正解値
+        preds (np.ndarray): 予測値
+        chunk_size (Optional[int], optional): 1回に集計する行数. Defaults to None (一度に集計).
+
+    Returns:
+        pd.DataFrame: SegmentMetrics.resultのDataFrame
+    """
+    metrics = SegmentMetrics(segment_cols)
+    labels = np.asarray(labels)
+    preds = np.asarray(preds)
+    columns = {col: df[col].to_numpy() for col in segment_cols}
+    chunk_size = chunk_size or max(len(df), 1)
+    for start in range(0, len(df), chunk_size):
+        end = start + chunk_size
+        metrics.update(
+            {col: values[start:end] for col, values in columns.items()},
+            labels[start:end],
+            preds[start:end],
+        )
+    return metrics.result()
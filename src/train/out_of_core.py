@@ -0,0 +1,271 @@
+import bisect
+import os
+import shutil
+from glob import glob
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from omegaconf import DictConfig
+from sklearn.preprocessing import LabelEncoder
+
+from src.bq import BQClient
+from src.gcs import GCSClient
+from src.log import get_logger
+from src.train.trainer import LGBMTrainer
+
+logger = get_logger(__name__)
+
+# split_flagごとにshardを書き出す。restはtrain, validの間などtest以外の残りの期間
+SPLIT_CONDITIONS = {
+    "train": 'split_flag = "train"',
+    "valid": 'split_flag = "valid"',
+    "rest": 'IFNULL(split_flag, "") NOT IN ("train", "valid", "test")',
+    "test": 'split_flag = "test"',
+}
+
+
+class ParquetSequence(lgb.Sequence):
+    """Parquetのshardをrow group単位で読み込み、lgb.Datasetに渡すSequence
+
+    lgb.Datasetは、binの境界を決めるためにサンプリングした行を昇順に1行ずつ読み、
+    その後batch_size行ずつ読み込んでbin化する。直前に読んだrow groupだけを保持するので、
+    メモリに載る生データは1つのrow groupと1バッチ分になる。
+
+    Args:
+        paths (List[str]): 読み込むParquetファイル (この順に連結する)
+        columns (List[str]): 特徴量のカラム (この順に並べる)
+        transform (Optional[Callable[[pd.DataFrame], pd.DataFrame]], optional):
+            読み込んだrow groupに適用する前処理 (カテゴリ変数のエンコードなど). Defaults to None.
+        batch_size (int, optional): Dataset作成時に1回に読み込む行数. Defaults to 100000.
+    """
+
+    def __init__(
+        self,
+        paths: List[str],
+        columns: List[str],
+        transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+        batch_size: int = 100000,
+    ):
+        self.paths = paths
+        self.columns = columns
+        self.transform = transform
+        self.batch_size = batch_size
+        # (ファイル, row group) ごとの先頭の行番号
+        self.row_groups: List[Tuple[str, int]] = []
+        self.offsets: List[int] = [0]
+        for path in paths:
+            metadata = pq.ParquetFile(path).metadata
+            for i in range(metadata.num_row_groups):
+                self.row_groups.append((path, i))
+                self.offsets.append(self.offsets[-1] + metadata.row_group(i).num_rows)
+        self._cached_index = -1
+        self._cached: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return self.offsets[-1]
+
+    def _read_row_group(self, index: int) -> np.ndarray:
+        if index != self._cached_index:
+            path, i = self.row_groups[index]
+            df = (
+                pq.ParquetFile(path).read_row_group(i, columns=self.columns).to_pandas()
+            )
+            if self.transform is not None:
+                df = self.transform(df)
+            self._cached = df[self.columns].to_numpy(dtype=np.float32)
+            self._cached_index = index
+        return self._cached
+
+    def _rows(self, start: int, stop: int) -> np.ndarray:
+        chunks = []
+        while start < stop:
+            index = bisect.bisect_right(self.offsets, start) - 1
+            row_group = self._read_row_group(index)
+            end = min(stop, self.offsets[index + 1])
+            chunks.append(
+                row_group[start - self.offsets[index] : end - self.offsets[index]]
+            )
+            start = end
+        return np.concatenate(chunks) if len(chunks) > 1 else chunks[0].copy()
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            # サンプリングした行はfloat64で渡す必要がある
+            return self._rows(int(idx), int(idx) + 1)[0].astype(np.float64)
+        if isinstance(idx, slice):
+            start, stop, _ = idx.indices(len(self))
+            return self._rows(start, stop)
+        raise TypeError(
+            f"Sequence index must be integer or slice, got {type(idx).__name__}"
+        )
+
+
+def shard_paths(shard_dir: str, split: str) -> List[str]:
+    return sorted(glob(f"{shard_dir}/{split}/*.parquet"))
+
+
+def read_column(paths: Iterable[str], col: str) -> np.ndarray:
+    """shardから1カラムだけを読み込んで連結する"""
+    return np.concatenate(
+        [pq.read_table(path, columns=[col])[col].to_numpy() for path in paths]
+    )
+
+
+def unique_values(paths: Iterable[str], col: str) -> set:
+    """shardに登場するカテゴリを1ファイルずつ集計する"""
+    values = set()
+    for path in paths:
+        values |= set(pc.unique(pq.read_table(path, columns=[col])[col]).to_pylist())
+    values.discard(None)
+    return values
+
+
+class OutOfCoreLGBMTrainer(LGBMTrainer):
+    """学習データをParquetのshardに書き出し、メモリに載せずにLightGBMのDatasetを作成するTrainer
+
+    BQのEXPORT DATAでsplit_flagごとにshardを書き出してローカルにダウンロードし、
+    特徴量とラベルのカラムだけをParquetSequenceでrow groupごとに読み込んでbin化する。
+    pandasに載せるのは期間の短いtestデータだけなので、ピークメモリはbin化したDatasetと1バッチ程度になる。
+
+    Args:
+        config (DictConfig): train.trainerの設定
+        exp_name (str): 実験名
+    """
+
+    def __init__(self, config: DictConfig, exp_name: str):
+        super().__init__(config, exp_name)
+        if self.setting.lgbm.second_stage != "retrain":
+            raise ValueError(
+                "out-of-core training supports only second_stage: retrain."
+            )
+        setting = self.config.out_of_core
+        self.shard_prefix = f"{self.exp_name}/{setting.dir}/{setting.execution_date}"
+        self.local_dir = os.path.join(setting.local_dir, self.exp_name)
+
+    def _export_shards(self) -> str:
+        """split_flagごとにshardをGCSに書き出し、ローカルにダウンロードする
+
+        Returns:
+            str: shardをダウンロードしたディレクトリ
+        """
+        bq = BQClient(self.setting.gcp_project)
+        gcs = GCSClient(self.setting.gcp_project)
+        train_cols = ", ".join(self.feature_cols + [self.setting.lgbm.label_col])
+        for split, condition in SPLIT_CONDITIONS.items():
+            # testは評価とアップロードに使うので全カラムを書き出す
+            columns = "*" if split == "test" else train_cols
+            query = f"""
+            EXPORT DATA OPTIONS(
+              uri="gs://{self.setting.bucket}/{self.shard_prefix}/{split}/shard-*.parquet",
+              format="PARQUET",
+              overwrite=true
+            ) AS
+            SELECT {columns}
+            FROM {self.setting.dataset_id}.train_dataset_{self.exp_name}
+            WHERE {self._debug_condition()} AND {condition}
+            """
+            bq.execute_query(query)
+        shutil.rmtree(self.local_dir, ignore_errors=True)
+        gcs.download_directory(self.setting.bucket, self.shard_prefix, self.local_dir)
+        logger.info(
+            f"shards gs://{self.setting.bucket}/{self.shard_prefix} were downloaded to {self.local_dir}."
+        )
+        return self.local_dir
+
+    def _fit_label_encoders(self, shard_dir: str) -> Dict[str, LabelEncoder]:
+        """train, validに共通して登場するカテゴリでLabelEncoderをfitする (_preprocessと同じ)"""
+        le_dict = {}
+        for col in self.setting.lgbm.cat_cols:
+            cats = unique_values(shard_paths(shard_dir, "train"), col) & unique_values(
+                shard_paths(shard_dir, "valid"), col
+            )
+            le = LabelEncoder()
+            if pd.api.types.is_numeric_dtype(pd.Series(list(cats))):
+                le.fit(list(cats) + [-20000])
+            else:
+                le.fit(list(cats) + ["other"])
+            le_dict[col] = le
+        return le_dict
+
+    def _make_shard_dataset(
+        self,
+        paths: List[str],
+        le_dict: Dict[str, LabelEncoder],
+        reference: Optional[lgb.Dataset] = None,
+    ) -> lgb.Dataset:
+        sequence = ParquetSequence(
+            paths,
+            self.feature_cols,
+            transform=lambda df: self._encode(df, le_dict),
+            batch_size=self.config.out_of_core.batch_size,
+        )
+        return lgb.Dataset(
+            sequence,
+            label=read_column(paths, self.setting.lgbm.label_col).astype(np.float32),
+            reference=reference,
+            feature_name=self.feature_cols,
+            categorical_feature=list(self.setting.lgbm.cat_cols),
+        )
+
+    def fit_shards(
+        self, shard_dir: str, resume: bool = False
+    ) -> Tuple[Dict[str, LabelEncoder], lgb.Booster, pd.DataFrame]:
+        """shardからvalidで最適iterationを求め、valid期間まで含めて再学習する
+
+        Args:
+            shard_dir (str): split_flagごとのshardを含むディレクトリ
+            resume (bool, optional): checkpointを保存し、途中から再開するか. Defaults to False.
+
+        Returns:
+            Tuple[Dict[str, LabelEncoder], lgb.Booster, pd.DataFrame]: エンコーダ, 学習済みモデル, testデータ
+        """
+        le_dict = self._fit_label_encoders(shard_dir)
+        train_paths = shard_paths(shard_dir, "train")
+        lgtrain = self._make_shard_dataset(train_paths, le_dict)
+        lgvalid = self._make_shard_dataset(
+            shard_paths(shard_dir, "valid"), le_dict, reference=lgtrain
+        )
+        bst = self._train(
+            "first",
+            lgtrain,
+            num_boost_round=self.setting.lgbm.num_iterations,
+            valid_sets=[lgtrain, lgvalid],
+            valid_names=["train", "valid"],
+            early_stopping_rounds=self.setting.lgbm.early_stopping_rounds,
+            resume=resume,
+        )
+        n_train = lgtrain.num_data()
+        train_valid_paths = (
+            train_paths
+            + shard_paths(shard_dir, "valid")
+            + shard_paths(shard_dir, "rest")
+        )
+        lgtrain_valid = self._make_shard_dataset(train_valid_paths, le_dict)
+        n_train_valid = len(lgtrain_valid.data)
+        best_iterations = int(bst.current_iteration() * n_train_valid / n_train)
+        # 1段階目のbin化済みDatasetを解放してから再学習する
+        del bst, lgtrain, lgvalid
+        bst = self._train(
+            "second",
+            lgtrain_valid,
+            num_boost_round=best_iterations,
+            valid_sets=[lgtrain_valid],
+            valid_names=["train"],
+            resume=resume,
+        )
+        test_df = pd.concat(
+            [pd.read_parquet(path) for path in shard_paths(shard_dir, "test")],
+            ignore_index=True,
+        )
+        return le_dict, bst, test_df
+
+    def execute(self):
+        shard_dir = self._export_shards()
+        le_dict, bst, test_df = self.fit_shards(
+            shard_dir, resume=self.config.checkpoint.enabled
+        )
+        self._report(le_dict, bst, test_df)
@@ -0,0 +1,210 @@
+import json
+import math
+import os
+import shutil
+import threading
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+import lightgbm as lgb
+import numpy as np
+
+# 枝刈りされたtrial, 完了したtrial, エラーになったtrialの状態
+COMPLETE = "complete"
+PRUNED = "pruned"
+FAILED = "failed"
+# validの評価値の向き (rmseなどは小さいほど良く、aucなどは大きいほど良い)
+DIRECTIONS = ("minimize", "maximize")
+
+
+def _check_direction(direction: str) -> None:
+    if direction not in DIRECTIONS:
+        raise ValueError(f"direction must be one of {DIRECTIONS}, got '{direction}'")
+
+
+class TrialPruned(Exception):
+    """途中のvalidの評価値が悪く、打ち切られたtrial"""
+
+    def __init__(self, step: int, value: float):
+        super().__init__(f"pruned at iteration {step} (valid: {value:.6f})")
+        self.step = step
+        self.value = value
+
+
+def sample_params(space: Mapping, seed: int, trial_id: int) -> Dict[str, Any]:
+    """探索空間からパラメータをランダムに1つ選ぶ
+
+    trial_idごとに乱数系列を固定しているので、途中から再開しても同じパラメータが選ばれる。
+
+    Args:
+        space (Mapping): パラメータ名と{type: int | float | choice, low, high, log, choices}の辞書
+        seed (int): 探索全体のseed
+        trial_id (int): trialの番号
+
+    Returns:
+        Dict[str, Any]: LightGBMのパラメータ
+    """
+    rng = np.random.default_rng([seed, trial_id])
+    params = {}
+    for name, dist in space.items():
+        if dist["type"] == "choice":
+            choices = list(dist["choices"])
+            params[name] = choices[rng.integers(len(choices))]
+            continue
+        low, high = float(dist["low"]), float(dist["high"])
+        if dist.get("log", False):
+            value = math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            value = rng.uniform(low, high)
+        if dist["type"] == "int":
+            value = int(min(round(value), high))
+        params[name] = value
+    return params
+
+
+class MedianPruner(object):
+    """同じiterationでの完了済みtrialの評価値の中央値より悪いtrialを打ち切る
+
+    Args:
+        n_startup_trials (int): この数のtrialが完了するまでは打ち切らない
+        n_warmup_steps (int): このiteration数までは打ち切らない
+        direction (str): 評価値の向き (minimize or maximize)
+    """
+
+    def __init__(
+        self,
+        n_startup_trials: int = 4,
+        n_warmup_steps: int = 0,
+        direction: str = "minimize",
+    ):
+        _check_direction(direction)
+        self.n_startup_trials = n_startup_trials
+        self.n_warmup_steps = n_warmup_steps
+        self.direction = direction
+        # 完了済みtrialのiterationごとの評価値
+        self._completed: List[Dict[int, float]] = []
+        self._lock = threading.Lock()
+
+    def add_completed(self, intermediate_values: Mapping[int, float]) -> None:
+        with self._lock:
+            self._completed.append(dict(intermediate_values))
+
+    def should_prune(self, step: int, value: float) -> bool:
+        if step <= self.n_warmup_steps:
+            return False
+        maximize = self.direction == "maximize"
+        with self._lock:
+            if len(self._completed) < self.n_startup_trials:
+                return False
+            # early stoppingで先に止まったtrialはその時点の最良値を使う
+            values = []
+            for intermediate in self._completed:
+                reported = [v for s, v in intermediate.items() if s <= step]
+                if reported:
+                    values.append(max(reported) if maximize else min(reported))
+        if len(values) < self.n_startup_trials:
+            return False
+        median = float(np.median(values))
+        return value < median if maximize else value > median
+
+
+def pruning_callback(
+    pruner: MedianPruner,
+    intermediate_values: Dict[int, float],
+    interval: int,
+    valid_name: str = "valid",
+) -> Callable:
+    """interval iterationごとにvalidの評価値を記録し、枝刈りを判定するlightgbmのcallback"""
+
+    def _callback(env: lgb.callback.CallbackEnv) -> None:
+        step = env.iteration + 1
+        if step % interval != 0:
+            return
+        for data_name, eval_name, value, is_higher_better in env.evaluation_result_list:
+            if data_name == valid_name:
+                break
+        else:
+            return
+        if is_higher_better != (pruner.direction == "maximize"):
+            raise ValueError(
+                f"metric '{eval_name}' does not match direction '{pruner.direction}'"
+            )
+        intermediate_values[step] = value
+        if pruner.should_prune(step, value):
+            raise TrialPruned(step, value)
+
+    _callback.order = 25
+    return _callback
+
+
+class TrialLog(object):
+    """trialの結果をJSON Linesで保存する。同じpathを指定すれば途中から再開できる
+
+    アップロードは書き込みのロックの外で1つずつ行い、アップロード中も他のtrialの記録を待たせない。
+    アップロード中に記録されたtrialは、アップロード中のスレッドがまとめて続けてアップロードする。
+
+    Args:
+        local_path (str): ローカルに保存するファイルのパス
+        upload (Optional[Callable[[str], None]]): 書き込みの度に呼ぶ関数 (GCSへのアップロードなど)
+        direction (str): 評価値の向き (minimize or maximize)
+    """
+
+    def __init__(
+        self,
+        local_path: str,
+        upload: Optional[Callable[[str], None]] = None,
+        direction: str = "minimize",
+    ):
+        _check_direction(direction)
+        self.local_path = local_path
+        self.upload = upload
+        self.direction = direction
+        self._lock = threading.Lock()
+        # 記録したtrial数と、アップロード済みの内容に含まれるtrial数
+        self._version = 0
+        self._uploaded_version = 0
+        self._uploading = False
+        self.records: List[Dict[str, Any]] = []
+        if os.path.exists(local_path):
+            with open(local_path, "r") as f:
+                self.records = [json.loads(line) for line in f if line.strip()]
+
+    def finished_trial_ids(self) -> set:
+        # エラーになったtrialは再開時にやり直す
+        return {
+            record["trial_id"] for record in self.records if record["state"] != FAILED
+        }
+
+    def append(self, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self.records.append(record)
+            with open(self.local_path, "a") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._version += 1
+            if self.upload is None or self._uploading:
+                # アップロード中のスレッドが、終わった後にこの記録を含めてアップロードする
+                return
+            self._uploading = True
+        upload_path = f"{self.local_path}.upload"
+        try:
+            while True:
+                with self._lock:
+                    if self._uploaded_version >= self._version:
+                        self._uploading = False
+                        return
+                    # 書き込み中の行をアップロードしないように、ロック中にコピーする
+                    shutil.copyfile(self.local_path, upload_path)
+                    version = self._version
+                self.upload(upload_path)
+                self._uploaded_version = version
+        except BaseException:
+            with self._lock:
+                self._uploading = False
+            raise
+
+    def best(self) -> Optional[Dict[str, Any]]:
+        completed = [r for r in self.records if r["state"] == COMPLETE]
+        if not completed:
+            return None
+        if self.direction == "maximize":
+            return max(completed, key=lambda r: r["value"])
+        return min(completed, key=lambda r: r["value"])
@@ -0,0 +1,287 @@
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+from sklearn.preprocessing import LabelEncoder
+
+from src.artifacts import ArtifactUploader, render_barh
+from src.cpu import available_cpus
+from src.log import get_logger, init_worker, worker_state
+from src.predict.routed import SEGMENT_COL, RoutedBooster, SegmentKey
+from src.shared import SharedFrames, read_shared
+from src.train.trainer import LGBMTrainer
+
+logger = get_logger(__name__)
+
+# workerのプロセスでinitializerが設定するtrainerとエンコーダ
+# train, valid, train_valid, testのDataFrameはSharedFramesのファイルのパス
+_segment_trainer: Optional["SegmentedLGBMTrainer"] = None
+_segment_paths: Optional[Tuple[str, ...]] = None
+_segment_le_dict: Optional[Dict[str, LabelEncoder]] = None
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def core_budgets(
+    row_counts: Mapping[str, int], n_cores: int, n_parallel: int
+) -> Dict[str, int]:
+    """segmentごとの学習に使うスレッド数
+
+    全segmentを同時に学習する場合は行数に比例してコアを分け、
+    そうでない場合は同時に学習するsegment数でコアを等分する。
+    """
+    if n_parallel < len(row_counts):
+        return {segment: max(1, n_cores // n_parallel) for segment in row_counts}
+    total = sum(row_counts.values())
+    return {
+        segment: max(1, int(n_cores * count / total))
+        for segment, count in row_counts.items()
+    }
+
+
+def _init_worker(
+    trainer: "SegmentedLGBMTrainer",
+    paths: Tuple[str, ...],
+    le_dict: Dict[str, LabelEncoder],
+    log_state: Dict[str, Any],
+) -> None:
+    global _segment_trainer, _segment_paths, _segment_le_dict
+    init_worker(log_state)
+    _segment_trainer = trainer
+    _segment_paths = paths
+    _segment_le_dict = le_dict
+
+
+def _train_segment(
+    segment: str, indices: Tuple[np.ndarray, ...], num_thread: int
+) -> Dict[str, Any]:
+    """1つのsegmentのデータだけを取り出して2段階の学習と評価を行う (子プロセスで実行される)"""
+    start = time.perf_counter()
+    rss_before = _rss_mb()
+    trainer = _segment_trainer
+    train_df, valid_df, train_valid_df, test_df = [
+        read_shared(path, index).reset_index(drop=True)
+        for path, index in zip(_segment_paths, indices)
+    ]
+    trainer.params["num_thread"] = num_thread
+    bst = trainer._first_train(train_df, valid_df)
+    bst = trainer._second_stage(
+        trainer.setting.lgbm.second_stage, bst, train_df, train_valid_df
+    )
+    metrics = {"rmse": np.nan}
+    if len(test_df) > 0:
+        metrics, _ = trainer.evaluate(_segment_le_dict, bst, test_df)
+    return {
+        "segment": segment,
+        "model": bst.model_to_string(),
+        "n_train": len(train_df),
+        "n_valid": len(valid_df),
+        "n_train_valid": len(train_valid_df),
+        "n_test": len(test_df),
+        "num_thread": num_thread,
+        "num_trees": bst.current_iteration(),
+        "rmse": metrics["rmse"],
+        "train_sec": time.perf_counter() - start,
+        # workerの起動時の分を除いた、segmentの学習で増えたメモリ
+        # (workerを再利用した場合は前のsegmentのピークを含む)
+        "delta_peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        - rss_before,
+    }
+
+
+class SegmentedLGBMTrainer(LGBMTrainer):
+    """学習データをsegment (ABCクラス, yj_codeの先頭など) に分け、segmentごとのモデルを並列に学習するTrainer
+
+    カテゴリ変数のエンコードは全データで1回だけ行い、segmentごとの学習はspawnしたプロセスで行う。
+    データはSharedFramesで共有し、各プロセスは自分のsegmentの行だけを取り出してDatasetを作るので、
+    1プロセスのメモリは全体のモデルより小さくなる。
+    行数の多いsegmentから学習し、全segmentを同時に学習する場合は行数に比例してコアを分ける。
+    学習したモデルはRoutedBoosterにまとめ、全体のモデルと同じ{"le", "model"}の形式でアップロードする。
+
+    Args:
+        config (DictConfig): train.trainerの設定
+        exp_name (str): 実験名
+    """
+
+    def __init__(self, config: DictConfig, exp_name: str):
+        super().__init__(config, exp_name)
+        setting = self.config.segmented
+        self.segment_key = SegmentKey.from_config(setting)
+        self.default_segment = str(setting.default_segment)
+        self.min_rows = int(setting.min_rows)
+        self.n_parallel = int(setting.n_parallel)
+        self.segment_report: Optional[pd.DataFrame] = None
+
+    def _predict(self, bst: lgb.Booster, df: pd.DataFrame) -> np.ndarray:
+        if isinstance(bst, RoutedBooster):
+            return bst.predict(df[self.feature_cols], df[SEGMENT_COL].to_numpy())
+        return super()._predict(bst, df)
+
+    def _merge_small_segments(
+        self, train_df: pd.DataFrame, valid_df: pd.DataFrame
+    ) -> Dict[str, str]:
+        """trainがmin_rows行より少ないsegmentとvalidが無いsegmentをまとめる対応
+
+        まとめた先もtrainがmin_rows行以上, validが1行以上でないとearly stoppingができないため、
+        default_segmentにまとめた結果が条件を満たさない場合 (default_segmentが無いkeyを含む) は
+        条件を満たす最も大きいsegmentにまとめ、default_segmentをそのsegmentに変更する。
+        """
+        train_counts = train_df[SEGMENT_COL].value_counts()
+        valid_counts = valid_df[SEGMENT_COL].value_counts()
+
+        def qualifies(segments: Any) -> bool:
+            n_train = sum(train_counts.get(segment, 0) for segment in segments)
+            n_valid = sum(valid_counts.get(segment, 0) for segment in segments)
+            return n_train >= self.min_rows and n_valid > 0
+
+        # validにしか無いsegmentもまとめる (trainの無いsegmentのモデルは作らない)
+        segments = set(train_counts.index) | set(valid_counts.index)
+        small = {segment for segment in segments if not qualifies([segment])}
+        merged = small | {self.default_segment}
+        target = self.default_segment
+        if not qualifies(merged):
+            kept = sorted(
+                segments - small, key=lambda segment: (-train_counts[segment], segment)
+            )
+            # 全てのsegmentが条件を満たさない場合は全体を1つのモデルで学習する
+            if len(kept) > 0:
+                target = kept[0]
+        self.default_segment = target
+        return {
+            segment: target
+            for segment in merged
+            if segment != target and segment in segments
+        }
+
+    def fit(
+        self, df: pd.DataFrame, resume: bool = False
+    ) -> Tuple[Dict[str, LabelEncoder], RoutedBooster, pd.DataFrame]:
+        """segmentごとにvalidで最適iterationを求め、valid期間まで含めて再学習する
+
+        Args:
+            df (pd.DataFrame): split_flagを含む学習データ
+            resume (bool, optional): segmentごとの学習ではcheckpointに対応していないため使用しない
+
+        Returns:
+            Tuple[Dict[str, LabelEncoder], RoutedBooster, pd.DataFrame]: エンコーダ, 学習済みモデル, testデータ
+        """
+        if resume:
+            logger.warning("checkpoint is not supported in segmented training.")
+        segments = self.segment_key.assign(df, self.setting.gcp_project)
+        df[SEGMENT_COL] = np.where(pd.isna(segments), self.default_segment, segments)
+        train_df, valid_df, train_valid_df, test_df, le_dict = self._preprocess(df)
+        del df
+        frames = (train_df, valid_df, train_valid_df, test_df)
+        mapping = self._merge_small_segments(train_df, valid_df)
+        if mapping:
+            logger.info(
+                f"segments merged into '{self.default_segment}': {sorted(mapping)}"
+            )
+            for frame in frames:
+                frame[SEGMENT_COL] = frame[SEGMENT_COL].replace(mapping)
+
+        empty = np.array([], dtype=np.int64)
+        groups = [frame.groupby(SEGMENT_COL, sort=False).indices for frame in frames]
+        row_counts = train_df[SEGMENT_COL].value_counts().to_dict()
+        indices = {
+            segment: tuple(group.get(segment, empty) for group in groups)
+            for segment in row_counts
+        }
+        n_parallel = max(1, min(self.n_parallel, len(row_counts)))
+        budgets = core_budgets(row_counts, available_cpus(), n_parallel)
+        logger.info(
+            f"train {len(row_counts)} segments with {n_parallel} workers: "
+            + ", ".join(
+                f"{segment}={count} rows/{budgets[segment]} threads"
+                for segment, count in row_counts.items()
+            )
+        )
+
+        rows = []
+        boosters = {}
+        shared = SharedFrames(
+            dict(zip(["train", "valid", "train_valid", "test"], frames))
+        )
+        with shared as paths:
+            with ProcessPoolExecutor(
+                max_workers=n_parallel,
+                # LightGBM (OpenMP) を使った後のforkは子プロセスが止まることがあるのでspawnにする
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self, tuple(paths.values()), le_dict, worker_state()),
+            ) as executor:
+                # 行数の多いsegmentから始めると、全体の時間が最も長いsegmentで決まりやすい
+                jobs = [
+                    executor.submit(
+                        _train_segment, segment, indices[segment], budgets[segment]
+                    )
+                    for segment in sorted(row_counts, key=row_counts.get, reverse=True)
+                ]
+                for future in as_completed(jobs):
+                    result = future.result()
+                    boosters[result["segment"]] = lgb.Booster(
+                        model_str=result.pop("model")
+                    )
+                    logger.info(
+                        f"[done] segment {result['segment']}: {result['num_trees']} trees, "
+                        f"rmse={result['rmse']:.4f} ({result['train_sec']:.1f} sec)"
+                    )
+                    rows.append(result)
+        self.segment_report = (
+            pd.DataFrame(rows)
+            .sort_values("n_train", ascending=False)
+            .reset_index(drop=True)
+        )
+        bst = RoutedBooster(boosters, self.segment_key, self.default_segment)
+        return le_dict, bst, test_df
+
+    def _upload_importance(
+        self, uploader: ArtifactUploader, bst: RoutedBooster
+    ) -> None:
+        """segmentごとと合計の特徴量重要度 (gain) をアップロード"""
+        importance_df = pd.DataFrame(
+            {
+                segment: booster.feature_importance(importance_type="gain")
+                for segment, booster in zip(bst.segments, bst.boosters)
+            },
+            index=self.feature_cols,
+        )
+        importance_df.insert(0, "importance", importance_df.sum(axis=1))
+        importance_df = importance_df.sort_values(by="importance", ascending=False)
+        uploader.upload_dataframe(
+            importance_df, f"{self.exp_name}/feature_importance_{self.exp_name}.csv"
+        )
+        uploader.upload_plot(
+            render_barh,
+            (importance_df["importance"].head(100), "Feature importance"),
+            f"{self.exp_name}/feature_importance_{self.exp_name}.png",
+        )
+
+    def _upload_artifacts(
+        self,
+        uploader: ArtifactUploader,
+        le_dict: Dict[str, LabelEncoder],
+        bst: RoutedBooster,
+    ) -> None:
+        """モデル, 特徴量重要度と、segmentごとの行数, 学習時間, メモリ, rmseのreportをアップロードする"""
+        super()._upload_artifacts(uploader, le_dict, bst)
+        uploader.upload_dataframe(
+            self.segment_report, f"{self.exp_name}/segment_report_{self.exp_name}.csv"
+        )
+
+    def execute(self):
+        df = self._load_data()
+        le_dict, bst, test_df = self.fit(df)
+        logger.info(f"[segment report]\n{self.segment_report.to_string(index=False)}")
+        # testデータの予測にはsegmentのカラムを使う
+        self._report(le_dict, bst, test_df)
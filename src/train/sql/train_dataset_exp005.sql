@@ -56,12 +56,12 @@ WITH BASE AS (
 )
 
 SELECT
-  *,
+  *{% if dropped_cols %} EXCEPT({{ dropped_cols | join(", ") }}){% endif %},
 FROM TRAIN_DATA 
-LEFT JOIN `{{project_id}}.{{dataset_id}}.monthly_target_feature` USING(yj_code, store_code, dispensing_date)
-LEFT JOIN `{{project_id}}.{{dataset_id}}.monthly_category_feature` USING(yj_code, store_code, dispensing_date)
-LEFT JOIN `{{project_id}}.{{dataset_id}}.monthly_holiday_feature` USING(yj_code, store_code, dispensing_date)
-LEFT JOIN `{{project_id}}.{{dataset_id}}.monthly_last_prescription_feature` USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.{{dataset_id}}.monthly_target_feature` WHERE dispensing_date >= TRAIN_START_DATE AND dispensing_date <= END_DATE) USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.{{dataset_id}}.monthly_category_feature` WHERE dispensing_date >= TRAIN_START_DATE AND dispensing_date <= END_DATE) USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.{{dataset_id}}.monthly_holiday_feature` WHERE dispensing_date >= TRAIN_START_DATE AND dispensing_date <= END_DATE) USING(yj_code, store_code, dispensing_date)
+LEFT JOIN (SELECT * FROM `{{project_id}}.{{dataset_id}}.monthly_last_prescription_feature` WHERE dispensing_date >= TRAIN_START_DATE AND dispensing_date <= END_DATE) USING(yj_code, store_code, dispensing_date)
 LEFT JOIN `{{project_id}}.{{dataset_id}}.doctor_feature` USING(yj_code, store_code)
 LEFT JOIN (SELECT jst_date AS dispensing_date, is_holiday, day_type, day_type_sequence FROM`{{project_id}}.import.holiday_master`) USING (dispensing_date)
 
@@ -1,8 +1,18 @@
+import json
+import os
+import subprocess
+import sys
 from glob import glob
 from typing import Optional
 
 from invoke import Collection, Context
 from src.bq import BQClient
+from src.cpu import available_cpus
+from src.preprocess.tasks import preprocess_tasks
+from src.train.backtest import Backtester, origin_date
+from src.train.distributed import ClusterSpec, DistributedLGBMTrainer
+from src.train.out_of_core import OutOfCoreLGBMTrainer
+from src.train.segmented import SegmentedLGBMTrainer
 from src.train.trainer import LGBMTrainer
 from src.utils import add_create_delete_task, render_template, task, setup_logger
 
@@ -17,6 +27,9 @@ def train(
     exp_name: str,
     label_col: Optional[str] = None,
     execution_date: Optional[str] = None,
+    distributed: bool = False,
+    out_of_core: bool = False,
+    segmented: bool = False,
 ):
     """モデルの学習を行うtask
 
@@ -24,23 +37,260 @@ def train(
         c (Context): invokeのContext
         exp_name (str): 学習を行う実験名
         execution_date (str): 学習実行日
+        distributed (bool, optional): CLUSTER_SPECのワーカーでdata-parallel学習を行うか. Defaults to False.
+        out_of_core (bool, optional): 学習データをParquetのshardに書き出し、メモリに載せずに学習するか.
+            Defaults to False.
+        segmented (bool, optional): 学習データをsegmentに分け、segmentごとのモデルを並列に学習するか.
+            Defaults to False.
     """
+    if sum([distributed, out_of_core, segmented]) > 1:
+        raise ValueError(
+            "distributed, out_of_core and segmented cannot be used together."
+        )
     if execution_date is not None:
         c.execution_date = execution_date
         # vertex pipelinesで動的な環境変数を使えないので暫定対応
         c.train.trainer.model_path = f"{execution_date}/model"
         c.train.trainer.importance_path = f"{execution_date}/feature_importance"
         c.train.trainer.evaluation_path = f"{execution_date}/evaluation_result"
+        c.train.trainer.checkpoint.execution_date = execution_date
+        c.train.trainer.out_of_core.execution_date = execution_date
     if label_col is not None:
         # execution_date -> label_colの順に代入しないと何故かc.execution_date = execution_dateの部分でリセットされる
         c.train.trainer.lgbm.label_col = label_col
     logger = setup_logger(c)
 
-    trainer = LGBMTrainer(c.train.trainer, exp_name=exp_name)
+    if distributed:
+        cluster = ClusterSpec.from_env(c.train.trainer.distributed.base_port)
+        trainer = DistributedLGBMTrainer(c.train.trainer, exp_name, cluster)
+    elif out_of_core:
+        trainer = OutOfCoreLGBMTrainer(c.train.trainer, exp_name=exp_name)
+    elif segmented:
+        trainer = SegmentedLGBMTrainer(c.train.trainer, exp_name=exp_name)
+    else:
+        trainer = LGBMTrainer(c.train.trainer, exp_name=exp_name)
     trainer.execute()
     logger.info(f"[done] {exp_name} training.")
 
 
+@task
+def local_cluster(
+    c: Context,
+    exp_name: str,
+    num_workers: int = 2,
+    label_col: Optional[str] = None,
+    execution_date: Optional[str] = None,
+):
+    """ローカルで複数プロセスを立ち上げ、train.train --distributedの分散学習を確認するtask
+
+    VertexのCLUSTER_SPECと同じ形式で127.0.0.1のワーカーを設定し、
+    CPUをワーカー数で分けて各プロセスでtrain.trainを実行する。
+
+    Args:
+        c (Context): invokeのContext
+        exp_name (str): 学習を行う実験名
+        num_workers (int, optional): ワーカーのプロセス数. Defaults to 2.
+        label_col (Optional[str], optional): 目的変数のカラム名
+        execution_date (Optional[str], optional): 学習実行日
+    """
+    logger = setup_logger(c)
+    num_workers = int(num_workers)
+    cmd = [sys.executable, "-m", "invoke"]
+    # -fでoverrideするyamlを指定している場合
+    if c.config._runtime_path is not None:
+        cmd += ["-f", c.config._runtime_path]
+    cmd += ["train.train", "--exp-name", exp_name, "--distributed"]
+    if label_col is not None:
+        cmd += ["--label-col", label_col]
+    if execution_date is not None:
+        cmd += ["--execution-date", execution_date]
+
+    num_thread = max(available_cpus() // num_workers, 1)
+    processes = []
+    for rank in range(num_workers):
+        cluster_spec = {
+            "cluster": {
+                "workerpool0": ["127.0.0.1:2222"],
+                "workerpool1": ["127.0.0.1:2222"] * (num_workers - 1),
+            },
+            "task": {
+                "type": "workerpool0" if rank == 0 else "workerpool1",
+                "index": 0 if rank == 0 else rank - 1,
+            },
+        }
+        env = dict(os.environ, CLUSTER_SPEC=json.dumps(cluster_spec))
+        # num_thread: -1 (OpenMPのデフォルト) の場合にワーカー間でCPUを取り合わないようにする
+        env["OMP_NUM_THREADS"] = str(num_thread)
+        processes.append(subprocess.Popen(cmd, env=env))
+    return_codes = [p.wait() for p in processes]
+    if any(return_codes):
+        raise RuntimeError(f"distributed training failed: {return_codes}")
+    logger.info(f"[done] {exp_name} training with {num_workers} local workers.")
+
+
+@task
+def search(
+    c: Context,
+    exp_name: str,
+    label_col: Optional[str] = None,
+    n_trials: Optional[int] = None,
+    n_parallel: Optional[int] = None,
+    output: Optional[str] = None,
+):
+    """LightGBMのハイパーパラメータ探索を行うtask
+
+    同じexp_nameで再実行すると、GCSのtrials.jsonlから続きを探索する。
+
+    Args:
+        c (Context): invokeのContext
+        exp_name (str): 学習を行う実験名
+        label_col (Optional[str], optional): 目的変数のカラム名
+        n_trials (Optional[int], optional): 探索するtrial数。指定されない場合、yamlの値が使用される
+        n_parallel (Optional[int], optional): 同時に学習するtrial数。指定されない場合、yamlの値が使用される
+        output (Optional[str], optional): 最良のパラメータのoverride yamlをローカルに保存するパス (例: exps/exp042_search.yaml)
+    """
+    if label_col is not None:
+        c.train.trainer.lgbm.label_col = label_col
+    if n_trials is not None:
+        c.train.trainer.search.n_trials = int(n_trials)
+    if n_parallel is not None:
+        c.train.trainer.search.n_parallel = int(n_parallel)
+    logger = setup_logger(c)
+
+    trainer = LGBMTrainer(c.train.trainer, exp_name=exp_name)
+    trainer.search(output_path=output)
+    logger.info(f"[done] {exp_name} search.")
+
+
+@task
+def backtest(
+    c: Context,
+    exp_name: str,
+    origins: str,
+    label_col: Optional[str] = None,
+    n_parallel: Optional[int] = None,
+    build: bool = True,
+):
+    """複数のend_ts (origin)で学習, testデータの予測, 評価を行うrolling-origin backtestのtask
+
+    特徴量テーブルと学習データは全originを含む期間で1回だけ作成し、originごとに切り出して学習する。
+    originごとの評価指標と集計値は{bucket}/{exp_name}/backtest/にアップロードされる。
+
+    Args:
+        c (Context): invokeのContext
+        exp_name (str): 学習を行う実験名
+        origins (str): カンマ区切りのend_ts (例: 2022-09-01T00:00:00+09:00,2022-12-01T00:00:00+09:00)
+        label_col (Optional[str], optional): 目的変数のカラム名
+        n_parallel (Optional[int], optional): 同時に学習するfold数。指定されない場合、yamlの値が使用される
+        build (bool, optional): 特徴量テーブルと学習データを作成するか. Defaults to True.
+    """
+    if label_col is not None:
+        c.train.trainer.lgbm.label_col = label_col
+    if n_parallel is None:
+        n_parallel = c.train.backtest.n_parallel
+    logger = setup_logger(c)
+
+    origin_list = sorted(
+        [origin.strip() for origin in origins.split(",") if origin.strip()],
+        key=origin_date,
+    )
+    # foldごとの期間は元のsplit設定で切り出す
+    split_config = {
+        key: int(c.train.sql[key])
+        for key in ["sum_days", "train_days", "valid_days", "test_days"]
+    }
+    if build:
+        # 最も古いoriginの学習期間まで含むように期間を伸ばし、最新のoriginで1回だけ作成する
+        span_days = (origin_date(origin_list[-1]) - origin_date(origin_list[0])).days
+        train_days = c.preprocess.sql.train_days, c.train.sql.train_days
+        c.preprocess.sql.train_days = split_config["train_days"] + span_days
+        c.train.sql.train_days = split_config["train_days"] + span_days
+        try:
+            preprocess_tasks["all"](c, end_ts=origin_list[-1])
+            train_tasks[f"train-dataset-{exp_name}"](c, end_ts=origin_list[-1])
+        finally:
+            # 同じContextで続けて実行するtaskには元の期間を使う
+            c.preprocess.sql.train_days, c.train.sql.train_days = train_days
+
+    trainer = LGBMTrainer(c.train.trainer, exp_name=exp_name)
+    df = trainer._load_data()
+    backtester = Backtester(trainer, split_config, origin_list, int(n_parallel))
+    report_df = backtester.run(df)
+    logger.info(f"[backtest report]\n{report_df.to_string(index=False)}")
+    report_df.to_csv(
+        f"gs://{c.train.trainer.bucket}/{exp_name}/backtest/backtest_report_{exp_name}.csv",
+        index=False,
+    )
+    logger.info(f"[done] {exp_name} backtest.")
+
+
+@task
+def compare_second_stage(
+    c: Context,
+    exp_name: str,
+    strategies: str = "retrain,continue,refit",
+    label_col: Optional[str] = None,
+):
+    """2段階目の学習方法 (lgbm.second_stage) ごとの学習時間とtestデータの評価指標を比較するtask
+
+    1段階目の学習は1回だけ行い、同じモデルから各方法で2段階目を行う。
+    結果は{bucket}/{exp_name}/second_stage/second_stage_report_{exp_name}.csvにアップロードされる。
+
+    Args:
+        c (Context): invokeのContext
+        exp_name (str): 学習を行う実験名
+        strategies (str, optional): カンマ区切りの比較する方法. Defaults to "retrain,continue,refit".
+        label_col (Optional[str], optional): 目的変数のカラム名
+    """
+    if label_col is not None:
+        c.train.trainer.lgbm.label_col = label_col
+    logger = setup_logger(c)
+
+    trainer = LGBMTrainer(c.train.trainer, exp_name=exp_name)
+    df = trainer._load_data()
+    report_df = trainer.compare_second_stages(
+        df, [strategy.strip() for strategy in strategies.split(",")]
+    )
+    logger.info(f"[second stage report]\n{report_df.to_string(index=False)}")
+    report_df.to_csv(
+        f"gs://{c.train.trainer.bucket}/{exp_name}/second_stage/second_stage_report_{exp_name}.csv",
+        index=False,
+    )
+    logger.info(f"[done] {exp_name} second stage comparison.")
+
+
+@task
+def select_features(
+    c: Context,
+    exp_name: str,
+    label_col: Optional[str] = None,
+    output: Optional[str] = None,
+):
+    """gainの累積割合で数値特徴量を選択し、feature.numerical_cols, dropped_colsのoverride yamlを作成するtask
+
+    -fでexpのyamlを指定している場合、出力したyamlはそのyamlに重ねて読み込まれる
+    (例: inv -f exps/exp006.yaml train.select-features --exp-name exp006 --output exps/exp006_selected.yaml
+    の後は inv -f exps/exp006_selected.yaml ...)。dropped_colsは学習, 予測データのSQLでEXCEPTされる。
+
+    Args:
+        c (Context): invokeのContext
+        exp_name (str): 学習を行う実験名
+        label_col (Optional[str], optional): 目的変数のカラム名
+        output (Optional[str], optional): override yamlをローカルに保存するパス
+    """
+    if label_col is not None:
+        c.train.trainer.lgbm.label_col = label_col
+    logger = setup_logger(c)
+
+    base_config = None
+    if c.config._runtime_path is not None:
+        base_config = os.path.splitext(os.path.basename(c.config._runtime_path))[0]
+    trainer = LGBMTrainer(c.train.trainer, exp_name=exp_name)
+    report_df = trainer.select_features(output_path=output, base_config=base_config)
+    logger.info(f"[feature gain]\n{report_df.head(50).to_string(index=False)}")
+    logger.info(f"[done] {exp_name} feature selection.")
+
+
 @task
 def insert_evaluation(c: Context, exp_name: str, execution_date: Optional[str] = None):
     """testデータに対する評価結果をBQに挿入
@@ -74,4 +324,9 @@ def insert_evaluation(c: Context, exp_name: str, execution_date: Optional[str] =
 
 
 train_tasks.add_task(train)
+train_tasks.add_task(local_cluster)
+train_tasks.add_task(search)
+train_tasks.add_task(backtest)
+train_tasks.add_task(compare_second_stage)
+train_tasks.add_task(select_features)
 train_tasks.add_task(insert_evaluation)
@@ -1,31 +1,46 @@
-import logging
 import pickle
 import tempfile
+import time
 import uuid
 import warnings
-from typing import Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import lightgbm as lgb
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
 
+from src.artifacts import ArtifactUploader, render_barh
 from src.bq import BQClient
+from src.cache import table_cache
+from src.config import TrainerSetting
+from src.cpu import available_cpus
 from src.gcs import GCSClient
-
-# TODO: cloud loggingにも飛ばす設定をする
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(
-    logging.Formatter(
-        "[%(asctime)s] [%(name)s] [L%(lineno)d] [%(levelname)s][%(funcName)s] %(message)s "
-    )
+from src.log import get_logger
+from src.predict.explain import KEY_COLS, ContributionExplainer, upload_contributions
+from src.predict.routed import SEGMENT_COL
+from src.train.checkpoint import (
+    CheckpointStore,
+    ResumableEarlyStopping,
+    checkpoint_callback,
+)
+from src.train.feature_selection import feature_override_yaml, select_by_cumulative_gain
+from src.train.metrics import segment_metrics
+from src.train.search import (
+    COMPLETE,
+    FAILED,
+    PRUNED,
+    MedianPruner,
+    TrialLog,
+    TrialPruned,
+    pruning_callback,
+    sample_params,
 )
-logger.addHandler(handler)
+
+logger = get_logger(__name__)
 
 
 class LGBMTrainer(object):
@@ -36,38 +51,59 @@ class LGBMTrainer(object):
     ):
         self.config = config
         self.exp_name = exp_name
-        self.feature_cols = self.config.lgbm.numerical_cols + self.config.lgbm.cat_cols
+        # ループの中で参照するパス, カラム, パラメータは開始時に1回だけ解決して使う
+        self.setting = TrainerSetting.from_config(config)
+        self.feature_cols = list(self.setting.lgbm.feature_cols)
+        # 学習に使用するLightGBMのパラメータ (backtestなどでnum_threadを上書きする)
+        self.params = dict(self.setting.lgbm.params)
         # 大容量のクエリ結果を一時格納するテーブル
         self.dest_table_id = (
             f"tmp_train_dataset_{self.exp_name}_{str(uuid.uuid4())[0:8]}"
         )
 
+    def _debug_condition(self) -> str:
+        """デバッグ用にdownsamplingする条件"""
+        if not self.setting.debug:
+            return "TRUE"
+        return f"""
+            yj_code in (
+                SELECT DISTINCT yj_code
+                FROM {self.setting.dataset_id}.train_dataset_{self.exp_name}
+                ORDER BY 1
+                LIMIT 10
+            )
+            """
+
     def _load_data(self) -> pd.DataFrame:
         query = f"""
-        SELECT * FROM {self.config.dataset_id}.train_dataset_{self.exp_name}
+        SELECT * FROM {self.setting.dataset_id}.train_dataset_{self.exp_name}
         """
-        if self.config.debug:
-            # デバッグ用にdownsamplingする
-            query += f"""
-                WHERE yj_code in (
-                    SELECT DISTINCT yj_code
-                    FROM {self.config.dataset_id}.train_dataset_{self.exp_name}
-                    ORDER BY 1
-                    LIMIT 10
-                )
-                """
+        if self.setting.debug:
+            query += f"WHERE {self._debug_condition()}"
+        cache = table_cache(self.config.cache, self.setting.gcp_project)
+        if cache is not None:
+            return cache.read(
+                self.setting.gcp_project,
+                self.setting.dataset_id,
+                f"train_dataset_{self.exp_name}",
+                query,
+                lambda: self._read_gbq(query),
+            )
+        return self._read_gbq(query)
 
+    def _read_gbq(self, query: str) -> pd.DataFrame:
+        """大容量のクエリ結果を一時テーブル経由で読み込む"""
         df = pd.read_gbq(
             query,
-            project_id=self.config.gcp_project,
+            project_id=self.setting.gcp_project,
             use_bqstorage_api=True,
             progress_bar_type="tqdm",
             configuration={
                 "query": {
                     "allowLargeResults": True,
                     "destinationTable": {
-                        "projectId": self.config.gcp_project,
-                        "datasetId": self.config.dataset_id,
+                        "projectId": self.setting.gcp_project,
+                        "datasetId": self.setting.dataset_id,
                         "tableId": self.dest_table_id,
                     },
                 },
@@ -76,16 +112,23 @@ class LGBMTrainer(object):
         df_bytes = df.memory_usage(index=True).sum()
         logger.info(f"Data size: {df_bytes / 1024 / 1024} MB")
         logger.info(f"DataFrame Shape: {df.shape}")
-        bq = BQClient(self.config.gcp_project)
-        bq.delete_table(self.config.dataset_id, self.dest_table_id)
+        bq = BQClient(self.setting.gcp_project)
+        bq.delete_table(self.setting.dataset_id, self.dest_table_id)
 
         return df
 
     def _preprocess(
-        self, df: pd.DataFrame
+        self, df: pd.DataFrame, vocab: Optional[Dict[str, Iterable]] = None
     ) -> Tuple[
         pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame, Dict[str, LabelEncoder]
     ]:
+        """split_flagで分割し、カテゴリ変数をLabelEncoderで変換する
+
+        Args:
+            df (pd.DataFrame): split_flagを含む学習データ
+            vocab (Optional[Dict[str, Iterable]], optional): カテゴリ変数ごとに使用するカテゴリ。
+                指定されない場合はtrain, validに共通して登場するカテゴリを使う. Defaults to None.
+        """
         train_df = df.query('split_flag=="train"').reset_index(drop=True)
         valid_df = df.query('split_flag=="valid"').reset_index(drop=True)
         # train, validの間のデータも含むdf
@@ -93,9 +136,12 @@ class LGBMTrainer(object):
         test_df = df.query('split_flag=="test"').reset_index(drop=True)
         le_dict = {}
         # 共通して登場しないカテゴリは削除
-        for col in self.config.lgbm.cat_cols:
+        for col in self.setting.lgbm.cat_cols:
             le = LabelEncoder()
-            cats = set(train_df[col].unique()) & set(valid_df[col].unique())
+            if vocab is not None:
+                cats = set(vocab[col])
+            else:
+                cats = set(train_df[col].unique()) & set(valid_df[col].unique())
             if pd.api.types.is_numeric_dtype(train_df[col]):
                 train_df.loc[train_df.query(f"{col} not in @cats").index, col] = -20000
                 valid_df.loc[valid_df.query(f"{col} not in @cats").index, col] = -20000
@@ -121,156 +167,311 @@ class LGBMTrainer(object):
             le_dict[col] = le
         return train_df, valid_df, train_valid_df, test_df, le_dict
 
+    def _make_dataset(
+        self,
+        df: pd.DataFrame,
+        reference: Optional[lgb.Dataset] = None,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> lgb.Dataset:
+        return lgb.Dataset(
+            df[self.feature_cols],
+            label=np.array(df[self.setting.lgbm.label_col]),
+            reference=reference,
+            feature_name=self.feature_cols,
+            categorical_feature=list(self.setting.lgbm.cat_cols),
+            params=params,
+        )
+
+    def _checkpoint_store(self, stage: str) -> CheckpointStore:
+        setting = self.config.checkpoint
+        return CheckpointStore(
+            GCSClient(self.setting.gcp_project),
+            self.setting.bucket,
+            f"{self.exp_name}/{setting.dir}/{setting.execution_date}/{stage}",
+        )
+
+    def _train(
+        self,
+        stage: str,
+        lgtrain: lgb.Dataset,
+        num_boost_round: int,
+        valid_sets: List[lgb.Dataset],
+        valid_names: List[str],
+        early_stopping_rounds: Optional[int] = None,
+        resume: bool = False,
+        init_model: Optional[lgb.Booster] = None,
+    ) -> lgb.Booster:
+        """lgb.trainを実行する。resumeの場合はcheckpointを保存し、既存のcheckpointから再開する
+
+        同じexp_name, execution_dateで再実行すると、完了済みのstageは保存したモデルを返し、
+        途中のstageはcheckpointのモデルをinit_modelにして残りのiterationを学習する。
+        init_modelを指定した場合は、その木に追加でnum_boost_round回学習する。
+        """
+        callbacks = [lgb.log_evaluation(self.setting.lgbm.verbose_eval)]
+        if not resume:
+            if early_stopping_rounds is not None:
+                callbacks.append(lgb.early_stopping(early_stopping_rounds))
+            return lgb.train(
+                self.params,
+                lgtrain,
+                num_boost_round=num_boost_round,
+                init_model=init_model,
+                valid_sets=valid_sets,
+                valid_names=valid_names,
+                callbacks=callbacks,
+            )
+
+        store = self._checkpoint_store(stage)
+        state = store.load()
+        if state is not None and state["completed"]:
+            logger.info(f"[skip] {stage} training was already completed.")
+            return state["booster"]
+        early_stopping = None
+        if early_stopping_rounds is not None:
+            early_stopping = ResumableEarlyStopping(
+                early_stopping_rounds,
+                state=state["early_stopping"] if state is not None else None,
+            )
+            callbacks.append(early_stopping)
+        callbacks.append(
+            checkpoint_callback(
+                store, self.config.checkpoint.interval_sec, early_stopping
+            )
+        )
+        # checkpointのモデルとiterationはinit_modelの木も含む
+        base_iterations = (
+            init_model.current_iteration() if init_model is not None else 0
+        )
+        if state is not None:
+            init_model = state["booster"]
+        done_iterations = (
+            state["iteration"] - base_iterations if state is not None else 0
+        )
+        if done_iterations < num_boost_round:
+            bst = lgb.train(
+                self.params,
+                lgtrain,
+                num_boost_round=num_boost_round - done_iterations,
+                init_model=init_model,
+                valid_sets=valid_sets,
+                valid_names=valid_names,
+                callbacks=callbacks,
+            )
+        else:
+            bst = init_model
+        store.save(
+            bst,
+            {
+                "iteration": bst.current_iteration(),
+                "completed": True,
+                "best_iteration": bst.best_iteration,
+                "early_stopping": early_stopping.state() if early_stopping else None,
+            },
+        )
+        return bst
+
     def _first_train(
-        self, train_df: pd.DataFrame, valid_df: pd.DataFrame
+        self, train_df: pd.DataFrame, valid_df: pd.DataFrame, resume: bool = False
     ) -> lgb.Booster:
         """validを用いて最適なiterationを求める
 
         Args:
             train_df (pd.DataFrame): 訓練期間のデータ
             valid_df (pd.DataFrame): 検証期間のデータ
+            resume (bool, optional): checkpointを保存し、途中から再開するか. Defaults to False.
 
         Returns:
             lgb.Booster: 学習済みモデル
         """
-        X_train = train_df[self.feature_cols]
-        y_train = train_df[self.config.lgbm.label_col]
-        X_valid = valid_df[self.feature_cols]
-        y_valid = valid_df[self.config.lgbm.label_col]
-        lgtrain = lgb.Dataset(
-            X_train,
-            label=np.array(y_train),
-            feature_name=self.feature_cols,
-            categorical_feature=self.config.lgbm.cat_cols,
-        )
-        lgvalid = lgb.Dataset(
-            X_valid,
-            label=np.array(y_valid),
-            feature_name=self.feature_cols,
-            categorical_feature=self.config.lgbm.cat_cols,
-        )
-        bst = lgb.train(
-            dict(self.config.lgbm.params),
+        lgtrain = self._make_dataset(train_df)
+        lgvalid = self._make_dataset(valid_df)
+        return self._train(
+            "first",
             lgtrain,
-            num_boost_round=self.config.lgbm.num_iterations,
+            num_boost_round=self.setting.lgbm.num_iterations,
             valid_sets=[lgtrain, lgvalid],
             valid_names=["train", "valid"],
-            callbacks=[
-                lgb.log_evaluation(self.config.lgbm.verbose_eval),
-                lgb.early_stopping(self.config.lgbm.early_stopping_rounds),
-            ],
+            early_stopping_rounds=self.setting.lgbm.early_stopping_rounds,
+            resume=resume,
         )
-        return bst
 
-    def _second_train(self, train_df: pd.DataFrame, num_iterations: int) -> lgb.Booster:
+    def _second_train(
+        self, train_df: pd.DataFrame, num_iterations: int, resume: bool = False
+    ) -> lgb.Booster:
         """validを用いて求めた最適iterationとvalid期間まで含めたデータで再学習する
 
         Args:
             train_df (pd.DataFrame): valid期間まで含めたデータ
             num_iterations (int): validを用いて求めた最適iterationをデータ数で線形に増やした値
+            resume (bool, optional): checkpointを保存し、途中から再開するか. Defaults to False.
 
         Returns:
             lgb.Booster: 学習済みモデル
         """
-        X_train = train_df[self.feature_cols]
-        y_train = train_df[self.config.lgbm.label_col]
-        lgtrain = lgb.Dataset(
-            X_train,
-            label=np.array(y_train),
-            feature_name=self.feature_cols,
-            categorical_feature=self.config.lgbm.cat_cols,
-        )
-        bst = lgb.train(
-            dict(self.config.lgbm.params),
+        lgtrain = self._make_dataset(train_df)
+        return self._train(
+            "second",
             lgtrain,
             num_boost_round=num_iterations,
             valid_sets=[lgtrain],
             valid_names=["train"],
-            callbacks=[
-                lgb.log_evaluation(self.config.lgbm.verbose_eval),
-            ],
+            resume=resume,
         )
-        return bst
+
+    def _continue_train(
+        self,
+        bst: lgb.Booster,
+        train_df: pd.DataFrame,
+        num_iterations: int,
+        resume: bool = False,
+    ) -> lgb.Booster:
+        """1段階目のモデルから、valid期間まで含めたデータで不足分のiterationだけ追加で学習する
+
+        Args:
+            bst (lgb.Booster): 1段階目の学習済みモデル
+            train_df (pd.DataFrame): valid期間まで含めたデータ
+            num_iterations (int): 追加学習後の木の数
+            resume (bool, optional): checkpointを保存し、途中から再開するか. Defaults to False.
+
+        Returns:
+            lgb.Booster: 学習済みモデル
+        """
+        num_boost_round = num_iterations - bst.current_iteration()
+        if num_boost_round <= 0:
+            # 1段階目の木の数が少ないと追加するiterationが無い (lgb.trainは0回の学習ができない)
+            logger.info(
+                f"[skip] no iterations to add to the first stage ({bst.current_iteration()} trees)."
+            )
+            return bst
+        lgtrain = self._make_dataset(train_df)
+        return self._train(
+            "second",
+            lgtrain,
+            num_boost_round=num_boost_round,
+            valid_sets=[lgtrain],
+            valid_names=["train"],
+            resume=resume,
+            init_model=bst,
+        )
+
+    def _refit(self, bst: lgb.Booster, train_df: pd.DataFrame) -> lgb.Booster:
+        """1段階目のモデルの木の構造はそのままで、葉の値をvalid期間まで含めたデータで更新する
+
+        Args:
+            bst (lgb.Booster): 1段階目の学習済みモデル
+            train_df (pd.DataFrame): valid期間まで含めたデータ
+
+        Returns:
+            lgb.Booster: 葉の値を更新したモデル
+        """
+        return bst.refit(
+            train_df[self.feature_cols],
+            np.array(train_df[self.setting.lgbm.label_col]),
+            decay_rate=self.setting.lgbm.refit_decay_rate,
+        )
+
+    def _second_stage(
+        self,
+        strategy: str,
+        bst: lgb.Booster,
+        train_df: pd.DataFrame,
+        train_valid_df: pd.DataFrame,
+        resume: bool = False,
+    ) -> lgb.Booster:
+        """lgbm.second_stageの方法でvalid期間まで含めたデータのモデルを作成する
+
+        Args:
+            strategy (str): retrain, continue, refitのいずれか
+            bst (lgb.Booster): 1段階目の学習済みモデル
+            train_df (pd.DataFrame): 訓練期間のデータ
+            train_valid_df (pd.DataFrame): valid期間まで含めたデータ
+            resume (bool, optional): checkpointを保存し、途中から再開するか. Defaults to False.
+
+        Returns:
+            lgb.Booster: 学習済みモデル
+        """
+        best_iterations = int(
+            bst.current_iteration() * len(train_valid_df) / len(train_df)
+        )
+        if strategy == "retrain":
+            return self._second_train(
+                train_valid_df, num_iterations=best_iterations, resume=resume
+            )
+        if strategy == "continue":
+            return self._continue_train(
+                bst, train_valid_df, num_iterations=best_iterations, resume=resume
+            )
+        if strategy == "refit":
+            return self._refit(bst, train_valid_df)
+        raise ValueError(f"unknown second_stage: {strategy}")
 
     def _upload_model(
-        self, le_dict: Dict[str, LabelEncoder], bst: lgb.Booster, deploy: bool = False
+        self,
+        uploader: ArtifactUploader,
+        le_dict: Dict[str, LabelEncoder],
+        bst: lgb.Booster,
+        deploy: bool = False,
     ) -> None:
         """
         モデルと前処理に必要なDict[str, LabelEncoderを{"oe": oe, "model": bst}の形でupload
 
         Args:
+            uploader (ArtifactUploader): backgroundでアップロードするuploader
             le_dict (Dict[str, LabelEncoder]): カテゴリ毎のfit済LabelEncoder
             bst (lgb.Booster): 学習済みモデル
             deploy (bool, optional): latest pathにアップロードするかどうか。Defaults to False.
         """
-        with tempfile.TemporaryDirectory() as tmp_d:
-            gcs = GCSClient(self.config.gcp_project)
-            local_path = f"{tmp_d}/{self.exp_name}.pkl"
-            with open(local_path, "wb") as fout:
-                pickle.dump({"le": le_dict, "model": bst}, fout)
-            if deploy:
-                gcs.upload_blob(
-                    self.config.bucket,
-                    local_path,
-                    f"{self.config.latest_model_path}/model_{self.exp_name}.pkl",
-                )
-            else:
-                gcs.upload_blob(
-                    self.config.bucket,
-                    local_path,
-                    f"{self.exp_name}/model_{self.exp_name}.pkl",
-                )
+        if deploy:
+            destination = f"{self.setting.latest_model_path}/model_{self.exp_name}.pkl"
+        else:
+            destination = f"{self.exp_name}/model_{self.exp_name}.pkl"
+        uploader.upload_pickle({"le": le_dict, "model": bst}, destination)
 
-    def _upload_importance(self, bst: lgb.Booster) -> None:
+    def _upload_importance(self, uploader: ArtifactUploader, bst: lgb.Booster) -> None:
         """
         特徴量重要度をアップロード
         Args:
+            uploader (ArtifactUploader): backgroundでアップロードするuploader
             bst (lgb.Booster): 学習済みモデル
         """
         importance = bst.feature_importance(importance_type="gain")
         importance_df = pd.DataFrame(
             {"importance": importance}, index=self.feature_cols
         ).sort_values(by="importance", ascending=False)
-        importance_df.to_csv(
-            f"gs://{self.config.bucket}/{self.exp_name}/feature_importance_{self.exp_name}.csv",
-            index=False,
+        uploader.upload_dataframe(
+            importance_df, f"{self.exp_name}/feature_importance_{self.exp_name}.csv"
+        )
+        uploader.upload_plot(
+            render_barh,
+            (importance_df["importance"].head(100), "Feature importance"),
+            f"{self.exp_name}/feature_importance_{self.exp_name}.png",
         )
-        with tempfile.TemporaryDirectory() as tmp_d:
-            gcs = GCSClient(self.config.gcp_project)
-            local_path = f"{tmp_d}/{self.exp_name}.png"
-            lgb.plot_importance(
-                bst, figsize=(10, 20), importance_type="gain", max_num_features=100
-            )
-            plt.tight_layout()
-            plt.savefig(local_path)
-            gcs.upload_blob(
-                self.config.bucket,
-                local_path,
-                f"{self.exp_name}/feature_importance_{self.exp_name}.png",
-            )
 
-    def _upload_evaluation(self, eval_df: pd.DataFrame) -> None:
+    def _upload_evaluation(
+        self, uploader: ArtifactUploader, eval_df: pd.DataFrame
+    ) -> None:
         """
         現行モデルと最新モデルの評価指標をGCSにアップロードする
 
         Args:
+            uploader (ArtifactUploader): backgroundでアップロードするuploader
             eval_df (pd.DataFrame): 評価指標をまとめたDataFrame
         """
-        eval_df.to_csv(
-            f"gs://{self.config.bucket}/{self.exp_name}/evaluation_result_{self.exp_name}.csv",
-            index=False,
+        uploader.upload_dataframe(
+            eval_df, f"{self.exp_name}/evaluation_result_{self.exp_name}.csv"
         )
 
-    def _upload_preds(self, test_df: pd.DataFrame) -> None:
+    def _upload_preds(self, uploader: ArtifactUploader, test_df: pd.DataFrame) -> None:
         """
-        現行モデルと最新モデルの評価指標をGCSにアップロードする
+        testデータの予測値をGCSにアップロードする
 
         Args:
-            eval_df (pd.DataFrame): 評価指標をまとめたDataFrame
+            uploader (ArtifactUploader): backgroundでアップロードするuploader
+            test_df (pd.DataFrame): 予測値を含めたtestデータ
         """
-        test_df[self.config.upload_cols].to_csv(
-            f"gs://{self.config.bucket}/{self.exp_name}/pred_result_{self.exp_name}.csv",
-            index=False,
+        uploader.upload_dataframe(
+            test_df[list(self.setting.upload_cols)],
+            f"{self.exp_name}/pred_result_{self.exp_name}.csv",
         )
 
     def _load_latest_model(self) -> Tuple[Dict[str, LabelEncoder], lgb.Booster]:
@@ -281,32 +482,146 @@ class LGBMTrainer(object):
             Tuple[Dict[str, LabelEncoder], lgb.Booster]: デプロイ済みモデルとエンコーダ
         """
         with tempfile.TemporaryDirectory() as tmp_d:
-            gcs = GCSClient(self.config.gcp_project)
+            gcs = GCSClient(self.setting.gcp_project)
             local_path = f"{tmp_d}/{self.exp_name}.pkl"
             gcs.download_blob(
-                self.config.bucket,
-                f"{self.config.latest_model_path}/model_{self.exp_name}.pkl",
+                self.setting.bucket,
+                f"{self.setting.latest_model_path}/model_{self.exp_name}.pkl",
                 local_path,
             )
             with open(local_path, "rb") as fin:
                 model_dict = pickle.load(fin)
         return model_dict["le"], model_dict["model"]
 
-    def evaluate(
-        self, le_dict: Dict[str, LabelEncoder], bst: lgb.Booster, test_df: pd.DataFrame
-    ) -> Tuple[Dict[str, float], np.ndarray]:
-        for col in self.config.lgbm.cat_cols:
+    def _labels(self, test_df: pd.DataFrame) -> np.ndarray:
+        """評価に使う正解値 (差分の目的変数は処方量に戻す)"""
+        labels = test_df[self.setting.lgbm.label_col].to_numpy(dtype=np.float64)
+        if "diff" in self.setting.lgbm.label_col:
+            labels = labels + test_df["lag_total_dose_by_yj_store"].to_numpy()
+        return labels
+
+    def _load_abc_flags(self, test_df: pd.DataFrame) -> pd.DataFrame:
+        """testデータの期間のABCフラグをdate_store_yj_abcから取得する"""
+        setting = self.config.segment_metrics
+        dates = pd.to_datetime(test_df["dispensing_date"])
+        # prediction_result.sqlと同様に1日ずらして結合する
+        query = f"""
+        SELECT
+          DATE_ADD(dispensing_date, INTERVAL 1 DAY) AS dispensing_date,
+          yj_code,
+          store_code,
+          {setting.abc_col} AS abc_flag,
+        FROM `{setting.abc_table}`
+        WHERE
+          DATE_ADD(dispensing_date, INTERVAL 1 DAY)
+            BETWEEN "{dates.min():%Y-%m-%d}" AND "{dates.max():%Y-%m-%d}"
+        """
+        abc_df = pd.read_gbq(
+            query, project_id=self.setting.gcp_project, use_bqstorage_api=True
+        )
+        abc_df["dispensing_date"] = pd.to_datetime(abc_df["dispensing_date"])
+        return abc_df
+
+    def _segment_metrics(
+        self, test_df: pd.DataFrame, preds: np.ndarray
+    ) -> pd.DataFrame:
+        """yj_code, store_code, ABCフラグ, horizon (test期間の何日目か) ごとの評価指標を計算する"""
+        setting = self.config.segment_metrics
+        segments = list(setting.segments)
+        segment_df = test_df[["yj_code", "store_code"]].copy()
+        segment_df["dispensing_date"] = pd.to_datetime(test_df["dispensing_date"])
+        segment_df["horizon"] = (
+            segment_df["dispensing_date"] - segment_df["dispensing_date"].min()
+        ).dt.days
+        if "abc_flag" in segments:
+            # 行の順番を保ったままフラグを付ける
+            segment_df = segment_df.merge(
+                self._load_abc_flags(test_df),
+                on=["dispensing_date", "yj_code", "store_code"],
+                how="left",
+            )
+        return segment_metrics(
+            segment_df,
+            segments,
+            self._labels(test_df),
+            preds,
+            chunk_size=setting.chunk_size,
+        )
+
+    def _upload_segment_metrics(
+        self, uploader: ArtifactUploader, metrics_df: pd.DataFrame
+    ) -> None:
+        """セグメントごとの評価指標をevaluation_resultと同じ場所にParquetでアップロードする"""
+        uploader.upload_dataframe(
+            metrics_df, f"{self.exp_name}/segment_metrics_{self.exp_name}.parquet"
+        )
+
+    def _encode(
+        self, df: pd.DataFrame, le_dict: Dict[str, LabelEncoder]
+    ) -> pd.DataFrame:
+        """fit済みのLabelEncoderでカテゴリ変数を変換する (未知のカテゴリはotherにする)"""
+        for col in self.setting.lgbm.cat_cols:
             cats = le_dict[col].classes_
-            if pd.api.types.is_numeric_dtype(test_df[col]):
-                test_df.loc[test_df.query(f"{col} not in @cats").index, col] = -20000
+            if pd.api.types.is_numeric_dtype(df[col]):
+                df.loc[df.query(f"{col} not in @cats").index, col] = -20000
             else:
-                test_df.loc[test_df.query(f"{col} not in @cats").index, col] = "other"
-            test_df.loc[:, col] = le_dict[col].transform(test_df[col])
-        preds = bst.predict(test_df[self.feature_cols])
-        labels = test_df[self.config.lgbm.label_col]
-        if "diff" in self.config.lgbm.label_col:
+                df.loc[df.query(f"{col} not in @cats").index, col] = "other"
+            df.loc[:, col] = le_dict[col].transform(df[col])
+        return df
+
+    def _predict(self, bst: lgb.Booster, df: pd.DataFrame) -> np.ndarray:
+        """エンコード済みのデータを予測する"""
+        return bst.predict(df[self.feature_cols])
+
+    def _upload_contributions(
+        self, bst: lgb.Booster, keys_df: pd.DataFrame, test_df: pd.DataFrame
+    ) -> None:
+        """testデータの行ごとの特徴量の寄与のtop-kを{exp_name}/contributions_{exp_name}/にアップロードする"""
+        setting = self.setting.explain
+        explainer = ContributionExplainer(
+            bst,
+            self.feature_cols,
+            top_k=setting.top_k,
+            chunk_size=setting.chunk_size,
+            n_workers=setting.n_workers,
+        )
+        segments = test_df[SEGMENT_COL].to_numpy() if SEGMENT_COL in test_df else None
+        upload_contributions(
+            explainer,
+            GCSClient(self.setting.gcp_project),
+            self.setting.bucket,
+            f"{self.exp_name}/contributions_{self.exp_name}",
+            keys_df,
+            test_df[self.feature_cols],
+            segments=segments,
+        )
+
+    def evaluate(
+        self,
+        le_dict: Dict[str, LabelEncoder],
+        bst: lgb.Booster,
+        test_df: pd.DataFrame,
+        explain: bool = False,
+    ) -> Tuple[Dict[str, float], np.ndarray]:
+        """testデータを予測して評価指標を計算する
+
+        Args:
+            le_dict (Dict[str, LabelEncoder]): カテゴリ毎のfit済LabelEncoder
+            bst (lgb.Booster): 学習済みモデル
+            test_df (pd.DataFrame): エンコード前のtestデータ (エンコードで上書きされる)
+            explain (bool, optional): 行ごとの特徴量の寄与をアップロードするか. Defaults to False.
+
+        Returns:
+            Tuple[Dict[str, float], np.ndarray]: 評価指標, 予測値 (処方量のスケール)
+        """
+        keys_df = test_df[KEY_COLS].copy() if explain else None
+        test_df = self._encode(test_df, le_dict)
+        preds = self._predict(bst, test_df)
+        if explain:
+            self._upload_contributions(bst, keys_df, test_df)
+        labels = self._labels(test_df)
+        if "diff" in self.setting.lgbm.label_col:
             preds += test_df["lag_total_dose_by_yj_store"].to_numpy()
-            labels += test_df["lag_total_dose_by_yj_store"].to_numpy()
         metrics = {
             "model_version": self.exp_name,
             "rmse": np.sqrt(mean_squared_error(labels, preds)),
@@ -315,19 +630,377 @@ class LGBMTrainer(object):
         }
         return metrics, preds
 
+    def fit(
+        self, df: pd.DataFrame, resume: bool = False
+    ) -> Tuple[Dict[str, LabelEncoder], lgb.Booster, pd.DataFrame]:
+        """split_flagに従ってvalidで最適iterationを求め、valid期間まで含めて再学習する
+
+        Args:
+            df (pd.DataFrame): split_flagを含む学習データ
+            resume (bool, optional): checkpointを保存し、途中から再開するか. Defaults to False.
+
+        Returns:
+            Tuple[Dict[str, LabelEncoder], lgb.Booster, pd.DataFrame]: エンコーダ, 学習済みモデル, testデータ
+        """
+        train_df, valid_df, train_valid_df, test_df, le_dict = self._preprocess(df)
+        bst = self._first_train(train_df, valid_df, resume=resume)
+        bst = self._second_stage(
+            self.setting.lgbm.second_stage,
+            bst,
+            train_df,
+            train_valid_df,
+            resume=resume,
+        )
+        return le_dict, bst, test_df
+
+    def compare_second_stages(
+        self, df: pd.DataFrame, strategies: Iterable[str]
+    ) -> pd.DataFrame:
+        """1段階目の学習を1回だけ行い、2段階目の学習方法ごとの学習時間とtestデータの評価指標を比較する
+
+        Args:
+            df (pd.DataFrame): split_flagを含む学習データ
+            strategies (Iterable[str]): 比較する2段階目の学習方法 (retrain, continue, refit)
+
+        Returns:
+            pd.DataFrame: second_stage, first_sec, second_sec, total_sec, num_trees, 評価指標
+        """
+        train_df, valid_df, train_valid_df, test_df, le_dict = self._preprocess(df)
+        start = time.perf_counter()
+        first_bst = self._first_train(train_df, valid_df)
+        first_sec = time.perf_counter() - start
+        rows = []
+        for strategy in strategies:
+            start = time.perf_counter()
+            bst = self._second_stage(strategy, first_bst, train_df, train_valid_df)
+            second_sec = time.perf_counter() - start
+            metrics, _ = self.evaluate(le_dict, bst, test_df.copy())
+            logger.info(f"[{strategy}] {second_sec:.1f} sec, {metrics}")
+            rows.append(
+                {
+                    "second_stage": strategy,
+                    "first_sec": first_sec,
+                    "second_sec": second_sec,
+                    "total_sec": first_sec + second_sec,
+                    "num_trees": bst.current_iteration(),
+                    **metrics,
+                }
+            )
+        return pd.DataFrame(rows)
+
     def execute(self):
         df = self._load_data()
-        train_df, valid_df, train_valid_df, test_df, le_dict = self._preprocess(df)
-        bst = self._first_train(train_df, valid_df)
-        best_iterations = int(
-            bst.current_iteration() * len(train_valid_df) / len(train_df)
+        le_dict, bst, test_df = self.fit(df, resume=self.config.checkpoint.enabled)
+        self._report(le_dict, bst, test_df)
+
+    def _report(
+        self, le_dict: Dict[str, LabelEncoder], bst: lgb.Booster, test_df: pd.DataFrame
+    ) -> None:
+        """学習済みモデル, 特徴量の重要度, testデータの評価結果と予測値をアップロードする
+
+        アップロードはArtifactUploaderでbackgroundに行い、testデータの評価と並行に進める。
+        最後に全てのアップロードを待ち、学習後にかかった時間と直列に実行した場合の時間を出力する。
+        """
+        start = time.perf_counter()
+        with ArtifactUploader(
+            GCSClient(self.setting.gcp_project),
+            self.setting.bucket,
+            self.setting.upload_workers,
+        ) as uploader:
+            self._upload_artifacts(uploader, le_dict, bst)
+            # 最新モデルと現行モデルの比較
+            metrics, preds = self.evaluate(
+                le_dict, bst, test_df.copy(), explain=self.setting.explain.enabled
+            )
+            test_df[self.setting.lgbm.pred_col] = preds
+            eval_df = pd.DataFrame(metrics, index=[0])
+            self._upload_evaluation(uploader, eval_df)
+            self._upload_segment_metrics(
+                uploader, self._segment_metrics(test_df, preds)
+            )
+            self._upload_preds(uploader, test_df)
+            main_sec = time.perf_counter() - start
+        total_sec = time.perf_counter() - start
+        report = uploader.report
+        artifact_sec = report["serialize_sec"].sum() + report["upload_sec"].sum()
+        logger.info(
+            f"[artifacts]\n{report.to_string(index=False, float_format='{:.2f}'.format)}"
+        )
+        logger.info(
+            f"post-training tail took {total_sec:.1f} sec "
+            f"(serial: {main_sec + artifact_sec:.1f} sec = evaluation {main_sec:.1f} sec "
+            f"+ artifacts {artifact_sec:.1f} sec)."
         )
-        bst = self._second_train(train_valid_df, num_iterations=best_iterations)
-        self._upload_model(le_dict, bst, deploy=False)
-        self._upload_importance(bst)
-        # 最新モデルと現行モデルの比較
-        metrics, preds = self.evaluate(le_dict, bst, test_df.copy())
-        test_df[self.config.lgbm.pred_col] = preds
-        eval_df = pd.DataFrame(metrics, index=[0])
-        self._upload_evaluation(eval_df)
-        self._upload_preds(test_df)
+
+    def _upload_artifacts(
+        self,
+        uploader: ArtifactUploader,
+        le_dict: Dict[str, LabelEncoder],
+        bst: lgb.Booster,
+    ) -> None:
+        """評価を待たずにアップロードできる成果物 (モデル, 特徴量重要度)"""
+        self._upload_model(uploader, le_dict, bst, deploy=False)
+        self._upload_importance(uploader, bst)
+
+    def _run_trial(
+        self,
+        trial_id: int,
+        lgtrain: lgb.Dataset,
+        lgvalid: lgb.Dataset,
+        pruner: MedianPruner,
+        trial_log: TrialLog,
+        num_thread: int,
+    ) -> None:
+        """探索空間からパラメータを選んで1回学習し、結果をtrial_logに記録する"""
+        search_config = self.config.search
+        params = dict(self.params)
+        params.update(sample_params(search_config.space, search_config.seed, trial_id))
+        # 並列に走らせるtrialでコアを分け合う
+        params["num_thread"] = num_thread
+        intermediate_values: Dict[int, float] = {}
+        record: Dict[str, Any] = {"trial_id": trial_id, "params": params}
+        start_time = time.time()
+        try:
+            bst = lgb.train(
+                params,
+                lgtrain,
+                num_boost_round=search_config.num_iterations,
+                valid_sets=[lgvalid],
+                valid_names=["valid"],
+                # 構築済みのDatasetと同じ指定にしないと作り直しになる (raw dataは解放済み)
+                categorical_feature=list(self.setting.lgbm.cat_cols),
+                callbacks=[
+                    lgb.early_stopping(
+                        search_config.early_stopping_rounds, verbose=False
+                    ),
+                    pruning_callback(
+                        pruner, intermediate_values, search_config.pruning_interval
+                    ),
+                ],
+            )
+            value = list(bst.best_score["valid"].values())[0]
+            record.update(
+                state=COMPLETE, value=value, best_iteration=bst.best_iteration
+            )
+            pruner.add_completed(intermediate_values)
+        except TrialPruned as e:
+            record.update(state=PRUNED, value=e.value, best_iteration=e.step)
+        except Exception as e:
+            # 1つのtrialの失敗で探索全体を止めない
+            logger.exception(f"trial {trial_id} failed.")
+            record.update(state=FAILED, value=None, error=str(e))
+        record["intermediate_values"] = intermediate_values
+        record["elapsed"] = time.time() - start_time
+        trial_log.append(record)
+        logger.info(
+            f"[trial {trial_id}] {record['state']} value: {record['value']} "
+            f"({record['elapsed']:.1f} s)"
+        )
+
+    def _save_best_params(
+        self, best: Dict[str, Any], output_path: Optional[str] = None
+    ) -> str:
+        """最良のパラメータをexps/*.yamlと同じ形式のoverride yamlとして保存する"""
+        params = dict(self.params)
+        params.update(
+            {key: value for key, value in best["params"].items() if key != "num_thread"}
+        )
+        override = OmegaConf.create(
+            {"train": {"trainer": {"lgbm": {"params": params}}}}
+        )
+        text = (
+            f"# train.search ({self.exp_name}) の結果\n"
+            f"# trial: {best['trial_id']}, valid: {best['value']}, "
+            f"best_iteration: {best['best_iteration']}\n" + OmegaConf.to_yaml(override)
+        )
+        with tempfile.TemporaryDirectory() as tmp_d:
+            local_path = f"{tmp_d}/best_params.yaml"
+            with open(local_path, "w") as f:
+                f.write(text)
+            gcs = GCSClient(self.setting.gcp_project)
+            gcs.upload_blob(
+                self.setting.bucket,
+                local_path,
+                f"{self.exp_name}/{self.config.search.output_dir}/best_params.yaml",
+            )
+        if output_path is not None:
+            with open(output_path, "w") as f:
+                f.write(text)
+        return text
+
+    def search(self, output_path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """LightGBMのハイパーパラメータをランダムサーチする
+
+        データの読み込み, encode, lgb.Datasetの作成は1回だけ行い、複数のtrialを並列に学習する。
+        途中のvalidの評価値が完了済みtrialの中央値より悪いtrialは打ち切る。
+        trialの結果はGCSのtrials.jsonlに保存され、再実行すると続きから探索する。
+
+        Args:
+            output_path (Optional[str], optional): 最良のパラメータのoverride yamlの保存先
+
+        Returns:
+            Optional[Dict[str, Any]]: 最良のtrialの記録
+        """
+        search_config = self.config.search
+        df = self._load_data()
+        train_df, valid_df, _, _, _ = self._preprocess(df)
+        del df
+        # binの作成などDatasetに関するパラメータは全trialで共通
+        # feature_pre_filterを切らないとtrialごとにmin_child_samplesを変えられない
+        dataset_params = {
+            "max_bin": self.params["max_bin"],
+            "feature_pre_filter": False,
+            "verbose": -1,
+        }
+        lgtrain = self._make_dataset(train_df, params=dataset_params).construct()
+        lgvalid = self._make_dataset(
+            valid_df, reference=lgtrain, params=dataset_params
+        ).construct()
+        del train_df, valid_df
+
+        gcs = GCSClient(self.setting.gcp_project)
+        log_blob = f"{self.exp_name}/{search_config.output_dir}/trials.jsonl"
+        with tempfile.TemporaryDirectory() as tmp_d:
+            local_log = f"{tmp_d}/trials.jsonl"
+            if gcs.exists(self.setting.bucket, log_blob):
+                gcs.download_blob(self.setting.bucket, log_blob, local_log)
+            trial_log = TrialLog(
+                local_log,
+                upload=lambda path: gcs.upload_blob(
+                    self.setting.bucket, path, log_blob
+                ),
+                direction=search_config.direction,
+            )
+            pruner = MedianPruner(
+                search_config.n_startup_trials,
+                search_config.n_warmup_steps,
+                direction=search_config.direction,
+            )
+            for record in trial_log.records:
+                if record["state"] == COMPLETE:
+                    pruner.add_completed(
+                        {int(k): v for k, v in record["intermediate_values"].items()}
+                    )
+            finished = trial_log.finished_trial_ids()
+            trial_ids = [i for i in range(search_config.n_trials) if i not in finished]
+            logger.info(
+                f"{len(finished)} trials were loaded from log. {len(trial_ids)} trials remain."
+            )
+            num_thread = max(1, available_cpus() // search_config.n_parallel)
+            with ThreadPoolExecutor(max_workers=search_config.n_parallel) as executor:
+                jobs = [
+                    executor.submit(
+                        self._run_trial,
+                        trial_id,
+                        lgtrain,
+                        lgvalid,
+                        pruner,
+                        trial_log,
+                        num_thread,
+                    )
+                    for trial_id in trial_ids
+                ]
+                for future in as_completed(jobs):
+                    future.result()
+
+        num_pruned = sum(r["state"] == PRUNED for r in trial_log.records)
+        logger.info(f"{num_pruned} / {len(trial_log.records)} trials were pruned.")
+        best = trial_log.best()
+        if best is None:
+            logger.warning("no trial was completed.")
+            return None
+        logger.info(f"best trial: {best['trial_id']} value: {best['value']}")
+        logger.info(self._save_best_params(best, output_path))
+        return best
+
+    def _load_sample(self, percent: float) -> pd.DataFrame:
+        """TABLESAMPLEで学習データの一部のブロックだけを読み込む"""
+        query = f"""
+        SELECT * FROM {self.setting.dataset_id}.train_dataset_{self.exp_name}
+        TABLESAMPLE SYSTEM ({percent} PERCENT)
+        WHERE {self._debug_condition()}
+        """
+        return self._read_gbq(query)
+
+    def select_features(
+        self, output_path: Optional[str] = None, base_config: Optional[str] = None
+    ) -> pd.DataFrame:
+        """サンプリングしたデータで少ないiterationのモデルを学習し、gainの小さい数値特徴量を削除する
+
+        gainの累積割合がfeature_selection.cumulative_gainに達するまでの数値特徴量を残し、
+        feature.numerical_colsとfeature.dropped_colsを上書きするyamlを保存する。
+        dropped_colsは学習, 予測データのSQLでEXCEPTされるので、以降は読み込まれない。
+
+        Args:
+            output_path (Optional[str], optional): override yamlをローカルに保存するパス
+            base_config (Optional[str], optional): override yamlを重ねるexpのyaml名 (例: exp006)
+
+        Returns:
+            pd.DataFrame: 特徴量ごとのgainと残すかどうか
+        """
+        setting = self.config.feature_selection
+        df = self._load_sample(setting.sample_percent)
+        train_df, valid_df, _, _, _ = self._preprocess(df)
+        del df
+        lgtrain = self._make_dataset(train_df)
+        lgvalid = self._make_dataset(valid_df)
+        params = dict(self.params, learning_rate=setting.learning_rate)
+        bst = lgb.train(
+            params,
+            lgtrain,
+            num_boost_round=setting.num_iterations,
+            valid_sets=[lgvalid],
+            valid_names=["valid"],
+            callbacks=[
+                lgb.log_evaluation(self.setting.lgbm.verbose_eval),
+                lgb.early_stopping(setting.early_stopping_rounds),
+            ],
+        )
+        gain = pd.Series(
+            bst.feature_importance(importance_type="gain"), index=self.feature_cols
+        )
+        # カテゴリ変数はエンコードや結合に使うので削除しない
+        report_df = select_by_cumulative_gain(
+            gain, setting.cumulative_gain, candidates=self.setting.lgbm.numerical_cols
+        )
+        kept = set(report_df.query("keep")["feature"])
+        numerical_cols = [
+            col for col in self.setting.lgbm.numerical_cols if col in kept
+        ]
+        # アップロードや差分のラベルを戻すのに使うカラムは特徴量から外してもSQLでは残す
+        required_cols = set(self.setting.upload_cols) | {"lag_total_dose_by_yj_store"}
+        dropped_cols = [
+            col
+            for col in self.setting.lgbm.numerical_cols
+            if col not in kept and col not in required_cols
+        ]
+        logger.info(
+            f"{len(numerical_cols)} / {len(self.setting.lgbm.numerical_cols)} numerical features were kept."
+        )
+
+        text = feature_override_yaml(
+            numerical_cols,
+            dropped_cols,
+            header=(
+                f"# train.select-features ({self.exp_name}) の結果\n"
+                f"# cumulative_gain: {setting.cumulative_gain}, "
+                f"sample: {setting.sample_percent}%, iteration: {bst.current_iteration()}\n"
+            ),
+            base_config=base_config,
+        )
+        output_dir = f"gs://{self.setting.bucket}/{self.exp_name}/{setting.output_dir}"
+        report_df.to_csv(f"{output_dir}/feature_gain_{self.exp_name}.csv", index=False)
+        with tempfile.TemporaryDirectory() as tmp_d:
+            local_path = f"{tmp_d}/selected_features.yaml"
+            with open(local_path, "w") as f:
+                f.write(text)
+            gcs = GCSClient(self.setting.gcp_project)
+            gcs.upload_blob(
+                self.setting.bucket,
+                local_path,
+                f"{self.exp_name}/{setting.output_dir}/selected_features.yaml",
+            )
+        if output_path is not None:
+            with open(output_path, "w") as f:
+                f.write(text)
+        return report_df
@@ -1,20 +1,22 @@
+import hashlib
 import logging
 import os
+import re
 from inspect import ArgSpec, getfullargspec
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from unittest.mock import patch
 
 import invoke
 from hydra.errors import MissingConfigException
 from hydra import compose, initialize_config_dir
-from google.cloud.logging import Client, Resource
-
-# from google.cloud.logging.handlers import CloudLoggingHandler, setup_logging
 from invoke import Collection, Context
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader
 from omegaconf import DictConfig, OmegaConf
 
 from src.bq import BQClient
+from src.cost import GIB, check_before_run, make_job_labels
+from src.log import configure, get_logger, log_context, set_context
+from src.profiling import ProfiledTask
 
 
 @invoke.task
@@ -52,6 +54,8 @@ def update_config(c):
         else:
             hydra_config = override_config
     update(c.config, hydra_config)
+    # ログの設定はimportでは行わず、taskの開始時に1回だけ行う
+    setup_logger(c)
 
 
 def task(*args, **kwargs):
@@ -59,8 +63,9 @@ def task(*args, **kwargs):
     参考：https://github.com/pyinvoke/invoke/blob/ed94c59f1eacc700dac3815530493e0809fe001d/invoke/tasks.py#L268
     @taskを用いたときにdefaultででupdate_configが事前に実行される。
     preを指定した場合は、@task(pre=[hoge])のhogeでこのtaskを使用していれば問題ない。
+    環境変数SUGI_PROFILEを設定すると、taskの本体をprofilerの下で実行する (src/profiling.py)。
     """
-    klass = kwargs.pop("klass", invoke.Task)
+    klass = kwargs.pop("klass", ProfiledTask)
     # @task -- no options were (probably) given.
     if len(args) == 1 and callable(args[0]) and not isinstance(args[0], invoke.Task):
         return klass(args[0], pre=[update_config])
@@ -142,11 +147,157 @@ def render_template(sql_path: str, params: Optional[Dict[str, Any]] = None) -> s
     """
     if params is None:
         params = {}
-    query_template = Template(read_sql(sql_path))
+    # 同じディレクトリのSQLを{% include %}できるようにする
+    env = Environment(
+        loader=FileSystemLoader(os.path.dirname(os.path.abspath(sql_path)))
+    )
+    query_template = env.from_string(read_sql(sql_path))
     query = query_template.render(params)
     return query
 
 
+def render_table_layout(setting: Optional[Dict[str, Any]]) -> str:
+    """BQClient.create_tableと同じ形式のsettingからPARTITION BY, CLUSTER BY句を作成する
+
+    Args:
+        setting (Optional[Dict[str, Any]]): timePartitioning, clusteringを含む設定
+
+    Returns:
+        str: CREATE TABLE文に埋め込むDDL
+    """
+    if not setting:
+        return ""
+    clauses = []
+    if setting.get("timePartitioning"):
+        clauses.append(f"PARTITION BY {setting['timePartitioning']['field']}")
+    if setting.get("clustering"):
+        clauses.append(f"CLUSTER BY {', '.join(setting['clustering']['fields'])}")
+    return "\n".join(clauses)
+
+
+# CREATE OR REPLACE TABLE `project.dataset.table` の直後のPARTITION BY句
+REPLACE_TABLE_PATTERN = re.compile(
+    r"CREATE\s+OR\s+REPLACE\s+TABLE\s+`[\w-]+\.(\w+)\.(\w+)`\s*(?:PARTITION\s+BY\s+(\S+))?",
+    re.IGNORECASE,
+)
+
+
+def replaced_tables(query: str) -> List[Tuple[str, str, str]]:
+    """クエリがCREATE OR REPLACEするテーブルと、作成後のパーティション列 (無い場合は空文字) の一覧"""
+    return [
+        (dataset_id, table_id, partition_field or "")
+        for dataset_id, table_id, partition_field in REPLACE_TABLE_PATTERN.findall(
+            query
+        )
+    ]
+
+
+def drop_repartitioned_tables(
+    bq: BQClient, query: str, logger: logging.Logger
+) -> List[str]:
+    """既存のテーブルとパーティションの指定が異なるテーブルを削除する
+
+    BigQueryはパーティションの指定が異なるテーブルをCREATE OR REPLACEできない
+    (Cannot replace a table with a different partitioning spec) ので、
+    table_layoutを変更した後の最初の実行では作り直す前に削除する。
+
+    Returns:
+        List[str]: 削除したテーブル
+    """
+    dropped = []
+    for dataset_id, table_id, partition_field in replaced_tables(query):
+        current = bq.table_partitioning(dataset_id, table_id)
+        if current is None or current == partition_field:
+            continue
+        logger.warning(
+            f"[migrate] drop {dataset_id}.{table_id} to change partitioning "
+            f"from '{current}' to '{partition_field}'."
+        )
+        bq.delete_table(dataset_id, table_id)
+        dropped.append(f"{dataset_id}.{table_id}")
+    return dropped
+
+
+def table_layout_setting(c: Context, sql_dir_name: str, table_id: str):
+    """configのtable_layoutからテーブルの物理レイアウトの設定を取得する。
+
+    テーブル名の設定が無い場合はdefaultの設定を使う。
+    """
+    table_layout = getattr(c, sql_dir_name).get("table_layout") or {}
+    if table_id in table_layout:
+        return table_layout[table_id]
+    return table_layout.get("default")
+
+
+def render_sql_task(
+    c: Context,
+    sql_path: str,
+    start_ts: Optional[str] = None,
+    end_ts: Optional[str] = None,
+) -> Tuple[str, str]:
+    """SQLタスクのクエリを現在のconfigでレンダリングする
+
+    Args:
+        c (Context): invokeのContextクラス
+        sql_path (str): SQLのファイルパス (src/{collection}/sql/*.sql)
+        start_ts (Optional[str], optional): sqlの実行開始日. デフォルトでyamlの値を使用
+        end_ts (Optional[str], optional): sqlの実行終了日. デフォルトでyamlの値を使用
+
+    Returns:
+        Tuple[str, str]: タスク名(SQLのファイル名)とレンダリングされたクエリ
+    """
+    script_name = os.path.basename(sql_path).split(".")[0]
+    sql_dir_name = sql_path.split("/")[1]
+    if start_ts is None:
+        start_ts = c.config.get("start_ts")
+    if end_ts is None:
+        end_ts = c.end_ts
+    params = {
+        "project_id": c.env.gcp_project,
+        "dataset_id": c.env.dataset_id,
+        "script_name": script_name,
+        "start_ts": start_ts,
+        "end_ts": end_ts,
+    }
+    params.update(dict(getattr(c, sql_dir_name).sql or {}))
+    params["table_layout"] = render_table_layout(
+        table_layout_setting(c, sql_dir_name, script_name)
+    )
+    return script_name, render_template(sql_path, params=params)
+
+
+def _execute_query(
+    c: Context,
+    logger: logging.Logger,
+    script_name: str,
+    sql_path: str,
+    query: str,
+    delete: bool,
+) -> None:
+    """add_create_delete_taskで作成したtaskの本体。deleteの場合はテーブルを削除する"""
+    bq = BQClient(c.env.gcp_project)
+    logger.info(f"[query]\n {query}")
+    logger.info(f"Loaded query from {sql_path}")
+    if delete:
+        bq.delete_table(c.env.dataset_id, script_name)
+        return
+    # パーティションの指定が異なるとdry runも失敗するので、先に削除する
+    drop_repartitioned_tables(bq, query, logger)
+    if c.cost.check_before_run:
+        bytes_processed = bq.dry_run_query(query)
+        logger.info(
+            f"[dry run] {script_name} will process {bytes_processed / GIB:.2f} GiB."
+        )
+        check_before_run(c.cost, script_name, bytes_processed)
+    job = bq.execute_query(query, labels=make_job_labels(c.execution_date, script_name))
+    stats = bq.job_statistics(job)
+    logger.info(
+        f"[done] execution {script_name} query completed. "
+        f"billed: {stats['total_bytes_billed'] / GIB:.2f} GiB, "
+        f"slot: {stats['slot_millis'] / 1000:.1f} s"
+    )
+
+
 def add_create_delete_task(ns: Collection, sql_paths: List[str]) -> None:
     """SQLのファイル名と同じ名前でSQL実行のinvokeタスクを作成
 
@@ -158,11 +309,10 @@ def add_create_delete_task(ns: Collection, sql_paths: List[str]) -> None:
     """
     for sql_path in sql_paths:
         script_name = os.path.basename(sql_path).split(".")[0]
-        sql_dir_name = sql_path.split("/")[1]
 
-        def get_task(script_name: str, sql_path: str, sql_dir_name: str):
+        def get_task(script_name: str, sql_path: str):
             @task
-            def _execute_task(c, end_ts=None, delete=False):
+            def _execute_task(c, start_ts=None, end_ts=None, delete=False):
                 """
                 Args:
                     c (invoke.Context): invokeのContextクラス
@@ -171,49 +321,25 @@ def add_create_delete_task(ns: Collection, sql_paths: List[str]) -> None:
                     delete (bool, optional): テーブルを消すオプション. Defaults to False.
                 """
                 logger = setup_logger(c)
-                bq = BQClient(c.env.gcp_project)
-                if end_ts is None:
-                    end_ts = c.end_ts
-                params = {
-                    "project_id": c.env.gcp_project,
-                    "dataset_id": c.env.dataset_id,
-                    "script_name": script_name,
-                    "end_ts": end_ts,
-                }
-                params.update(dict(getattr(c, sql_dir_name).sql))
-                query = render_template(sql_path, params=params)
-                logger.info(f"[query]\n {query}")
-                logger.info(f"Loaded query from {sql_path}")
-                if delete:
-                    bq.delete_table(c.env.dataset_id, script_name)
-                else:
-                    bq.execute_query(query)
-                    logger.info(f"[done] execution {script_name} query completed.")
+                _, query = render_sql_task(
+                    c, sql_path, start_ts=start_ts, end_ts=end_ts
+                )
+                # クエリ全体はメッセージの上限で切り詰められるので、sha1で同じクエリを識別できるようにする
+                query_sha1 = hashlib.sha1(query.encode("utf-8")).hexdigest()[:12]
+                with log_context(task=script_name, query_sha1=query_sha1):
+                    _execute_query(c, logger, script_name, sql_path, query, delete)
 
             return _execute_task
 
-        execute_task = get_task(script_name, sql_path, sql_dir_name)
+        execute_task = get_task(script_name, sql_path)
         ns.add_task(execute_task, script_name)
 
 
-def setup_logger(c: Context):
-    """ルートロガーに CloudLoggingの設定をする"""
-
-    # logging_client = Client()
-    # resource = Resource(
-    #     type="k8s_pod",
-    #     labels={"project_id": c.env.gcp_project, "location": c.env.location},
-    # )
-    # handler = CloudLoggingHandler(logging_client, resource=resource)
-    logging.getLogger().setLevel(logging.INFO)
-    # setup_logging(handler)
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    handler = logging.StreamHandler()
-    handler.setFormatter(
-        logging.Formatter(
-            "[%(asctime)s] [%(name)s] [L%(lineno)d] [%(levelname)s][%(funcName)s] %(message)s "
-        )
-    )
-    logger.addHandler(handler)
-    return logger
+def setup_logger(c: Context) -> logging.Logger:
+    """invoke.yamlのloggingでログの設定 (src/log.py) をプロセスで1回だけ行い、loggerを返す
+
+    何度呼んでもhandlerは増えない。execution_dateは以降の全てのレコードのcontextに付ける。
+    """
+    configure(c.config.get("logging"), gcp_project=c.env.gcp_project)
+    set_context(execution_date=c.config.get("execution_date"))
+    return get_logger(__name__)
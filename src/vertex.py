@@ -1,21 +1,11 @@
-import logging
 from typing import List, Dict, Optional
 from time import sleep, time
 from timeout_decorator import TimeoutError
 from google.cloud import aiplatform
 
+from src.log import get_logger
 
-# TODO: cloud loggingにも飛ばす設定をする
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(
-    logging.Formatter(
-        "[%(asctime)s] [%(name)s] [L%(lineno)d] [%(levelname)s][%(funcName)s] %(message)s "
-    )
-)
-logger.addHandler(handler)
-logger.propagate = False
+logger = get_logger(__name__)
 
 
 class TrainingJob(object):
@@ -34,21 +24,32 @@ class TrainingJob(object):
         args: List[str],
         env_args: Optional[List[Dict[str, Optional[str]]]] = None,
         timeout=10800,
+        restart_job_on_worker_restart: bool = False,
+        replica_count: int = 1,
     ):
+        worker_pool_spec = {
+            "machine_spec": {
+                "machine_type": instance_type,
+            },
+            "replica_count": 1,
+            "container_spec": {
+                "image_uri": image_uri,
+                "args": args,
+                "env": env_args,
+            },
+        }
+        worker_pool_specs = [worker_pool_spec]
+        if replica_count > 1:
+            # 分散学習ではworkerpool0をchief, workerpool1を残りのワーカーにする (CLUSTER_SPECで参照)
+            worker_pool_specs.append(
+                dict(worker_pool_spec, replica_count=replica_count - 1)
+            )
         job_spec = {
-            "worker_pool_specs": [
-                {
-                    "machine_spec": {
-                        "machine_type": instance_type,
-                    },
-                    "replica_count": 1,
-                    "container_spec": {
-                        "image_uri": image_uri,
-                        "args": args,
-                        "env": env_args,
-                    },
-                }
-            ],
+            "worker_pool_specs": worker_pool_specs,
+            # ワーカーが再起動(メンテナンスやプリエンプション)された場合にジョブを再実行する
+            "scheduling": {
+                "restart_job_on_worker_restart": restart_job_on_worker_restart,
+            },
         }
         parent = f"projects/{self.project}/locations/{self.location}"
         custom_job = {
@@ -1,19 +1,35 @@
 import os
 import re
+from glob import glob
+
 import pandas as pd
 from invoke import Collection, Context
 from typing import Optional
 
-from src.utils import fix_invoke_annotations, task
+from src.utils import fix_invoke_annotations, render_sql_task, setup_logger, task
 
 fix_invoke_annotations()
 
 from src.imp.tasks import import_tasks
-from src.preprocess.tasks import preprocess_tasks
+from src.preprocess.tasks import DATE_RELATIVE_TASKS, preprocess_tasks
 from src.train.tasks import train_tasks
 from src.predict.tasks import predict_tasks
+from src.bench.tasks import bench_tasks
 from src.vertex import TrainingJob
 from src.bq import BQClient
+from src.cache import TableCache
+from src.cost import GIB, CostEstimator
+from src.profiling import PROFILE_ENV
+from src.backfill import (
+    DOWNSTREAM,
+    BackfillManifest,
+    BackfillRunner,
+    DatePredictor,
+    backfill_dates,
+    date_end_ts,
+    modified_tables,
+    upstream_key,
+)
 
 from dags.runner import PipelineRunner
 
@@ -55,6 +71,97 @@ def get_columns(c: Context, dataset_id: str, table_id: str):
     print(sorted(column_names))
 
 
+@task
+def plan(
+    c: Context,
+    collection: str = "preprocess",
+    start_ts: Optional[str] = None,
+    end_ts: Optional[str] = None,
+    check: bool = True,
+    baseline: Optional[str] = None,
+):
+    """collection内の全SQLタスクを現在のconfigでレンダリングしてdry runし、スキャン量を見積もる
+
+    Args:
+        c (Context): invokeのContext
+        collection (str, optional): 対象のcollection名 (imp, preprocess, train, predict). Defaults to "preprocess".
+        start_ts (Optional[str], optional): クエリに渡すパラメータ、デフォルトでinvoke.yamlの値が使われる
+        end_ts (Optional[str], optional): クエリに渡すパラメータ、デフォルトでinvoke.yamlの値が使われる
+        check (bool, optional): costの上限を超えた場合にエラーにするか. Defaults to True.
+        baseline (Optional[str], optional): 比較対象とする過去のplanのcsv。指定した場合は変更前後のスキャン量を並べて出力する
+    """
+    logger = setup_logger(c)
+    queries = dict(
+        render_sql_task(c, sql_path, start_ts=start_ts, end_ts=end_ts)
+        for sql_path in sorted(glob(f"src/{collection}/sql/*.sql"))
+    )
+    estimator = CostEstimator(BQClient(c.env.gcp_project), c.cost)
+    plan_df = estimator.plan(queries)
+
+    os.makedirs(c.cost.report_dir, exist_ok=True)
+    report_path = f"{c.cost.report_dir}/plan_{collection}_{c.execution_date}.csv"
+    plan_df.to_csv(report_path, index=False)
+    report_cols = ["task", "gib_processed", "exceeded", "error"]
+    if baseline is not None:
+        # テーブルレイアウトの変更前後などでスキャン量を比較する
+        baseline_df = pd.read_csv(baseline)[["task", "gib_processed"]]
+        plan_df = plan_df.merge(
+            baseline_df, on="task", how="left", suffixes=("", "_baseline")
+        )
+        plan_df["gib_diff"] = (
+            plan_df["gib_processed"] - plan_df["gib_processed_baseline"]
+        )
+        report_cols = ["task", "gib_processed_baseline", "gib_processed", "gib_diff"]
+        print(f"baseline total: {baseline_df['gib_processed'].fillna(0).sum():.2f} GiB")
+    print(plan_df[report_cols].to_string(index=False, float_format="{:.2f}".format))
+    print(f"total: {plan_df['bytes_processed'].fillna(0).sum() / GIB:.2f} GiB")
+    logger.info(f"plan was saved to {report_path}")
+    if check:
+        estimator.check(plan_df)
+
+
+@task
+def cost_report(c: Context, execution_date: Optional[str] = None):
+    """SQLタスクの実行実績(課金byte数, slot使用時間)をjob統計から集計する
+
+    Args:
+        c (Context): invokeのContext
+        execution_date (Optional[str], optional): 集計するrun(execution_date)。デフォルトでinvoke.yamlの値が使われる
+    """
+    logger = setup_logger(c)
+    if execution_date is None:
+        execution_date = c.execution_date
+    estimator = CostEstimator(BQClient(c.env.gcp_project), c.cost)
+    report_df = estimator.run_report(execution_date)
+
+    os.makedirs(c.cost.report_dir, exist_ok=True)
+    report_path = f"{c.cost.report_dir}/run_{execution_date}.csv"
+    report_df.to_csv(report_path, index=False)
+    print(report_df.to_string(index=False, float_format="{:.2f}".format))
+    print(f"total: {report_df['total_bytes_billed'].sum() / GIB:.2f} GiB billed")
+    logger.info(f"report was saved to {report_path}")
+
+
+@task
+def cache_stats(c: Context, clear: bool = False):
+    """BQのテーブルのローカルキャッシュ (src/cache.py) のsnapshotの一覧とhit率を表示する
+
+    Args:
+        c (Context): invokeのContext
+        clear (bool, optional): 全てのsnapshotを削除するか. Defaults to False.
+    """
+    logger = setup_logger(c)
+    cache = TableCache(c.cache.dir, int(c.cache.max_gb * GIB))
+    if clear:
+        cache.clear()
+        logger.info(f"cache {c.cache.dir} was cleared.")
+    stats_df = cache.stats()
+    if len(stats_df) > 0:
+        print(stats_df.to_string(index=False, float_format="{:.2f}".format))
+    for key, value in cache.summary().items():
+        print(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}")
+
+
 @task
 def vertex_jobs(
     c: Context,
@@ -64,6 +171,8 @@ def vertex_jobs(
     image_uri: str = None,
     job_name: str = None,
     instance_type: str = None,
+    replica_count: int = 1,
+    profile: Optional[str] = None,
 ):
     """Vertex Trainingを用いて所定の処理を実行する
 
@@ -75,6 +184,10 @@ def vertex_jobs(
         image_uri (str, optional): Vertex Custom Jobsで使用するコンテナのimage_uri。指定されない場合、invoke.yamlの値が使用される.
         job_name (str, optional): ダッシュボード上に表示されるジョブの名前。指定されない場合、commandから自動生成される。
         instance_type (str, optional): Vertex Custom Jobsで使用するインスタンス名。指定されない場合、invoke.yamlの値が使用される.
+        replica_count (int, optional): 同じcommandを実行するワーカー数。
+            2以上の場合はtrain.train --distributedと合わせて使う。Defaults to 1.
+        profile (Optional[str], optional): ジョブのSUGI_PROFILE (例: sample,memory)。
+            指定されない場合は手元のSUGI_PROFILEを引き継ぐ。
     """
     if push:
         build_docker(c, push=True)
@@ -97,13 +210,20 @@ def vertex_jobs(
         job_name = "_".join(re.split("[/.]", command)[:2]).replace("-", "_")
     user = os.getenv("USER", "unknown")
     job_id = f"{job_name}_{user}"
+    env_args = [{"name": "USER", "value": user}]
+    if profile is None:
+        profile = os.getenv(PROFILE_ENV)
+    if profile:
+        env_args.append({"name": PROFILE_ENV, "value": profile})
     vertex_job.execute(
         job_id,
         image_uri=image_uri,
         instance_type=instance_type,
         timeout=c.vertex.timeout,
         args=cmd,
-        env_args=[{"name": "USER", "value": user}],
+        env_args=env_args,
+        restart_job_on_worker_restart=c.vertex.restart_job_on_worker_restart,
+        replica_count=int(replica_count),
     )
 
 
@@ -128,6 +248,134 @@ def run_pipeline(
     runner.run(start_ts=start_ts, end_ts=end_ts, execution_date=c.execution_date)
 
 
+@task
+def backfill(
+    c: Context,
+    start_date: str,
+    end_date: str,
+    concurrency: Optional[int] = None,
+    mode: Optional[str] = None,
+    step_days: Optional[int] = None,
+    name: Optional[str] = None,
+    resume: bool = True,
+):
+    """start_dateからend_dateまでの実行日のdaily pipelineを再実行するtask
+
+    localの場合は日付で分割された特徴量テーブルとABCフラグを全日付を含む期間で1回だけ作成し (backtestと同様に期間を伸ばす)、
+    日付ごとにend_tsに対する期間で集計するテーブル (DATE_RELATIVE_TASKS) とpredict_datasetの作成, 予測, 書き込みを
+    concurrency日ずつ並行に行い、最後にprediction-resultを1回で更新する。
+    1回だけ作成したテーブルがmanifestの完了後に更新されている場合 (daily pipelineで上書きされた場合など) は作り直す。
+    pipelineの場合は日付ごとにPipelineRunnerで実行して完了を待つ。
+    完了したstep, 日付は{manifest_dir}/{name}.jsonlに記録し、再実行時はskipする。
+
+    Args:
+        c (Context): invokeのContext
+        start_date (str): 最初の実行日 (YYYY-MM-DD)
+        end_date (str): 最後の実行日 (YYYY-MM-DD)
+        concurrency (Optional[int], optional): 同時に処理する日付の数。指定されない場合、yamlの値が使用される
+        mode (Optional[str], optional): local or pipeline。指定されない場合、yamlの値が使用される
+        step_days (Optional[int], optional): 実行日の間隔。指定されない場合、yamlの値が使用される
+        name (Optional[str], optional): manifestの名前。指定されない場合、{mode}_{start_date}_{end_date}
+        resume (bool, optional): manifestで完了しているstep, 日付をskipするか. Defaults to True.
+    """
+    logger = setup_logger(c)
+    setting = c.backfill
+    mode = mode or setting.mode
+    if mode not in ("local", "pipeline"):
+        raise ValueError(f"mode must be local or pipeline, got '{mode}'")
+    if concurrency is None:
+        concurrency = setting.concurrency
+    if step_days is None:
+        step_days = setting.step_days
+    if name is None:
+        name = f"{mode}_{start_date}_{end_date}"
+    dates = backfill_dates(start_date, end_date, int(step_days))
+    manifest = BackfillManifest(f"{setting.manifest_dir}/{name}.jsonl")
+
+    if mode == "pipeline":
+        if int(concurrency) > 1:
+            # predict_dataset_*などのテーブル名は日付によらないため、pipelineを同時に実行すると上書きし合う
+            logger.warning("pipeline mode runs one date at a time.")
+        runner = BackfillRunner(manifest, 1, resume=resume)
+        pipeline = PipelineRunner(c.kfp)
+        report_df = runner.run_dates(
+            dates,
+            lambda date: pipeline.run(
+                start_ts=date_end_ts(date, days=-1),
+                end_ts=date_end_ts(date),
+                execution_date=date,
+                wait=True,
+            ),
+        )
+    else:
+        runner = BackfillRunner(manifest, int(concurrency), resume=resume)
+        end_ts = date_end_ts(dates[-1])
+        upstream_tasks = [
+            name
+            for name in preprocess_tasks.tasks.keys()
+            if name not in DATE_RELATIVE_TASKS + ["all", "fused-monthly-feature"]
+        ] + ["date-store-yj-abc"]
+        key = upstream_key(dates)
+
+        def upstream():
+            # 最も古い実行日の特徴量とABCフラグまで含むように期間を伸ばし、最新の実行日で1回だけ作成する
+            # (実行日ごとに作成するテーブルはdaily pipelineと同じ期間にするため、作成後に元に戻す)
+            span_days = (pd.Timestamp(dates[-1]) - pd.Timestamp(dates[0])).days
+            train_days, test_days = c.preprocess.sql.train_days, c.predict.sql.test_days
+            c.preprocess.sql.train_days = int(train_days) + span_days
+            c.predict.sql.test_days = int(test_days) + span_days
+            try:
+                preprocess_tasks["all"](
+                    c, end_ts=end_ts, exclude=",".join(DATE_RELATIVE_TASKS)
+                )
+                predict_tasks["date-store-yj-abc"](c, end_ts=end_ts)
+            finally:
+                c.preprocess.sql.train_days = train_days
+                c.predict.sql.test_days = test_days
+
+        if key in runner.completed:
+            modified = modified_tables(
+                BQClient(c.env.gcp_project),
+                [(c.env.dataset_id, name.replace("-", "_")) for name in upstream_tasks],
+                manifest.load()[key]["finished_at"],
+            )
+            if modified:
+                logger.warning(
+                    f"rebuild {key} because {modified} were modified after it."
+                )
+                runner.invalidate(key)
+        runner.run_once(key, upstream)
+
+        def prepare(date_ts: str) -> None:
+            for name in DATE_RELATIVE_TASKS:
+                preprocess_tasks[name](c, end_ts=date_ts)
+
+        date_predictor = DatePredictor(
+            c.predict.predictor,
+            list(setting.exp_names),
+            lambda exp_name, date_ts: predict_tasks[f"predict-dataset-{exp_name}"](
+                c, end_ts=date_ts
+            ),
+            int(concurrency),
+            prepare=prepare,
+        )
+        report_df = runner.run_dates(dates, date_predictor.predict)
+
+    print(report_df.to_string(index=False, float_format="{:.1f}".format))
+    failed = [date for date in dates if date not in runner.completed]
+    if failed:
+        raise RuntimeError(f"backfill failed: {failed} (see {manifest.path})")
+    if mode == "local":
+        # 全日付の予測がそろってから、統合した予測結果を期間でまとめて更新する
+        runner.run_once(
+            DOWNSTREAM,
+            lambda: predict_tasks["prediction-result"](
+                c, start_ts=date_end_ts(dates[0], days=-1), end_ts=end_ts
+            ),
+        )
+    logger.info(f"[done] backfill of {len(dates)} dates ({manifest.path}).")
+
+
 @task
 def build_pipeline(c: Context):
     """pipeline.jsonを作成する
@@ -144,10 +392,15 @@ ns = Collection(
     get_columns,
     vertex_jobs,
     create_dataset,
+    plan,
+    cost_report,
+    cache_stats,
     run_pipeline,
+    backfill,
     build_pipeline,
     imp=import_tasks,
     preprocess=preprocess_tasks,
     train=train_tasks,
     predict=predict_tasks,
+    bench=bench_tasks,
 )
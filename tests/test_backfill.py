@@ -0,0 +1,204 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from src.backfill import (
+    BackfillManifest,
+    BackfillRunner,
+    backfill_dates,
+    modified_tables,
+    upstream_key,
+)
+
+
+class FakeBQClient(object):
+    """テーブルごとの最終更新日時だけを返すBQClientの代わり"""
+
+    def __init__(self, last_modified):
+        self.last_modified = last_modified
+
+    def table_metadata(self, dataset_id, table_id):
+        modified = self.last_modified.get(f"{dataset_id}.{table_id}")
+        if modified is None:
+            return None
+        return {"last_modified": modified, "num_rows": 0, "num_bytes": 0}
+
+
+class BackfillTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "manifest", "backfill.jsonl")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+class BackfillManifestTest(BackfillTestCase):
+    def test_load_missing_manifest(self):
+        manifest = BackfillManifest(self.path)
+        self.assertEqual(manifest.load(), {})
+        self.assertEqual(manifest.completed(), [])
+
+    def test_later_record_overrides(self):
+        manifest = BackfillManifest(self.path)
+        manifest.record("2022-01-01", "failed", 1.0, "RuntimeError()")
+        manifest.record("2022-01-02", "ok", 2.0)
+        manifest.record("2022-01-01", "ok", 3.0)
+        manifest.record("2022-01-02", "failed", 4.0, "RuntimeError()")
+        records = BackfillManifest(self.path).load()
+        self.assertEqual(records["2022-01-01"]["status"], "ok")
+        self.assertEqual(records["2022-01-02"]["error"], "RuntimeError()")
+        self.assertEqual(BackfillManifest(self.path).completed(), ["2022-01-01"])
+
+    def test_concurrent_records(self):
+        # 複数のスレッドから追記しても行が混ざらない
+        manifest = BackfillManifest(self.path)
+        threads = [
+            threading.Thread(
+                target=lambda i=i: [
+                    manifest.record(f"{i}_{j}", "ok", 0.0) for j in range(50)
+                ]
+            )
+            for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with open(self.path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 200)
+        self.assertEqual(len(manifest.completed()), 200)
+
+
+class BackfillRunnerTest(BackfillTestCase):
+    dates = ["2022-01-01", "2022-01-02", "2022-01-03"]
+
+    def test_resume_skips_completed_dates(self):
+        calls = []
+
+        def func(date):
+            calls.append(date)
+            if date == "2022-01-02":
+                raise RuntimeError("failed")
+
+        # 失敗した日付があっても他の日付は続ける
+        report_df = BackfillRunner(BackfillManifest(self.path), 2).run_dates(
+            self.dates, func
+        )
+        self.assertEqual(sorted(calls), self.dates)
+        self.assertEqual(list(report_df["key"]), self.dates)
+        self.assertEqual(list(report_df["status"]), ["ok", "failed", "ok"])
+
+        # 再実行では失敗した日付だけを処理する
+        calls.clear()
+        report_df = BackfillRunner(BackfillManifest(self.path), 2).run_dates(
+            self.dates, func
+        )
+        self.assertEqual(calls, ["2022-01-02"])
+        self.assertEqual(list(report_df["key"]), ["2022-01-02"])
+
+    def test_no_resume_reruns_all_dates(self):
+        BackfillRunner(BackfillManifest(self.path), 1).run_dates(
+            self.dates, lambda date: None
+        )
+        calls = []
+        runner = BackfillRunner(BackfillManifest(self.path), 1, resume=False)
+        runner.run_dates(self.dates, calls.append)
+        self.assertEqual(sorted(calls), self.dates)
+
+    def test_run_once(self):
+        key = upstream_key(self.dates)
+        calls = []
+        runner = BackfillRunner(BackfillManifest(self.path), 1)
+        runner.run_once(key, lambda: calls.append(key))
+        runner.run_once(key, lambda: calls.append(key))
+        self.assertEqual(calls, [key])
+        # 再実行でも完了したstepはskipする
+        BackfillRunner(BackfillManifest(self.path), 1).run_once(
+            key, lambda: calls.append(key)
+        )
+        self.assertEqual(calls, [key])
+
+    def test_run_once_failure(self):
+        def fail():
+            raise RuntimeError("failed")
+
+        manifest = BackfillManifest(self.path)
+        with self.assertRaises(RuntimeError):
+            BackfillRunner(manifest, 1).run_once("upstream", fail)
+        self.assertEqual(manifest.load()["upstream"]["status"], "failed")
+        # 失敗したstepは再実行で実行する
+        calls = []
+        BackfillRunner(manifest, 1).run_once("upstream", lambda: calls.append(1))
+        self.assertEqual(calls, [1])
+        self.assertEqual(manifest.completed(), ["upstream"])
+
+    def test_invalidate(self):
+        key = upstream_key(self.dates)
+        BackfillRunner(BackfillManifest(self.path), 1).run_once(key, lambda: None)
+        calls = []
+        runner = BackfillRunner(BackfillManifest(self.path), 1)
+        self.assertIn(key, runner.completed)
+        runner.invalidate(key)
+        runner.run_once(key, lambda: calls.append(key))
+        self.assertEqual(calls, [key])
+        # 存在しないkeyのinvalidateは何もしない
+        runner.invalidate("unknown")
+
+    def test_invalidate_when_upstream_tables_modified(self):
+        # tasks.backfillと同じく、完了後に更新されたテーブルがあればupstreamを作り直す
+        key = upstream_key(self.dates)
+        manifest = BackfillManifest(self.path)
+        BackfillRunner(manifest, 1).run_once(key, lambda: None)
+        finished_at = manifest.load()[key]["finished_at"]
+        tables = [("dataset", "feature_a"), ("dataset", "feature_b")]
+
+        bq = FakeBQClient(
+            {
+                "dataset.feature_a": "2000-01-01T00:00:00+00:00",
+                "dataset.feature_b": "2000-01-01T00:00:00+00:00",
+            }
+        )
+        self.assertEqual(modified_tables(bq, tables, finished_at), [])
+
+        bq.last_modified["dataset.feature_b"] = "2999-01-01T00:00:00+00:00"
+        modified = modified_tables(bq, tables, finished_at)
+        self.assertEqual(modified, ["dataset.feature_b"])
+
+        calls = []
+        runner = BackfillRunner(manifest, 1)
+        if modified:
+            runner.invalidate(key)
+        runner.run_once(key, lambda: calls.append(key))
+        self.assertEqual(calls, [key])
+
+
+class BackfillKeysTest(unittest.TestCase):
+    def test_backfill_dates(self):
+        self.assertEqual(
+            backfill_dates("2022-01-30", "2022-02-03", 2),
+            ["2022-01-30", "2022-02-01", "2022-02-03"],
+        )
+        with self.assertRaises(ValueError):
+            backfill_dates("2022-01-02", "2022-01-01")
+
+    def test_upstream_key(self):
+        # 最新の実行日と期間が同じ場合だけ同じkeyになる
+        key = upstream_key(["2022-01-01", "2022-01-31"])
+        self.assertEqual(key, "upstream_2022-01-31T00:00:00+09:00_30d")
+        self.assertNotEqual(key, upstream_key(["2022-01-02", "2022-01-31"]))
+        self.assertNotEqual(key, upstream_key(["2022-01-01", "2022-02-01"]))
+
+    def test_modified_tables_missing_table(self):
+        bq = FakeBQClient({})
+        self.assertEqual(
+            modified_tables(bq, [("dataset", "feature_a")], "2022-01-01T00:00:00"),
+            ["dataset.feature_a"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+from src.train.backtest import Backtester, split_flags
+from src.train.trainer import LGBMTrainer
+
+SPLIT_CONFIG = {"sum_days": 1, "train_days": 20, "valid_days": 5, "test_days": 5}
+
+
+def make_data(n_days: int = 60, n_rows_per_day: int = 40, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    dates = np.repeat(pd.date_range("2022-01-01", periods=n_days), n_rows_per_day)
+    df = pd.DataFrame(
+        {
+            "dispensing_date": dates.strftime("%Y-%m-%d"),
+            "x": rng.normal(size=len(dates)),
+            "store_code": rng.choice(["s1", "s2", "s3"], size=len(dates)),
+        }
+    )
+    df["label"] = df["x"] * 2 + (df["store_code"] == "s1") + rng.normal(size=len(df))
+    return df
+
+
+def make_trainer() -> LGBMTrainer:
+    config = OmegaConf.create(
+        {
+            "gcp_project": "project",
+            "dataset_id": "dataset",
+            "bucket": "bucket",
+            "latest_model_path": "models/latest",
+            "lgbm": {
+                "numerical_cols": ["x"],
+                "cat_cols": ["store_code"],
+                "label_col": "label",
+                "params": {"objective": "regression", "verbose": -1, "seed": 0},
+                "num_iterations": 20,
+                "early_stopping_rounds": 5,
+                "verbose_eval": 0,
+                "second_stage": "retrain",
+            },
+        }
+    )
+    return LGBMTrainer(config, "exp")
+
+
+class BacktesterTest(unittest.TestCase):
+    def test_run_after_lightgbm_in_parent(self):
+        # 親プロセスでLightGBM (OpenMP) を使った後でもworkerが止まらない
+        rng = np.random.default_rng(1)
+        X = rng.normal(size=(1000, 3))
+        lgb.train(
+            {"verbose": -1, "num_thread": 2},
+            lgb.Dataset(X, X.sum(axis=1)),
+            num_boost_round=5,
+        )
+        origins = ["2022-02-20T00:00:00+09:00", "2022-02-25T00:00:00+09:00"]
+        backtester = Backtester(make_trainer(), SPLIT_CONFIG, origins, n_parallel=2)
+        df = make_data()
+        report_df = backtester.run(df)
+        self.assertEqual(list(report_df["origin"]), origins + ["mean", "std"])
+        dates = pd.to_datetime(df["dispensing_date"])
+        for i, origin in enumerate(origins):
+            flags = split_flags(dates, origin, SPLIT_CONFIG)
+            self.assertEqual(report_df["num_test"].iloc[i], (flags == "test").sum())
+        self.assertTrue(np.isfinite(report_df["rmse"]).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
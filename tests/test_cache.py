@@ -0,0 +1,140 @@
+import os
+import tempfile
+import unittest
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from src.cache import TableCache
+
+QUERY = "SELECT * FROM dataset.train_dataset_exp"
+
+
+class FakeBQClient(object):
+    """テーブルの最終更新日時, 行数, byte数だけを返すBQClient"""
+
+    def __init__(self):
+        self.metadata = {}
+
+    def table_metadata(self, dataset_id, table_id):
+        return self.metadata.get((dataset_id, table_id))
+
+
+def make_frame(n_rows: int = 1000, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "yj_code": rng.choice(["a", "b", "c"], size=n_rows),
+            "x": rng.normal(size=n_rows),
+            "n": rng.integers(0, 100, size=n_rows),
+        }
+    )
+
+
+class TableCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.bq = FakeBQClient()
+        self.cache = TableCache(self.tmp_dir.name, 10 * 1024 * 1024, bq=self.bq)
+        self.loads = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def set_table(self, table_id: str, last_modified: str, num_rows: int = 1000):
+        self.bq.metadata[("dataset", table_id)] = {
+            "last_modified": last_modified,
+            "num_rows": num_rows,
+            "num_bytes": 0,
+        }
+
+    def read(self, table_id: str, df: pd.DataFrame) -> pd.DataFrame:
+        def load():
+            self.loads.append(table_id)
+            return df
+
+        return self.cache.read("project", "dataset", table_id, QUERY, load)
+
+    def test_miss_then_hit(self):
+        df = make_frame()
+        self.set_table("t1", "2022-01-01T00:00:00")
+        pd.testing.assert_frame_equal(self.read("t1", df), df)
+        pd.testing.assert_frame_equal(self.read("t1", df), df)
+        self.assertEqual(self.loads, ["t1"])
+        summary = self.cache.summary()
+        self.assertEqual(summary["snapshots"], 1)
+        stats = self.cache.stats()
+        self.assertEqual(list(stats["hits"]), [1])
+
+    def test_table_without_metadata_is_not_cached(self):
+        df = make_frame()
+        self.read("missing", df)
+        self.read("missing", df)
+        self.assertEqual(self.loads, ["missing", "missing"])
+        self.assertEqual(len(self.cache.stats()), 0)
+
+    def test_modified_table_replaces_snapshot(self):
+        self.set_table("t1", "2022-01-01T00:00:00")
+        self.read("t1", make_frame(seed=0))
+        self.set_table("t1", "2022-01-02T00:00:00")
+        df = make_frame(seed=1)
+        pd.testing.assert_frame_equal(self.read("t1", df), df)
+        self.assertEqual(self.loads, ["t1", "t1"])
+        # 古いsnapshotは削除される
+        self.assertEqual(len(self.cache.stats()), 1)
+        feathers = [f for f in os.listdir(self.tmp_dir.name) if f.endswith(".feather")]
+        self.assertEqual(len(feathers), 1)
+
+    def test_evict_least_recently_used(self):
+        df = make_frame(n_rows=20000)
+        self.set_table("t1", "2022-01-01T00:00:00")
+        self.read("t1", df)
+        size = int(self.cache.stats()["gib"].iloc[0] * 1024**3)
+        # snapshot 2つ分の上限
+        self.cache.max_bytes = int(size * 2.5)
+        for table_id in ["t2", "t3"]:
+            self.set_table(table_id, "2022-01-01T00:00:00")
+        self.read("t2", df)
+        self.read("t1", df)
+        self.read("t3", df)
+        # 最後に使われたのが最も古いt2が削除される
+        tables = sorted(self.cache.stats()["table"])
+        self.assertEqual(tables, ["project.dataset.t1", "project.dataset.t3"])
+        self.read("t2", df)
+        self.assertEqual(self.loads, ["t1", "t2", "t3", "t2"])
+
+    def test_hit_survives_eviction_after_lock(self):
+        # ロックを外した直後に別のプロセスがsnapshotを削除しても、hitしたsnapshotを読み込める
+        df = make_frame()
+        self.set_table("t1", "2022-01-01T00:00:00")
+        self.read("t1", df)
+        locked_index = self.cache._locked_index
+
+        @contextmanager
+        def evict_after_unlock():
+            with locked_index() as index:
+                yield index
+            for name in os.listdir(self.tmp_dir.name):
+                if name.endswith(".feather"):
+                    os.remove(os.path.join(self.tmp_dir.name, name))
+
+        self.cache._locked_index = evict_after_unlock
+        pd.testing.assert_frame_equal(self.read("t1", df), df)
+        self.assertEqual(self.loads, ["t1"])
+
+    def test_missing_snapshot_is_a_miss(self):
+        # indexにあってもファイルが削除されている場合はBQから読み込み直す
+        df = make_frame()
+        self.set_table("t1", "2022-01-01T00:00:00")
+        self.read("t1", df)
+        for name in os.listdir(self.tmp_dir.name):
+            if name.endswith(".feather"):
+                os.remove(os.path.join(self.tmp_dir.name, name))
+        pd.testing.assert_frame_equal(self.read("t1", df), df)
+        self.assertEqual(self.loads, ["t1", "t1"])
+        self.assertEqual(self.cache.summary()["misses"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
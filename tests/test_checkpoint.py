@@ -0,0 +1,246 @@
+import unittest
+from unittest.mock import patch
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+from src.train.checkpoint import (
+    CheckpointStore,
+    ResumableEarlyStopping,
+    checkpoint_callback,
+)
+from src.train.trainer import LGBMTrainer
+
+
+class FakeGCSClient(object):
+    """blobをメモリに保存するGCSClient"""
+
+    def __init__(self):
+        self.blobs = {}
+        self.generation = 0
+
+    def upload_blob(self, bucket_name, source_file_name, destination_blob_name):
+        with open(source_file_name, "rb") as f:
+            self.generation += 1
+            self.blobs[(bucket_name, destination_blob_name)] = (
+                f.read(),
+                self.generation,
+            )
+
+    def download_blob(self, bucket_name, source_blob_name, destination_file_name):
+        with open(destination_file_name, "wb") as f:
+            f.write(self.blobs[(bucket_name, source_blob_name)][0])
+
+    def blob_generation(self, bucket_name, blob_name):
+        blob = self.blobs.get((bucket_name, blob_name))
+        return None if blob is None else blob[1]
+
+    def delete_blob(self, bucket_name, blob_name):
+        del self.blobs[(bucket_name, blob_name)]
+
+    def fetch_list_blobs(self, bucket_name, prefix=None, delimiter=None):
+        return [
+            name
+            for bucket, name in self.blobs
+            if bucket == bucket_name and name.startswith(prefix or "")
+        ]
+
+
+class Interrupted(Exception):
+    """学習の途中でプロセスが落ちたことを表す"""
+
+
+def interrupt_at(iteration: int):
+    def _callback(env):
+        if env.iteration + 1 == iteration:
+            raise Interrupted()
+
+    # checkpointを保存した後に落とす
+    _callback.order = 50
+    return _callback
+
+
+def make_data(n_rows: int = 2000, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.normal(size=(n_rows, 3)), columns=["x1", "x2", "x3"])
+    df["label"] = df["x1"] * 2 + df["x2"] ** 2 + rng.normal(scale=0.5, size=n_rows)
+    return df
+
+
+def make_trainer() -> LGBMTrainer:
+    config = OmegaConf.create(
+        {
+            "gcp_project": "project",
+            "dataset_id": "dataset",
+            "bucket": "bucket",
+            "latest_model_path": "models/latest",
+            "checkpoint": {
+                "interval_sec": 0,
+                "dir": "checkpoints",
+                "execution_date": "2022-01-01",
+            },
+            "lgbm": {
+                "numerical_cols": ["x1", "x2", "x3"],
+                "cat_cols": [],
+                "label_col": "label",
+                "params": {
+                    "objective": "regression",
+                    "learning_rate": 0.3,
+                    "num_leaves": 7,
+                    "verbose": -1,
+                    "seed": 0,
+                    "num_thread": 1,
+                    "deterministic": True,
+                },
+                "num_iterations": 300,
+                "early_stopping_rounds": 10,
+                "verbose_eval": 0,
+            },
+        }
+    )
+    return LGBMTrainer(config, "exp")
+
+
+def make_datasets(trainer: LGBMTrainer):
+    """学習ごとに作るtrain, validのDataset (構築済みのDatasetは別の学習に使えない)"""
+    df = make_data()
+    lgtrain = trainer._make_dataset(df.iloc[:1500])
+    return lgtrain, trainer._make_dataset(df.iloc[1500:], reference=lgtrain)
+
+
+class CheckpointStoreTest(unittest.TestCase):
+    def test_save_and_load(self):
+        gcs = FakeGCSClient()
+        store = CheckpointStore(gcs, "bucket", "exp/checkpoints/2022-01-01/first")
+        self.assertIsNone(store.load())
+        df = make_data()
+        bst = lgb.train(
+            {"verbose": -1, "seed": 0},
+            lgb.Dataset(df[["x1", "x2", "x3"]], df["label"]),
+            num_boost_round=5,
+        )
+        store.save(bst, {"iteration": 5, "completed": False, "early_stopping": None})
+        bst = lgb.train(
+            {"verbose": -1, "seed": 0},
+            lgb.Dataset(df[["x1", "x2", "x3"]], df["label"]),
+            num_boost_round=8,
+        )
+        store.save(
+            bst,
+            {
+                "iteration": 8,
+                "completed": True,
+                "best_iteration": 6,
+                "early_stopping": None,
+            },
+        )
+        # 古いcheckpointのモデルは削除される
+        self.assertEqual(
+            sorted(name for _, name in gcs.blobs),
+            [
+                "exp/checkpoints/2022-01-01/first/model_8.txt",
+                "exp/checkpoints/2022-01-01/first/state.json",
+            ],
+        )
+        state = store.load()
+        self.assertTrue(state["completed"])
+        self.assertEqual(state["iteration"], 8)
+        self.assertEqual(state["booster"].current_iteration(), 8)
+        self.assertEqual(state["booster"].best_iteration, 6)
+        X = df[["x1", "x2", "x3"]]
+        np.testing.assert_allclose(
+            state["booster"].predict(X, num_iteration=-1), bst.predict(X)
+        )
+
+
+class ResumableEarlyStoppingTest(unittest.TestCase):
+    def setUp(self):
+        self.trainer = make_trainer()
+
+    def train(self, callbacks, num_boost_round=300, init_model=None):
+        lgtrain, lgvalid = make_datasets(self.trainer)
+        return lgb.train(
+            self.trainer.params,
+            lgtrain,
+            num_boost_round=num_boost_round,
+            init_model=init_model,
+            valid_sets=[lgtrain, lgvalid],
+            valid_names=["train", "valid"],
+            callbacks=callbacks,
+        )
+
+    def test_same_as_lgb_early_stopping(self):
+        expected = self.train([lgb.early_stopping(10, verbose=False)])
+        early_stopping = ResumableEarlyStopping(10)
+        bst = self.train([early_stopping])
+        self.assertLess(expected.best_iteration, 300)
+        self.assertEqual(bst.best_iteration, expected.best_iteration)
+        self.assertEqual(bst.best_score, expected.best_score)
+
+    def test_resume_from_state(self):
+        expected = self.train([ResumableEarlyStopping(10)])
+        stop_at = expected.best_iteration + 5
+        first = ResumableEarlyStopping(10)
+        bst = self.train([first], num_boost_round=stop_at)
+        # 状態はJSONで保存される
+        state = {k: list(v) for k, v in first.state().items()}
+        resumed = ResumableEarlyStopping(10, state=state)
+        bst = self.train([resumed], num_boost_round=300 - stop_at, init_model=bst)
+        # 再開前の最良のiterationを引き継いでearly stoppingする
+        self.assertEqual(bst.best_iteration, expected.best_iteration)
+        self.assertEqual(bst.current_iteration(), expected.current_iteration())
+
+
+class TrainerResumeTest(unittest.TestCase):
+    def test_resume_after_interruption(self):
+        trainer = make_trainer()
+
+        def args():
+            lgtrain, lgvalid = make_datasets(trainer)
+            return ("first", lgtrain, 300, [lgtrain, lgvalid], ["train", "valid"], 10)
+
+        expected = trainer._train(*args())
+
+        gcs = FakeGCSClient()
+        store = CheckpointStore(gcs, "bucket", "exp/checkpoints/2022-01-01/first")
+        # 1回目: checkpointを保存しながら学習し、途中で落ちる
+        early_stopping = ResumableEarlyStopping(10)
+        lgtrain, lgvalid = make_datasets(trainer)
+        with self.assertRaises(Interrupted):
+            lgb.train(
+                trainer.params,
+                lgtrain,
+                num_boost_round=300,
+                valid_sets=[lgtrain, lgvalid],
+                valid_names=["train", "valid"],
+                callbacks=[
+                    early_stopping,
+                    checkpoint_callback(store, 0, early_stopping),
+                    interrupt_at(expected.best_iteration + 3),
+                ],
+            )
+        self.assertEqual(store.load()["iteration"], expected.best_iteration + 3)
+
+        # 2回目: checkpointから再開する
+        with patch.object(LGBMTrainer, "_checkpoint_store", return_value=store):
+            bst = trainer._train(*args(), resume=True)
+            self.assertEqual(bst.best_iteration, expected.best_iteration)
+            self.assertEqual(bst.current_iteration(), expected.current_iteration())
+            X = make_data()[["x1", "x2", "x3"]].iloc[1500:]
+            np.testing.assert_allclose(
+                bst.predict(X, num_iteration=bst.best_iteration),
+                expected.predict(X, num_iteration=expected.best_iteration),
+                rtol=1e-6,
+            )
+            self.assertTrue(store.load()["completed"])
+            # 完了済みのstageは学習せずに保存したモデルを返す
+            with patch("lightgbm.train") as train:
+                bst = trainer._train(*args(), resume=True)
+            train.assert_not_called()
+            self.assertEqual(bst.best_iteration, expected.best_iteration)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+
+from src.predict.compiler import CompiledForest
+
+
+def make_data(n_rows: int = 2000, seed: int = 0):
+    """数値, 0, NaN, カテゴリを含む特徴量と目的変数"""
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_rows, 5))
+    # 0が多い列と欠損のある列
+    X[rng.random(n_rows) < 0.3, 1] = 0.0
+    X[rng.random(n_rows) < 0.2, 2] = np.nan
+    # 40種類のカテゴリ (bitsetが32bitを超える)
+    X[:, 3] = rng.integers(0, 40, size=n_rows)
+    X[:, 4] = rng.integers(0, 5, size=n_rows)
+    y = (
+        X[:, 0]
+        + np.nan_to_num(X[:, 2]) * 2
+        + (X[:, 3] % 7 == 0) * 3
+        + (X[:, 1] == 0)
+        + rng.normal(scale=0.1, size=n_rows)
+    )
+    return X, y
+
+
+def train(X: np.ndarray, y: np.ndarray, **params) -> lgb.Booster:
+    params = {
+        "objective": "regression",
+        "num_leaves": 15,
+        "min_data_in_leaf": 5,
+        "min_data_per_group": 5,
+        "cat_smooth": 1,
+        "verbose": -1,
+        "seed": 0,
+        **params,
+    }
+    dataset = lgb.Dataset(X, y, categorical_feature=[3, 4], free_raw_data=False)
+    return lgb.train(params, dataset, num_boost_round=30)
+
+
+class CompiledForestTest(unittest.TestCase):
+    """CompiledForestの予測がBooster.predictと一致することを確認する"""
+
+    def assert_parity(self, bst: lgb.Booster, X: np.ndarray, **kwargs) -> None:
+        forest = CompiledForest.from_booster(
+            bst, num_iteration=kwargs.get("num_iteration")
+        )
+        np.testing.assert_allclose(
+            forest.predict(X, batch_size=kwargs.get("batch_size", 4096)),
+            bst.predict(X, num_iteration=kwargs.get("num_iteration")),
+            rtol=1e-6,
+            atol=1e-9,
+        )
+
+    def test_regression(self):
+        X, y = make_data()
+        bst = train(X, y)
+        X_test, _ = make_data(seed=1)
+        self.assert_parity(bst, X_test)
+
+    def test_unseen_and_negative_categories(self):
+        X, y = make_data()
+        bst = train(X, y)
+        X_test, _ = make_data(n_rows=500, seed=2)
+        X_test[:100, 3] = 100
+        X_test[100:200, 3] = -1
+        X_test[200:300, 3] = np.nan
+        self.assert_parity(bst, X_test)
+
+    def test_zero_as_missing(self):
+        X, y = make_data()
+        bst = train(X, y, zero_as_missing=True)
+        X_test, _ = make_data(seed=3)
+        self.assert_parity(bst, X_test)
+
+    def test_missing_type_none(self):
+        X, y = make_data()
+        bst = train(X, y, use_missing=False)
+        X_test, _ = make_data(seed=4)
+        self.assert_parity(bst, X_test)
+
+    def test_values_on_threshold(self):
+        # float64の閾値の前後の値でも同じ分岐になる
+        X, y = make_data()
+        bst = train(X, y)
+        thresholds = [
+            node["threshold"]
+            for tree in bst.dump_model()["tree_info"]
+            for node in _split_nodes(tree["tree_structure"])
+            if node["decision_type"] == "<="
+        ]
+        X_test = np.repeat(make_data(n_rows=1, seed=5)[0], len(thresholds) * 3, axis=0)
+        values = np.concatenate(
+            [
+                thresholds,
+                np.nextafter(thresholds, np.inf),
+                np.nextafter(thresholds, -np.inf),
+            ]
+        )
+        for col in [0, 1, 2]:
+            X_col = X_test.copy()
+            X_col[:, col] = values
+            self.assert_parity(bst, X_col)
+            self.assert_parity(bst, X_col.astype(np.float32))
+
+    def test_dataframe(self):
+        X, y = make_data()
+        bst = train(X, y)
+        df = pd.DataFrame(X).astype({3: np.int64, 4: np.int32}, errors="ignore")
+        df[[3, 4]] = df[[3, 4]].fillna(-1)
+        self.assert_parity(bst, df)
+
+    def test_objectives(self):
+        X, y = make_data()
+        for params, label in [
+            ({"objective": "binary"}, (y > np.median(y)).astype(float)),
+            ({"objective": "tweedie"}, np.abs(y)),
+            ({"objective": "poisson"}, np.abs(y)),
+        ]:
+            with self.subTest(**params):
+                self.assert_parity(train(X, label, **params), X)
+
+    def test_num_iteration_and_batches(self):
+        X, y = make_data()
+        bst = train(X, y)
+        self.assert_parity(bst, X, num_iteration=10, batch_size=333)
+        self.assert_parity(bst, X[:1])
+
+
+def _split_nodes(node):
+    if "leaf_value" in node:
+        return []
+    return [node] + _split_nodes(node["left_child"]) + _split_nodes(node["right_child"])
+
+
+if __name__ == "__main__":
+    unittest.main()
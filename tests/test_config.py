@@ -0,0 +1,97 @@
+import pickle
+import unittest
+
+from omegaconf import OmegaConf
+
+from src.config import PredictorSetting, TrainerSetting
+
+LGBM = {
+    "numerical_cols": ["x1", "x2"],
+    "cat_cols": ["c1"],
+    "label_col": "label",
+    "pred_col": "pred",
+    "params": {"objective": "regression"},
+    "num_iterations": 10,
+}
+TRAINER = {
+    "gcp_project": "project",
+    "dataset_id": "dataset",
+    "bucket": "bucket",
+    "latest_model_path": "models/latest",
+    "lgbm": LGBM,
+}
+PREDICTOR = {
+    "gcp_project": "project",
+    "dataset": "dataset",
+    "train_bucket": "train_bucket",
+    "bucket": "bucket",
+    "latest_model_path": "models/latest",
+    "inverse_transform": {"exp001": "min_max"},
+    "lgbm": LGBM,
+}
+
+
+def make_config(base, **overrides):
+    return OmegaConf.create({**base, **overrides})
+
+
+class TrainerSettingTest(unittest.TestCase):
+    def test_from_config(self):
+        setting = TrainerSetting.from_config(make_config(TRAINER, debug="False"))
+        self.assertEqual(setting.gcp_project, "project")
+        self.assertEqual(setting.lgbm.feature_cols, ("x1", "x2", "c1"))
+        self.assertFalse(setting.debug)
+        self.assertFalse(setting.explain.enabled)
+        self.assertEqual(pickle.loads(pickle.dumps(setting)), setting)
+
+    def test_required_fields(self):
+        for name in ["gcp_project", "dataset_id", "bucket", "latest_model_path"]:
+            with self.subTest(name=name):
+                for value in [None, ""]:
+                    config = make_config(TRAINER, **{name: value})
+                    with self.assertRaisesRegex(ValueError, f"trainer.{name}"):
+                        TrainerSetting.from_config(config)
+
+    def test_bool(self):
+        for value, expected in [(True, True), ("true", True), ("False", False)]:
+            with self.subTest(value=value):
+                config = make_config(TRAINER, debug=value)
+                self.assertEqual(TrainerSetting.from_config(config).debug, expected)
+        for value in ["no", 1]:
+            with self.subTest(value=value):
+                config = make_config(TRAINER, debug=value)
+                with self.assertRaisesRegex(ValueError, "trainer.debug"):
+                    TrainerSetting.from_config(config)
+        config = make_config(TRAINER, explain={"enabled": "yes"})
+        with self.assertRaisesRegex(ValueError, "explain.enabled"):
+            TrainerSetting.from_config(config)
+
+
+class PredictorSettingTest(unittest.TestCase):
+    def test_from_config(self):
+        setting = PredictorSetting.from_config(make_config(PREDICTOR, compiled="True"))
+        self.assertTrue(setting.compiled)
+        self.assertEqual(setting.inverse_transform("exp001"), "min_max")
+        self.assertEqual(setting.inverse_transform("exp002"), "log1p")
+
+    def test_required_fields(self):
+        for name in [
+            "gcp_project",
+            "dataset",
+            "train_bucket",
+            "bucket",
+            "latest_model_path",
+        ]:
+            with self.subTest(name=name):
+                config = make_config(PREDICTOR, **{name: None})
+                with self.assertRaisesRegex(ValueError, f"predictor.{name}"):
+                    PredictorSetting.from_config(config)
+
+    def test_unknown_inverse_transform(self):
+        config = make_config(PREDICTOR, inverse_transform={"exp001": "log"})
+        with self.assertRaisesRegex(ValueError, "inverse_transform.exp001"):
+            PredictorSetting.from_config(config)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import logging
+import os
+import subprocess
+import sys
+import unittest
+
+from src import log
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class GetLoggerTest(unittest.TestCase):
+    def test_import_does_not_configure(self):
+        # moduleのimportではルートロガーのhandlerもlistenerのスレッドも作らない
+        code = (
+            "import logging, threading\n"
+            "import src.cache, src.predict.server, src.train.trainer\n"
+            "from src import log\n"
+            "log.get_logger('src.test')\n"
+            "assert log._state['listener'] is None\n"
+            "assert not [h for h in logging.getLogger().handlers\n"
+            "            if isinstance(h, log.ContextQueueHandler)]\n"
+            "assert threading.active_count() == 1, threading.enumerate()\n"
+        )
+        result = subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", code],
+            cwd=ROOT_DIR,
+            env={**os.environ, "PYTHONPATH": ROOT_DIR},
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_get_logger_is_plain(self):
+        self.assertIs(log.get_logger("src.test"), logging.getLogger("src.test"))
+
+
+class ConfigureTest(unittest.TestCase):
+    def setUp(self):
+        self.state = dict(log._state)
+        self.handlers = list(logging.getLogger().handlers)
+        self.level = logging.getLogger().level
+        log._state.update(listener=None, setting=None, explicit=False)
+
+    def tearDown(self):
+        log._stop()
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            if h not in self.handlers:
+                root.removeHandler(h)
+        root.setLevel(self.level)
+        log._state.update(self.state)
+
+    def queue_handlers(self):
+        return [
+            h
+            for h in logging.getLogger().handlers
+            if isinstance(h, log.ContextQueueHandler)
+        ]
+
+    def test_configure_once(self):
+        log.configure({"level": "DEBUG"})
+        log.configure({"level": "WARNING"})
+        log.configure()
+        self.assertEqual(len(self.queue_handlers()), 1)
+        # 最初に指定した設定が使われる
+        self.assertEqual(logging.getLogger().level, logging.DEBUG)
+
+    def test_invalid_setting(self):
+        with self.assertRaises(ValueError):
+            log.configure({"sink": "file"})
+
+    def test_worker_state(self):
+        log.configure({"format": "json"}, gcp_project="project")
+        state = log.worker_state()
+        self.assertEqual(state["setting"]["format"], "json")
+        self.assertEqual(state["context"]["run_id"], log.current_context()["run_id"])
+
+
+if __name__ == "__main__":
+    unittest.main()
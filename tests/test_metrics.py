@@ -0,0 +1,96 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from src.train.metrics import segment_metrics
+
+
+def make_data(n_rows: int = 5000, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "yj_code": rng.choice([f"yj{i:03d}" for i in range(50)], size=n_rows),
+            "store_code": rng.integers(0, 20, size=n_rows),
+            "abc_flag": rng.choice(["A", "B", "C", None], size=n_rows),
+            "label": rng.gamma(1.0, 10.0, size=n_rows),
+        }
+    )
+    # 実績が全て0のグループ (wape, biasが計算できない)
+    df.loc[df["yj_code"] == "yj000", "label"] = 0.0
+    df["pred"] = df["label"] + rng.normal(scale=3.0, size=n_rows)
+    return df
+
+
+def expected_metrics(df: pd.DataFrame, col: str) -> pd.DataFrame:
+    """pandasのgroupbyで同じ評価指標を計算する"""
+    df = df.assign(
+        error=df["pred"] - df["label"],
+        key=df[col].fillna("unknown").astype(str),
+    )
+    grouped = df.groupby("key")
+    expected = pd.DataFrame(
+        {
+            "n": grouped.size(),
+            "rmse": grouped["error"].apply(lambda e: np.sqrt((e**2).mean())),
+            "mae": grouped["error"].apply(lambda e: e.abs().mean()),
+            "wape": grouped["error"].apply(lambda e: e.abs().sum())
+            / grouped["label"].apply(lambda y: y.abs().sum()),
+            "bias": grouped["error"].sum()
+            / grouped["label"].apply(lambda y: y.abs().sum()),
+            "sum_label": grouped["label"].sum(),
+            "sum_pred": grouped["pred"].sum(),
+        }
+    )
+    return expected.rename_axis("segment_value").reset_index()
+
+
+class SegmentMetricsTest(unittest.TestCase):
+    """SegmentMetricsの集計がpandasのgroupbyと一致することを確認する"""
+
+    segment_cols = ["yj_code", "store_code", "abc_flag"]
+
+    def assert_matches_groupby(self, df: pd.DataFrame, result: pd.DataFrame) -> None:
+        for col in self.segment_cols:
+            with self.subTest(segment=col):
+                actual = (
+                    result[result["segment"] == col]
+                    .drop(columns="segment")
+                    .sort_values("segment_value", ignore_index=True)
+                )
+                expected = expected_metrics(df, col).sort_values(
+                    "segment_value", ignore_index=True
+                )
+                pd.testing.assert_frame_equal(
+                    actual, expected, check_dtype=False, rtol=1e-5
+                )
+
+    def test_matches_groupby(self):
+        df = make_data()
+        result = segment_metrics(
+            df, self.segment_cols, df["label"].to_numpy(), df["pred"].to_numpy()
+        )
+        self.assert_matches_groupby(df, result)
+
+    def test_all_rows(self):
+        df = make_data()
+        result = segment_metrics(
+            df, self.segment_cols, df["label"].to_numpy(), df["pred"].to_numpy()
+        )
+        actual = result[result["segment"] == "all"].drop(columns="segment")
+        expected = expected_metrics(df.assign(all="0"), "all")
+        pd.testing.assert_frame_equal(
+            actual.reset_index(drop=True), expected, check_dtype=False, rtol=1e-5
+        )
+
+    def test_chunks_give_same_result(self):
+        df = make_data()
+        args = (df, self.segment_cols, df["label"].to_numpy(), df["pred"].to_numpy())
+        pd.testing.assert_frame_equal(
+            segment_metrics(*args, chunk_size=777), segment_metrics(*args)
+        )
+        self.assert_matches_groupby(df, segment_metrics(*args, chunk_size=777))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+from unittest.mock import patch
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+
+from src.predict.routed import RoutedBooster, SegmentKey
+
+
+def train(X: np.ndarray, y: np.ndarray) -> lgb.Booster:
+    params = {"objective": "regression", "num_leaves": 7, "verbose": -1, "seed": 0}
+    return lgb.train(params, lgb.Dataset(X, y), num_boost_round=10)
+
+
+class RoutedBoosterTest(unittest.TestCase):
+    """RoutedBoosterが行ごとにsegmentのモデルのBooster.predictと同じ値を返すことを確認する"""
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        cls.X = rng.normal(size=(600, 4))
+        # segmentごとに目的変数を変えて、別のモデルになるようにする
+        cls.boosters = {
+            segment: train(cls.X, cls.X[:, i] * (i + 1))
+            for i, segment in enumerate(["a", "b", "c"])
+        }
+        cls.model = RoutedBooster(cls.boosters, SegmentKey(kind="column"), default="b")
+        cls.segments = rng.choice(
+            np.array(["a", "b", "c", "unknown", None], dtype=object), size=len(cls.X)
+        )
+
+    def expected(self, X: np.ndarray) -> np.ndarray:
+        return np.array(
+            [
+                self.boosters[segment if segment in self.boosters else "b"].predict(
+                    X[i : i + 1]
+                )[0]
+                for i, segment in enumerate(self.segments)
+            ]
+        )
+
+    def test_route(self):
+        routes = self.model.route(
+            np.array(["c", "a", "unknown", None, np.nan, "b"], dtype=object)
+        )
+        np.testing.assert_array_equal(routes, [2, 0, 1, 1, 1, 1])
+
+    def test_predict_matches_segment_booster(self):
+        expected = self.expected(self.X)
+        np.testing.assert_allclose(self.model.predict(self.X, self.segments), expected)
+        np.testing.assert_allclose(
+            self.model.predict(pd.DataFrame(self.X), self.segments), expected
+        )
+
+    def test_predict_with_missing_segments(self):
+        # 一部のsegmentの行が無い場合
+        segments = np.array(["a"] * len(self.X), dtype=object)
+        np.testing.assert_allclose(
+            self.model.predict(self.X, segments), self.boosters["a"].predict(self.X)
+        )
+
+    def test_default_must_have_model(self):
+        with self.assertRaises(ValueError):
+            RoutedBooster(self.boosters, SegmentKey(kind="column"), default="d")
+
+
+class SegmentKeyTest(unittest.TestCase):
+    def test_column(self):
+        df = pd.DataFrame({"yj_code": ["1124017F1", "1124017F2", "2149039F1"]})
+        key = SegmentKey(kind="column", column="yj_code", prefix_length=4)
+        np.testing.assert_array_equal(
+            key.assign(df, "project"), ["1124", "1124", "2149"]
+        )
+
+    def test_abc_uses_flag_of_each_row_date(self):
+        df = pd.DataFrame(
+            {
+                "yj_code": ["y1", "y1", "y1", "y2"],
+                "store_code": ["s1", "s1", "s1", "s1"],
+                "dispensing_date": [
+                    "2022-01-02",
+                    "2022-01-03",
+                    "2022-01-04",
+                    "2022-01-03",
+                ],
+            }
+        )
+        flags = pd.Series(
+            ["a", "c", "b"],
+            index=pd.MultiIndex.from_tuples(
+                [
+                    (pd.Timestamp("2022-01-02"), "y1", "s1"),
+                    (pd.Timestamp("2022-01-03"), "y1", "s1"),
+                    (pd.Timestamp("2022-01-03"), "y2", "s1"),
+                ],
+                names=["dispensing_date", "yj_code", "store_code"],
+            ),
+        )
+        key = SegmentKey(kind="abc", abc_table="dataset.date_store_yj_abc")
+        with patch.object(SegmentKey, "_load_abc_flags", return_value=flags) as load:
+            segments = key.assign(df, "project")
+        # 行の期間のフラグを読み込み、フラグが無い日付の行はNoneにする
+        load.assert_called_once_with(
+            "project", pd.Timestamp("2022-01-02"), pd.Timestamp("2022-01-04")
+        )
+        self.assertEqual(list(segments), ["a", "c", None, "b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
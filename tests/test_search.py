@@ -0,0 +1,171 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import lightgbm as lgb
+import numpy as np
+
+from src.train.search import (
+    COMPLETE,
+    FAILED,
+    PRUNED,
+    MedianPruner,
+    TrialLog,
+    TrialPruned,
+    pruning_callback,
+    sample_params,
+)
+
+
+def completed_pruner(direction: str) -> MedianPruner:
+    pruner = MedianPruner(n_startup_trials=3, n_warmup_steps=10, direction=direction)
+    for values in [
+        {10: 5.0, 20: 4.0, 30: 3.0},
+        {10: 6.0, 20: 5.0},
+        {10: 7.0, 20: 6.0, 30: 5.0},
+    ]:
+        pruner.add_completed(values)
+    return pruner
+
+
+class MedianPrunerTest(unittest.TestCase):
+    def test_minimize(self):
+        pruner = completed_pruner("minimize")
+        # iteration 20の中央値は5.0
+        self.assertTrue(pruner.should_prune(20, 5.5))
+        self.assertFalse(pruner.should_prune(20, 4.5))
+        # early stoppingで止まったtrialはその時点の最良値 (5.0) を使う: 中央値は5.0
+        self.assertTrue(pruner.should_prune(30, 5.1))
+        # warmupの間は打ち切らない
+        self.assertFalse(pruner.should_prune(10, 100.0))
+
+    def test_maximize(self):
+        pruner = completed_pruner("maximize")
+        # iteration 20までの最良値は最大値: 5.0, 6.0, 7.0 -> 中央値は6.0
+        self.assertTrue(pruner.should_prune(20, 5.5))
+        self.assertFalse(pruner.should_prune(20, 6.5))
+
+    def test_startup_trials(self):
+        pruner = MedianPruner(n_startup_trials=2, n_warmup_steps=0)
+        pruner.add_completed({10: 1.0})
+        self.assertFalse(pruner.should_prune(10, 100.0))
+
+    def test_invalid_direction(self):
+        with self.assertRaises(ValueError):
+            MedianPruner(direction="lower")
+
+
+class PruningCallbackTest(unittest.TestCase):
+    def train(self, pruner: MedianPruner, metric: str):
+        rng = np.random.default_rng(0)
+        X = rng.normal(size=(500, 3))
+        y = (X[:, 0] > 0).astype(float)
+        lgtrain = lgb.Dataset(X, y)
+        intermediate_values = {}
+        lgb.train(
+            {"objective": "binary", "metric": metric, "verbose": -1},
+            lgtrain,
+            num_boost_round=10,
+            valid_sets=[lgb.Dataset(X, y, reference=lgtrain)],
+            valid_names=["valid"],
+            callbacks=[pruning_callback(pruner, intermediate_values, interval=2)],
+        )
+        return intermediate_values
+
+    def test_records_and_prunes(self):
+        pruner = MedianPruner(n_startup_trials=1, n_warmup_steps=0)
+        pruner.add_completed({2: 0.0, 4: 0.0})
+        with self.assertRaises(TrialPruned) as cm:
+            self.train(pruner, "binary_logloss")
+        self.assertEqual(cm.exception.step, 2)
+
+    def test_maximize_metric(self):
+        pruner = MedianPruner(n_startup_trials=1, direction="maximize")
+        values = self.train(pruner, "auc")
+        self.assertEqual(sorted(values), [2, 4, 6, 8, 10])
+
+    def test_direction_must_match_metric(self):
+        pruner = MedianPruner(direction="minimize")
+        with self.assertRaisesRegex(ValueError, "auc"):
+            self.train(pruner, "auc")
+
+
+class TrialLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "trials.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def records(self):
+        return [
+            {"trial_id": 0, "state": COMPLETE, "value": 0.5},
+            {"trial_id": 1, "state": PRUNED, "value": 0.1},
+            {"trial_id": 2, "state": COMPLETE, "value": 0.3},
+            {"trial_id": 3, "state": FAILED, "value": None},
+            {"trial_id": 4, "state": COMPLETE, "value": 0.4},
+        ]
+
+    def test_resume_and_best(self):
+        trial_log = TrialLog(self.path)
+        for record in self.records():
+            trial_log.append(record)
+        resumed = TrialLog(self.path)
+        self.assertEqual(resumed.records, self.records())
+        # エラーになったtrialはやり直す
+        self.assertEqual(resumed.finished_trial_ids(), {0, 1, 2, 4})
+        self.assertEqual(resumed.best()["trial_id"], 2)
+        maximize = TrialLog(self.path, direction="maximize")
+        self.assertEqual(maximize.best()["trial_id"], 0)
+        self.assertIsNone(TrialLog(os.path.join(self.tmp_dir.name, "none")).best())
+
+    def test_upload_does_not_block_append(self):
+        uploading = threading.Event()
+        release = threading.Event()
+        uploaded = []
+
+        def upload(path):
+            with open(path) as f:
+                uploaded.append([json.loads(line) for line in f])
+            uploading.set()
+            release.wait(5)
+
+        trial_log = TrialLog(self.path, upload=upload)
+        records = self.records()
+        first = threading.Thread(target=trial_log.append, args=(records[0],))
+        first.start()
+        self.assertTrue(uploading.wait(5))
+        # アップロード中でも記録できる
+        appender = threading.Thread(
+            target=lambda: [trial_log.append(r) for r in records[1:]]
+        )
+        appender.start()
+        appender.join(5)
+        self.assertFalse(appender.is_alive())
+        self.assertEqual(len(trial_log.records), len(records))
+        self.assertEqual(len(uploaded), 1)
+        release.set()
+        first.join(5)
+        # アップロード中に記録したtrialは、まとめて1回でアップロードされる
+        self.assertEqual(uploaded, [records[:1], records])
+
+
+class SampleParamsTest(unittest.TestCase):
+    def test_reproducible(self):
+        space = {
+            "num_leaves": {"type": "int", "low": 16, "high": 512, "log": True},
+            "learning_rate": {"type": "float", "low": 0.005, "high": 0.1},
+            "boosting": {"type": "choice", "choices": ["gbdt", "dart"]},
+        }
+        params = sample_params(space, seed=0, trial_id=3)
+        self.assertEqual(params, sample_params(space, seed=0, trial_id=3))
+        self.assertTrue(16 <= params["num_leaves"] <= 512)
+        self.assertTrue(0.005 <= params["learning_rate"] <= 0.1)
+        self.assertIn(params["boosting"], ["gbdt", "dart"])
+
+
+if __name__ == "__main__":
+    unittest.main()
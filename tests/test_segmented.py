@@ -0,0 +1,164 @@
+import unittest
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+from src.predict.routed import SEGMENT_COL, RoutedBooster
+from src.train.segmented import SegmentedLGBMTrainer, core_budgets
+
+
+def make_trainer(
+    key: str = "abc", default_segment: str = "c", min_rows: int = 10
+) -> SegmentedLGBMTrainer:
+    config = OmegaConf.create(
+        {
+            "gcp_project": "project",
+            "dataset_id": "dataset",
+            "bucket": "bucket",
+            "latest_model_path": "models/latest",
+            "lgbm": {
+                "numerical_cols": ["x"],
+                "cat_cols": ["store_code"],
+                "label_col": "label",
+                "params": {"objective": "regression", "verbose": -1, "seed": 0},
+                "num_iterations": 20,
+                "early_stopping_rounds": 5,
+                "verbose_eval": 0,
+                "second_stage": "retrain",
+            },
+            "segmented": {
+                "key": key,
+                "abc_table": "dataset.date_store_yj_abc",
+                "abc_col": "model_abc_flag",
+                "column": "yj_code",
+                "prefix_length": 4,
+                "min_rows": min_rows,
+                "default_segment": default_segment,
+                "n_parallel": 2,
+            },
+        }
+    )
+    return SegmentedLGBMTrainer(config, "exp")
+
+
+def frame(counts) -> pd.DataFrame:
+    return pd.DataFrame(
+        {SEGMENT_COL: [segment for segment, n in counts.items() for _ in range(n)]}
+    )
+
+
+class MergeSmallSegmentsTest(unittest.TestCase):
+    """まとめた先のsegmentがtrainでmin_rows行以上, validで1行以上になることを確認する"""
+
+    def assert_trainable(self, trainer, mapping, train_df, valid_df):
+        train = train_df[SEGMENT_COL].replace(mapping).value_counts()
+        valid = valid_df[SEGMENT_COL].replace(mapping).value_counts()
+        self.assertIn(trainer.default_segment, train.index)
+        for segment, count in train.items():
+            self.assertGreaterEqual(count, trainer.min_rows)
+            self.assertGreater(valid.get(segment, 0), 0)
+
+    def test_merge_into_default(self):
+        trainer = make_trainer()
+        train_df = frame({"a": 50, "b": 5, "c": 20})
+        valid_df = frame({"a": 5, "b": 1, "c": 2})
+        mapping = trainer._merge_small_segments(train_df, valid_df)
+        # default_segment自身は対応に含めない
+        self.assertEqual(mapping, {"b": "c"})
+        self.assertEqual(trainer.default_segment, "c")
+        self.assert_trainable(trainer, mapping, train_df, valid_df)
+
+    def test_small_default_merged_with_small_segments(self):
+        # default_segment単体ではmin_rowsより少ないが、まとめると条件を満たす
+        trainer = make_trainer()
+        train_df = frame({"a": 50, "b": 6, "c": 6})
+        valid_df = frame({"a": 5, "c": 1})
+        mapping = trainer._merge_small_segments(train_df, valid_df)
+        self.assertEqual(mapping, {"b": "c"})
+        self.assert_trainable(trainer, mapping, train_df, valid_df)
+
+    def test_default_without_valid_falls_back_to_largest(self):
+        trainer = make_trainer()
+        train_df = frame({"a": 30, "b": 50, "c": 20})
+        valid_df = frame({"a": 5, "b": 5})
+        mapping = trainer._merge_small_segments(train_df, valid_df)
+        self.assertEqual(trainer.default_segment, "b")
+        self.assertEqual(mapping, {"c": "b"})
+        self.assert_trainable(trainer, mapping, train_df, valid_df)
+
+    def test_default_not_in_key(self):
+        # yj_codeの先頭のようにdefault_segmentの値が無いkey
+        trainer = make_trainer(key="column", default_segment="other")
+        train_df = frame({"1124": 20, "2149": 20, "3999": 3})
+        valid_df = frame({"1124": 2, "2149": 3, "3999": 1})
+        mapping = trainer._merge_small_segments(train_df, valid_df)
+        # 同じ行数の場合はsegment名の順で決まる
+        self.assertEqual(trainer.default_segment, "1124")
+        self.assertEqual(mapping, {"3999": "1124"})
+        self.assert_trainable(trainer, mapping, train_df, valid_df)
+
+    def test_no_small_segments(self):
+        trainer = make_trainer()
+        train_df = frame({"a": 50, "c": 20})
+        valid_df = frame({"a": 5, "c": 2})
+        self.assertEqual(trainer._merge_small_segments(train_df, valid_df), {})
+        self.assertEqual(trainer.default_segment, "c")
+
+    def test_all_segments_small(self):
+        # 条件を満たすsegmentが無い場合は全体をdefault_segmentの1つのモデルで学習する
+        trainer = make_trainer()
+        train_df = frame({"a": 5, "b": 5})
+        valid_df = frame({"a": 1})
+        mapping = trainer._merge_small_segments(train_df, valid_df)
+        self.assertEqual(mapping, {"a": "c", "b": "c"})
+        self.assertEqual(trainer.default_segment, "c")
+
+
+class SegmentedFitTest(unittest.TestCase):
+    def test_fit_after_lightgbm_in_parent(self):
+        # 親プロセスでLightGBM (OpenMP) を使った後でもworkerが止まらない
+        rng = np.random.default_rng(0)
+        X = rng.normal(size=(1000, 3))
+        lgb.train(
+            {"verbose": -1, "num_thread": 2},
+            lgb.Dataset(X, X.sum(axis=1)),
+            num_boost_round=5,
+        )
+        n_rows = 3000
+        df = pd.DataFrame(
+            {
+                "yj_code": rng.choice(["1124A", "2149B", "3999C"], size=n_rows),
+                "store_code": rng.choice(["s1", "s2"], size=n_rows),
+                "x": rng.normal(size=n_rows),
+                "split_flag": rng.choice(
+                    ["train", "valid", "test"], p=[0.7, 0.15, 0.15], size=n_rows
+                ),
+            }
+        )
+        # 3999のsegmentはtrainがmin_rowsより少ない
+        df = df[(df["yj_code"] != "3999C") | (rng.random(n_rows) < 0.05)]
+        df["label"] = df["x"] * df["yj_code"].str[0].astype(int) + rng.normal(
+            size=len(df)
+        )
+        trainer = make_trainer(key="column", default_segment="other", min_rows=100)
+        le_dict, bst, test_df = trainer.fit(df.reset_index(drop=True))
+        self.assertIsInstance(bst, RoutedBooster)
+        self.assertEqual(sorted(bst.segments), ["1124", "2149"])
+        self.assertEqual(sorted(trainer.segment_report["segment"]), ["1124", "2149"])
+        metrics, preds = trainer.evaluate(le_dict, bst, test_df.copy())
+        self.assertEqual(len(preds), len(test_df))
+        self.assertTrue(np.isfinite(metrics["rmse"]))
+
+
+class CoreBudgetsTest(unittest.TestCase):
+    def test_budgets(self):
+        counts = {"a": 600, "b": 300, "c": 100}
+        self.assertEqual(core_budgets(counts, 10, 3), {"a": 6, "b": 3, "c": 1})
+        self.assertEqual(core_budgets(counts, 10, 2), {"a": 5, "b": 5, "c": 5})
+        self.assertEqual(core_budgets(counts, 2, 3), {"a": 1, "b": 1, "c": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
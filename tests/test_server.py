@@ -0,0 +1,102 @@
+import json
+import threading
+import unittest
+from urllib import request as urllib_request
+from urllib.error import HTTPError
+
+import numpy as np
+
+from src.predict.server import MicroBatcher, PredictionHandler, PredictionServer
+
+
+class RecordingPredictor(object):
+    """呼び出しごとのbundleと行番号を記録し、行番号 * 10 + bundleの値を予測値として返す"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, bundle, positions):
+        self.calls.append((bundle, positions.copy()))
+        return positions * 10.0 + bundle
+
+
+class MicroBatcherTest(unittest.TestCase):
+    def test_batches_concurrent_requests_by_bundle(self):
+        predictor = RecordingPredictor()
+        batcher = MicroBatcher(predictor, max_batch_size=1000, max_wait_ms=200)
+        requests = [
+            (1, np.array([0, 1])),
+            (2, np.array([5])),
+            (1, np.array([2])),
+            (2, np.array([6, 7])),
+        ]
+        # max_wait_msの間に来たリクエストは1回の_collectでまとめられる
+        futures = [batcher.submit(bundle, positions) for bundle, positions in requests]
+        for (bundle, positions), future in zip(requests, futures):
+            np.testing.assert_array_equal(
+                future.result(timeout=5), positions * 10.0 + bundle
+            )
+        # 同じbundleのリクエストは1回の予測にまとめる
+        self.assertEqual(len(predictor.calls), 2)
+        calls = {bundle: positions for bundle, positions in predictor.calls}
+        np.testing.assert_array_equal(calls[1], [0, 1, 2])
+        np.testing.assert_array_equal(calls[2], [5, 6, 7])
+
+    def test_max_batch_size(self):
+        predictor = RecordingPredictor()
+        batcher = MicroBatcher(predictor, max_batch_size=2, max_wait_ms=200)
+        futures = [batcher.submit(1, np.array([i])) for i in range(4)]
+        for i, future in enumerate(futures):
+            np.testing.assert_array_equal(future.result(timeout=5), [i * 10.0 + 1])
+        self.assertTrue(all(len(positions) <= 2 for _, positions in predictor.calls))
+
+    def test_error_is_set_on_every_future(self):
+        def fail(bundle, positions):
+            raise RuntimeError("predict failed")
+
+        batcher = MicroBatcher(fail, max_batch_size=1000, max_wait_ms=50)
+        futures = [batcher.submit(1, np.array([i])) for i in range(3)]
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=5)
+
+
+class FailingService(object):
+    exp_name = "exp"
+
+    def predict(self, keys):
+        raise RuntimeError("model is broken")
+
+
+class PredictionHandlerTest(unittest.TestCase):
+    def test_prediction_error_returns_500(self):
+        handler = type("Handler", (PredictionHandler,), {"service": FailingService()})
+        server = PredictionServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/predict"
+        try:
+            requests = [
+                urllib_request.Request(f"{url}?yj_code=y1&store_code=s1"),
+                urllib_request.Request(
+                    url,
+                    data=json.dumps(
+                        {"items": [{"yj_code": "y1", "store_code": "s1"}]}
+                    ).encode(),
+                    headers={"Content-Type": "application/json"},
+                ),
+            ]
+            for req in requests:
+                with self.subTest(method=req.get_method()):
+                    with self.assertLogs("src.predict.server", level="ERROR"):
+                        with self.assertRaises(HTTPError) as cm:
+                            urllib_request.urlopen(req, timeout=5)
+                    self.assertEqual(cm.exception.code, 500)
+                    self.assertIn("error", json.loads(cm.exception.read()))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()